@@ -1,4 +1,6 @@
 
+import sys
+
 # Making this available directly via esgfpid.check_pid_queue_availability
 # instead of esgfpid.check.check_pid_queue_availability
 from .check import check_pid_queue_availability
@@ -11,3 +13,9 @@ from .utils import make_handle_from_drsid_and_versionnumber
 # instead of esgfpid.connector.Connector
 from .connector import Connector
 
+# Making this available directly via esgfpid.AsyncConnector
+# instead of esgfpid.asyncconnector.AsyncConnector
+# (only on Python 3, as it uses asyncio)
+if sys.version_info >= (3, 7):
+    from .asyncconnector import AsyncConnector
+
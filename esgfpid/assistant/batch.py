@@ -0,0 +1,238 @@
+import logging
+import esgfpid.exceptions
+import esgfpid.assistant.publish
+import esgfpid.utils as utils
+from esgfpid.rabbit.exceptions import PIDServerException
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+=========================
+Batch publication session
+=========================
+
+Publishes many dataset versions (of one data node) at once,
+e.g. when republishing all datasets of an institution.
+
+Each dataset is handled by a normal DatasetPublicationAssistant,
+so the messages and checks are the same as when publishing the
+datasets one by one. But:
+
+ * The files of the previous publications, which are needed for
+   the consistency checks, are retrieved from solr for many
+   datasets at once (in grouped queries), instead of one query
+   per dataset.
+ * In synchronous mode, the connection to RabbitMQ is opened
+   once for all datasets, instead of once per dataset.
+ * A dataset that cannot be published (e.g. if its consistency
+   check fails, or its messages could not be sent) does not stop
+   the others. The result of each dataset is reported at the end.
+
+API:
+ * add_dataset(), called by the library user for each dataset
+ * finish(), called by the library user once, at the end
+
+'''
+
+class BatchPublicationAssistant(object):
+
+    def __init__(self, **args):
+        logdebug(LOGGER, 'Constructor for batch publication assistant at host "%s".', args['data_node'])
+
+        # Check args
+        mandatory_args = ['data_node', 'prefix', 'thredds_service_path',
+                          'coupler', 'consumer_solr_url']
+        utils.check_presence_of_mandatory_args(args, mandatory_args)
+
+        # The same args are passed to all datasets' assistants:
+        self.__data_node = args['data_node']
+        self.__prefix = args['prefix']
+        self.__thredds_service_path = args['thredds_service_path']
+        self.__consumer_solr_url = args['consumer_solr_url']
+
+        # The assistants use a stand-in coupler (see below):
+        self.__coupler = args['coupler']
+        self.__batch_coupler = BatchCoupler(self.__coupler)
+
+        # List of (drs_id, version_number, assistant), in order:
+        self.__datasets = []
+        self.__finished = False
+
+    def add_dataset(self, **args):
+        '''
+        Add a dataset version to be published, and optionally
+        its files.
+
+        :param drs_id: Mandatory. The dataset id of the dataset
+            to be published.
+
+        :param version_number: Mandatory. The version number of the
+            dataset to be published.
+
+        :param is_replica: Mandatory. Flag to indicate whether the
+            dataset is a replica.
+
+        :param records, mapfile, data_root, file_name, ...: Optional.
+            The dataset's files, in any of the ways accepted by
+            :func:`~esgfpid.assistant.publish.DatasetPublicationAssistant.add_files`.
+
+        :return: The dataset's publication assistant. More files
+            can be added to it, but its dataset_publication_finished()
+            must not be called, as this is done by finish().
+        :raises: OperationUnsupportedException: If the batch was
+            finished already.
+        '''
+
+        # Check if allowed:
+        if self.__finished:
+            msg = 'Too late to add datasets!'
+            logwarn(LOGGER, msg)
+            raise esgfpid.exceptions.OperationUnsupportedException(msg)
+
+        # Check args
+        mandatory_args = ['drs_id', 'version_number', 'is_replica']
+        utils.check_presence_of_mandatory_args(args, mandatory_args)
+        file_args = utils.find_additional_args(args, mandatory_args)
+
+        # Create assistant
+        assistant = esgfpid.assistant.publish.DatasetPublicationAssistant(
+            drs_id=args['drs_id'],
+            version_number=args['version_number'],
+            thredds_service_path=self.__thredds_service_path,
+            data_node=self.__data_node,
+            prefix=self.__prefix,
+            coupler=self.__batch_coupler,
+            is_replica=args['is_replica'],
+            consumer_solr_url=self.__consumer_solr_url # may be None
+        )
+        if len(file_args) > 0:
+            assistant.add_files(**file_args)
+
+        # The assistant checked the version number:
+        version_number = int(args['version_number'])
+        self.__datasets.append((args['drs_id'], version_number, assistant))
+        return assistant
+
+    def finish(self, ignore_exception=False):
+        '''
+        Publish all datasets that were added (in their order).
+
+        :param ignore_exception: Optional. If True, datasets whose
+            consistency check failed are published nevertheless.
+
+        :return: A list with one dictionary per dataset (in the order
+            they were added) with the keys "drs_id", "version_number",
+            "dataset_handle", "success" (boolean), "error" (the
+            exception why it was not published, or None) and "future"
+            (the dataset's
+            :py:class:`~esgfpid.rabbit.delivery.AggregateDeliveryFuture`
+            in asynchronous mode, otherwise None).
+        :raises: OperationUnsupportedException: If the batch was
+            finished already.
+        '''
+        if self.__finished:
+            msg = 'Batch publication was already done.'
+            logwarn(LOGGER, msg)
+            raise esgfpid.exceptions.OperationUnsupportedException(msg)
+        self.__finished = True
+
+        self.__retrieve_previous_files_of_all_datasets()
+        results = []
+        self.__coupler.start_rabbit_business() # Synchronous: Opens connection. Asynchronous: Ignored.
+        try:
+            for drs_id, version_number, assistant in self.__datasets:
+                results.append(self.__finish_one_dataset(drs_id, version_number, assistant, ignore_exception))
+        finally:
+            self.__coupler.done_with_rabbit_business() # Synchronous: Closes connection. Asynchronous: Ignored.
+
+        num_ok = len([result for result in results if result['success']])
+        loginfo(LOGGER, 'Requested to publish PIDs for %i of %i datasets at "%s".', num_ok, len(results), self.__data_node)
+        return results
+
+    def __finish_one_dataset(self, drs_id, version_number, assistant, ignore_exception):
+        result = dict(
+            drs_id=drs_id,
+            version_number=version_number,
+            dataset_handle=assistant.get_dataset_handle(),
+            success=False,
+            error=None,
+            future=None
+        )
+        try:
+            result['future'] = assistant.dataset_publication_finished(ignore_exception)
+            result['success'] = True
+        except (esgfpid.exceptions.InconsistentFilesetException,
+                esgfpid.exceptions.OperationUnsupportedException) as e:
+            logwarn(LOGGER, 'Not publishing dataset "%s" (version %s): %s', drs_id, version_number, e)
+            result['error'] = e
+        except (esgfpid.exceptions.MessageNotDeliveredException,
+                esgfpid.exceptions.MessageQueueFullException,
+                PIDServerException) as e:
+            logerror(LOGGER, 'Could not send the messages of dataset "%s" (version %s): %s', drs_id, version_number, e)
+            result['error'] = e
+        return result
+
+    def __retrieve_previous_files_of_all_datasets(self):
+        datasets = [(drs_id, version_number) for drs_id, version_number, unused in self.__datasets]
+        self.__batch_coupler.retrieve_previous_files_of_all_datasets(datasets, self.__data_node)
+
+
+class BatchCoupler(object):
+    '''
+    Stands in for the coupler towards the publication assistants
+    (and consistency checkers) of many datasets. It passes
+    everything on to the coupler, except:
+
+     * Opening and closing the synchronous connection is ignored,
+       as this is done once for all datasets.
+     * The previous files of a dataset are taken from the ones
+       that were retrieved for all datasets at once (see
+       retrieve_previous_files_of_all_datasets()), if they were
+       found there. Otherwise, solr is asked as usual.
+
+    Used by the BatchPublicationAssistant and the
+    PublicationWorkerPool.
+    '''
+
+    def __init__(self, coupler):
+        self.__coupler = coupler
+        self.__previous_file_handles = {}
+
+    '''
+    Ask solr for the previous files of all given datasets at once
+    (in grouped queries), if solr is not switched off. If that
+    fails, solr is asked for each dataset when it is checked.
+
+    :param datasets: List of (drs_id, version_number) tuples.
+    :param data_node: The data node of all of them.
+    '''
+    def retrieve_previous_files_of_all_datasets(self, datasets, data_node):
+        if self.__coupler.is_solr_switched_off():
+            return
+        try:
+            previous = self.__coupler.retrieve_file_handles_of_many_datasets(
+                datasets=datasets,
+                data_node=data_node.rstrip('/')
+            )
+        except (esgfpid.exceptions.SolrSwitchedOff, esgfpid.exceptions.SolrError) as e:
+            logdebug(LOGGER, 'Could not retrieve the files of all datasets at once: %s', repr(e))
+            return
+        logdebug(LOGGER, 'Retrieved previous files of %i of %i datasets.', len(previous), len(datasets))
+        self.__previous_file_handles = previous
+
+    def start_rabbit_business(self):
+        pass
+
+    def done_with_rabbit_business(self):
+        pass
+
+    def retrieve_file_handles_of_same_dataset(self, **args):
+        key = (args['drs_id'], args['version_number'])
+        if key in self.__previous_file_handles:
+            return self.__previous_file_handles[key]
+        return self.__coupler.retrieve_file_handles_of_same_dataset(**args)
+
+    def __getattr__(self, name):
+        return getattr(self.__coupler, name)
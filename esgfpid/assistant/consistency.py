@@ -21,6 +21,7 @@ class Checker(object):
 
         # Other         
         self.__list_of_previous_files = None # from solr
+        self.__set_of_previous_files = None # for quick lookups
         self.__will_run_check = True
         self.__message_why_not = 'No reason specified.'
 
@@ -112,6 +113,22 @@ class Checker(object):
         else:
             raise ValueError('Consistency check can not be run. Reason: %s' % self.__message_why_not)
 
+    '''
+    Only checks whether the given files were part of the previous
+    publication, e.g. before their messages are sent while not all
+    files of the dataset were added yet. Missing files can only be
+    checked once all files were added (data_consistency_check()).
+
+    :return: True if none of the files is superfluous, or if no
+        check can be run.
+    '''
+    def superfluous_files_check(self, list_of_given_files):
+        if not self.__will_run_check:
+            return True
+        list_too_many_files = self.__check_for_superfluous_files(list_of_given_files)
+        self.__log_too_many_files_if_any(list_too_many_files)
+        return len(list_too_many_files) == 0
+
     def __data_consistency_check(self, list_of_given_files):
         logdebug(LOGGER, 'Performing consistency check...')
         list_too_many_files = self.__check_for_superfluous_files(list_of_given_files)
@@ -129,9 +146,11 @@ class Checker(object):
             return True
 
     def __check_for_superfluous_files(self, list_of_given_files):
+        if self.__set_of_previous_files is None:
+            self.__set_of_previous_files = set(self.__list_of_previous_files)
         list_too_many_files = []
         for file_handle in list_of_given_files:
-            if file_handle not in self.__list_of_previous_files:
+            if file_handle not in self.__set_of_previous_files:
                 list_too_many_files.append(file_handle)
         return list_too_many_files
 
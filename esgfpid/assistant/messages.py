@@ -18,29 +18,95 @@ def publish_file(**args):
                       'file_version', 'data_node']
     esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
 
-    # Message:
-    message = dict(
-        handle = args['file_handle'],
-        aggregation_level = 'file',
-        operation = 'publish',
+    # Message (the data URL is used as it is):
+    record = FileRecord(
+        args['file_handle'],
+        args['file_size'],
+        args['file_name'],
+        args['checksum'],
+        args['data_url'],
+        args['checksum_type'],
+        args['file_version']
+    )
+    return publish_files([record],
         is_replica=args['is_replica'],
-        file_name=args['file_name'],
-        file_size=args['file_size'],
-        checksum=args['checksum'],
-        data_url=args['data_url'],
-        data_node=args['data_node'],
+        data_url_base='',
         parent_dataset=args['parent_dataset'],
-        message_timestamp = args['timestamp'],
-        checksum_type = args['checksum_type'],
-        file_version = args['file_version'] # can be int or string or ...
-    )
+        timestamp=args['timestamp'],
+        data_node=args['data_node']
+    )[0]
+
+class FileRecord(object):
+    '''
+    The information of one file to be published that differs from
+    file to file. The publication assistant keeps these until it
+    creates the file publication messages (see publish_files()),
+    instead of keeping the messages, which repeat the dataset's
+    information for every file.
+
+    The publish path is kept instead of the URL, which is made
+    from it when the message is created.
+    '''
+    __slots__ = ('file_handle', 'file_size', 'file_name', 'checksum',
+                 'publish_path', 'checksum_type', 'file_version')
+
+    def __init__(self, file_handle, file_size, file_name, checksum,
+                 publish_path, checksum_type, file_version):
+        self.file_handle = file_handle
+        self.file_size = file_size
+        self.file_name = file_name
+        self.checksum = checksum
+        self.publish_path = publish_path
+        self.checksum_type = checksum_type
+        self.file_version = file_version
+
+def publish_files(records, **args):
+    '''
+    Create the file publication messages for many files of the same
+    dataset (publish_file() uses this for one file).
+
+    :param records: List of FileRecords.
+    :param data_url_base: The start of the file URLs, to which the
+        records' publish paths are appended.
+    :return: List of messages (in the order of the records).
+    '''
 
-    # Routing key:
+    # Check args:
+    mandatory_args = ['is_replica', 'data_url_base', 'parent_dataset',
+                      'timestamp', 'data_node']
+    esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
+
+    # Same for all files:
+    is_replica = args['is_replica']
+    data_url_base = args['data_url_base']
+    data_node = args['data_node']
+    parent_dataset = args['parent_dataset']
+    timestamp = args['timestamp']
     routing_key = ROUTING_KEYS['publi_file']
-    if args['is_replica'] == True: # Publish Assistant parses this to boolean!
+    if is_replica == True: # Publish Assistant parses this to boolean!
         routing_key = ROUTING_KEYS['publi_file_rep']
-    message[JSON_KEY_ROUTING_KEY] = routing_key
-    return message
+
+    # Messages:
+    messages = []
+    for record in records:
+        message = dict(
+            handle = record.file_handle,
+            aggregation_level = 'file',
+            operation = 'publish',
+            is_replica=is_replica,
+            file_name=record.file_name,
+            file_size=record.file_size,
+            checksum=record.checksum,
+            data_url=data_url_base + record.publish_path,
+            data_node=data_node,
+            parent_dataset=parent_dataset,
+            message_timestamp = timestamp,
+            checksum_type = record.checksum_type,
+            file_version = record.file_version # can be int or string or ...
+        )
+        message[JSON_KEY_ROUTING_KEY] = routing_key
+        messages.append(message)
+    return messages
 
 def publish_dataset(**args):
 
@@ -1,13 +1,20 @@
+import os
 import logging
 import esgfpid.exceptions
 import esgfpid.assistant.consistency
 import esgfpid.assistant.messages
 import esgfpid.utils as utils
+import esgfpid.defaults as defaults
+from esgfpid.rabbit.delivery import DeliveryFuture, AggregateDeliveryFuture
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
+MANDATORY_FILE_ARGS = ['file_name', 'file_handle', 'file_size',
+                       'checksum', 'publish_path', 'checksum_type',
+                       'file_version']
+
 # Helper:
 
 def create_dataset_handle(**args):
@@ -17,6 +24,73 @@ def create_dataset_handle(**args):
         prefix=args['prefix']
     )
 
+def records_to_columns(records):
+    '''
+    Turn file records (dictionaries with the same keys as
+    the arguments of add_file()) into columns (one list per
+    argument).
+
+    :raises: ArgumentError: If a record lacks a mandatory argument.
+    '''
+    records = list(records)
+    columns = {}
+    for name in MANDATORY_FILE_ARGS:
+        try:
+            columns[name] = [record[name] for record in records]
+        except KeyError:
+            for record in records:
+                utils.check_presence_of_mandatory_args(record, MANDATORY_FILE_ARGS)
+    return columns
+
+def read_mapfile(path, data_root=None, default_file_version=None):
+    '''
+    Read the file information from an ESGF mapfile into columns
+    (one list per argument of add_file()).
+
+    Each line looks like this:
+    "dataset_id#version | /path/to/file.nc | size | key=value | ..."
+    The keys "checksum", "checksum_type" and "tracking_id" (the file
+    handle) are needed, other keys are ignored. Empty lines and lines
+    starting with "#" are skipped.
+
+    :param path: Path to the mapfile.
+    :param data_root: Optional. Part of the file paths that is not
+        part of the THREDDS publish path, e.g. "/esg/data". If not
+        given, the whole file path is used as publish path.
+    :param default_file_version: Optional. Used as file version if
+        the dataset id has no "#version".
+    :raises: ArgumentError: If a line lacks some information.
+    '''
+    columns = dict((name, []) for name in MANDATORY_FILE_ARGS)
+    if data_root is not None:
+        data_root = data_root.rstrip('/')+'/'
+    with open(path, 'r') as mapfile:
+        for line_number, line in enumerate(mapfile, 1):
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) < 3:
+                raise esgfpid.exceptions.ArgumentError('Mapfile %s, line %i: Expected at least dataset id, file path and size' % (path, line_number))
+            extra = dict(field.split('=', 1) for field in fields[3:] if '=' in field)
+            missing = [key for key in ('checksum', 'checksum_type', 'tracking_id') if key not in extra]
+            if len(missing) > 0:
+                raise esgfpid.exceptions.ArgumentError('Mapfile %s, line %i: Missing %s' % (path, line_number, ', '.join(missing)))
+            file_path = fields[1]
+            if data_root is not None and file_path.startswith(data_root):
+                publish_path = file_path[len(data_root):]
+            else:
+                publish_path = file_path
+            version = fields[0].partition('#')[2] or default_file_version
+            columns['file_name'].append(os.path.basename(file_path))
+            columns['file_handle'].append(extra['tracking_id'])
+            columns['file_size'].append(fields[2])
+            columns['checksum'].append(extra['checksum'])
+            columns['publish_path'].append(publish_path)
+            columns['checksum_type'].append(extra['checksum_type'])
+            columns['file_version'].append(version)
+    return columns
+
 class DatasetPublicationAssistant(object):
 
     def __init__(self, **args):
@@ -30,11 +104,12 @@ class DatasetPublicationAssistant(object):
         mandatory_args = ['drs_id', 'version_number', 'data_node', 'prefix',
                           'thredds_service_path', 'is_replica', 'coupler',
                           'consumer_solr_url']
-        optional_args = []
+        optional_args = ['stream_files']
         utils.check_presence_of_mandatory_args(args, mandatory_args)
         utils.add_missing_optional_args_with_value_none(args, optional_args)
         self.__enforce_integer_version_number(args)
         self.__enforce_boolean_replica_flag(args)
+        self.__enforce_boolean_stream_flag(args)
 
         # Init methods...
         self.__store_args_in_attributes(args)
@@ -63,6 +138,17 @@ class DatasetPublicationAssistant(object):
                    % args['is_replica'])
             raise esgfpid.exceptions.ArgumentError(msg)
 
+    def __enforce_boolean_stream_flag(self, args):
+        if args['stream_files'] is None:
+            args['stream_files'] = False
+        try:
+            args['stream_files'] = utils.get_boolean(args['stream_files'])
+        except ValueError:
+            msg = ('Streaming flag "%s" could not be parsed to boolean. '
+                   'Please pass a boolean or "True" or "true" or "False" or "false"'
+                   % args['stream_files'])
+            raise esgfpid.exceptions.ArgumentError(msg)
+
     def __enforce_integer_file_size(self, args):
         try:
             args['file_size'] = int(args['file_size'])
@@ -75,18 +161,30 @@ class DatasetPublicationAssistant(object):
     def __define_other_attributes(self):
         self.__dataset_handle = None
         self.__list_of_file_handles = []
-        self.__list_of_file_messages = []
+        self.__list_of_file_records = [] # FileRecords, see messages module
         self.__message_timestamp = utils.get_now_utc_as_formatted_string()
 
+        self.__checker = None # see __get_checker()
+
+        # Only used when streaming the file messages:
+        self.__futures_of_sent_file_messages = []
+        self.__num_sent_file_messages = 0
+        self.__rabbit_business_started = False
+
     def __store_args_in_attributes(self, args):
         self.__drs_id = args['drs_id']
         self.__version_number = args['version_number']
         self.__data_node = args['data_node'].rstrip('/')
         self.__prefix = args['prefix']
         self.__thredds_service_path = args['thredds_service_path'].strip('/')
+        self.__file_url_base = self.__data_node +'/'+ self.__thredds_service_path +'/'
+        if not self.__file_url_base.startswith('http'):
+            self.__file_url_base = 'http://'+self.__file_url_base
+        self.__file_handle_start = 'hdl:'+args['prefix']+'/'
         self.__is_replica = args['is_replica']
         self.__coupler = args['coupler']
         self.__consumer_solr_url = args['consumer_solr_url']
+        self.__stream_files = args['stream_files']
 
     def __init_state_machine(self):
         self.__machine_states = {'dataset_added':0, 'files_added':1, 'publication_finished':2}
@@ -159,32 +257,155 @@ class DatasetPublicationAssistant(object):
         :param file_version: Mandatory. Any string. File versions
             are not managed in the PID. This information will simply be
             included in the PID record, but not used for any reasoning.
+
+        .. note:: If the assistant was created with "stream_files",
+            the file's message is sent right away. Otherwise, it is
+            kept until the dataset publication is finished.
+
+        :raises: InconsistentFilesetException: Only if the assistant
+            was created with "stream_files": If the file was not part
+            of the previous publication of this dataset version (if
+            any was found). Then the file is not added, and its
+            message is not sent.
         '''
 
         # Check if allowed:
         self.__check_if_adding_files_allowed_right_now()
 
         # Check if args ok:
-        mandatory_args = ['file_name', 'file_handle', 'file_size',
-                          'checksum', 'publish_path', 'checksum_type',
-                          'file_version']
-        utils.check_presence_of_mandatory_args(args, mandatory_args)
+        utils.check_presence_of_mandatory_args(args, MANDATORY_FILE_ARGS)
         self.__enforce_integer_file_size(args)
         self.__enforce_string_file_version(args)
 
         # Add file:
         self.__check_and_correct_handle_syntax(args)
+        self.__check_streamed_files_were_published_before([args['file_handle']])
         self.__add_file(**args)
 
+    def add_files(self, records=None, mapfile=None, data_root=None, **columns):
+        '''
+        Adds the information of many files to the set of files to
+        be published in this dataset. This does the same as calling
+        add_file() for each file, but it is faster for many files.
+
+        Pass exactly one of these:
+
+        :param records: An iterable of dictionaries, each containing
+            the arguments of add_file() for one file.
+
+        :param mapfile: The path to an ESGF mapfile. Each line must
+            contain the keys "checksum", "checksum_type" and
+            "tracking_id" (the file handle). The file name is taken
+            from the file path, and the file version from the
+            dataset id ("dataset_id#version", or the dataset's
+            version number if it has none).
+
+        :param columns: The arguments of add_file() as keyword
+            arguments, each of them a list with one entry per file
+            (all of the same length), e.g. file_name=[...],
+            file_handle=[...], file_size=[...], ...
+
+        :param data_root: Optional, only used with a mapfile. The
+            part of the file paths that is not part of the THREDDS
+            publish path, e.g. "/esg/data".
+
+        .. note:: All files are checked before any of them is added,
+            so if any file's information is not ok, none is added.
+
+        :raises: ArgumentError: If the information of any file is not
+            ok (see add_file()), or if the columns differ in length.
+        :raises: ESGFException: If any file handle does not have the
+            expected prefix.
+        :raises: InconsistentFilesetException: Only when streaming:
+            If any file was not part of the previous publication
+            (see add_file()).
+        '''
+
+        # Check if allowed:
+        self.__check_if_adding_files_allowed_right_now()
+
+        # Collect the info, one list per argument:
+        columns = self.__get_file_columns(records, mapfile, data_root, columns)
+        num_files = self.__check_length_of_file_columns(columns)
+
+        # Check and adapt all files' args, before adding any:
+        file_sizes = self.__enforce_integer_file_sizes(columns['file_size'])
+        file_versions = [str(file_version) for file_version in columns['file_version']]
+        file_handles = self.__check_and_correct_handle_syntax_of_many(columns['file_handle'])
+        publish_paths = [publish_path.strip('/') for publish_path in columns['publish_path']]
+        self.__check_streamed_files_were_published_before(file_handles)
+
+        # Add files:
+        logdebug(LOGGER, 'Adding %i files.', num_files)
+        file_names = columns['file_name']
+        checksums = columns['checksum']
+        checksum_types = columns['checksum_type']
+        for i in range(num_files):
+            self.__add_file_to_datasets_children(file_handles[i])
+            record = esgfpid.assistant.messages.FileRecord(
+                file_handles[i],
+                file_sizes[i],
+                file_names[i],
+                checksums[i],
+                publish_paths[i],
+                checksum_types[i],
+                file_versions[i]
+            )
+            self.__store_file_record(record)
+        if num_files > 0:
+            self.__set_machine_state_to_files_added()
+        logdebug(LOGGER, 'Adding %i files done.', num_files)
+
+    def __get_file_columns(self, records, mapfile, data_root, columns):
+        num_given = len([x for x in (records, mapfile, columns or None) if x is not None])
+        if not num_given == 1:
+            raise esgfpid.exceptions.ArgumentError('Please pass either records, or a mapfile, or columns of file information')
+        if records is not None:
+            return records_to_columns(records)
+        elif mapfile is not None:
+            return read_mapfile(mapfile, data_root, self.__version_number)
+        else:
+            utils.check_presence_of_mandatory_args(columns, MANDATORY_FILE_ARGS)
+            return dict((name, list(columns[name])) for name in MANDATORY_FILE_ARGS)
+
+    def __check_length_of_file_columns(self, columns):
+        lengths = set(len(columns[name]) for name in MANDATORY_FILE_ARGS)
+        if len(lengths) > 1:
+            raise esgfpid.exceptions.ArgumentError('The file information columns differ in length')
+        return lengths.pop()
+
+    def __enforce_integer_file_sizes(self, file_sizes):
+        try:
+            return [int(file_size) for file_size in file_sizes]
+        except ValueError:
+            raise esgfpid.exceptions.ArgumentError('File size is not an integer')
+
+    def __check_and_correct_handle_syntax_of_many(self, file_handles):
+        file_handles = [handle if handle.startswith('hdl:') else 'hdl:'+handle for handle in file_handles]
+        for file_handle in file_handles:
+            if not file_handle.startswith(self.__file_handle_start):
+                self.__check_if_prefix_is_there(file_handle) # raises
+        return file_handles
+
     def __check_and_correct_handle_syntax(self, args):
         self.__make_sure_hdl_is_added(args)
         self.__check_if_prefix_is_there(args['file_handle'])
 
+    def __check_streamed_files_were_published_before(self, file_handles):
+        # Streamed file messages are sent before all files were
+        # added, so files that were not part of the previous
+        # publication are refused before they are sent. Missing
+        # files can only be found when finishing.
+        if self.__stream_files:
+            if not self.__get_checker().superfluous_files_check(file_handles):
+                msg = 'Some files were not part of the previous publication'
+                logwarn(LOGGER, msg)
+                raise esgfpid.exceptions.InconsistentFilesetException(msg)
+
     def __add_file(self, **args):
         logdebug(LOGGER, 'Adding file "%s" with handle "%s".', args['file_name'], args['file_handle'])
         self.__add_file_to_datasets_children(args['file_handle'])
-        self.__adapt_file_args(args)
-        self.__create_and_store_file_publication_message(args)        
+        self.__create_and_store_file_record(args)
         self.__set_machine_state_to_files_added()
         logtrace(LOGGER, 'Adding file done.')
 
@@ -196,7 +417,7 @@ class DatasetPublicationAssistant(object):
             args['file_handle'] = 'hdl:'+args['file_handle']
 
     def __check_if_prefix_is_there(self, file_handle):
-        if not file_handle.startswith('hdl:'+self.__prefix+'/'):
+        if not file_handle.startswith(self.__file_handle_start):
 
             expected = self.__prefix + '/'+ file_handle.lstrip('hdl:')
             msg = ('\nThis file\'s tracking_id "%s" does not have the expected handle prefix "%s".'
@@ -210,20 +431,32 @@ class DatasetPublicationAssistant(object):
             raise esgfpid.exceptions.ESGFException(msg)
 
 
-    def __adapt_file_args(self, args):
-        url = self.__create_file_url(args['publish_path'])
-        args['data_url'] = url
-        del args['publish_path']
+    def __create_and_store_file_record(self, args):
+        record = esgfpid.assistant.messages.FileRecord(
+            args['file_handle'],
+            args['file_size'],
+            args['file_name'],
+            args['checksum'],
+            args['publish_path'].strip('/'),
+            args['checksum_type'],
+            args['file_version']
+        )
+        self.__store_file_record(record)
 
-    def __create_file_url(self, publish_path):
-        url = self.__data_node +'/'+ self.__thredds_service_path +'/'+ publish_path.strip('/')
-        if not url.startswith('http'):
-            url = 'http://'+url
-        return url
+    def __store_file_record(self, record):
+        if self.__stream_files:
+            self.__send_file_message_to_queue_right_away(record)
+        else:
+            self.__list_of_file_records.append(record)
 
-    def __create_and_store_file_publication_message(self, args):
-        message = self.__create_file_publication_message(args)
-        self.__list_of_file_messages.append(message)
+    def __send_file_message_to_queue_right_away(self, record):
+        self.__start_rabbit_business_once()
+        message = self.__create_file_publication_messages([record])[0]
+        future = self.__send_message_to_queue(message)
+        self.__num_sent_file_messages += 1
+        if future is not None:
+            self.__futures_of_sent_file_messages.append(future)
+        logtrace(LOGGER, 'File publication message handed to rabbit thread.')
 
     def __set_machine_state_to_files_added(self):
         self.__machine_state = self.__machine_states['files_added']
@@ -246,15 +479,64 @@ class DatasetPublicationAssistant(object):
         * The dataset publication message is created and sent to the queue.
         * All file publication messages are sent to the queue.
 
+        If the file messages were streamed (see "stream_files"), they
+        were sent already, and only the dataset publication message is
+        sent, after them. Files that were not part of the previous
+        publication were refused when they were added, so only missing
+        files can make the consistency check fail here. Then the dataset
+        publication message is not sent, so the dataset is not published,
+        but its files' messages were sent nevertheless.
+
+        :return: In asynchronous mode, an
+            :py:class:`~esgfpid.rabbit.delivery.AggregateDeliveryFuture`
+            that is resolved once all messages of the dataset were
+            confirmed by RabbitMQ (or could not be delivered).
+            Otherwise None.
         '''
         self.__check_if_dataset_publication_allowed_right_now()
-        self.__check_data_consistency(ignore_exception)
-        self.__coupler.start_rabbit_business() # Synchronous: Opens connection. Asynchronous: Ignored.
-        self.__create_and_send_dataset_publication_message_to_queue()
-        self.__send_existing_file_messages_to_queue()
-        self.__coupler.done_with_rabbit_business() # Synchronous: Closes connection. Asynchronous: Ignored.
+        if self.__stream_files:
+            futures = self.__finish_streamed_publication(ignore_exception)
+        else:
+            self.__check_data_consistency(ignore_exception)
+            self.__coupler.start_rabbit_business() # Synchronous: Opens connection. Asynchronous: Ignored.
+            futures = [self.__create_and_send_dataset_publication_message_to_queue()]
+            futures += self.__send_existing_file_messages_to_queue() or []
+            self.__coupler.done_with_rabbit_business() # Synchronous: Closes connection. Asynchronous: Ignored.
         self.__set_machine_state_to_finished()
         loginfo(LOGGER, 'Requesting to publish PID for dataset "%s" (version %s) and its files at "%s" (handle %s).', self.__drs_id, self.__version_number, self.__data_node, self.__dataset_handle)
+        return self.__make_aggregate_future(futures)
+
+    def __finish_streamed_publication(self, ignore_exception):
+        # The dataset message is the "commit", so it is only sent
+        # after all file messages, and only if the check passed:
+        try:
+            self.__check_data_consistency(ignore_exception)
+        except esgfpid.exceptions.InconsistentFilesetException:
+            logwarn(LOGGER, 'Not publishing dataset %s, but its %i file messages were sent already.', self.__dataset_handle, self.__num_sent_file_messages)
+            self.__done_with_rabbit_business_if_started()
+            raise
+        self.__start_rabbit_business_once()
+        futures = self.__futures_of_sent_file_messages
+        futures.append(self.__create_and_send_dataset_publication_message_to_queue())
+        self.__done_with_rabbit_business_if_started()
+        logdebug(LOGGER, 'All %i file publication jobs were handed to rabbit thread before.', self.__num_sent_file_messages)
+        return futures
+
+    def __start_rabbit_business_once(self):
+        if not self.__rabbit_business_started:
+            self.__coupler.start_rabbit_business() # Synchronous: Opens connection. Asynchronous: Ignored.
+            self.__rabbit_business_started = True
+
+    def __done_with_rabbit_business_if_started(self):
+        if self.__rabbit_business_started:
+            self.__coupler.done_with_rabbit_business() # Synchronous: Closes connection. Asynchronous: Ignored.
+            self.__rabbit_business_started = False
+
+    def __make_aggregate_future(self, futures):
+        # Only asynchronous mode returns DeliveryFutures:
+        if all(isinstance(future, DeliveryFuture) for future in futures):
+            return AggregateDeliveryFuture(futures)
+        return None
 
     def __check_if_dataset_publication_allowed_right_now(self):
         if not self.__machine_state == self.__machine_states['files_added']:
@@ -269,13 +551,20 @@ class DatasetPublicationAssistant(object):
             raise esgfpid.exceptions.OperationUnsupportedException(msg)
 
 
+    def __get_checker(self):
+        # Created once, so solr is asked only once (when streaming,
+        # already when the first file is added):
+        if self.__checker is None:
+            self.__checker = esgfpid.assistant.consistency.Checker(
+                coupler=self.__coupler,
+                drs_id=self.__drs_id,
+                version_number=self.__version_number,
+                data_node=self.__data_node
+            )
+        return self.__checker
+
     def __check_data_consistency(self, ignore_exception):
-        checker = esgfpid.assistant.consistency.Checker(
-            coupler=self.__coupler,
-            drs_id=self.__drs_id,
-            version_number=self.__version_number,
-            data_node=self.__data_node
-        )
+        checker = self.__get_checker()
         check_possible = checker.can_run_check()
         if check_possible:
             check_passed = checker.data_consistency_check(self.__list_of_file_handles)
@@ -292,44 +581,40 @@ class DatasetPublicationAssistant(object):
     def __create_and_send_dataset_publication_message_to_queue(self):
         self.__remove_duplicates_from_list_of_file_handles()
         message = self.__create_dataset_publication_message()
-        self.__send_message_to_queue(message)
+        future = self.__send_message_to_queue(message)
         logdebug(LOGGER, 'Dataset publication message handed to rabbit thread.')
         logtrace(LOGGER, 'Dataset publication message: %s (%s, version %s).', self.__dataset_handle, self.__drs_id, self.__version_number)
+        return future
 
     def __remove_duplicates_from_list_of_file_handles(self):
         self.__list_of_file_handles = list(set(self.__list_of_file_handles))
 
     def __send_existing_file_messages_to_queue(self):
-        for i in range(0, len(self.__list_of_file_messages)):
-            self.__try_to_send_one_file_message(i)
-        msg = 'All file publication jobs handed to rabbit thread.'
-        logdebug(LOGGER, msg)
-        
-    def __try_to_send_one_file_message(self, list_index):
-        msg = self.__list_of_file_messages[list_index]
-        success = self.__send_message_to_queue(msg)
-        logdebug(LOGGER, 'File publication message handed to rabbit thread: %s (%s)', msg['handle'], msg['file_name'])
-        return success
+        # The messages are created just before sending them, a
+        # chunk at a time, so they are never all in memory at once:
+        records = self.__list_of_file_records
+        chunk_size = defaults.PUBLISH_FILE_MESSAGES_PER_CHUNK
+        futures = []
+        for start in range(0, len(records), chunk_size):
+            messages = self.__create_file_publication_messages(records[start:start+chunk_size])
+            futures += self.__coupler.send_many_messages_to_queue(messages) or []
+        logdebug(LOGGER, 'All %i file publication jobs handed to rabbit thread.', len(records))
+        return futures
 
     def __set_machine_state_to_finished(self):
         self.__machine_state = self.__machine_states['publication_finished']
 
-    def __create_file_publication_message(self, args):
-        
-        message = esgfpid.assistant.messages.publish_file(
-            file_handle=args['file_handle'],
-            file_size=args['file_size'],
-            file_name=args['file_name'],
-            checksum=args['checksum'],
-            data_url=args['data_url'],
+    def __create_file_publication_messages(self, records):
+
+        messages = esgfpid.assistant.messages.publish_files(
+            records,
+            data_url_base=self.__file_url_base,
             data_node=self.__data_node,
             parent_dataset=self.__dataset_handle,
-            checksum_type=args['checksum_type'],
-            file_version=args['file_version'],
             is_replica=self.__is_replica,
             timestamp=self.__message_timestamp,
         )
-        return message
+        return messages
 
     def __create_dataset_publication_message(self):
 
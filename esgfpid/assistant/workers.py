@@ -0,0 +1,388 @@
+import logging
+import pickle
+import collections
+import multiprocessing
+import multiprocessing.pool
+import esgfpid.exceptions
+import esgfpid.assistant.publish
+import esgfpid.assistant.consistency
+import esgfpid.assistant.batch
+import esgfpid.utils as utils
+import esgfpid.utils.routingkeys
+import esgfpid.defaults as defaults
+from esgfpid.rabbit.delivery import DeliveryFuture, AggregateDeliveryFuture
+from esgfpid.rabbit.exceptions import PIDServerException
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+========================
+Publication worker pool
+========================
+
+Publishes many dataset versions (of one data node) like the
+BatchPublicationAssistant, but reads and checks the datasets'
+files and builds their messages in several workers (threads
+or processes) at the same time.
+
+The messages are not sent by the workers. The results of the
+workers are collected in the order the datasets were added, and
+all messages are sent by the library user's thread through the
+one sender of the connector (so through one connection to
+RabbitMQ), while the workers go on with the next datasets. Only
+a few datasets per worker are built ahead of the sender, so the
+messages of all datasets are not held in memory at the same time.
+So:
+
+ * The messages of one dataset are sent together and in the
+   same order as when publishing the dataset on its own, and
+   the datasets are sent in the order they were added.
+ * The consistency check of each dataset is done before its
+   messages are sent. The previous files of all datasets are
+   retrieved from solr at once, before the workers start.
+ * A dataset that cannot be published (e.g. if a file is not
+   ok, its consistency check fails, or its messages could not be
+   sent) does not stop the others.
+   The result of each dataset is reported at the end.
+
+API:
+ * add_dataset(), called by the library user for each dataset
+ * finish(), called by the library user once, at the end
+
+'''
+
+class PublicationWorkerPool(object):
+
+    def __init__(self, **args):
+        logdebug(LOGGER, 'Constructor for publication worker pool at host "%s".', args['data_node'])
+
+        # Check args
+        mandatory_args = ['data_node', 'prefix', 'thredds_service_path',
+                          'coupler', 'consumer_solr_url']
+        optional_args = ['num_workers', 'use_processes']
+        utils.check_presence_of_mandatory_args(args, mandatory_args)
+        utils.add_missing_optional_args_with_value_none(args, optional_args)
+        self.__enforce_positive_integer_num_workers(args)
+        self.__enforce_boolean_process_flag(args)
+
+        # The same args are passed to all workers:
+        self.__assistant_args = dict(
+            data_node=args['data_node'],
+            prefix=args['prefix'],
+            thredds_service_path=args['thredds_service_path'],
+            consumer_solr_url=args['consumer_solr_url'] # may be None
+        )
+        self.__data_node = args['data_node']
+        self.__prefix = args['prefix']
+        self.__num_workers = args['num_workers']
+        self.__use_processes = args['use_processes']
+
+        # The consistency checks use a stand-in coupler
+        # (see batch module):
+        self.__coupler = args['coupler']
+        self.__batch_coupler = esgfpid.assistant.batch.BatchCoupler(self.__coupler)
+
+        # List of (drs_id, version_number, is_replica, file_args), in order:
+        self.__datasets = []
+        self.__finished = False
+
+    def __enforce_positive_integer_num_workers(self, args):
+        if args['num_workers'] is None:
+            args['num_workers'] = defaults.PUBLISH_NUM_WORKERS
+        try:
+            args['num_workers'] = int(args['num_workers'])
+        except ValueError:
+            raise esgfpid.exceptions.ArgumentError('Number of workers is not an integer')
+        if args['num_workers'] < 1:
+            raise esgfpid.exceptions.ArgumentError('Number of workers must be at least 1')
+
+    def __enforce_boolean_process_flag(self, args):
+        if args['use_processes'] is None:
+            args['use_processes'] = False
+        try:
+            args['use_processes'] = utils.get_boolean(args['use_processes'])
+        except ValueError:
+            msg = ('Process flag "%s" could not be parsed to boolean. '
+                   'Please pass a boolean or "True" or "true" or "False" or "false"'
+                   % args['use_processes'])
+            raise esgfpid.exceptions.ArgumentError(msg)
+
+    def add_dataset(self, **args):
+        '''
+        Add a dataset version to be published, and its files.
+
+        The files are only read and checked by the workers, once
+        finish() is called. If any of them is not ok, the dataset
+        is not published (see finish()).
+
+        :param drs_id: Mandatory. The dataset id of the dataset
+            to be published.
+
+        :param version_number: Mandatory. The version number of the
+            dataset to be published.
+
+        :param is_replica: Mandatory. Flag to indicate whether the
+            dataset is a replica.
+
+        :param records, mapfile, data_root, file_name, ...: Mandatory.
+            The dataset's files, in any of the ways accepted by
+            :func:`~esgfpid.assistant.publish.DatasetPublicationAssistant.add_files`.
+            When using processes, they must be picklable (so better
+            pass a mapfile than an iterator).
+
+        :return: The handle string of the dataset, e.g.
+            "hdl:21.14100/abcxyzfoo".
+        :raises: OperationUnsupportedException: If the pool was
+            finished already.
+        :raises: ArgumentError: If the version number is not an
+            integer.
+        '''
+
+        # Check if allowed:
+        if self.__finished:
+            msg = 'Too late to add datasets!'
+            logwarn(LOGGER, msg)
+            raise esgfpid.exceptions.OperationUnsupportedException(msg)
+
+        # Check args
+        mandatory_args = ['drs_id', 'version_number', 'is_replica']
+        utils.check_presence_of_mandatory_args(args, mandatory_args)
+        file_args = utils.find_additional_args(args, mandatory_args)
+        try:
+            version_number = int(args['version_number'])
+        except ValueError:
+            raise esgfpid.exceptions.ArgumentError('Dataset version number is not an integer')
+
+        self.__datasets.append((args['drs_id'], version_number, args['is_replica'], file_args))
+        return esgfpid.assistant.publish.create_dataset_handle(
+            drs_id=args['drs_id'],
+            version_number=version_number,
+            prefix=self.__prefix
+        )
+
+    def finish(self, ignore_exception=False):
+        '''
+        Build the messages of all datasets that were added in the
+        workers, and publish them (in the order the datasets were
+        added).
+
+        :param ignore_exception: Optional. If True, datasets whose
+            consistency check failed are published nevertheless.
+
+        :return: A list with one dictionary per dataset (in the order
+            they were added) with the keys "drs_id", "version_number",
+            "dataset_handle", "success" (boolean), "error" (the
+            exception why it was not published, or None) and "future"
+            (the dataset's
+            :py:class:`~esgfpid.rabbit.delivery.AggregateDeliveryFuture`
+            in asynchronous mode, otherwise None).
+        :raises: OperationUnsupportedException: If the pool was
+            finished already.
+        '''
+        if self.__finished:
+            msg = 'Publication by the worker pool was already done.'
+            logwarn(LOGGER, msg)
+            raise esgfpid.exceptions.OperationUnsupportedException(msg)
+        self.__finished = True
+
+        datasets = [(drs_id, version_number) for drs_id, version_number, unused, unused in self.__datasets]
+        self.__batch_coupler.retrieve_previous_files_of_all_datasets(datasets, self.__data_node)
+        tasks = iter([(self.__assistant_args, dataset) for dataset in self.__datasets])
+
+        results = []
+        pool, num_workers = self.__create_pool()
+        self.__coupler.start_rabbit_business() # Synchronous: Opens connection. Asynchronous: Ignored.
+        try:
+            # Only a limited number of tasks is handed to the pool
+            # at a time (as the messages built by the workers wait
+            # in memory until they are sent). The results are taken
+            # in the order of the tasks:
+            max_outstanding = num_workers*defaults.PUBLISH_TASKS_PER_WORKER
+            outstanding = collections.deque()
+            self.__submit_tasks(pool, tasks, outstanding, max_outstanding)
+            while len(outstanding) > 0:
+                built = outstanding.popleft().get()
+                self.__submit_tasks(pool, tasks, outstanding, max_outstanding)
+                results.append(self.__finish_one_dataset(built, ignore_exception))
+        finally:
+            self.__coupler.done_with_rabbit_business() # Synchronous: Closes connection. Asynchronous: Ignored.
+            pool.close()
+            pool.join()
+
+        num_ok = len([result for result in results if result['success']])
+        loginfo(LOGGER, 'Requested to publish PIDs for %i of %i datasets at "%s".', num_ok, len(results), self.__data_node)
+        return results
+
+    def __create_pool(self):
+        num_workers = min(self.__num_workers, max(len(self.__datasets), 1))
+        if self.__use_processes:
+            logdebug(LOGGER, 'Starting %i worker processes.', num_workers)
+            return multiprocessing.Pool(num_workers, _init_worker_process, (self.__prefix,)), num_workers
+        else:
+            logdebug(LOGGER, 'Starting %i worker threads.', num_workers)
+            return multiprocessing.pool.ThreadPool(num_workers), num_workers
+
+    def __submit_tasks(self, pool, tasks, outstanding, max_outstanding):
+        while len(outstanding) < max_outstanding:
+            task = next(tasks, None)
+            if task is None:
+                break
+            outstanding.append(pool.apply_async(_build_dataset_messages, (task,)))
+
+    def __finish_one_dataset(self, built, ignore_exception):
+        drs_id, version_number, dataset_handle, messages, error = built
+        result = dict(
+            drs_id=drs_id,
+            version_number=version_number,
+            dataset_handle=dataset_handle,
+            success=False,
+            error=None,
+            future=None
+        )
+        if error is not None:
+            error_class, error_args = error
+            e = error_class(*error_args)
+            logwarn(LOGGER, 'Not publishing dataset "%s" (version %s): %s', drs_id, version_number, e)
+            result['error'] = e
+            return result
+        try:
+            self.__check_data_consistency(drs_id, version_number, messages, ignore_exception)
+            futures = self.__coupler.send_many_messages_to_queue(messages) or []
+            result['future'] = self.__make_aggregate_future(futures)
+            result['success'] = True
+            logdebug(LOGGER, 'Handed %i messages of dataset %s to rabbit thread.', len(messages), dataset_handle)
+        except (esgfpid.exceptions.ArgumentError,
+                esgfpid.exceptions.ESGFException,
+                esgfpid.exceptions.InconsistentFilesetException,
+                esgfpid.exceptions.OperationUnsupportedException) as e:
+            logwarn(LOGGER, 'Not publishing dataset "%s" (version %s): %s', drs_id, version_number, e)
+            result['error'] = e
+        except (esgfpid.exceptions.MessageNotDeliveredException,
+                esgfpid.exceptions.MessageQueueFullException,
+                PIDServerException) as e:
+            logerror(LOGGER, 'Could not send the messages of dataset "%s" (version %s): %s', drs_id, version_number, e)
+            result['error'] = e
+        return result
+
+    def __check_data_consistency(self, drs_id, version_number, messages, ignore_exception):
+        checker = esgfpid.assistant.consistency.Checker(
+            coupler=self.__batch_coupler,
+            drs_id=drs_id,
+            version_number=version_number,
+            data_node=self.__data_node.rstrip('/')
+        )
+        if checker.can_run_check():
+            list_of_files = _find_dataset_message(messages)['files']
+            if checker.data_consistency_check(list_of_files):
+                loginfo(LOGGER, 'Data consistency check passed for dataset "%s" (version %s).', drs_id, version_number)
+            else:
+                msg = 'Dataset consistency check failed'
+                logwarn(LOGGER, msg)
+                if not ignore_exception:
+                    raise esgfpid.exceptions.InconsistentFilesetException(msg)
+        else:
+            logdebug(LOGGER, 'No consistency check was carried out.')
+
+    def __make_aggregate_future(self, futures):
+        # Only asynchronous mode returns DeliveryFutures:
+        if len(futures) > 0 and all(isinstance(future, DeliveryFuture) for future in futures):
+            return AggregateDeliveryFuture(futures)
+        return None
+
+
+# Run in the workers:
+
+def _init_worker_process(prefix):
+    # Processes that were not forked do not have the routing
+    # keys, which are set when creating the connector:
+    esgfpid.utils.routingkeys.add_prefix_to_routing_keys(prefix)
+
+def _build_dataset_messages(task):
+    '''
+    Read and check the files of one dataset and build all of its
+    messages, in the order they are to be sent.
+
+    This is run in the workers, so it does not send anything. Any
+    error is returned as the dataset's error, as exception class
+    and args (see _make_transferable_error()), so that it does not
+    stop the other datasets.
+
+    :return: Tuple of drs_id, version number, dataset handle, list
+        of messages, and error (None or a tuple of exception class
+        and args).
+    '''
+    assistant_args, (drs_id, version_number, is_replica, file_args) = task
+    collector = _CollectingCoupler()
+    dataset_handle = esgfpid.assistant.publish.create_dataset_handle(
+        drs_id=drs_id,
+        version_number=version_number,
+        prefix=assistant_args['prefix']
+    )
+    error = None
+    try:
+        assistant = esgfpid.assistant.publish.DatasetPublicationAssistant(
+            drs_id=drs_id,
+            version_number=version_number,
+            is_replica=is_replica,
+            coupler=collector,
+            **assistant_args
+        )
+        if len(file_args) > 0:
+            assistant.add_files(**file_args)
+        assistant.dataset_publication_finished()
+    except (esgfpid.exceptions.ArgumentError,
+            esgfpid.exceptions.ESGFException,
+            esgfpid.exceptions.OperationUnsupportedException) as e:
+        error = (e.__class__, (e.custom_message,))
+    except (IOError, OSError) as e:
+        error = (esgfpid.exceptions.ArgumentError, ('Could not read the files: %s' % e,))
+    except Exception as e:
+        logerror(LOGGER, 'Unexpected error while building the messages of dataset "%s" (version %s): %s', drs_id, version_number, repr(e))
+        error = _make_transferable_error(e)
+    return (drs_id, version_number, dataset_handle, collector.messages, error)
+
+def _make_transferable_error(exception):
+    '''
+    Return class and args of an unexpected exception. If it cannot
+    be rebuilt from them, a plain Exception with the same message
+    is returned instead, as a result that cannot be passed back
+    from a worker process would stop the whole pool.
+    '''
+    try:
+        pickle.loads(pickle.dumps(exception))
+        return (exception.__class__, exception.args)
+    except Exception:
+        return (Exception, ('%s: %s' % (exception.__class__.__name__, exception),))
+
+def _find_dataset_message(messages):
+    for message in messages:
+        if message['aggregation_level'] == 'dataset':
+            return message
+
+class _CollectingCoupler(object):
+    '''
+    Stands in for the coupler towards the publication assistant
+    in a worker. It collects the messages instead of sending them.
+    The consistency check is not done here (solr is "switched off"),
+    but by the pool, before sending the messages.
+    '''
+
+    def __init__(self):
+        self.messages = []
+
+    def is_solr_switched_off(self):
+        return True
+
+    def start_rabbit_business(self):
+        pass
+
+    def done_with_rabbit_business(self):
+        pass
+
+    def send_message_to_queue(self, message):
+        self.messages.append(message)
+
+    def send_many_messages_to_queue(self, messages):
+        self.messages.extend(messages)
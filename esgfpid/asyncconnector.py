@@ -0,0 +1,200 @@
+'''
+This module provides the API of the ESGF PID module for
+asyncio applications.
+
+It offers the same operations as the
+:py:class:`~esgfpid.connector.Connector`, but the methods that send
+PID requests are coroutines, which return once RabbitMQ confirmed the
+messages. The messages are sent on the running event loop (see
+:py:mod:`esgfpid.rabbit.aio`), so many publications can run
+concurrently on one event loop, sharing one connection, without
+a thread per connector.
+
+Only available on Python 3.
+
+'''
+
+import asyncio
+import logging
+import esgfpid.connector
+from esgfpid.rabbit.aio import FutureCollector
+from esgfpid.utils import logdebug
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class AsyncConnector(object):
+    '''
+    This class provides the main functionality for the ESGF PID
+    module, for asyncio applications.
+
+    Usage:
+        async with AsyncConnector(**args) as connector:
+            assistant = connector.create_publication_assistant(...)
+            await assistant.add_file(...)
+            await assistant.dataset_publication_finished()
+
+    .. note:: The messages are built exactly like in the
+        :py:class:`~esgfpid.connector.Connector`. If a solr_url
+        is given, the solr queries (e.g. during unpublication of
+        all versions, or for consistency checks) still block the
+        event loop.
+    '''
+
+    def __init__(self, **args):
+        '''
+        Create a connector object. It does not connect to
+        RabbitMQ before the first PID request is sent.
+
+        The arguments are the same as for the
+        :py:class:`~esgfpid.connector.Connector`. The
+        arguments for synchronous and threaded communication
+        with RabbitMQ are ignored.
+        '''
+        args['message_service_asyncio'] = True
+        self.__connector = esgfpid.connector.Connector(**args)
+        self.prefix = self.__connector.prefix
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *unused):
+        await self.close()
+        return False
+
+    def create_publication_assistant(self, **args):
+        '''
+        Create an assistant for a dataset that allows to make PID
+        requests for the dataset and all of its files.
+
+        Please see :meth:`~esgfpid.connector.Connector.create_publication_assistant`.
+
+        :return: An :py:class:`~esgfpid.asyncconnector.AsyncPublicationAssistant`.
+        '''
+        assistant = self.__connector.create_publication_assistant(**args)
+        return AsyncPublicationAssistant(assistant)
+
+    async def unpublish_one_version(self, **args):
+        '''
+        Please see :meth:`~esgfpid.connector.Connector.unpublish_one_version`.
+
+        :raises: MessageNotDeliveredException, PIDServerException:
+            If the messages could not be delivered.
+        '''
+        await _wait_for_messages(self.__connector.unpublish_one_version, **args)
+
+    async def unpublish_all_versions(self, **args):
+        '''
+        Please see :meth:`~esgfpid.connector.Connector.unpublish_all_versions`.
+
+        :raises: MessageNotDeliveredException, PIDServerException:
+            If the messages could not be delivered.
+        '''
+        await _wait_for_messages(self.__connector.unpublish_all_versions, **args)
+
+    async def add_errata_ids(self, **args):
+        '''
+        Please see :meth:`~esgfpid.connector.Connector.add_errata_ids`.
+
+        :raises: MessageNotDeliveredException, PIDServerException:
+            If the message could not be delivered.
+        '''
+        await _wait_for_messages(self.__connector.add_errata_ids, **args)
+
+    async def remove_errata_ids(self, **args):
+        '''
+        Please see :meth:`~esgfpid.connector.Connector.remove_errata_ids`.
+
+        :raises: MessageNotDeliveredException, PIDServerException:
+            If the message could not be delivered.
+        '''
+        await _wait_for_messages(self.__connector.remove_errata_ids, **args)
+
+    async def create_data_cart_pid(self, dict_of_drs_ids_and_pids):
+        '''
+        Please see :meth:`~esgfpid.connector.Connector.create_data_cart_pid`.
+
+        :return: The handle string for this data cart.
+        :raises: MessageNotDeliveredException, PIDServerException:
+            If the message could not be delivered.
+        '''
+        return await _wait_for_messages(self.__connector.create_data_cart_pid, dict_of_drs_ids_and_pids)
+
+    def make_handle_from_drsid_and_versionnumber(self, **args):
+        '''
+        Please see :meth:`~esgfpid.connector.Connector.make_handle_from_drsid_and_versionnumber`.
+        '''
+        return self.__connector.make_handle_from_drsid_and_versionnumber(**args)
+
+    async def close(self):
+        '''
+        Close the connection to RabbitMQ. Messages that were
+        not confirmed yet are not delivered (the coroutines
+        waiting for them raise MessageNotDeliveredException).
+        '''
+        await self.__connector.finish_messaging_thread()
+
+
+class AsyncPublicationAssistant(object):
+    '''
+    Wraps a :py:class:`~esgfpid.assistant.publish.DatasetPublicationAssistant`,
+    so that the publication can be awaited.
+
+    Please see the documentation of the wrapped assistant.
+    '''
+
+    def __init__(self, assistant):
+        self.__assistant = assistant
+        self.__futures_of_streamed_files = []
+
+    def get_dataset_handle(self):
+        return self.__assistant.get_dataset_handle()
+
+    async def add_file(self, **args):
+        '''
+        This does not wait for anything: The file messages are only
+        sent when the dataset publication is finished. If the
+        assistant was created with "stream_files", the file's message
+        is sent right away, but its delivery is only awaited when the
+        dataset publication is finished.
+        '''
+        with FutureCollector() as futures:
+            try:
+                return self.__assistant.add_file(**args)
+            finally:
+                self.__futures_of_streamed_files.extend(futures)
+
+    async def dataset_publication_finished(self, ignore_exception=False):
+        '''
+        Send the messages for the dataset and all its files (unless
+        they were streamed), and wait until RabbitMQ confirmed all
+        of them, including the streamed ones.
+
+        :raises: MessageNotDeliveredException, PIDServerException:
+            If any message could not be delivered.
+        '''
+        streamed = self.__futures_of_streamed_files
+        try:
+            await _wait_for_messages(self.__assistant.dataset_publication_finished, ignore_exception)
+        except Exception:
+            # The streamed files' results are retrieved nevertheless,
+            # but the first error is the one that is raised:
+            await asyncio.gather(*streamed, return_exceptions=True)
+            raise
+        if len(streamed) > 0:
+            logdebug(LOGGER, 'Waiting for the confirms of %i streamed file messages.', len(streamed))
+            await asyncio.gather(*streamed)
+
+
+'''
+Call a (synchronous) method of the connector or an assistant,
+and wait for the delivery of all messages it sent.
+'''
+async def _wait_for_messages(function, *args, **kwargs):
+    with FutureCollector() as futures:
+        result = function(*args, **kwargs)
+    if len(futures) > 0:
+        logdebug(LOGGER, 'Waiting for the confirms of %i messages.', len(futures))
+        await asyncio.gather(*futures)
+    return result
@@ -1,8 +1,10 @@
 
 
 import pika
+import time
 import logging
 import socket
+import threading
 from esgfpid.utils import check_presence_of_mandatory_args
 from esgfpid.utils import add_missing_optional_args_with_value_none
 import esgfpid.defaults
@@ -41,6 +43,12 @@ Example result:
     print method.)
 :param send_message: Optional. Boolean. If True, a test message will be sent to
     a RabbitMQ instance after successful connection.
+:param concurrent: Optional. Boolean. If True, all RabbitMQ instances are
+    checked at the same time (see probe_pid_queue_nodes()), instead of one
+    after the other until one works. Defaults to False.
+:param timeout_seconds: Optional. When checking concurrently: How long to
+    wait for the answers of all instances at most. Defaults to
+    RABBIT_CHECK_TIMEOUT_SECONDS.
 :return: String message, or None. If the check passed, returns None. Otherwise,
     returns a detailed, printable string problem message - see example above.
 '''
@@ -48,6 +56,36 @@ def check_pid_queue_availability(**args):
     rabbit_checker = RabbitChecker(**args)
     return rabbit_checker.check_and_inform()
 
+'''
+Check all RabbitMQ instances of a connector object at the same time
+(connection, channel, exchange and optionally a test message), and
+report on each of them.
+
+The results are also passed to the connector's node manager, so that
+it prefers the instances that answered fast, and avoids the ones that
+failed (see esgfpid.rabbit.nodehealth).
+
+Example result:
+[
+    {'host': 'fast.rabbit.de', 'priority': '1', 'ok': True, 'seconds': 0.05, 'error': None},
+    {'host': 'slow.rabbit.de', 'priority': '1', 'ok': True, 'seconds': 0.8, 'error': None},
+    {'host': 'dead.rabbit.de', 'priority': '2', 'ok': False, 'seconds': 10.0,
+     'error': 'No answer within 10.0 seconds.'}
+]
+
+:param connector: Connector object, readily configured with RabbitMQ
+    instance(s).
+:param send_message: Optional. Boolean. If True, a test message will be sent to
+    each RabbitMQ instance after successful connection.
+:param timeout_seconds: Optional. How long to wait for the answers of all
+    instances at most. Defaults to RABBIT_CHECK_TIMEOUT_SECONDS.
+:return: List of dictionaries, one per instance: The working ones first
+    (the fastest first), then the others (by priority).
+'''
+def probe_pid_queue_nodes(**args):
+    rabbit_checker = RabbitChecker(**args)
+    return rabbit_checker.probe_all_hosts()
+
 class RabbitChecker(object):
 
     #
@@ -56,7 +94,7 @@ class RabbitChecker(object):
 
     def __init__(self, **args):
         mandatory_args = ['connector']
-        optional_args = ['send_message', 'print_to_console', 'print_success_to_console']
+        optional_args = ['send_message', 'print_to_console', 'print_success_to_console', 'concurrent', 'timeout_seconds']
         check_presence_of_mandatory_args(args, mandatory_args)
         add_missing_optional_args_with_value_none(args, optional_args)
         self.__define_all_attributes()
@@ -75,6 +113,8 @@ class RabbitChecker(object):
         self.__exchange_name = None
         self.__send_message = False
         self.__prefix = None
+        self.__concurrent = False
+        self.__timeout_seconds = esgfpid.defaults.RABBIT_CHECK_TIMEOUT_SECONDS
 
     def __fill_all_attributes(self, args):
         self.__nodemanager = args['connector']._Connector__coupler._Coupler__rabbit_message_sender._RabbitMessageSender__node_manager
@@ -85,6 +125,10 @@ class RabbitChecker(object):
         if args['send_message'] is not None and args['send_message'] == True:
             self.__send_message = True
         self.__prefix = args['connector'].prefix
+        if args['concurrent'] is not None and args['concurrent'] == True:
+            self.__concurrent = True
+        if args['timeout_seconds'] is not None:
+            self.__timeout_seconds = args['timeout_seconds']
 
 
 
@@ -100,7 +144,10 @@ class RabbitChecker(object):
     '''
     def check_and_inform(self):
         self.__loginfo('Checking config for PID module (rabbit messaging queue) ...')
-        success = self.__iterate_over_all_hosts()
+        if self.__concurrent:
+            success = self.__check_all_hosts_concurrently()
+        else:
+            success = self.__iterate_over_all_hosts()
         msg = None
         if success:
             self.__loginfo('Config for PID module (rabbit messaging queue).. ok.')
@@ -192,15 +239,7 @@ class RabbitChecker(object):
             delivery_mode = 2
         )
         
-        # This also does the trick:
-        #esgfpid.utils.routingkeys.add_prefix_to_routing_keys(self.__prefix)
-        #rkey = utils.routingkeys.ROUTING_KEYS['pre_flight']
-        rkey = utils.routingkeys.ROUTING_KEYS_TEMPLATES['pre_flight']
-        sanitized_prefix = utils.routingkeys._sanitize_prefix(self.__prefix)
-        rkey = rkey.replace('PREFIX', sanitized_prefix)
-        if 'PREFIX' in rkey:
-            raise ValueError('Prefix placeholder in routing key was not replaced!')
-
+        rkey = self.__get_pre_flight_routing_key()
         body = 'PLEASE PRINT: Testing pre-flight check...'
         self.__loginfo(' .. checking message ...')
         try:
@@ -219,6 +258,17 @@ class RabbitChecker(object):
                     (self.__current_rabbit_host))
 
 
+    def __get_pre_flight_routing_key(self):
+        # This also does the trick:
+        #esgfpid.utils.routingkeys.add_prefix_to_routing_keys(self.__prefix)
+        #rkey = utils.routingkeys.ROUTING_KEYS['pre_flight']
+        rkey = utils.routingkeys.ROUTING_KEYS_TEMPLATES['pre_flight']
+        sanitized_prefix = utils.routingkeys._sanitize_prefix(self.__prefix)
+        rkey = rkey.replace('PREFIX', sanitized_prefix)
+        if 'PREFIX' in rkey:
+            raise ValueError('Prefix placeholder in routing key was not replaced!')
+        return rkey
+
     def __check_opening_channel(self, connection):
         channel = None
         try:
@@ -278,6 +328,125 @@ class RabbitChecker(object):
     def __pika_blocking_connection(self, params): # this is easy to mock
         return pika.BlockingConnection(params)
 
+    #
+    # Checking all hosts concurrently:
+    #
+
+    '''
+    Check all RabbitMQ instances at the same time, each in its own
+    thread, and wait for their answers until the deadline.
+
+    The instances that did not answer by then are reported as
+    failed. Their threads are left to finish on their own (they
+    are daemon threads, and the connection is closed once they
+    get an answer).
+
+    :return: List of dictionaries, one per instance, see
+        probe_pid_queue_nodes().
+    '''
+    def probe_all_hosts(self):
+        nodes = self.__nodemanager.get_all_nodes()
+        self.__loginfo(' .. checking %i hosts at once (waiting %s seconds at most) ...' % (len(nodes), self.__timeout_seconds))
+        results = []
+        threads = []
+        for node in nodes:
+            result = dict(host=node['host'], priority=node['priority'], ok=False, seconds=None, error=None, done=False)
+            thread = threading.Thread(target=self.__probe_host, args=(node, result))
+            thread.daemon = True
+            thread.start()
+            results.append(result)
+            threads.append(thread)
+
+        deadline = time.time() + self.__timeout_seconds
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+
+        report = []
+        for node, result in zip(nodes, results):
+            result = dict(result) # the thread may still change the original
+            if not result.pop('done'):
+                result['ok'] = False
+                result['seconds'] = self.__timeout_seconds
+                result['error'] = 'No answer within %s seconds.' % self.__timeout_seconds
+            if result['ok']:
+                self.__nodemanager.report_success_of_node(node, result['seconds'])
+                self.__loginfo(' .. host "%s": ok (%.3f seconds).' % (result['host'], result['seconds']))
+            else:
+                self.__nodemanager.report_failure_of_node(node)
+                self.__loginfo(' .. host "%s": FAILED (%s)' % (result['host'], result['error']))
+            report.append(result)
+
+        # Working ones first, the fastest first (the sort is
+        # stable, so the others stay ordered by priority):
+        report.sort(key=lambda result: (not result['ok'], result['seconds'] if result['ok'] else 0))
+        return report
+
+    '''
+    Checks one RabbitMQ instance (in its own thread) and stores
+    the outcome in the result dictionary. Does not touch any
+    attributes of the checker, except for reading them.
+    '''
+    def __probe_host(self, node, result):
+        start = time.time()
+        connection = None
+        try:
+            connection = self.__pika_blocking_connection(node['params'])
+            if connection is None or not connection.is_open:
+                raise ValueError('Unknown connection failure.')
+            try:
+                channel = self.__open_channel(connection)
+            except pika.exceptions.ChannelClosed:
+                raise ValueError('Channel failure.')
+            if node['exchange_name'] is not None:
+                try:
+                    channel.exchange_declare(node['exchange_name'], passive=True)
+                except pika.exceptions.ChannelClosed:
+                    raise ValueError('Exchange %s does not exist.' % node['exchange_name'])
+            if self.__send_message:
+                rkey = self.__get_pre_flight_routing_key()
+                try:
+                    channel.basic_publish(
+                        exchange=node['exchange_name'],
+                        routing_key=rkey,
+                        body='PLEASE PRINT: Testing pre-flight check...',
+                        properties=pika.BasicProperties(delivery_mode=2),
+                        mandatory=True
+                    )
+                except pika.exceptions.UnroutableError:
+                    raise ValueError('Message failure with routing key "%s".' % rkey)
+            result['ok'] = True
+
+        except ValueError as e:
+            result['error'] = str(e)
+        except pika.exceptions.ProbableAuthenticationError:
+            result['error'] = 'Authentication failure (user %s).' % node['params'].credentials.username
+        except pika.exceptions.ProbableAccessDeniedError as e:
+            if ('vhost %s not found' % node['params'].virtual_host) in str(e):
+                result['error'] = 'Virtual host "%s" does not exist.' % node['params'].virtual_host
+            else:
+                result['error'] = 'Access denied.'
+        except (pika.exceptions.AMQPError, socket.error) as e:
+            result['error'] = 'Connection failure (wrong host or port?): %s' % e.__class__.__name__
+        except Exception as e:
+            result['error'] = repr(e)
+        finally:
+            if connection is not None and connection.is_open:
+                try:
+                    connection.close()
+                except (pika.exceptions.AMQPError, socket.error):
+                    pass
+            result['seconds'] = time.time() - start
+            result['done'] = True
+
+    def __check_all_hosts_concurrently(self):
+        report = self.probe_all_hosts()
+        if len(report) > 0 and report[0]['ok']:
+            self.__current_rabbit_host = report[0]['host']
+            return True
+        for result in report:
+            self.__error_messages.append(' - host "%s": %s' % (result['host'], result['error']))
+        return False
+
     #
     # Error messages
     #
@@ -7,6 +7,8 @@ Author: Merret Buurman (DKRZ), 2015-2016
 
 import logging
 import esgfpid.assistant.publish
+import esgfpid.assistant.batch
+import esgfpid.assistant.workers
 import esgfpid.assistant.unpublish
 import esgfpid.assistant.errata
 import esgfpid.assistant.datacart
@@ -60,7 +62,8 @@ class Connector(object):
             They may have an integer "priority" too. If two nodes have
             the same priority, the library chooses randomly between
             them. They also may have a "vhost" (RabbitMQ virtual host),
-            a "port" and a boolean "ssl_enabled". Please refer to pika's
+            a "port", a boolean "ssl_enabled" and a number "weight" (see
+            "messaging_service_distribution"). Please refer to pika's
             documentation
             (http://pika.readthedocs.io/en/latest/modules/parameters.html).
             Dictionaries for 'open nodes' do not need a password
@@ -126,6 +129,93 @@ class Connector(object):
             that will be overwritten by real publications. Also,
             test publications cannot update real handles.
 
+        :param messaging_service_spool_file: Optional. Path of a
+            file in which the messages are kept until RabbitMQ has
+            confirmed them (only in asynchronous mode). Messages
+            that were not confirmed (e.g. because the process
+            died) are published again the next time the messaging
+            thread is started with the same file. No default (no
+            spool file is used).
+
+        :param messaging_service_max_in_flight: Optional. Maximum
+            number of messages that may be waiting to be published
+            or confirmed at a time (only in asynchronous mode), to
+            cap the memory used by large publications. Defaults to
+            no limit.
+
+        :param messaging_service_overflow_policy: Optional. What to
+            do with new messages if that limit is reached: "block"
+            waits until enough messages were confirmed (and raises
+            a MessageQueueFullException after a timeout), "raise"
+            raises a MessageQueueFullException right away, "spill"
+            writes them to a temporary file until there is room.
+            Defaults to "block".
+
+        :param messaging_service_overflow_timeout: Optional. How
+            many seconds to block at most if the limit is reached
+            (policy "block"). Defaults to 60 seconds.
+
+        :param messaging_service_num_channels: Optional. On how
+            many channels of the RabbitMQ connection to publish
+            (only in asynchronous mode). Each channel waits for its
+            own confirms, so more channels may increase the
+            throughput if the confirms are slow. The messages are
+            spread over the channels, so their order is not kept.
+            Defaults to 1.
+
+        :param messaging_service_distribution: Optional. By default,
+            the library is connected to one RabbitMQ node at a time,
+            and the other nodes are only used if it fails. If this
+            is "round_robin" or "least_unconfirmed", it is connected
+            to all trusted nodes of the highest priority at once (only
+            in asynchronous mode), and the messages are distributed
+            over them: By weighted round-robin (using the optional
+            "weight" of each node in the credentials, default 1), or
+            to the node with the fewest messages waiting for
+            confirmation. The order of the messages is not kept.
+
+        :param messaging_service_metrics: Optional flag. If True,
+            the library records how long the messages wait to be
+            published and confirmed, how many were rejected or
+            returned, how often it reconnected, and how many
+            messages are waiting (only in asynchronous mode). See
+            :meth:`~esgfpid.connector.Connector.get_messaging_metrics`.
+            Defaults to False.
+
+        :param messaging_service_node_health_dir: Optional. Directory
+            where the library keeps a small file recording which
+            RabbitMQ nodes failed recently and how long connecting
+            to them took. All processes that use the same directory
+            share this information, so short-lived processes do not
+            have to find out again which nodes are down or slow.
+            Defaults to None (only kept in memory, per process).
+
+        :param messaging_service_publish_window: Optional. How many
+            messages to publish at once in synchronous mode, when
+            a dataset with many files is published. They are sent
+            in one transaction, so the library waits for RabbitMQ
+            once per window instead of once per message. If any of
+            them is not delivered, MessageNotDeliveredException is
+            raised right away, listing all messages that were not
+            delivered. Defaults to 1 (each message is confirmed
+            before the next one is sent).
+
+        :param messaging_service_connection_pool: Optional flag. If
+            True, the connection to RabbitMQ is not closed after each
+            dataset publication, unpublication etc. (only in
+            synchronous mode), but kept open for a while to be reused
+            by the next one (by any connector of the process). Idle
+            connections are closed after 30 seconds, and when the
+            process ends. Defaults to False.
+
+        :param message_service_asyncio: Optional flag. If True,
+            the messages are sent on the running asyncio event
+            loop, instead of synchronously or in a thread. Please
+            do not set this, but use
+            :py:class:`~esgfpid.asyncconnector.AsyncConnector`
+            instead, which waits for the delivery of the messages.
+            Defaults to False.
+
         :returns: An instance of the connector, configured for one 
             data node, and for connection with a specific RabbitMQ node.
 
@@ -156,7 +246,18 @@ class Connector(object):
             'disable_insecure_request_warning',
             'solr_switched_off',
             'consumer_solr_url',
-            'message_service_synchronous'
+            'message_service_synchronous',
+            'message_service_asyncio',
+            'messaging_service_spool_file',
+            'messaging_service_max_in_flight',
+            'messaging_service_overflow_policy',
+            'messaging_service_overflow_timeout',
+            'messaging_service_num_channels',
+            'messaging_service_distribution',
+            'messaging_service_metrics',
+            'messaging_service_node_health_dir',
+            'messaging_service_connection_pool',
+            'messaging_service_publish_window'
         ]
         esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
 
@@ -191,9 +292,42 @@ class Connector(object):
         if 'message_service_synchronous' not in args or args['message_service_synchronous'] is None:
             args['message_service_synchronous'] = not esgfpid.defaults.RABBIT_IS_ASYNCHRONOUS
 
+        if 'message_service_asyncio' not in args or args['message_service_asyncio'] is None:
+            args['message_service_asyncio'] = False
+
         if 'consumer_solr_url' not in args or args['consumer_solr_url'] is None:
             args['consumer_solr_url'] = None
 
+        if 'messaging_service_spool_file' not in args or args['messaging_service_spool_file'] is None:
+            args['messaging_service_spool_file'] = None
+
+        if 'messaging_service_max_in_flight' not in args or args['messaging_service_max_in_flight'] is None:
+            args['messaging_service_max_in_flight'] = esgfpid.defaults.RABBIT_ASYN_MAX_IN_FLIGHT
+
+        if 'messaging_service_overflow_policy' not in args or args['messaging_service_overflow_policy'] is None:
+            args['messaging_service_overflow_policy'] = esgfpid.defaults.RABBIT_ASYN_OVERFLOW_POLICY
+
+        if 'messaging_service_overflow_timeout' not in args or args['messaging_service_overflow_timeout'] is None:
+            args['messaging_service_overflow_timeout'] = esgfpid.defaults.RABBIT_ASYN_OVERFLOW_TIMEOUT_SECONDS
+
+        if 'messaging_service_num_channels' not in args or args['messaging_service_num_channels'] is None:
+            args['messaging_service_num_channels'] = esgfpid.defaults.RABBIT_ASYN_NUM_CHANNELS
+
+        if 'messaging_service_distribution' not in args or args['messaging_service_distribution'] is None:
+            args['messaging_service_distribution'] = esgfpid.defaults.RABBIT_ASYN_DISTRIBUTION
+
+        if 'messaging_service_metrics' not in args or args['messaging_service_metrics'] is None:
+            args['messaging_service_metrics'] = esgfpid.defaults.RABBIT_ASYN_METRICS
+
+        if 'messaging_service_node_health_dir' not in args or args['messaging_service_node_health_dir'] is None:
+            args['messaging_service_node_health_dir'] = esgfpid.defaults.RABBIT_NODE_HEALTH_DIR
+
+        if 'messaging_service_connection_pool' not in args or args['messaging_service_connection_pool'] is None:
+            args['messaging_service_connection_pool'] = esgfpid.defaults.RABBIT_SYN_CONNECTION_POOL
+
+        if 'messaging_service_publish_window' not in args or args['messaging_service_publish_window'] is None:
+            args['messaging_service_publish_window'] = esgfpid.defaults.RABBIT_SYN_PUBLISH_WINDOW
+
     def __check_rabbit_credentials_completeness(self, args):
         for credentials in args['messaging_service_credentials']:
 
@@ -303,6 +437,16 @@ class Connector(object):
             namely if the dataset was already published at a different
             host. For this, please refer to the consumer documentation.
 
+        :param stream_files: Optional. If True, each file's message
+            is sent as soon as the file is added, instead of keeping
+            all of them until the dataset publication is finished.
+            This bounds the memory needed for large datasets. Files
+            that were not part of the previous publication of the
+            dataset version are refused when they are added (before
+            their message is sent). The dataset's message is still
+            sent at the end, after checking for missing files.
+            Defaults to False.
+
         :return: A publication assistant which provides all necessary
             methods to publish a dataset and its files.
         '''
@@ -310,17 +454,10 @@ class Connector(object):
         # Check args
         logdebug(LOGGER, 'Creating publication assistant..')
         mandatory_args = ['drs_id', 'version_number', 'is_replica']
+        optional_args = ['stream_files']
         esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
-        # Check if service path is given
-        if self.__thredds_service_path is None:
-            msg = 'No thredds_service_path given (but it is mandatory for publication)'
-            logwarn(LOGGER, msg)
-            raise esgfpid.exceptions.ArgumentError(msg)
-        # Check if data node is given
-        if self.__data_node is None:
-            msg = 'No data_node given (but it is mandatory for publication)'
-            logwarn(LOGGER, msg)
-            raise esgfpid.exceptions.ArgumentError(msg)
+        esgfpid.utils.add_missing_optional_args_with_value_none(args, optional_args)
+        self.__check_publication_args()
 
         # Check if solr has access:
         if self.__coupler.is_solr_switched_off():
@@ -335,12 +472,85 @@ class Connector(object):
             prefix=self.prefix,
             coupler=self.__coupler,
             is_replica=args['is_replica'],
-            consumer_solr_url=self.__consumer_solr_url # may be None
+            consumer_solr_url=self.__consumer_solr_url, # may be None
+            stream_files=args['stream_files'] # may be None
         )
         logdebug(LOGGER, 'Creating publication assistant.. done')
         return assistant
 
 
+    def create_batch_publication_assistant(self):
+        '''
+        Create an assistant that publishes many datasets (and all
+        of their files) at once, e.g. for republishing all datasets
+        of an institution. See
+        :py:class:`~esgfpid.assistant.batch.BatchPublicationAssistant`.
+
+        :return: A batch publication assistant, to which the datasets
+            are added one by one, and which is finished once.
+        '''
+
+        # Check args
+        logdebug(LOGGER, 'Creating batch publication assistant..')
+        self.__check_publication_args()
+
+        # Create batch publication assistant
+        assistant = esgfpid.assistant.batch.BatchPublicationAssistant(
+            thredds_service_path=self.__thredds_service_path,
+            data_node=self.__data_node,
+            prefix=self.prefix,
+            coupler=self.__coupler,
+            consumer_solr_url=self.__consumer_solr_url # may be None
+        )
+        logdebug(LOGGER, 'Creating batch publication assistant.. done')
+        return assistant
+
+    def create_publication_worker_pool(self, num_workers=None, use_processes=False):
+        '''
+        Create a pool of workers that read and check the files and
+        build the messages of many datasets at the same time, while
+        all messages are sent through this connector. See
+        :py:class:`~esgfpid.assistant.workers.PublicationWorkerPool`.
+
+        :param num_workers: Optional. How many datasets are handled
+            at the same time. Defaults to 4.
+        :param use_processes: Optional. If True, the workers are
+            processes instead of threads. Only worth it for datasets
+            with many files, as the datasets' file information has
+            to be passed to the processes.
+        :return: A worker pool, to which the datasets are added one
+            by one, and which is finished once.
+        '''
+
+        # Check args
+        logdebug(LOGGER, 'Creating publication worker pool..')
+        self.__check_publication_args()
+
+        # Create worker pool
+        pool = esgfpid.assistant.workers.PublicationWorkerPool(
+            thredds_service_path=self.__thredds_service_path,
+            data_node=self.__data_node,
+            prefix=self.prefix,
+            coupler=self.__coupler,
+            consumer_solr_url=self.__consumer_solr_url, # may be None
+            num_workers=num_workers,
+            use_processes=use_processes
+        )
+        logdebug(LOGGER, 'Creating publication worker pool.. done')
+        return pool
+
+    def __check_publication_args(self):
+        # Check if service path is given
+        if self.__thredds_service_path is None:
+            msg = 'No thredds_service_path given (but it is mandatory for publication)'
+            logwarn(LOGGER, msg)
+            raise esgfpid.exceptions.ArgumentError(msg)
+        # Check if data node is given
+        if self.__data_node is None:
+            msg = 'No data_node given (but it is mandatory for publication)'
+            logwarn(LOGGER, msg)
+            raise esgfpid.exceptions.ArgumentError(msg)
+
     '''
     Please see documentation of solr module (:func:`~check.check_pid_queue_availability`).
     '''
@@ -348,6 +558,13 @@ class Connector(object):
         rabbit_checker = esgfpid.check.RabbitChecker(connector = self, prefix = self.prefix, **args)
         return rabbit_checker.check_and_inform()
 
+    '''
+    Please see documentation of check module (:func:`~check.probe_pid_queue_nodes`).
+    '''
+    def probe_pid_queue_nodes(self, **args):
+        rabbit_checker = esgfpid.check.RabbitChecker(connector = self, prefix = self.prefix, **args)
+        return rabbit_checker.probe_all_hosts()
+
     def unpublish_one_version(self, **args):
         '''
         Sends a PID update request for the unpublication of one version
@@ -558,6 +775,9 @@ class Connector(object):
         they will not be lost, but pile up and sent once the connection
         is ready).
 
+        If a spool file was configured, the messages that were not
+        confirmed during an earlier run are re-enqueued here.
+
         .. important:: Please do not forget to finish the thread at the end,
             using :meth:`~esgfpid.connector.Connector.finish_messaging_thread`
             or :meth:`~esgfpid.connector.Connector.force_finish_messaging_thread`.
@@ -572,14 +792,21 @@ class Connector(object):
 
         If some messages are still in the stack to be sent,
         or if some messages were not confirmed yet, this method
-        blocks and waits for some time while it iteratively
-        checks for message confirmation.
-
-        Currently, it waits up to 5 seconds: It checks up to
-        11 times, waiting 0.5 seconds in between - these
-        values can be configured in the defaults module).
+        blocks until the last confirmation has arrived, up to
+        a maximum waiting time. If nothing is pending, it
+        returns right away.
+
+        Currently, it waits up to 5 seconds (this value can
+        be configured in the defaults module). While RabbitMQ
+        blocks the connection (flow control, e.g. during a
+        memory alarm), the waiting time is extended by up to
+        30 seconds.
+
+        :return: None (or, only if "message_service_asyncio"
+            was set, a future that is resolved when the
+            connection is closed).
         '''
-        self.__coupler.finish_rabbit_connection()
+        return self.__coupler.finish_rabbit_connection()
 
     def force_finish_messaging_thread(self):
         '''
@@ -600,7 +827,29 @@ class Connector(object):
 
 
         '''
-        self.__coupler.force_finish_rabbit_connection()
+        return self.__coupler.force_finish_rabbit_connection()
+
+    def get_messaging_metrics(self, prometheus=False):
+        '''
+        Return the metrics of the asynchronous communication with
+        RabbitMQ, if they were switched on (see
+        "messaging_service_metrics").
+
+        The counters (e.g. "messages_acked", "messages_nacked",
+        "messages_returned", "reconnections") count from the
+        creation of the connector. The durations ("queue_seconds",
+        "confirm_seconds", "total_seconds", "reconnection_seconds")
+        are histograms with "count", "sum", "max" and "buckets".
+        The queue depths ("messages_unpublished",
+        "messages_unconfirmed") are the current values.
+
+        :param prometheus: Optional. If True, the metrics are
+            returned in the Prometheus text exposition format,
+            e.g. to be served by a metrics endpoint.
+        :return: A dictionary (or a string), or None if no
+            metrics are recorded.
+        '''
+        return self.__coupler.get_rabbit_metrics(prometheus)
 
     def make_handle_from_drsid_and_versionnumber(self, **args):
         '''
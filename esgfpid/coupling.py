@@ -29,7 +29,18 @@ class Coupler(object):
     :param messaging_service_credentials: Mandatory.
     :param messaging_service_exchange_name: Mandatory.
     :param message_service_synchronous: Mandatory. Boolean.
+    :param message_service_asyncio: Mandatory. Boolean.
     :param test_publication: Mandatory. Boolean.
+    :param messaging_service_spool_file: Mandatory. May be None.
+    :param messaging_service_max_in_flight: Mandatory. May be None.
+    :param messaging_service_overflow_policy: Mandatory. May be None.
+    :param messaging_service_overflow_timeout: Mandatory. May be None.
+    :param messaging_service_num_channels: Mandatory. May be None.
+    :param messaging_service_distribution: Mandatory. May be None.
+    :param messaging_service_metrics: Mandatory. Boolean.
+    :param messaging_service_node_health_dir: Mandatory. May be None.
+    :param messaging_service_connection_pool: Mandatory. Boolean.
+    :param messaging_service_publish_window: Mandatory. Integer.
 
     :param solr_switched_off: Mandatory. Boolean.
     :param solr_url: Mandatory. May be None if switched off.
@@ -49,7 +60,18 @@ class Coupler(object):
             exchange_name=args['messaging_service_exchange_name'],
             credentials=args['messaging_service_credentials'],
             test_publication=args['test_publication'],
-            is_synchronous_mode=args['message_service_synchronous']
+            is_synchronous_mode=args['message_service_synchronous'],
+            is_asyncio_mode=args['message_service_asyncio'],
+            spool_file=args['messaging_service_spool_file'],
+            max_in_flight=args['messaging_service_max_in_flight'],
+            overflow_policy=args['messaging_service_overflow_policy'],
+            overflow_timeout_seconds=args['messaging_service_overflow_timeout'],
+            num_channels=args['messaging_service_num_channels'],
+            distribution=args['messaging_service_distribution'],
+            metrics=args['messaging_service_metrics'],
+            node_health_dir=args['messaging_service_node_health_dir'],
+            connection_pool=args['messaging_service_connection_pool'],
+            publish_window=args['messaging_service_publish_window']
         )
 
     def __complete_credentials_for_open_nodes(self, args):
@@ -73,7 +95,13 @@ class Coupler(object):
     Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.send_message_to_queue`).
     '''
     def send_message_to_queue(self, message):
-        self.__rabbit_message_sender.send_message_to_queue(message)
+        return self.__rabbit_message_sender.send_message_to_queue(message)
+
+    '''
+    Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.send_many_messages_to_queue`).
+    '''
+    def send_many_messages_to_queue(self, messages):
+        return self.__rabbit_message_sender.send_many_messages_to_queue(messages)
 
     ### For synchronous
 
@@ -101,13 +129,19 @@ class Coupler(object):
     Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.finish`).
     '''
     def finish_rabbit_connection(self):
-        self.__rabbit_message_sender.finish()
+        return self.__rabbit_message_sender.finish()
 
     '''
     Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.force_finish`).
     '''
     def force_finish_rabbit_connection(self):
-        self.__rabbit_message_sender.force_finish()
+        return self.__rabbit_message_sender.force_finish()
+
+    '''
+    Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.get_metrics`).
+    '''
+    def get_rabbit_metrics(self, prometheus=False):
+        return self.__rabbit_message_sender.get_metrics(prometheus)
 
     ### Communications with solr
 
@@ -139,6 +173,19 @@ class Coupler(object):
         )
         return result_dict
 
+    '''
+    Please see documentation of solr module (:func:`~solr.SolrInteractor.retrieve_file_handles_of_many_datasets`).
+    '''
+    def retrieve_file_handles_of_many_datasets(self, **args):
+        mandatory_args = ['datasets', 'data_node']
+        esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
+        esgfpid.utils.check_noneness_of_mandatory_args(args, mandatory_args)
+
+        return self.__solr_sender.retrieve_file_handles_of_many_datasets(
+            datasets=args['datasets'],
+            data_node=args['data_node']
+        )
+
     '''
     Please see documentation of solr module (:func:`~solr.SolrInteractor.is_switched_off`).
     '''
@@ -17,9 +17,16 @@ LOG_TRACE_TO_DEBUG=False # Print extremely detailed log messages of rabbit modul
 LOG_SHOW_TO_INFO=False # So I can selectively show some log messages to Katharina without having to modify the whole code. Deprecated.
 RABBIT_LOG_MESSAGE_INCREMENT = 10
 
+# Publication assistant:
+PUBLISH_FILE_MESSAGES_PER_CHUNK=1000 # How many file messages to create and hand over to the sender at a time, when the dataset publication is finished
+PUBLISH_NUM_WORKERS=4 # How many workers (threads or processes) build the datasets' messages at the same time (publication worker pool)
+PUBLISH_TASKS_PER_WORKER=2 # How many datasets per worker may be built ahead of sending their messages (publication worker pool)
+
 # Solr:
 SOLR_HTTPS_VERIFY_DEFAULT=False
 SOLR_QUERY_DISTRIB=False
+SOLR_DATASETS_PER_QUERY=50 # How many dataset versions to ask for in one query, when retrieving the files of many dataset versions (batch publication)
+SOLR_FILES_PER_QUERY=10000 # How many file documents to retrieve per query (page) at most in that case
 
 # Rabbit
 RABBIT_IS_ASYNCHRONOUS = True
@@ -35,12 +42,34 @@ RABBIT_PIKA_SOCKET_TIMEOUT=0.25 # defaults to 0.25 sec
 RABBIT_PIKA_CONNECTION_ATTEMPTS=1 # defaults to 1
 RABBIT_PIKA_CONNECTION_RETRY_DELAY_SECONDS=0 # defaults to 2.0
 # Rabbit reconnection attempts
-RABBIT_RECONNECTION_SECONDS=0.5 # after how much time try to retry connecting to same hosts if connection was closed?
+RABBIT_RECONNECTION_SECONDS=0.5 # after how much time try to retry connecting to same hosts if connection was closed? Doubled at every further round (with jitter).
+RABBIT_RECONNECTION_MAX_SECONDS=30.0 # upper limit for that waiting time
 RABBIT_RECONNECTION_MAX_TRIES=2 # how many times should the module try reconnecting? Not so many times, rather throw exception to publisher.
+RABBIT_NODE_FAILURES_BEFORE_COOLDOWN=2 # after how many consecutive connection failures a node is skipped (as long as other nodes are left to try)...
+RABBIT_NODE_COOLDOWN_SECONDS=60.0 # ... and for how long
+RABBIT_NODE_LATENCY_TOLERANCE=2.0 # nodes that took more than this times as long to connect as the fastest one of the same priority are only tried after it
+RABBIT_NODE_HEALTH_DIR=None # directory for a file where the node failures and connection times are shared between processes (None: not shared)
+RABBIT_NODE_HEALTH_MAX_AGE_SECONDS=86400 # how long to keep a node's entry in that file after its last update
+RABBIT_CHECK_TIMEOUT_SECONDS=10.0 # how long the pre-flight check waits at most for the answers of all nodes, if it checks them concurrently
 # Rabbit attempts to send message (synchronous only):
 RABBIT_SYN_MESSAGE_MAX_TRIES=3
 RABBIT_SYN_MESSAGE_TIMEOUT_MILLISEC=10
+RABBIT_SYN_PUBLISH_WINDOW=1 # How many messages to publish at once (in one transaction) when sending several messages (1: each one is confirmed before the next one is sent)
+RABBIT_SYN_CONNECTION_POOL=False # Whether to keep the connections open for the next publication (shared by all connectors of the process)
+RABBIT_SYN_POOL_IDLE_SECONDS=30.0 # How long a pooled connection may be idle before it is closed (should be shorter than the heartbeat timeout)
+RABBIT_SYN_POOL_MAX_IDLE_PER_NODE=2 # How many idle connections to keep per node and credentials
+# Rabbit publishing (asynchronous only):
+RABBIT_ASYN_PUBLISH_MAX_PER_TRIGGER=1000 # How many messages to publish per publish trigger at most, before letting the ioloop handle other events (e.g. confirms)
+# Rabbit spool file (asynchronous only, if a spool file is configured):
+RABBIT_ASYN_SPOOL_FSYNC_EVERY_N=1000 # After how many records to fsync the spool file
+RABBIT_ASYN_SPOOL_FSYNC_SECONDS=1.0 # After how many seconds to fsync the spool file (checked whenever a record is written)
+RABBIT_ASYN_MAX_IN_FLIGHT=None # How many messages may be queued+unconfirmed at a time (None: unlimited)
+RABBIT_ASYN_OVERFLOW_POLICY='block' # What to do with new messages if the limit is reached: 'block', 'raise' or 'spill'
+RABBIT_ASYN_OVERFLOW_TIMEOUT_SECONDS=60 # How long to block the publisher at most if the limit is reached (policy 'block')
+RABBIT_ASYN_NUM_CHANNELS=1 # How many channels to publish on (round-robin), each with its own confirms
+RABBIT_ASYN_METRICS=False # Whether to record publication metrics (queue/confirm times, nacks, returns, reconnections, queue depths)
+RABBIT_ASYN_DISTRIBUTION=None # None: Use one node at a time (failover). 'round_robin' or 'least_unconfirmed': Use all trusted nodes of the highest priority at once
 # Rabbit closing down algorithm (asynchronous only):
-RABBIT_ASYN_FINISH_MAX_TRIES=10 # How many times to recheck if all messages are published+confirmed (on finish)
-RABBIT_ASYN_FINISH_WAIT_SECONDS=0.5 # How much time to wait until you recheck (on finish)
+RABBIT_ASYN_FINISH_TIMEOUT_SECONDS=5.0 # How long to wait at most for pending messages to be published+confirmed (on finish)
+RABBIT_ASYN_FINISH_MAX_EXTENSION_SECONDS=30.0 # By how much the waiting time is extended at most while RabbitMQ blocks the connection (on finish)
 
@@ -9,8 +9,11 @@ so we prefer to not even pretend we can return anything.
 '''
 class MessageNotDeliveredException(Exception):
 
-    def __init__(self, custom_message, undelivered_message):
+    def __init__(self, custom_message, undelivered_message, undelivered_messages=None):
         self.rabbit_msg = undelivered_message
+        if undelivered_messages is None:
+            undelivered_messages = [undelivered_message]
+        self.undelivered_messages = undelivered_messages
         self.msg = 'Message could not be delivered'
         self.custom_message = custom_message
 
@@ -103,4 +106,27 @@ class SolrResponseError(Exception):
             self.msg += ': '+self.custom_message
         self.msg += '.'
 
-        super(self.__class__, self).__init__(self.msg)
\ No newline at end of file
+        super(self.__class__, self).__init__(self.msg)
+
+'''
+When the library was started in the asynchronous mode with a
+limit for the number of messages in flight, and a message could
+not be accepted because the limit was reached, this exception
+is raised (depending on the overflow policy, immediately or
+after waiting for some time).
+
+The messages that were not accepted are attached, so the
+caller can retry them later.
+'''
+class MessageQueueFullException(Exception):
+
+    def __init__(self, custom_message, undelivered_messages):
+        self.undelivered_messages = undelivered_messages
+        self.msg = 'Message queue is full'
+        self.custom_message = custom_message
+
+        if self.custom_message is not None:
+            self.msg += ': '+self.custom_message
+        self.msg += '.'
+
+        super(self.__class__, self).__init__(self.msg)
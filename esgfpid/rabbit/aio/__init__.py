@@ -0,0 +1 @@
+from .aio import AioRabbitConnector, FutureCollector
@@ -0,0 +1,401 @@
+import time
+import json
+import asyncio
+import logging
+import contextvars
+import collections
+import pika
+import pika.adapters.asyncio_connection
+import esgfpid.defaults as defaults
+import esgfpid.utils
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+from esgfpid.exceptions import MessageNotDeliveredException
+from esgfpid.rabbit.exceptions import PIDServerException
+from esgfpid.rabbit import rabbitutils
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+================
+Asyncio messages
+================
+
+Sends the messages to RabbitMQ on the asyncio event loop of the
+caller, instead of in a thread of its own (asynchronous module) or
+blocking the caller (synchronous module). It is used by the
+:py:class:`~esgfpid.asyncconnector.AsyncConnector`.
+
+Every message that is sent gets an asyncio future, which is
+resolved once RabbitMQ confirmed it (ack), or which gets an exception
+if it was not delivered:
+
+ * MessageNotDeliveredException if RabbitMQ rejected it (nack), or
+   returned it a second time (with the emergency routing key), or if
+   the connection was closed by the library caller before it was
+   confirmed.
+ * PIDServerException if no RabbitMQ node could be reached (after
+   trying all nodes RABBIT_RECONNECTION_MAX_TRIES times).
+
+All messages share one connection and channel, so any number of
+concurrent publications can use it without a thread (or connection)
+each. The connection is opened when the first message is sent. The
+nodes are tried in the order of the NodeManager. If the connection
+is lost, the unconfirmed messages are published again on the next
+one (so they may arrive twice, which the consumer copes with).
+
+It is not thread-safe: All methods have to be called from the event
+loop (the one that was running when the first message was sent).
+
+API:
+ * send_message_to_queue() and send_many_messages_to_queue() return
+   the futures.
+ * close() closes the connection, returns a future.
+ * FutureCollector collects all futures created in the current
+   context (so that the AsyncConnector can wait for the messages
+   of one operation, without the assistants having to pass them on).
+
+'''
+
+_COLLECTED_FUTURES = contextvars.ContextVar('esgfpid_collected_futures', default=None)
+
+'''
+Context manager that collects the futures of all messages sent
+while it is active (in the current context, i.e. asyncio task).
+
+Usage:
+    with FutureCollector() as futures:
+        ... # send messages
+    await asyncio.gather(*futures)
+'''
+class FutureCollector(object):
+
+    def __enter__(self):
+        futures = []
+        self.__token = _COLLECTED_FUTURES.set(futures)
+        return futures
+
+    def __exit__(self, *unused):
+        _COLLECTED_FUTURES.reset(self.__token)
+        return False
+
+class AioRabbitConnector(object):
+
+    '''
+    :param nodemanager: NodeManager object that contains the
+        info about all the available RabbitMQ instances.
+    '''
+    def __init__(self, nodemanager):
+        self.__nodemanager = nodemanager
+        self.__loop = None
+        self.__connection = None
+        self.__channel = None
+
+        ''' Ready for publishing (channel in confirm mode)? '''
+        self.__ready = False
+
+        ''' Opening a connection (or waiting to reconnect)? '''
+        self.__connecting = False
+
+        ''' Closing on request of the library caller? '''
+        self.__closing = False
+        self.__close_futures = []
+
+        '''
+        Messages that still have to be published, and messages
+        that wait for their confirm (by delivery tag). Each entry
+        is a list [routing key, body, future, returned], where
+        "returned" is set if RabbitMQ returned it as unroutable
+        (it will still be confirmed).
+        '''
+        self.__unpublished = collections.deque()
+        self.__unconfirmed = collections.OrderedDict()
+        self.__delivery_number = 0
+
+        self.__reconnect_counter = 0
+        self.__start_connect_time = None
+
+    ###############
+    ### Sending ###
+    ###############
+
+    '''
+    :param message: JSON message as string or dictionary (see
+        :func:`~rabbit.RabbitMessageSender.send_message_to_queue`).
+    :return: An asyncio future, resolved when the message
+        was confirmed by RabbitMQ.
+    '''
+    def send_message_to_queue(self, message):
+        return self.send_many_messages_to_queue([message])[0]
+
+    '''
+    :param messages: List of JSON messages.
+    :return: List of asyncio futures, one per message.
+    '''
+    def send_many_messages_to_queue(self, messages):
+        loop = self.__get_loop()
+        collected = _COLLECTED_FUTURES.get()
+        futures = []
+        for message in messages:
+            routing_key, msg_string = rabbitutils.get_routing_key_and_string_message_from_message_if_possible(message)
+            future = loop.create_future()
+            self.__unpublished.append([routing_key, msg_string, future, False])
+            futures.append(future)
+        if collected is not None:
+            collected.extend(futures)
+        logtrace(LOGGER, 'Added %i messages. Now %i unpublished and %i unconfirmed.',
+            len(futures), len(self.__unpublished), len(self.__unconfirmed))
+
+        if self.__ready:
+            self.__publish_unpublished()
+        elif not self.__connecting:
+            self.__connecting = True
+            self.__connect()
+        return futures
+
+    def get_num_unpublished(self):
+        return len(self.__unpublished)
+
+    def get_num_unconfirmed(self):
+        return len(self.__unconfirmed)
+
+    '''
+    Close the connection. Messages that were not confirmed yet
+    get a MessageNotDeliveredException. The connector can still
+    be used afterwards (it connects again).
+
+    :return: An asyncio future, resolved when the connection
+        is closed.
+    '''
+    def close(self):
+        future = self.__get_loop().create_future()
+        if self.__connection is None or self.__connection.is_closed:
+            self.__connecting = False
+            self.__fail_all('The connection to RabbitMQ was closed by the library caller.')
+            future.set_result(None)
+            return future
+        self.__close_futures.append(future)
+        if not self.__closing:
+            loginfo(LOGGER, 'Closing asyncio connection to RabbitMQ (%i unpublished, %i unconfirmed messages).',
+                len(self.__unpublished), len(self.__unconfirmed))
+            self.__closing = True
+            if not self.__connection.is_closing:
+                self.__connection.close()
+        return future
+
+    def __get_loop(self):
+        loop = asyncio.get_event_loop()
+        if self.__loop is not loop:
+            if self.__connection is not None:
+                raise RuntimeError('The asyncio connection to RabbitMQ belongs to a different event loop.')
+            self.__loop = loop
+        return self.__loop
+
+    def __publish_unpublished(self):
+        exchange_name = self.__nodemanager.get_exchange_name()
+        properties = self.__nodemanager.get_properties_for_message_publications()
+        while self.__ready and len(self.__unpublished) > 0:
+            entry = self.__unpublished.popleft()
+            if entry[2].done():
+                continue # Cancelled by the library caller
+            routing_key = self.__nodemanager.adapt_routing_key_for_untrusted(entry[0])
+            try:
+                self.__channel.basic_publish(
+                    exchange=exchange_name,
+                    routing_key=routing_key,
+                    body=entry[1],
+                    properties=properties,
+                    mandatory=defaults.RABBIT_MANDATORY_DELIVERY
+                )
+            except pika.exceptions.AMQPError as e:
+                # The close callbacks take care of reconnecting:
+                logdebug(LOGGER, 'Publishing failed (%s), keeping the message.', e.__class__.__name__)
+                self.__unpublished.appendleft(entry)
+                break
+            self.__delivery_number += 1
+            self.__unconfirmed[self.__delivery_number] = entry
+
+    #####################
+    ### Confirmations ###
+    #####################
+
+    def on_delivery_confirmation(self, method_frame):
+        confirmation_type = method_frame.method.NAME.split('.')[1].lower()
+        delivery_tag = method_frame.method.delivery_tag
+        if method_frame.method.multiple:
+            tags = [tag for tag in self.__unconfirmed if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        logtrace(LOGGER, 'Received %s for %i messages (delivery tag %i).', confirmation_type, len(tags), delivery_tag)
+
+        resend = False
+        for tag in tags:
+            entry = self.__unconfirmed.pop(tag, None)
+            if entry is None or entry[2].done():
+                continue
+            if confirmation_type != 'ack':
+                logwarn(LOGGER, 'RabbitMQ rejected message %i (%s).', tag, confirmation_type)
+                entry[2].set_exception(MessageNotDeliveredException('RabbitMQ rejected the message.', entry[1]))
+            elif not entry[3]:
+                entry[2].set_result(None)
+            elif entry[0] == esgfpid.utils.RABBIT_EMERGENCY_ROUTING_KEY:
+                errormsg = 'The RabbitMQ node refused a message a second time (with the emergency routing key). Dropping it.'
+                logerror(LOGGER, errormsg)
+                entry[2].set_exception(MessageNotDeliveredException(errormsg, entry[1]))
+            else:
+                self.__unpublished.append(self.__make_emergency_entry(entry))
+                resend = True
+        if resend:
+            self.__publish_unpublished()
+
+    '''
+    Returned messages are confirmed afterwards, so they are only
+    marked here, and resent when the confirm arrives.
+    '''
+    def on_message_returned(self, channel, method, properties, body):
+        for entry in self.__unconfirmed.values():
+            msg_bytes = entry[1] if isinstance(entry[1], bytes) else entry[1].encode('utf-8')
+            if msg_bytes == body and not entry[3]:
+                logdebug(LOGGER, 'RabbitMQ returned a message with routing key "%s" (%s).', entry[0], method.reply_text)
+                entry[3] = True
+                return
+        logwarn(LOGGER, 'RabbitMQ returned a message that is not waiting for its confirm.')
+
+    def __make_emergency_entry(self, entry):
+        body_json = json.loads(entry[1])
+        body_json, new_routing_key = rabbitutils.add_emergency_routing_key(body_json)
+        logerror(LOGGER, 'Refused message with routing key "%s". Resending with "%s".' % (entry[0], new_routing_key))
+        return [new_routing_key, json.dumps(body_json), entry[2], False]
+
+    ##################
+    ### Connection ###
+    ##################
+
+    def __connect(self):
+        if self.__closing:
+            return
+        params = self.__nodemanager.get_connection_parameters()
+        logdebug(LOGGER, 'Connecting to RabbitMQ at %s (asyncio).', params.host)
+        self.__start_connect_time = time.time()
+        self.__connection = self.__make_connection(params)
+
+    def __make_connection(self, params):
+        return pika.adapters.asyncio_connection.AsyncioConnection(
+            params,
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_error,
+            on_close_callback=self.on_connection_closed,
+            custom_ioloop=self.__loop
+        )
+
+    def on_connection_open(self, connection):
+        logdebug(LOGGER, 'Opened connection to RabbitMQ, opening channel.')
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        self.__channel = channel
+        channel.add_on_close_callback(self.on_channel_closed)
+        channel.add_on_return_callback(self.on_message_returned)
+        channel.confirm_delivery(ack_nack_callback=self.on_delivery_confirmation, callback=self.on_confirm_select_ok)
+
+    def on_confirm_select_ok(self, method_frame):
+        connect_seconds = time.time() - self.__start_connect_time
+        loginfo(LOGGER, 'Ready to publish to RabbitMQ at %s (after %.3f seconds).',
+            self.__nodemanager.get_connection_parameters().host, connect_seconds)
+        self.__nodemanager.report_success_of_current(connect_seconds)
+        self.__reconnect_counter = 0
+        self.__delivery_number = 0
+        self.__connecting = False
+        self.__ready = True
+        self.__publish_unpublished()
+
+    def on_channel_closed(self, channel, reason):
+        self.__ready = False
+        if self.__closing:
+            return
+        logwarn(LOGGER, 'Channel to RabbitMQ was closed (%s). Closing the connection.', reason)
+        if self.__connection is not None and not (self.__connection.is_closing or self.__connection.is_closed):
+            self.__connection.close()
+
+    def on_connection_error(self, connection, error):
+        if self.__closing:
+            self.__finish_closing()
+            return
+        logwarn(LOGGER, 'Failed connecting to RabbitMQ at %s (%s: %s).',
+            self.__nodemanager.get_connection_parameters().host, error.__class__.__name__, error)
+        self.__on_connection_lost()
+
+    def on_connection_closed(self, connection, reason):
+        if self.__closing:
+            self.__finish_closing()
+            return
+        logwarn(LOGGER, 'Connection to RabbitMQ was closed (%s).', reason)
+        self.__on_connection_lost()
+
+    def __on_connection_lost(self):
+        self.__ready = False
+        self.__connection = None
+        self.__channel = None
+        self.__nodemanager.report_failure_of_current()
+
+        # Unconfirmed messages are published again, in their order:
+        requeue = list(self.__unconfirmed.values())
+        self.__unconfirmed.clear()
+        self.__unpublished.extendleft(reversed(requeue))
+
+        if len(self.__unpublished) == 0:
+            logdebug(LOGGER, 'No messages pending, reconnecting when the next one is sent.')
+            self.__connecting = False
+            self.__nodemanager.reset_nodes()
+            return
+
+        self.__connecting = True
+        if self.__nodemanager.has_more_urls():
+            self.__nodemanager.set_next_host()
+            self.__connect()
+            return
+
+        self.__reconnect_counter += 1
+        if self.__reconnect_counter <= defaults.RABBIT_RECONNECTION_MAX_TRIES:
+            wait_seconds = rabbitutils.get_reconnection_wait_seconds(self.__reconnect_counter)
+            loginfo(LOGGER, 'Failed connecting to all RabbitMQ nodes. Trying again in %s seconds.', wait_seconds)
+            self.__nodemanager.reset_nodes()
+            self.__loop.call_later(wait_seconds, self.__connect)
+            return
+
+        errormsg = 'Permanently failed to connect to RabbitMQ. Tried all hosts %i times. Giving up.' % defaults.RABBIT_RECONNECTION_MAX_TRIES
+        logerror(LOGGER, errormsg)
+        self.__reconnect_counter = 0
+        self.__connecting = False
+        self.__nodemanager.reset_nodes()
+        self.__fail_all(errormsg, PIDServerException)
+
+    def __finish_closing(self):
+        loginfo(LOGGER, 'Closed asyncio connection to RabbitMQ.')
+        self.__ready = False
+        self.__connecting = False
+        self.__closing = False
+        self.__connection = None
+        self.__channel = None
+        self.__fail_all('The connection to RabbitMQ was closed by the library caller.')
+        close_futures = self.__close_futures
+        self.__close_futures = []
+        for future in close_futures:
+            if not future.done():
+                future.set_result(None)
+
+    def __fail_all(self, errormsg, exception_class=None):
+        entries = list(self.__unconfirmed.values()) + list(self.__unpublished)
+        self.__unconfirmed.clear()
+        self.__unpublished.clear()
+        num = 0
+        for entry in entries:
+            if entry[2].done():
+                continue
+            num += 1
+            if exception_class is None:
+                entry[2].set_exception(MessageNotDeliveredException(errormsg, entry[1]))
+            else:
+                entry[2].set_exception(exception_class(errormsg))
+        if num > 0:
+            logwarn(LOGGER, '%i messages were not delivered: %s', num, errormsg)
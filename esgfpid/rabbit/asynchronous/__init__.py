@@ -1,2 +1,3 @@
 
 from .asynchronous import AsynchronousRabbitConnector
+from .distributor import DistributingRabbitConnector
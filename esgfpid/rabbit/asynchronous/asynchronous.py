@@ -14,6 +14,17 @@ the connection to the server.
 Then, the messages can be sent using "send_message_to_queue()" or
 "send_many_messages()".
 
+Optionally, the number of messages in flight (waiting to be published
+or to be confirmed) can be limited, so that the memory does not grow
+without limit if RabbitMQ is slow (see limiter.py).
+
+Optionally, a metrics registry records how long the messages wait
+and how many were confirmed, rejected or returned (see metrics.py).
+
+If the messages carry delivery futures (see delivery.py), the futures
+of messages that are refused, dropped or still pending when the thread
+is finished are resolved as not delivered here.
+
 After the messaging business is done, it is necessary to close the
 thread by calling "finish_rabbit_thread()" or "force_finish_rabbit_thread()".
 
@@ -36,10 +47,17 @@ import copy
 import datetime
 import logging
 import esgfpid.utils
+import esgfpid.exceptions
+import esgfpid.defaults as defaults
+import esgfpid.utils.logutils as logutils
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
 from .rabbitthread import RabbitThread
 from .thread_statemachine import StateMachine
+from .spool import MessageSpool
+from .limiter import InFlightLimiter
+from .messagequeue import MessageQueue
 from .exceptions import OperationNotAllowed
+from .. import delivery
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -55,9 +73,28 @@ class AsynchronousRabbitConnector(object):
     :param node_manager: NodeManager object that contains 
         the info about all the available RabbitMQ instances,
         their credentials, their priorities.
+    :param spool_file: Optional. Path of a file in which the
+        messages are kept until they are confirmed, so they
+        can be replayed after a crash (see spool.py).
+    :param max_in_flight: Optional. Maximum number of messages
+        that may be waiting to be published or confirmed at a
+        time. Defaults to no limit.
+    :param overflow_policy: Optional. What to do with messages
+        that exceed the limit: "block", "raise" or "spill" (see
+        limiter.py).
+    :param overflow_timeout_seconds: Optional. How long to block
+        at most if the limit is reached (policy "block").
+    :param num_channels: Optional. On how many channels of the
+        connection to publish (round-robin). Each channel waits
+        for its own confirms, so they can overlap. Defaults to 1.
+    :param metrics: Optional. PublishMetrics object to record
+        the publication metrics in. May be shared by several
+        connectors.
+    :raises: esgfpid.exceptions.ArgumentError: If the limit, the
+        policy or the number of channels are not valid.
 
     '''
-    def __init__(self, node_manager):
+    def __init__(self, node_manager, spool_file=None, max_in_flight=None, overflow_policy=None, overflow_timeout_seconds=None, num_channels=None, metrics=None):
         logdebug(LOGGER, 'Initializing rabbit connector...')
 
         '''
@@ -74,21 +111,79 @@ class AsynchronousRabbitConnector(object):
 
         # Shared objects
         self.__statemachine = StateMachine()
-        self.__unpublished_messages_queue = queue.Queue()
+        self.__unpublished_messages_queue = MessageQueue()
+
+        '''
+        Optional spool file, to keep the messages on disk until
+        they are confirmed. Written to by the main thread (messages
+        that are put into the queue) and by the rabbit thread (acks).
+        '''
+        self.__spool = None
+        if spool_file is not None:
+            self.__spool = MessageSpool(spool_file)
+
+        '''
+        Optional limiter for the number of messages in flight.
+        Used by the main thread (to put messages) and by the
+        rabbit thread (to notify about confirms).
+        '''
+        self.__limiter = self.__create_limiter(max_in_flight, overflow_policy, overflow_timeout_seconds)
 
         # Log flags
         self.__first_message_receival = True
         self.__logcounter_received = 1
         self.__LOGFREQUENCY = 10
 
+        '''
+        Number of channels the thread publishes on.
+        '''
+        if num_channels is None:
+            num_channels = defaults.RABBIT_ASYN_NUM_CHANNELS
+        if num_channels < 1:
+            raise esgfpid.exceptions.ArgumentError('Number of channels must be at least 1, got %s' % num_channels)
+        self.__num_channels = num_channels
+
+        '''
+        Optional metrics registry. Told about every new message
+        here, and about everything else by the rabbit thread.
+        '''
+        self.__metrics = metrics
+
         # Actually created the thread:
         #self.__thread = RabbitThread(self.__statemachine, self.__unpublished_messages_queue, self, node_manager)
         self.__thread = self.__create_thread(node_manager)
+        self.__add_gauges()
 
         logdebug(LOGGER, 'Initializing rabbit connector... done.')
 
     def __create_thread(self, node_manager): # easy to mock/patch in unit test!
-        return RabbitThread(self.__statemachine, self.__unpublished_messages_queue, self, node_manager)
+        return RabbitThread(self.__statemachine, self.__unpublished_messages_queue, self, node_manager, self.__spool, self.__num_channels, self.__metrics)
+
+    def __add_gauges(self):
+        if self.__metrics is not None:
+            self.__metrics.add_gauge('messages_unpublished', self.__unpublished_messages_queue.qsize)
+            self.__metrics.add_gauge('messages_unconfirmed', self.__thread.get_num_unconfirmed)
+            if self.__limiter is not None:
+                self.__metrics.add_gauge('messages_spilled', self.__limiter.get_num_spilled)
+
+    def __create_limiter(self, max_in_flight, overflow_policy, overflow_timeout_seconds):
+        if max_in_flight is None:
+            max_in_flight = defaults.RABBIT_ASYN_MAX_IN_FLIGHT
+        if max_in_flight is None:
+            return None
+        if overflow_policy is None:
+            overflow_policy = defaults.RABBIT_ASYN_OVERFLOW_POLICY
+        if overflow_timeout_seconds is None:
+            overflow_timeout_seconds = defaults.RABBIT_ASYN_OVERFLOW_TIMEOUT_SECONDS
+        return InFlightLimiter(max_in_flight, overflow_policy, overflow_timeout_seconds, self.get_num_in_flight)
+
+    '''
+    Number of messages that are waiting to be published or
+    to be confirmed. Used by the limiter, and by the
+    DistributingRabbitConnector to find the least busy node.
+    '''
+    def get_num_in_flight(self):
+        return self.__unpublished_messages_queue.qsize() + self.__thread.get_num_unconfirmed()
 
 
     '''
@@ -108,12 +203,23 @@ class AsynchronousRabbitConnector(object):
     * Testing of the library is easier.
     * If starting needs to be called explicitly, it is less likely that the stopping is forgotten, so abandoned connections and unjoined threads are avoided.
 
+    If a spool file is used, the messages that were not confirmed
+    in an earlier run are put into the queue, to be published as
+    soon as the connection is ready.
+
     '''
     def start_rabbit_thread(self):
         self.__not_started_yet = False
         self.__statemachine.set_to_waiting_to_be_available()
+        self.__replay_spool()
         self.__thread.start()
 
+    def __replay_spool(self):
+        if self.__spool is not None:
+            replayed = self.__spool.open()
+            self.__record_enqueued(replayed, True)
+            self.__unpublished_messages_queue.put_many(replayed)
+
     #################
     ### Finishing ###
     #################
@@ -121,6 +227,13 @@ class AsynchronousRabbitConnector(object):
     def is_finished(self):
         return (not self.__thread.is_alive())
 
+    '''
+    Whether new messages are accepted (i.e. the thread was
+    started, and is neither closing nor gave up connecting).
+    '''
+    def is_accepting_messages(self):
+        return self.__statemachine.is_WAITING_TO_BE_AVAILABLE() or self.__statemachine.is_AVAILABLE()
+
     '''
     "Gentle" finish of the thread.
     If any messages are not published or confirmed yet, the
@@ -185,6 +298,20 @@ class AsynchronousRabbitConnector(object):
                 self.__rescue_leftovers()
             else:
                 logerror(LOGGER, 'Joining failed again. No idea why.')
+        self.__close_spool()
+        self.__close_limiter()
+
+    '''
+    The messages that are not confirmed remain in the spool file,
+    to be replayed at the next start.
+    '''
+    def __close_spool(self):
+        if self.__spool is not None:
+            self.__spool.close()
+
+    def __close_limiter(self):
+        if self.__limiter is not None:
+            self.__limiter.close()
 
     def __join(self, timeout_seconds):        
         logdebug(LOGGER, 'Joining...')
@@ -212,6 +339,10 @@ class AsynchronousRabbitConnector(object):
         self.__rescue_unpublished_messages()
         self.__rescue_nacked_messages()
         self.__rescue_unconfirmed_messages()
+        delivery.set_not_delivered(self.__leftovers_unpublished, 'The message was not published before the messaging thread was finished')
+        delivery.set_not_delivered(self.__leftovers_unconfirmed, 'The message was not confirmed before the messaging thread was finished')
+        if self.__metrics is not None:
+            self.__metrics.on_messages_left_over(self.__leftovers_unconfirmed)
         logdebug(LOGGER, 'Storing unpublished/unconfirmed messages... done.')      
 
     def __rescue_unpublished_messages(self):
@@ -219,6 +350,12 @@ class AsynchronousRabbitConnector(object):
             logwarn(LOGGER, 'Cannot retrieve unpublished messages while thread still alive.')
         else:
             self.__leftovers_unpublished = self.__get_unpublished_messages_as_list()
+            if self.__limiter is not None:
+                spilled = self.__limiter.get_spilled_messages()
+                if self.__spool is not None:
+                    # Never entered the queue, so not spooled yet:
+                    self.__spool.put_many(spilled)
+                self.__leftovers_unpublished += spilled
             num = len(self.__leftovers_unpublished)
             if num > 0:
                 logdebug(LOGGER, 'Rescued %i unpublished messages.', num)
@@ -295,6 +432,8 @@ class AsynchronousRabbitConnector(object):
     :param message: JSON message to be published.
     :raises: OperationNotAllowed: If the rabbit thread was not started yet
     or stopped again.
+    :raises: esgfpid.exceptions.MessageQueueFullException: If the maximum
+    number of messages in flight was reached (depending on the policy).
     '''
     def send_message_to_queue(self, message):
         if self.__not_started_yet:
@@ -305,7 +444,7 @@ class AsynchronousRabbitConnector(object):
             # Note: This exception is only thrown if the code that calls the library does
             # it wrong. So we throw this exception to remind the developer to start the rabbit
             # before using it.
-        self.__send_a_message(message)
+        self.__send_a_message(message, True)
 
     '''
     Send many JSON messages to RabbitMQ.
@@ -313,6 +452,10 @@ class AsynchronousRabbitConnector(object):
     :param list_of_messages: List of JSON message to be published.
     :raises: OperationNotAllowed: If the rabbit thread was not started yet
     or stopped again.
+    :raises: esgfpid.exceptions.MessageQueueFullException: If the maximum
+    number of messages in flight was reached (depending on the policy).
+    Some of the messages may have been accepted, the others are attached
+    to the exception.
     '''
     def send_many_messages_to_queue(self, list_of_messages):
         if self.__not_started_yet:
@@ -320,22 +463,32 @@ class AsynchronousRabbitConnector(object):
                    '(Please call the PID connector\'s "start_messaging_thread()" before trying '+
                    'to send messages, and do not forget to "finish_messaging_thread()" afterwards.')
             raise OperationNotAllowed(msg)
-        self.__send_many_messages(list_of_messages)
+        self.__send_many_messages(list_of_messages, True)
 
-    def __send_a_message(self, message):
-        if self.__statemachine.is_WAITING_TO_BE_AVAILABLE():
-            self.__log_receival_one_message(message)
-            self.__put_one_message_into_queue_of_unsent_messages(message)
+    '''
+    Put messages back into the queue, e.g. unconfirmed messages
+    after a reconnection, or returned messages.
 
-        elif self.__statemachine.is_AVAILABLE():
+    Called by the rabbit thread. These messages are not subject
+    to the limit of messages in flight, as they were already
+    counted, and as the rabbit thread must never block.
+    '''
+    def resend_message_to_queue(self, message):
+        self.__send_a_message(message, False)
+
+    def resend_many_messages_to_queue(self, list_of_messages):
+        self.__send_many_messages(list_of_messages, False)
+
+    def __send_a_message(self, message, within_limit):
+        if self.__statemachine.is_WAITING_TO_BE_AVAILABLE() or self.__statemachine.is_AVAILABLE():
             self.__log_receival_one_message(message)
-            self.__put_one_message_into_queue_of_unsent_messages(message)
-            self.__trigger_one_publish_action()
+            self.__put_one_message_into_queue_of_unsent_messages(message, within_limit)
 
         elif self.__statemachine.is_AVAILABLE_BUT_WANTS_TO_STOP() or self.__statemachine.is_PERMANENTLY_UNAVAILABLE() or self.__statemachine.is_FORCE_FINISHED():
             errormsg = 'Accepting no more messages'
             logdebug(LOGGER, errormsg+' (dropping %s).', message)
             logwarn(LOGGER, 'RabbitMQ module was closed and does not accept any more messages. Dropping message. Reason: %s', self.__statemachine.get_reason_shutdown())
+            delivery.set_not_delivered([message], errormsg)
             # Note: This may happen if the connection failed. We may not stop
             # the publisher in this case, so we do not raise an exception.
             # We only raise an exception if the closing was asked by the publisher!
@@ -349,19 +502,15 @@ class AsynchronousRabbitConnector(object):
             # This is almost the same as the one raised if self.__not_started_yet is True.
 
 
-    def __send_many_messages(self, messages):
-        if self.__statemachine.is_WAITING_TO_BE_AVAILABLE():
+    def __send_many_messages(self, messages, within_limit):
+        if self.__statemachine.is_WAITING_TO_BE_AVAILABLE() or self.__statemachine.is_AVAILABLE():
             self.__log_receival_many_messages(messages)
-            self.__put_all_messages_into_queue_of_unsent_messages(messages)
-
-        elif self.__statemachine.is_AVAILABLE():
-            self.__log_receival_many_messages(messages)
-            self.__put_all_messages_into_queue_of_unsent_messages(messages)
-            self.__trigger_n_publish_actions(len(messages))
+            self.__put_all_messages_into_queue_of_unsent_messages(messages, within_limit)
 
         elif self.__statemachine.is_AVAILABLE_BUT_WANTS_TO_STOP() or self.__statemachine.is_PERMANENTLY_UNAVAILABLE() or self.__statemachine.is_FORCE_FINISHED():
             errormsg = 'Accepting no more messages'
             logwarn(LOGGER, errormsg+' (dropping %i messages).', len(messages))
+            delivery.set_not_delivered(messages, errormsg)
             if self.__statemachine.get_detail_closed_by_publisher():
                 raise OperationNotAllowed(errormsg)
 
@@ -370,15 +519,17 @@ class AsynchronousRabbitConnector(object):
             logwarn(LOGGER, errormsg+' (dropping %i messages).', len(messages))
             raise OperationNotAllowed(errormsg)
 
-    def __put_one_message_into_queue_of_unsent_messages(self, message):
+    def __put_one_message_into_queue_of_unsent_messages(self, message, within_limit):
         logtrace(LOGGER, 'Putting a message into stack that waits to be published...')
-        self.__unpublished_messages_queue.put(message, block=False)
+        self.__record_enqueued([message], within_limit)
+        self.__put_into_queue([message], within_limit)
 
     def __log_receival_one_message(self, message):
         if self.__first_message_receival:
             logdebug(LOGGER, 'Handing over first message to rabbit thread...')
             self.__first_message_receival = False
-        logtrace(LOGGER, 'Handing over one message over to the rabbit thread (%s)', message)
+        if logutils.TRACE_ENABLED:
+            logtrace(LOGGER, 'Handing over one message over to the rabbit thread (%s)', message)
         log_every_x_times(LOGGER, self.__logcounter_received, self.__LOGFREQUENCY, 'Handing over one message over to the rabbit thread (no. %i).', self.__logcounter_received)
         self.__logcounter_received += 1
 
@@ -389,21 +540,68 @@ class AsynchronousRabbitConnector(object):
         logdebug(LOGGER, 'Batch sending: Handing %i messages over to the sender.', len(messages))
         self.__logcounter_received += len(messages)
 
-    def __put_all_messages_into_queue_of_unsent_messages(self, messages):
-        counter = 1
-        for message in messages:
-            logtrace(LOGGER, 'Adding message %i/%i to stack to be sent.', counter, len(messages))
-            counter += 1
-            self.__put_one_message_into_queue_of_unsent_messages(message)
+    def __put_all_messages_into_queue_of_unsent_messages(self, messages, within_limit):
+        self.__record_enqueued(messages, within_limit)
+        self.__put_into_queue(messages, within_limit)
+
+    '''
+    Only new messages are recorded, not the ones that are put
+    back by the rabbit thread (which were recorded already).
+    The time spent waiting for the limiter counts as queue time.
+    '''
+    def __record_enqueued(self, messages, is_new):
+        if is_new and self.__metrics is not None:
+            self.__metrics.on_messages_enqueued(messages)
+
+    def __put_into_queue(self, messages, within_limit):
+        if within_limit and self.__limiter is not None:
+            try:
+                self.__limiter.put_many(messages, self.__spool_and_put_into_queue)
+            except esgfpid.exceptions.MessageQueueFullException as e:
+                if self.__metrics is not None:
+                    self.__metrics.on_messages_refused(e.undelivered_messages)
+                delivery.set_not_delivered(e.undelivered_messages, e.msg)
+                raise e
+        else:
+            self.__spool_and_put_into_queue(messages)
+
+    '''
+    Only the messages that enter the queue are recorded in the
+    spool, so messages refused by the limiter are not replayed
+    later. Spilled messages are recorded when they are moved
+    from the spill file to the queue (as the objects read from
+    the spill file, which are the ones that are acked later).
+    '''
+    def __spool_and_put_into_queue(self, messages):
+        if self.__spool is not None:
+            self.__spool.put_many(messages)
+        self.__put_into_queue_and_trigger(messages)
+
+    '''
+    Puts the messages into the queue. If the thread is available,
+    it is triggered to publish them. Otherwise, this is done by
+    the builder once the connection is ready.
+
+    The whole list is put at once, and the thread is woken up only
+    once, no matter how many messages there are.
+    '''
+    def __put_into_queue_and_trigger(self, messages):
+        logtrace(LOGGER, 'Adding %i messages to stack to be sent.', len(messages))
+        self.__unpublished_messages_queue.put_many(messages)
+        if self.__statemachine.is_AVAILABLE():
+            self.__trigger_one_publish_action()
 
     def __trigger_one_publish_action(self):
         self.__thread.add_event_publish_message()
 
-    def __trigger_n_publish_actions(self, num_messages_to_publish):
-        logdebug(LOGGER, 'Asking rabbit thread to publish %i messages...', num_messages_to_publish)
-        to_be_sure = 10
-        for i in range(num_messages_to_publish+to_be_sure):
-            self.__thread.add_event_publish_message()
+    '''
+    Called by the rabbit thread whenever messages were confirmed,
+    so that publishers that wait for the limit can continue, and
+    spilled messages are moved to the queue.
+    '''
+    def on_messages_confirmed(self):
+        if self.__limiter is not None:
+            self.__limiter.on_messages_confirmed(self.__spool_and_put_into_queue)
 
 
     ###############
@@ -0,0 +1,163 @@
+import logging
+import esgfpid.exceptions
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+from .asynchronous import AsynchronousRabbitConnector
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+STRATEGY_ROUND_ROBIN = 'round_robin'
+STRATEGY_LEAST_UNCONFIRMED = 'least_unconfirmed'
+STRATEGIES = [STRATEGY_ROUND_ROBIN, STRATEGY_LEAST_UNCONFIRMED]
+
+'''
+===========
+Distributor
+===========
+
+Normally, the asynchronous sender is connected to one RabbitMQ node
+at a time, and the other nodes are only used if this one fails.
+
+The DistributingRabbitConnector is connected to several nodes at
+once (to all trusted nodes of the highest priority), to use their
+combined capacity. It has one AsynchronousRabbitConnector per node,
+each with its own thread, connection, feeder and confirmer. If one
+of the nodes fails, its connector fails over to the other nodes as
+usual (see NodeManager.make_node_managers_for_active_nodes()).
+
+The messages are distributed according to the strategy:
+ * "round_robin": Weighted round-robin. A node with weight 2 gets
+   twice as many messages as a node with weight 1.
+ * "least_unconfirmed": Each message goes to the node with the
+   fewest messages waiting to be published or confirmed.
+
+Connectors that do not accept messages anymore (e.g. because they
+gave up connecting) are skipped. Note that the order of the messages
+is only kept per node.
+
+It has the same API as the AsynchronousRabbitConnector, so the
+RabbitMessageSender can use either of them.
+
+'''
+class DistributingRabbitConnector(object):
+
+    '''
+    :param node_managers_and_weights: List of tuples (NodeManager,
+        weight), one per node to connect to.
+    :param strategy: Optional. "round_robin" or "least_unconfirmed".
+        Defaults to "round_robin".
+    :param spool_file: Optional. Path of the spool file. Every node
+        gets its own file, with the node's index appended.
+    :param connector_args: Any other args are passed to each
+        AsynchronousRabbitConnector.
+    :raises: esgfpid.exceptions.ArgumentError: If the strategy
+        is not valid.
+    '''
+    def __init__(self, node_managers_and_weights, strategy=None, spool_file=None, **connector_args):
+        if strategy is None:
+            strategy = STRATEGY_ROUND_ROBIN
+        if strategy not in STRATEGIES:
+            raise esgfpid.exceptions.ArgumentError('Unknown distribution strategy "%s", expected one of %s' % (strategy, STRATEGIES))
+        self.__strategy = strategy
+
+        self.__connectors = []
+        self.__weights = []
+        for i, (node_manager, weight) in enumerate(node_managers_and_weights):
+            node_spool_file = None
+            if spool_file is not None:
+                node_spool_file = '%s.%i' % (spool_file, i)
+            self.__connectors.append(self.__create_connector(node_manager, node_spool_file, connector_args))
+            self.__weights.append(weight)
+
+        '''
+        For the smooth weighted round-robin: The current weight
+        of each connector. The connector with the highest one
+        gets the next message, then its current weight is
+        decreased by the sum of all weights.
+        '''
+        self.__current_weights = [0]*len(self.__connectors)
+
+        loginfo(LOGGER, 'Distributing messages over %i RabbitMQ nodes (strategy "%s").', len(self.__connectors), self.__strategy)
+
+    def __create_connector(self, node_manager, spool_file, connector_args): # easy to mock/patch in unit test!
+        return AsynchronousRabbitConnector(node_manager, spool_file=spool_file, **connector_args)
+
+    #################
+    ### Lifecycle ###
+    #################
+
+    def start_rabbit_thread(self):
+        for connector in self.__connectors:
+            connector.start_rabbit_thread()
+
+    '''
+    Finishes the connectors one after the other. As they all
+    keep publishing in the meantime, the later ones usually
+    do not have to wait long.
+    '''
+    def finish_rabbit_thread(self):
+        for connector in self.__connectors:
+            connector.finish_rabbit_thread()
+
+    def force_finish_rabbit_thread(self):
+        for connector in self.__connectors:
+            connector.force_finish_rabbit_thread()
+
+    def is_finished(self):
+        return all(connector.is_finished() for connector in self.__connectors)
+
+    ###############
+    ### Sending ###
+    ###############
+
+    def send_message_to_queue(self, message):
+        index = self.__choose_connectors(1)[0]
+        self.__connectors[index].send_message_to_queue(message)
+
+    '''
+    The messages are grouped by connector, so every connector
+    gets its share all at once.
+    '''
+    def send_many_messages_to_queue(self, list_of_messages):
+        shares = [[] for connector in self.__connectors]
+        indices = self.__choose_connectors(len(list_of_messages))
+        for index, message in zip(indices, list_of_messages):
+            shares[index].append(message)
+        for index, share in enumerate(shares):
+            if len(share) > 0:
+                logtrace(LOGGER, 'Handing %i messages to node %i.', len(share), index)
+                self.__connectors[index].send_many_messages_to_queue(share)
+
+    '''
+    :return: List of connector indices, one per message.
+    '''
+    def __choose_connectors(self, num_messages):
+        candidates = [i for i, connector in enumerate(self.__connectors) if connector.is_accepting_messages()]
+        if len(candidates) == 0:
+            # Let the first one raise or drop, as usual:
+            logwarn(LOGGER, 'None of the RabbitMQ nodes accepts messages.')
+            return [0]*num_messages
+
+        if self.__strategy == STRATEGY_LEAST_UNCONFIRMED:
+            return self.__choose_least_unconfirmed(candidates, num_messages)
+        return self.__choose_round_robin(candidates, num_messages)
+
+    def __choose_round_robin(self, candidates, num_messages):
+        total = sum(self.__weights[i] for i in candidates)
+        chosen = []
+        for n in range(num_messages):
+            for i in candidates:
+                self.__current_weights[i] += self.__weights[i]
+            best = max(candidates, key=lambda i: self.__current_weights[i])
+            self.__current_weights[best] -= total
+            chosen.append(best)
+        return chosen
+
+    def __choose_least_unconfirmed(self, candidates, num_messages):
+        in_flight = dict((i, self.__connectors[i].get_num_in_flight()) for i in candidates)
+        chosen = []
+        for n in range(num_messages):
+            best = min(candidates, key=lambda i: in_flight[i])
+            in_flight[best] += 1
+            chosen.append(best)
+        return chosen
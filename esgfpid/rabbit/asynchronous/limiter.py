@@ -0,0 +1,272 @@
+import json
+import time
+import collections
+import logging
+import tempfile
+import threading
+import esgfpid.exceptions
+from .. import rabbitutils
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+POLICY_BLOCK = 'block'
+POLICY_RAISE = 'raise'
+POLICY_SPILL = 'spill'
+POLICIES = [POLICY_BLOCK, POLICY_RAISE, POLICY_SPILL]
+
+'''
+=======
+Limiter
+=======
+
+The limiter caps the number of messages in flight, i.e. the messages
+that are waiting in the queue to be published plus the messages that
+were published but not confirmed yet, so that the memory does not grow
+without limit if RabbitMQ is slow or not reachable yet.
+
+It does not count by itself, but asks the AsynchronousRabbitConnector
+for the current number of messages in flight, so moving messages
+around inside the rabbit thread (e.g. republishing the unconfirmed
+messages after a reconnection) cannot make the count go wrong.
+
+If the limit is reached, the new messages are handled according to
+the policy:
+ * "block": The publisher has to wait until enough messages were
+   confirmed (or until the timeout is over, then it raises).
+ * "raise": MessageQueueFullException is raised right away.
+ * "spill": The messages are written to a temporary file, and are
+   moved to the queue as soon as enough messages were confirmed.
+   Once messages were spilled, all new messages are spilled too,
+   so that the order is kept.
+
+The messages that are put back into the queue by the rabbit thread
+itself do not pass the limiter, as the rabbit thread must never
+block.
+
+API:
+ * put_many() called by the AsynchronousRabbitConnector (main thread).
+ * on_messages_confirmed() called by the AsynchronousRabbitConnector, when the Confirmer received confirms (rabbit thread).
+ * get_spilled_messages() and close() called by the AsynchronousRabbitConnector after joining the thread.
+
+'''
+class InFlightLimiter(object):
+
+    '''
+    :param max_in_flight: Maximum number of messages in flight.
+    :param policy: What to do if the limit is reached. One of
+        "block", "raise" or "spill".
+    :param timeout_seconds: How long to block at most (only
+        used for policy "block").
+    :param count_function: Function that returns the number
+        of messages in flight.
+    :raises: esgfpid.exceptions.ArgumentError: If the policy
+        or the limit is not valid.
+    '''
+    def __init__(self, max_in_flight, policy, timeout_seconds, count_function):
+        if policy not in POLICIES:
+            raise esgfpid.exceptions.ArgumentError('Unknown overflow policy "%s", expected one of %s' % (policy, POLICIES))
+        if max_in_flight < 1:
+            raise esgfpid.exceptions.ArgumentError('Maximum number of messages in flight must be at least 1, got %s' % max_in_flight)
+
+        self.__max = max_in_flight
+        self.__policy = policy
+        self.__timeout_seconds = timeout_seconds
+        self.__count = count_function
+
+        '''
+        Used by the publisher to wait for confirms, and to make
+        sure that messages are counted and put by one thread at
+        a time. Notified by the rabbit thread on confirms.
+        '''
+        self.__condition = threading.Condition()
+
+        '''
+        Only used for policy "spill".
+        '''
+        self.__spill = None
+        if self.__policy == POLICY_SPILL:
+            self.__spill = SpillFile()
+
+        logdebug(LOGGER, 'Limiting messages in flight to %i (policy "%s").', self.__max, self.__policy)
+
+    def get_num_spilled(self):
+        if self.__spill is None:
+            return 0
+        return self.__spill.get_num_messages()
+
+    '''
+    Hands the messages to the put function, as far as the limit
+    allows. Called from the main thread.
+
+    The put function is called while holding the lock, so the
+    count cannot change between checking and putting (except
+    for confirms, which only decrease it).
+
+    :param messages: List of messages.
+    :param put_function: Function that takes a list of messages
+        and puts them into the queue.
+    :raises: esgfpid.exceptions.MessageQueueFullException: If
+        the messages could not be accepted (policy "raise", or
+        policy "block" after the timeout).
+    '''
+    def put_many(self, messages, put_function):
+        if self.__policy == POLICY_RAISE:
+            self.__put_or_raise(messages, put_function)
+        elif self.__policy == POLICY_BLOCK:
+            self.__put_or_block(messages, put_function)
+        elif self.__policy == POLICY_SPILL:
+            self.__put_or_spill(messages, put_function)
+
+    '''
+    Called from the rabbit thread whenever messages were
+    confirmed. Wakes up the blocked publishers, or moves the
+    spilled messages to the queue, as far as there is room.
+
+    :param put_function: Function that takes a list of messages
+        and puts them into the queue.
+    '''
+    def on_messages_confirmed(self, put_function):
+        with self.__condition:
+            if self.__spill is not None and self.__spill.get_num_messages() > 0:
+                room = self.__get_room()
+                if room > 0:
+                    messages = self.__spill.get_many(room)
+                    logdebug(LOGGER, 'Moving %i spilled messages to the queue (%i left in spill file).', len(messages), self.__spill.get_num_messages())
+                    put_function(messages)
+            self.__condition.notify_all()
+
+    '''
+    Returns and removes all messages that are still in the
+    spill file. Only to be called after the thread was joined.
+    '''
+    def get_spilled_messages(self):
+        with self.__condition:
+            if self.__spill is None:
+                return []
+            return self.__spill.get_many(self.__spill.get_num_messages())
+
+    def close(self):
+        if self.__spill is not None:
+            self.__spill.close()
+
+    ###############
+    ### Helpers ###
+    ###############
+
+    def __get_room(self):
+        return self.__max - self.__count()
+
+    def __put_or_raise(self, messages, put_function):
+        with self.__condition:
+            room = self.__get_room()
+            if len(messages) > room:
+                errormsg = 'Cannot accept %i messages, only room for %i (maximum %i in flight)' % (len(messages), max(room, 0), self.__max)
+                logwarn(LOGGER, errormsg)
+                raise esgfpid.exceptions.MessageQueueFullException(errormsg, messages)
+            put_function(messages)
+
+    '''
+    Puts as many messages as there is room for, then waits for
+    confirms to put the next ones. The deadline applies to all
+    of them together.
+    '''
+    def __put_or_block(self, messages, put_function):
+        deadline = time.time() + self.__timeout_seconds
+        remaining = messages
+        first_wait = True
+        with self.__condition:
+            while len(remaining) > 0:
+                room = self.__get_room()
+                if room > 0:
+                    put_function(remaining[:room])
+                    remaining = remaining[room:]
+                    continue
+
+                wait_seconds = deadline - time.time()
+                if wait_seconds <= 0:
+                    errormsg = 'Waited %s seconds, but %i messages still did not fit (maximum %i in flight)' % (self.__timeout_seconds, len(remaining), self.__max)
+                    logwarn(LOGGER, errormsg)
+                    raise esgfpid.exceptions.MessageQueueFullException(errormsg, remaining)
+                if first_wait:
+                    logdebug(LOGGER, 'Maximum of %i messages in flight reached. Waiting for confirms...', self.__max)
+                    first_wait = False
+                self.__condition.wait(wait_seconds)
+
+    def __put_or_spill(self, messages, put_function):
+        with self.__condition:
+            if self.__spill.get_num_messages() > 0:
+                # Keep the order: Behind the ones already spilled.
+                self.__spill.put_many(messages)
+                return
+            room = max(self.__get_room(), 0)
+            if room > 0:
+                put_function(messages[:room])
+            if len(messages) > room:
+                logdebug(LOGGER, 'Maximum of %i messages in flight reached. Spilling %i messages to disk.', self.__max, len(messages)-room)
+                self.__spill.put_many(messages[room:])
+
+'''
+First-in-first-out store for messages in a temporary file,
+one JSON record per line (see rabbitutils.message_to_record()). It is emptied (and the file
+truncated) whenever all messages were read.
+
+The delivery futures of the messages cannot be written to the file,
+so they are kept in memory, together with the number of the message
+they belong to, and handed over to the messages again when they are
+read. The same is done with the enqueue times (see metrics.py).
+
+Not thread-safe, the InFlightLimiter takes care of locking.
+'''
+class SpillFile(object):
+
+    def __init__(self):
+        self.__file = None
+        self.__read_position = 0
+        self.__num_messages = 0
+        self.__num_written = 0
+        self.__num_read = 0
+        self.__attached = collections.deque() # (number of message, future, enqueue time)
+
+    def get_num_messages(self):
+        return self.__num_messages
+
+    def put_many(self, messages):
+        if self.__file is None:
+            self.__file = tempfile.TemporaryFile(mode='w+')
+            logdebug(LOGGER, 'Created spill file.')
+        self.__file.seek(0, 2)
+        for message in messages:
+            self.__file.write(json.dumps(rabbitutils.message_to_record(message))+'\n')
+            future = getattr(message, 'future', None)
+            enqueued_at = getattr(message, 'enqueued_at', None)
+            if future is not None or enqueued_at is not None:
+                self.__attached.append((self.__num_written, future, enqueued_at))
+            self.__num_written += 1
+        self.__num_messages += len(messages)
+
+    def get_many(self, num):
+        messages = []
+        if self.__num_messages == 0:
+            return messages
+        self.__file.flush()
+        self.__file.seek(self.__read_position)
+        while len(messages) < num and self.__num_messages > 0:
+            message = rabbitutils.message_from_record(json.loads(self.__file.readline()))
+            if len(self.__attached) > 0 and self.__attached[0][0] == self.__num_read:
+                unused, message.future, message.enqueued_at = self.__attached.popleft()
+            messages.append(message)
+            self.__num_messages -= 1
+            self.__num_read += 1
+        self.__read_position = self.__file.tell()
+        if self.__num_messages == 0:
+            self.__file.seek(0)
+            self.__file.truncate()
+            self.__read_position = 0
+        return messages
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
@@ -0,0 +1,28 @@
+import sys
+if sys.version[0] == '2':
+    import Queue as queue
+else:
+    import queue as queue
+
+'''
+Thread-safe Queue for the unpublished messages, shared by the
+main thread (which puts messages) and the rabbit thread (which
+gets and publishes them).
+
+In addition to the standard Queue, it can take a whole list of
+messages at once: put_many() acquires the lock and wakes up a
+waiting consumer only once per list, instead of once per message.
+This matters for bulk publications (e.g. datasets with many files).
+
+The queue is unbounded (the number of messages in flight is
+limited by the InFlightLimiter, if at all).
+'''
+class MessageQueue(queue.Queue):
+
+    def put_many(self, messages):
+        if len(messages) == 0:
+            return
+        with self.not_empty:
+            self.queue.extend(messages)
+            self.unfinished_tasks += len(messages)
+            self.not_empty.notify()
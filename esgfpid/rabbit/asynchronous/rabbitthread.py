@@ -71,7 +71,7 @@ without needed references to each other.
 '''
 class RabbitThread(threading.Thread):
 
-    def __init__(self, statemachine, msg_queue, facade, node_manager):
+    def __init__(self, statemachine, msg_queue, facade, node_manager, spool=None, num_channels=1, metrics=None):
         threading.Thread.__init__(self)
 
         '''
@@ -98,12 +98,18 @@ class RabbitThread(threading.Thread):
         self.__gently_finish_ready = threading.Event()
 
         '''
-        Synchronization event which makes sure the main thread
-        waits for the rabbit thread to be ready for events before
-        sending events, without having to use time.sleep().
+        Events that the main thread added before the rabbit thread
+        was ready to accept them (i.e. before the connection object
+        existed). Instead of making the main thread wait for the
+        connection, they are kept here and handed over to the ioloop
+        in one go once it is ready.
+        Protected by the lock, as the flag that tells whether the
+        events can be handed over directly.
         Shared with the main thread!
         '''
-        self.__connection_is_set = threading.Event()
+        self.__pending_events = []
+        self.__accepting_events = False
+        self.__events_lock = threading.Lock()
         
         '''
         Thread-safe Queue that will contain the unpublished messages.
@@ -133,25 +139,29 @@ class RabbitThread(threading.Thread):
         self._connection = None
 
         '''
-        An object of type "pika.channel.Channel".
+        The objects of type "pika.channel.Channel" that are used
+        for publishing, all on the same connection. Each of them
+        is in confirm mode and has its own delivery tags, so that
+        the confirms of several channels can overlap.
+        The entries are None while a channel is not open.
 
         Used by the feeder for basic_publish, for logging
-        its channel number, and for checking whether it
-        exists (before publishing).
+        their channel numbers, and for checking whether they
+        exist (before publishing).
         '''
-        self._channel = None
+        self._channels = [None]*num_channels
 
         # Submodules that do the actual work:
         self.__nodemanager = node_manager
-        self.__confirmer = Confirmer()
-        self.__returnhandler = UnacceptedMessagesHandler(self)
-        self.__feeder = RabbitFeeder(self, self.__statemachine, self.__nodemanager)
+        self.__confirmers = [Confirmer(self, spool, metrics) for i in range(num_channels)] # one per channel
+        self.__returnhandler = UnacceptedMessagesHandler(self, metrics)
+        self.__feeder = RabbitFeeder(self, self.__statemachine, self.__nodemanager, num_channels, metrics)
         self.__shutter = ShutDowner(self, self.__statemachine)
 
         '''
         Needed to trigger the connection in run()
         '''
-        self.__builder = ConnectionBuilder(self, self.__statemachine, self.__confirmer, self.__returnhandler, self.__shutter, node_manager)
+        self.__builder = ConnectionBuilder(self, self.__statemachine, self.__confirmers, self.__returnhandler, self.__shutter, node_manager, metrics)
 
 
         '''
@@ -199,12 +209,10 @@ class RabbitThread(threading.Thread):
     '''
     def unblock_events(self):
         self.__gently_finish_ready.set()
-        self.__connection_is_set.set()
 
     def add_event_publish_message(self):
         logdebug(LOGGER, 'Asking rabbit thread to publish a message...')
         self.__add_event(self.__feeder.publish_message)
-        self.__add_event(self.__feeder.publish_message) # Send two...
         logdebug(LOGGER, '(Trigger sent.)')
 
     def add_event_force_finish(self):
@@ -236,11 +244,12 @@ class RabbitThread(threading.Thread):
     not using this facade.
 
     :raises: OperationNotAllowed: If the thread is still alive.
-    :return: A list containing all unconfirmed messages.
+    :return: A list containing all unconfirmed messages (of
+        all channels).
     '''
     def get_unconfirmed_messages_as_list_copy(self):
         if not self.is_alive():
-            return self.__confirmer.get_unconfirmed_messages_as_list_copy()
+            return self.__get_unconfirmed_messages(None)
         else:
             raise OperationNotAllowed('thread has not finished','retrieving unconfirmed messages')
 
@@ -257,11 +266,15 @@ class RabbitThread(threading.Thread):
     not using this facade.
 
     :raises: OperationNotAllowed: If the thread is still alive.
-    :return: A list containing all nacked messages.
+    :return: A list containing all nacked messages (of all
+        channels).
     '''
     def get_nacked_messages_as_list(self):
         if not self.is_alive():
-            return self.__confirmer.get_copy_of_nacked()
+            nacked = []
+            for confirmer in self.__confirmers:
+                nacked.extend(confirmer.get_copy_of_nacked())
+            return nacked
         else:
             raise OperationNotAllowed('thread has not finished','retrieving nacked messages')
  
@@ -272,25 +285,22 @@ class RabbitThread(threading.Thread):
 
     '''
     This is how to add an event to the rabbit thread
-    from the main thread. 
+    from the main thread.
+
+    If the main thread adds an event so quickly after starting
+    the thread that not even the connection object is listening
+    for events yet (e.g. for shopping carts, the main thread just
+    sends one message and then wants to close again), the event
+    is kept until the thread is ready, so the main thread does
+    not have to wait for the connection.
     '''
     def __add_event(self, event):
-        if self._connection is not None:
-            self._connection.ioloop.call_later(self.__PUBLISH_INTERVAL_SECONDS, event)
-        else:
-            # If the main thread wants to add an event so quickly after starting the
-            # thread that not even the connection object is listening for events yet,
-            # we need to force it to wait.
-            # Event listening is the first thing that happens when a thread is started,
-            # but e.g. for shopping carts, the main thread just sends one message and
-            # then wants to close again.
-            # In that case, the thread cannot even receive the close event, as it is
-            # not started yet.
-            logdebug(LOGGER, 'Main thread wants to add event to thread that is not ready to receive events yet. Blocking and waiting.')
-            self.__wait_for_thread_to_accept_events()
-            logdebug(LOGGER, 'Thread declared itself ready to receive events.')
-            self._connection.ioloop.call_later(self.__PUBLISH_INTERVAL_SECONDS, event)
-            logerror(LOGGER, 'Added event after having waited for thread to open.')
+        with self.__events_lock:
+            if self.__accepting_events:
+                self._connection.ioloop.call_later(self.__PUBLISH_INTERVAL_SECONDS, event)
+            else:
+                logdebug(LOGGER, 'Main thread wants to add event to thread that is not ready to receive events yet. Keeping it for later.')
+                self.__pending_events.append(event)
 
 
 
@@ -309,13 +319,22 @@ class RabbitThread(threading.Thread):
         self.__gently_finish_ready.wait()
         logdebug(LOGGER, 'Finished waiting for gentle close-down of RabbitMQ connection.')
 
-    def __wait_for_thread_to_accept_events(self):
-        logdebug(LOGGER, 'Now waiting for the connection before I can even close RabbitMQ connection...')
-        self.__connection_is_set.wait()
-
+    '''
+    Called by the builder once the connection object exists,
+    so the ioloop can receive events. Hands over the events that
+    the main thread added in the meantime (in their order), and
+    lets the main thread hand over any further events directly.
+    Executed by the rabbit thread.
+    '''
     def tell_publisher_to_stop_waiting_for_thread_to_accept_events(self):
-        self.__connection_is_set.set()
-        logdebug(LOGGER, 'Finished waiting for thread to start.')
+        with self.__events_lock:
+            if len(self.__pending_events) > 0:
+                logdebug(LOGGER, 'Handing over %i events that were added before the thread was ready.', len(self.__pending_events))
+            for event in self.__pending_events:
+                self._connection.ioloop.call_later(self.__PUBLISH_INTERVAL_SECONDS, event)
+            self.__pending_events = []
+            self.__accepting_events = True
+        logdebug(LOGGER, 'Thread is ready to receive events.')
  
     #
     # Methods called from inside the thread
@@ -348,9 +367,9 @@ class RabbitThread(threading.Thread):
     def get_num_unpublished(self):
         return self.__unpublished_messages_queue.qsize()
 
-    ''' Called by shutter, to check if all messages were confirmed. '''
+    ''' Called by shutter, to check if all messages were confirmed (on all channels). '''
     def get_num_unconfirmed(self):
-        return self.__confirmer.get_num_unconfirmed()
+        return sum(confirmer.get_num_unconfirmed() for confirmer in self.__confirmers)
 
     ''' Called by feeder, to publish a message. May raise queue.Empty. '''
     def get_message_from_unpublished_stack(self, seconds):
@@ -362,31 +381,62 @@ class RabbitThread(threading.Thread):
 
     ''' Called by builder, to republish messages after a reconnection. '''
     def send_many_messages(self, messages):
-        return self.__facade.send_many_messages_to_queue(messages)
+        return self.__facade.resend_many_messages_to_queue(messages)
 
     '''Called by returnhandle, to republish a message that was not accepted.'''
     def send_a_message(self, message):
-        return self.__facade.send_message_to_queue(message)
+        return self.__facade.resend_message_to_queue(message)
 
-    '''Called by feeder, to notify confirmer about which message it needs to get confirmed. '''
-    def put_to_unconfirmed_delivery_tags(self, delivery_tag):
-        return self.__confirmer.put_to_unconfirmed_delivery_tags(delivery_tag)
+    '''Called by returnhandler, to hand the delivery future of a returned message over to the resent one. '''
+    def take_future_of_unconfirmed(self, body):
+        for confirmer in self.__confirmers:
+            future = confirmer.take_future_of_unconfirmed(body)
+            if future is not None:
+                return future
+        return None
 
-    '''Called by feeder, to notify confirmer about which message it needs to get confirmed. '''
-    def put_to_unconfirmed_messages_dict(self, delivery_tag, message):
-        return self.__confirmer.put_to_unconfirmed_messages_dict(delivery_tag, message)
+    '''Called by feeder, to notify the channel's confirmer about which message it needs to get confirmed. '''
+    def put_to_unconfirmed(self, delivery_tag, message, channel_index=0):
+        return self.__confirmers[channel_index].put_to_unconfirmed(delivery_tag, message)
 
-    ''' Called by builder, to prepare message republication after reconnect/channel reopen. '''
-    def reset_unconfirmed_messages_and_delivery_tags(self):
-        return self.__confirmer.reset_unconfirmed_messages_and_delivery_tags()
+    ''' Called by confirmer, so that publishers waiting for the limit of messages in flight can continue. '''
+    def tell_publisher_messages_were_confirmed(self):
+        return self.__facade.on_messages_confirmed()
+
+    '''
+    Called by confirmer, so that a gentle finish does not need to wait any longer.
+    The confirmer only knows about its own channel, so we check the others.
+    '''
+    def tell_shutter_all_messages_confirmed(self):
+        if self.get_num_unconfirmed() == 0:
+            return self.__shutter.on_all_messages_confirmed()
+
+    '''
+    Called by builder, to prepare message republication after reconnect/channel reopen.
+    If no channel index is given, it applies to all channels (reconnect).
+    '''
+    def reset_unconfirmed_messages_and_delivery_tags(self, channel_index=None):
+        for confirmer in self.__get_confirmers(channel_index):
+            confirmer.reset_unconfirmed_messages_and_delivery_tags()
 
     ''' Called by builder, to prepare message republication after reconnect/channel reopen. '''
-    def get_unconfirmed_messages_as_list_copy_during_lifetime(self):
-        return self.__confirmer.get_unconfirmed_messages_as_list_copy()
+    def get_unconfirmed_messages_as_list_copy_during_lifetime(self, channel_index=None):
+        return self.__get_unconfirmed_messages(channel_index)
 
     ''' Called by builder, to prepare message republication after reconnect/channel reopen. '''
-    def reset_delivery_number(self):
-        return self.__feeder.reset_delivery_number()
+    def reset_delivery_number(self, channel_index=None):
+        return self.__feeder.reset_delivery_number(channel_index)
+
+    def __get_confirmers(self, channel_index):
+        if channel_index is None:
+            return self.__confirmers
+        return [self.__confirmers[channel_index]]
+
+    def __get_unconfirmed_messages(self, channel_index):
+        messages = []
+        for confirmer in self.__get_confirmers(channel_index):
+            messages.extend(confirmer.get_unconfirmed_messages_as_list_copy())
+        return messages
 
     ''' Called by feeder. Called by builder, only for logging. '''
     def get_exchange_name(self):
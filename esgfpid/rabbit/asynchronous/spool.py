@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import logging
+import threading
+import esgfpid.defaults as defaults
+from .. import rabbitutils
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+=====
+Spool
+=====
+
+The spool is an optional, append-only file (a write-ahead log) that
+keeps the messages on disk until RabbitMQ has confirmed them. If the
+process dies, or if the rabbit thread is force-finished, the messages
+that were not confirmed are still in the spool, and are re-enqueued the
+next time the messaging thread is started with the same spool file.
+
+Each line of the file is a JSON record:
+ * {"op": "put", "id": <n>, "msg": <message>}, written when the message
+   enters the queue of unpublished messages (main thread). Envelopes
+   are written as {"op": "put", "id": <n>, "key": <routing key>,
+   "body": <body>} instead.
+ * {"op": "ack", "id": <n>}, the tombstone, written when the Confirmer
+   receives the ack for the message (rabbit thread).
+
+Messages are not acked on NACKs, so rejected messages stay in the spool
+too.
+
+Messages that were refused by the limiter are not recorded. Messages
+that were spilled to disk by the limiter are recorded when they are
+moved to the queue, or when the thread is finished (if they are still
+in the spill file then). So they are not protected by the spool while
+they are in the spill file.
+
+To avoid capping the throughput, the file is not fsynced after every
+record, but after a number of records or a number of seconds (see
+"RABBIT_ASYN_SPOOL_FSYNC_*" in the defaults), and on close. If nothing
+else is written, a timer syncs the records once the seconds passed. So
+after a crash of the machine (not only of the process), the last
+records may be lost.
+
+If the spool file cannot be written (e.g. if the disk is full), the
+error is logged, and the messages are sent nevertheless (they are
+just not protected by the spool).
+
+The messages are identified by the objects themselves, so the
+confirmer can tombstone the message it holds without knowing its id.
+A message object that is already in the spool (e.g. if it is republished
+after a reconnection) is not recorded a second time.
+
+When the spool is opened (and closed), it is compacted: The file is
+rewritten, containing only the messages that were not acked.
+
+API:
+ * open() called by the AsynchronousRabbitConnector when the thread is started. Returns the messages to be replayed.
+ * put() and put_many() called by the AsynchronousRabbitConnector, when messages are put into the queue.
+ * ack() and ack_many() called by the Confirmer.
+ * close() called by the AsynchronousRabbitConnector after joining the thread.
+
+'''
+class MessageSpool(object):
+
+    def __init__(self, filename):
+        self.__filename = filename
+        self.__file = None
+        self.__lock = threading.Lock()
+
+        # Pending messages: id(message) -> (spool id, message).
+        # The reference to the message is kept, so that the
+        # object id cannot be reused while it is pending.
+        self.__pending = {}
+        self.__next_id = 1
+
+        # Batched fsync:
+        self.__unsynced_records = 0
+        self.__last_sync = time.time()
+        self.__sync_timer = None
+        self.__FSYNC_EVERY_N = defaults.RABBIT_ASYN_SPOOL_FSYNC_EVERY_N
+        self.__FSYNC_SECONDS = defaults.RABBIT_ASYN_SPOOL_FSYNC_SECONDS
+
+    '''
+    Opens the spool file (creating it if needed), compacts it and
+    returns the messages that were not acked in an earlier run.
+
+    The returned messages are registered as pending, so they do not
+    need to be put again.
+
+    :return: List of messages to be republished.
+    '''
+    def open(self):
+        with self.__lock:
+            messages = self.__read_unacked_messages()
+            for message in messages:
+                self.__register(message)
+            self.__rewrite_pending()
+            self.__file = open(self.__filename, 'a')
+            self.__last_sync = time.time()
+        if len(messages) > 0:
+            loginfo(LOGGER, 'Replaying %i unconfirmed messages from spool file %s.', len(messages), self.__filename)
+        else:
+            logdebug(LOGGER, 'Opened spool file %s (nothing to replay).', self.__filename)
+        return messages
+
+    '''
+    Flushes and closes the spool file, and compacts it,
+    so that only the messages that were not acked remain.
+    '''
+    def close(self):
+        with self.__lock:
+            if self.__file is None:
+                return
+            if self.__sync_timer is not None:
+                self.__sync_timer.cancel()
+                self.__sync_timer = None
+            self.__sync()
+            self.__file.close()
+            self.__file = None
+            self.__rewrite_pending()
+            num = len(self.__pending)
+        if num > 0:
+            logwarn(LOGGER, '%i messages were not confirmed. They are kept in spool file %s.', num, self.__filename)
+        else:
+            logdebug(LOGGER, 'Closed spool file %s (all messages confirmed).', self.__filename)
+
+    def get_num_pending(self):
+        return len(self.__pending)
+
+    '''
+    Records a message that enters the queue of unpublished messages.
+    Called from the main thread, or from the rabbit thread (when
+    spilled messages are moved to the queue).
+    '''
+    def put(self, message):
+        self.put_many([message])
+
+    def put_many(self, messages):
+        try:
+            with self.__lock:
+                for message in messages:
+                    if id(message) in self.__pending:
+                        continue # Republication, already recorded.
+                    spool_id = self.__register(message)
+                    self.__write(self.__make_put_record(spool_id, message))
+                self.__sync_if_needed()
+        except (IOError, OSError, ValueError) as e:
+            logerror(LOGGER, 'Could not write to spool file %s: %s', self.__filename, repr(e))
+
+    '''
+    Records the tombstone for a message that was acked by RabbitMQ.
+    Called from the rabbit thread (by the Confirmer).
+    '''
+    def ack(self, message):
+        self.ack_many([message])
+
+    def ack_many(self, messages):
+        try:
+            with self.__lock:
+                for message in messages:
+                    entry = self.__pending.pop(id(message), None)
+                    if entry is not None:
+                        self.__write({'op':'ack', 'id':entry[0]})
+                self.__sync_if_needed()
+        except (IOError, OSError, ValueError) as e:
+            logerror(LOGGER, 'Could not write to spool file %s: %s', self.__filename, repr(e))
+
+    ###############
+    ### Helpers ###
+    ###############
+
+    def __register(self, message):
+        spool_id = self.__next_id
+        self.__next_id += 1
+        self.__pending[id(message)] = (spool_id, message)
+        return spool_id
+
+    def __make_put_record(self, spool_id, message):
+        record = rabbitutils.message_to_record(message)
+        record['op'] = 'put'
+        record['id'] = spool_id
+        return record
+
+    def __write(self, record):
+        self.__file.write(json.dumps(record)+'\n')
+        self.__unsynced_records += 1
+
+    def __sync_if_needed(self):
+        if self.__unsynced_records >= self.__FSYNC_EVERY_N:
+            self.__sync()
+        elif self.__unsynced_records > 0:
+            seconds_left = self.__FSYNC_SECONDS - (time.time() - self.__last_sync)
+            if seconds_left <= 0:
+                self.__sync()
+            else:
+                self.__schedule_sync(seconds_left)
+
+    def __schedule_sync(self, seconds):
+        # So the records are synced in time even if nothing else is written:
+        if self.__sync_timer is None:
+            self.__sync_timer = threading.Timer(seconds, self.__sync_when_due)
+            self.__sync_timer.daemon = True
+            self.__sync_timer.start()
+
+    def __sync_when_due(self):
+        try:
+            with self.__lock:
+                self.__sync_timer = None
+                if self.__file is not None and self.__unsynced_records > 0:
+                    self.__sync()
+        except (IOError, OSError, ValueError) as e:
+            logerror(LOGGER, 'Could not sync spool file %s: %s', self.__filename, repr(e))
+
+    def __sync(self):
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        logtrace(LOGGER, 'Synced %i records to spool file.', self.__unsynced_records)
+        self.__unsynced_records = 0
+        self.__last_sync = time.time()
+
+    '''
+    Reads the spool file and returns the messages that were put
+    but not acked, in the order they were put. A truncated last
+    line (e.g. after a crash during writing) is ignored.
+    '''
+    def __read_unacked_messages(self):
+        if not os.path.exists(self.__filename):
+            return []
+        unacked = {}
+        order = []
+        with open(self.__filename, 'r') as spoolfile:
+            for line in spoolfile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logwarn(LOGGER, 'Ignoring corrupt line in spool file %s.', self.__filename)
+                    continue
+                if record['op'] == 'put':
+                    unacked[record['id']] = rabbitutils.message_from_record(record)
+                    order.append(record['id'])
+                elif record['op'] == 'ack':
+                    unacked.pop(record['id'], None)
+        return [unacked[spool_id] for spool_id in order if spool_id in unacked]
+
+    '''
+    Atomically replaces the spool file by one that only
+    contains the pending messages.
+    '''
+    def __rewrite_pending(self):
+        tmpname = self.__filename+'.tmp'
+        entries = sorted(self.__pending.values(), key=lambda entry: entry[0])
+        with open(tmpname, 'w') as tmpfile:
+            for spool_id, message in entries:
+                tmpfile.write(json.dumps(self.__make_put_record(spool_id, message))+'\n')
+            tmpfile.flush()
+            os.fsync(tmpfile.fileno())
+        os.rename(tmpname, self.__filename)
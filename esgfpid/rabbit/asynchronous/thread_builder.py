@@ -1,4 +1,5 @@
 import logging
+import functools
 import pika
 import time
 import copy
@@ -7,6 +8,7 @@ from esgfpid.utils import get_now_utc_as_formatted_string as get_now_utc_as_form
 import esgfpid.defaults as defaults
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
 from ..exceptions import PIDServerException
+from .. import rabbitutils
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -23,17 +25,23 @@ seconds before that.
 There is a maximum number of times that this is tried before
 giving up Permanently.
 
+The thread may publish on several channels of the same connection.
+They are all opened once the connection is open, and publishing
+starts once all of them are open. Each channel is identified by its
+index (in the thread's list of channels and of confirmers).
+
 '''
 class ConnectionBuilder(object):
     
-    def __init__(self, thread, statemachine, confirmer, returnhandler, shutter, nodemanager):
+    def __init__(self, thread, statemachine, confirmers, returnhandler, shutter, nodemanager, metrics=None):
         self.thread = thread
         self.statemachine = statemachine
 
         '''
         We need to pass the "confirmer.on_delivery_confirmation()" callback to
-        RabbitMQ's channel.'''
-        self.confirmer = confirmer
+        RabbitMQ's channels. One confirmer per channel, so this also tells
+        how many channels to open.'''
+        self.confirmers = confirmers
         
         '''
         We need to pass the "returnhandler.on_message_not_accepted()"" callback
@@ -70,10 +78,11 @@ class ConnectionBuilder(object):
 
         '''
         How many seconds to wait before reconnecting after having tried
-        all hosts. (There is no waiting time trying to connect to a different
-        host after one fails).
+        all hosts is computed for every round (exponential backoff with
+        jitter, see rabbitutils.get_reconnection_wait_seconds()). There
+        is no waiting time trying to connect to a different host after
+        one fails.
         '''
-        self.__wait_seconds_before_reconnect = defaults.RABBIT_RECONNECTION_SECONDS
 
         '''
         To see how much time it takes to connect. Once a connection is
@@ -81,6 +90,13 @@ class ConnectionBuilder(object):
         '''
         self.__start_connect_time = None
 
+        '''
+        How long it took to open the last connection. Reported
+        to the node manager once the connection is ready for
+        publishing (only once, not after reopening a channel).
+        '''
+        self.__connect_seconds = None
+
         '''
         Name of the fallback exchange to try if the normal exchange
         is not found.
@@ -92,6 +108,12 @@ class ConnectionBuilder(object):
         '''
         self.__connection_errors = {}
 
+        '''
+        Optional. PublishMetrics to be notified about reconnection
+        attempts, and when the connection is ready again.
+        '''
+        self.__metrics = metrics
+
     ####################
     ### Start ioloop ###
     ####################
@@ -214,10 +236,12 @@ class ConnectionBuilder(object):
             on_close_callback=self.on_connection_closed
             # Removed parameter, see https://github.com/pika/pika/issues/961
         )
+        self.__add_on_connection_blocked_callbacks()
 
     ''' Callback, called by RabbitMQ.'''
     def on_connection_open(self, unused_connection):
         logdebug(LOGGER, 'Opening connection... done.')
+        self.__connect_seconds = (datetime.datetime.now() - self.__start_connect_time).total_seconds()
         loginfo(LOGGER, 'Connection to RabbitMQ at %s opened... (%s)',
             self.__node_manager.get_connection_parameters().host,
             get_now_utc_as_formatted_string())
@@ -230,24 +254,35 @@ class ConnectionBuilder(object):
         # certainly was carried out before this callback. So this call to
         # "...stop_waiting..." is likelily redundant!
         self.thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
-        self.__please_open_rabbit_channel()
+        for channel_index in range(len(self.confirmers)):
+            self.__please_open_rabbit_channel(channel_index)
 
     ''' Asynchronous, waits for answer from RabbitMQ.'''
-    def __please_open_rabbit_channel(self):
-        logdebug(LOGGER, 'Opening channel...')
-        self.thread._connection.channel(on_open_callback=self.on_channel_open)
+    def __please_open_rabbit_channel(self, channel_index):
+        logdebug(LOGGER, 'Opening channel %i...', channel_index)
+        self.thread._connection.channel(on_open_callback=functools.partial(self.on_channel_open, channel_index=channel_index))
 
     ''' Callback, called by RabbitMQ. '''
-    def on_channel_open(self, channel):
+    def on_channel_open(self, channel, channel_index=0):
         time_passed = datetime.datetime.now() - self.__start_connect_time
-        logdebug(LOGGER, 'Opening channel... done. Took %s seconds.' % time_passed.total_seconds())
+        logdebug(LOGGER, 'Opening channel %i... done. Took %s seconds.' % (channel_index, time_passed.total_seconds()))
         logtrace(LOGGER, 'Channel has number: %s.', channel.channel_number)
-        self.thread._channel = channel
+        self.thread._channels[channel_index] = channel
         self.__reset_reconnect_counter()
-        self.__add_on_channel_close_callback()
-        self.__add_on_return_callback()
-        self.__make_channel_confirm_delivery()
-        self.__make_ready_for_publishing()
+        self.__add_on_channel_close_callback(channel, channel_index)
+        self.__add_on_return_callback(channel)
+        self.__make_channel_confirm_delivery(channel, channel_index)
+        if self.__all_channels_open():
+            self.__make_ready_for_publishing()
+        else:
+            logdebug(LOGGER, 'Waiting for the other channels to open before publishing.')
+
+    def __all_channels_open(self):
+        return None not in self.thread._channels
+
+    def __forget_all_channels(self):
+        for channel_index in range(len(self.thread._channels)):
+            self.thread._channels[channel_index] = None
 
     '''
     Once we succeeded in building a connection, we reset the
@@ -277,26 +312,31 @@ class ConnectionBuilder(object):
         logdebug(LOGGER, 'Undo resetting reconnection counter, because the channel that was opened did not actually function.')
         self.__reconnect_counter = self.__backup_reconnect_counter
 
-    def __make_channel_confirm_delivery(self):
+    def __make_channel_confirm_delivery(self, channel, channel_index):
         logtrace(LOGGER, 'Set confirm delivery... (Issue Confirm.Select RPC command)')
-        self.thread._channel.confirm_delivery(ack_nack_callback=self.confirmer.on_delivery_confirmation)
+        channel.confirm_delivery(ack_nack_callback=self.confirmers[channel_index].on_delivery_confirmation)
         logdebug(LOGGER, 'Set confirm delivery... done.')
  
     def __make_ready_for_publishing(self):
         logdebug(LOGGER, '(Re)connection established, making ready for publication...')
+        self.__node_manager.report_success_of_current(self.__connect_seconds)
+        self.__connect_seconds = None
 
         # Check for unexpected errors:
-        if self.thread._channel is None:
+        if not self.__all_channels_open():
             logerror(LOGGER, 'Channel is None after connecting to server. This should not happen.')
             self.statemachine.set_to_permanently_unavailable()
         if self.thread._connection is None:
             logerror(LOGGER, 'Connection is None after connecting to server. This should not happen.')
             self.statemachine.set_to_permanently_unavailable()
 
+        if self.__metrics is not None:
+            self.__metrics.on_connection_ready()
+
         # Normally, it should already be waiting to be available:
         if self.statemachine.is_WAITING_TO_BE_AVAILABLE():
             logdebug(LOGGER, 'Setup is finished. Publishing may start.')
-            logtrace(LOGGER, 'Publishing will use channel no. %s!', self.thread._channel.channel_number)
+            logtrace(LOGGER, 'Publishing will use channel no. %s!', ', '.join(str(channel.channel_number) for channel in self.thread._channels))
             self.statemachine.set_to_available()
             self.__check_for_already_arrived_messages_and_publish_them()
 
@@ -322,8 +362,7 @@ class ConnectionBuilder(object):
         num = self.thread.get_num_unpublished()
         if num > 0:
             loginfo(LOGGER, 'Ready to publish messages to RabbitMQ. %s messages are already waiting to be published.', num)
-            for i in range(int(num*1.1)):
-                self.thread.add_event_publish_message()
+            self.thread.add_event_publish_message() # One trigger drains the queue.
         else:
             loginfo(LOGGER, 'Ready to publish messages to RabbitMQ.')
             logdebug(LOGGER, 'Ready to publish messages to RabbitMQ. No messages waiting yet.')
@@ -351,6 +390,7 @@ class ConnectionBuilder(object):
         logerror(LOGGER, 'Could not connect to %s: "%s" (connection failure after %s seconds)', oldhost, msg, time_passed_seconds)
 
         self.__store_connection_error_info(msg, oldhost)
+        self.__node_manager.report_failure_of_current()
 
         # If there was a force-finish, we do not reconnect.
         if self.statemachine.is_FORCE_FINISHED():
@@ -377,7 +417,7 @@ class ConnectionBuilder(object):
         else:
             self.__reconnect_counter += 1;
             if self.__reconnect_counter <= self.__max_reconnection_tries:
-                reopen_seconds = self.__wait_seconds_before_reconnect
+                reopen_seconds = rabbitutils.get_reconnection_wait_seconds(self.__reconnect_counter)
                 logdebug(LOGGER, 'Connection failure: Failed connecting to all hosts. Waiting %s seconds and starting over.', reopen_seconds)
                 self.__node_manager.reset_nodes()
                 newhost = self.__node_manager.get_connection_parameters().host
@@ -444,6 +484,38 @@ class ConnectionBuilder(object):
         return name
 
 
+    ####################
+    ### Flow control ###
+    ####################
+
+    '''
+    This tells RabbitMQ what to do if it blocks the
+    connection, e.g. because it raised a memory or disk
+    alarm, and when it unblocks it again.
+    '''
+    def __add_on_connection_blocked_callbacks(self):
+        self.thread._connection.add_on_connection_blocked_callback(self.on_connection_blocked)
+        self.thread._connection.add_on_connection_unblocked_callback(self.on_connection_unblocked)
+
+    '''
+    Callback, called by RabbitMQ.
+
+    While the connection is blocked, RabbitMQ does not read
+    from the socket, so publishing makes no sense. The feeder
+    pauses, and a gentle finish waits longer (see shutter).
+    '''
+    def on_connection_blocked(self, connection, method_frame):
+        reason = getattr(method_frame.method, 'reason', None)
+        logwarn(LOGGER, 'RabbitMQ blocked the connection (reason: %s). Pausing publication until it is unblocked.', reason)
+        self.statemachine.set_detail_connection_blocked()
+
+    ''' Callback, called by RabbitMQ. '''
+    def on_connection_unblocked(self, connection, method_frame):
+        self.statemachine.set_detail_connection_unblocked()
+        loginfo(LOGGER, 'RabbitMQ unblocked the connection. Resuming publication. (Blocked for %.1f seconds in total so far).', self.statemachine.get_seconds_blocked())
+        if self.thread.get_num_unpublished() > 0:
+            self.thread.add_event_publish_message()
+
     #############################
     ### React to channel and  ###
     ### connection close      ###
@@ -452,8 +524,8 @@ class ConnectionBuilder(object):
     ''' This tells RabbitMQ what to do if it receives 
     a message it cannot accept, e.g. if it cannot
     route it. '''
-    def __add_on_return_callback(self):
-        self.thread._channel.add_on_return_callback(self.returnhandler.on_message_not_accepted)
+    def __add_on_return_callback(self, channel):
+        channel.add_on_return_callback(self.returnhandler.on_message_not_accepted)
 
     '''
     This tells RabbitMQ what to do if the channel
@@ -464,8 +536,8 @@ class ConnectionBuilder(object):
     called if the channel is closed without the underlying
     connection being closed. I am not 100 percent sure though.
     '''
-    def __add_on_channel_close_callback(self):
-        self.thread._channel.add_on_close_callback(self.on_channel_closed)
+    def __add_on_channel_close_callback(self, channel, channel_index):
+        channel.add_on_close_callback(functools.partial(self.on_channel_closed, channel_index=channel_index))
 
     '''
     Callback, called by RabbitMQ.
@@ -484,8 +556,9 @@ class ConnectionBuilder(object):
         the channel to close.
         In this case, we want to reopen a connection.
 
+    The channel index tells which of the thread's channels was closed.
     '''
-    def on_channel_closed(self, connection, exception):
+    def on_channel_closed(self, channel, exception, channel_index=0):
 
         # From the docs: The exception will either be an instance of
         # exceptions.ConnectionClosed if a fully-open connection was closed
@@ -498,7 +571,8 @@ class ConnectionBuilder(object):
             reply_code = -1
             reply_text = str(exception)
 
-        logdebug(LOGGER, 'Channel was closed: %s (code %s)', reply_text, reply_code)
+        logdebug(LOGGER, 'Channel %i was closed: %s (code %s)', channel_index, reply_text, reply_code)
+        self.thread._channels[channel_index] = None
 
         # Channel closed because user wants to close:
         if self.statemachine.is_PERMANENTLY_UNAVAILABLE() or self.statemachine.is_FORCE_FINISHED():
@@ -516,7 +590,7 @@ class ConnectionBuilder(object):
         # Channel closed because exchange did not exist:
         elif reply_code == 404:
             logdebug(LOGGER, 'Channel closed because the exchange "%s" did not exist.', self.__node_manager.get_exchange_name())
-            self.__use_different_exchange_and_reopen_channel()
+            self.__use_different_exchange_and_reopen_channel(channel_index)
 
         # Other unexpected channel close:
         else:
@@ -529,9 +603,11 @@ class ConnectionBuilder(object):
     An attempt to publish to a nonexistent exchange will close
     the channel. In this case, we use a different exchange name
     and reopen the channel. The underlying connection was kept
-    open.
+    open. The other channels are not affected (if they published
+    to the nonexistent exchange too, they are closed and reopened
+    the same way).
     '''
-    def __use_different_exchange_and_reopen_channel(self):
+    def __use_different_exchange_and_reopen_channel(self, channel_index):
 
         # Set to waiting to be available, so that incoming
         # messages are stored:
@@ -543,12 +619,12 @@ class ConnectionBuilder(object):
 
         # If this happened while sending message to the wrong exchange, we
         # have to trigger their resending...
-        self.__prepare_channel_reopen('Channel reopen')
+        self.__prepare_channel_reopen('Channel reopen', channel_index)
 
         # Reopen channel
-        logdebug(LOGGER, 'Reopening channel...')
+        logdebug(LOGGER, 'Reopening channel %i...', channel_index)
         self.statemachine.set_to_waiting_to_be_available()
-        self.__please_open_rabbit_channel()
+        self.__please_open_rabbit_channel(channel_index)
 
     '''
     Callback, called by RabbitMQ.
@@ -574,7 +650,8 @@ class ConnectionBuilder(object):
             reply_text = str(exception)
 
         loginfo(LOGGER, 'Connection to RabbitMQ was closed. Reason: %s.', reply_text)
-        self.thread._channel = None
+        self.__forget_all_channels()
+        self.statemachine.set_detail_connection_unblocked() # A new connection is not blocked.
         if self.__was_user_shutdown(reply_code, reply_text):
             loginfo(LOGGER, 'Connection to %s closed.', self.__node_manager.get_connection_parameters().host)
             self.make_permanently_closed_by_user()
@@ -658,6 +735,8 @@ class ConnectionBuilder(object):
             self.__give_up_reconnecting_and_raise_exception(errormsg)
         else:
             self.statemachine.set_to_waiting_to_be_available()
+            if self.__metrics is not None:
+                self.__metrics.on_reconnection_scheduled()
             loginfo(LOGGER, 'Trying to reconnect to RabbitMQ in %s seconds.', wait_seconds)
             connection.ioloop.call_later(wait_seconds, self.reconnect)
             logtrace(LOGGER, 'Reconnect event added to connection %s (not to %s)', connection, self.thread._connection)
@@ -701,29 +780,32 @@ class ConnectionBuilder(object):
     '''
     This is called during reconnection and during channel reopen.
     Both implies that a new channel is opened.
+
+    :param channel_index: The channel that is reopened, or None
+        for all channels (reconnection).
     '''
-    def __prepare_channel_reopen(self, operation_string):
+    def __prepare_channel_reopen(self, operation_string, channel_index=None):
         # We need to reset the message number, as
         # it works by channel:
         logdebug(LOGGER, operation_string+': Resetting delivery number (for publishing messages).')
-        self.thread.reset_delivery_number()
+        self.thread.reset_delivery_number(channel_index)
 
         # Furthermore, as we'd like to re-publish messages
         # that had not been confirmed yet, we remove them
         # from the stack of unconfirmed messages, and put them
         # back to the stack of unpublished messages.
         logdebug(LOGGER, operation_string+': Sending all messages that have not been confirmed yet...')
-        self.__prepare_republication_of_unconfirmed()
+        self.__prepare_republication_of_unconfirmed(channel_index)
 
         # Reset the unconfirmed delivery tags, as they also work by channel:
         logdebug(LOGGER, operation_string+': Resetting delivery tags (for confirming messages).')
-        self.thread.reset_unconfirmed_messages_and_delivery_tags()
+        self.thread.reset_unconfirmed_messages_and_delivery_tags(channel_index)
         
-    def __prepare_republication_of_unconfirmed(self):
+    def __prepare_republication_of_unconfirmed(self, channel_index):
         # Get all unconfirmed messages - we won't be able to receive their confirms anymore:
         # IMPORTANT: This has to happen before we reset the delivery_tags of the confirmer
         # module, as this deletes the collection of unconfirmed messages.
-        rescued_messages = self.thread.get_unconfirmed_messages_as_list_copy_during_lifetime()
+        rescued_messages = self.thread.get_unconfirmed_messages_as_list_copy_during_lifetime(channel_index)
         if len(rescued_messages)>0:
             logdebug(LOGGER, '%s unconfirmed messages were saved and are sent now.', len(rescued_messages))
             self.thread.send_many_messages(rescued_messages)
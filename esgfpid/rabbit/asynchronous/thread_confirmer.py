@@ -1,7 +1,9 @@
 import logging
-import copy
+import collections
+import esgfpid.utils.logutils as logutils
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
 from .exceptions import UnknownServerResponse
+from .. import delivery
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -17,26 +19,59 @@ other actions itself.
 
 It has a stack of unconfirmed messages (which is filled by the feeder,
 it puts every message it has successfully published into that stack).
+The stack is an ordered dict, mapping the delivery tags to the messages.
+As the feeder hands over the delivery tags in increasing order, the
+oldest unconfirmed message is always at its front, so a confirm for
+"this tag and all below" only needs to pop from the front until a
+bigger tag is found. This way, the cost of a confirm only depends on
+the number of messages it confirms, not on the number of messages
+waiting for confirmation.
 
 For each confirm, it must check what kind of confirm it is (ack/nack, single/multiple),
 and act accordingly. Confirmed messages  and their delivery numbers must be deleted
 from the stack. Unconfirmed messages remain. Nacked messages are stored in an
 extra stack.
 
+The delivery futures of the messages (see delivery.py) are resolved
+here: Acked messages were delivered, nacked ones were not.
+
 The unconfirmed messages can be retrieved from the confirmer to be republished.
 
+If a spool is used (see spool.py), the confirmer writes the tombstones
+for the acked messages to the spool. Nacked messages are not tombstoned.
+If a metrics registry is used (see metrics.py), it is told about the
+acked and nacked messages.
+
+After each confirmation, the confirmer notifies the thread, so that
+publishers that wait for the limit of messages in flight can continue.
+Whenever no more messages are waiting for confirmation, it notifies the
+thread too, so that a gentle finish that is waiting for the last confirms
+can close down right away.
+
 API:
  * on_delivery_confirmation() is called by RabbitMQ.
  * reset_unconfirmed_messages_and_delivery_tags() called by builder, during reconnection
  * get_unconfirmed_messages_as_list_copy() called by builder, during reconnection
- * put_to_unconfirmed_delivery_tags() called by feeder, to fill the stack
- * put_to_unconfirmed_messages_dict() called by feeder, to fill the stack
+ * put_to_unconfirmed() called by feeder, to fill the stack
+ * take_future_of_unconfirmed() called by returnhandler, to hand the
+   future of a returned message over to the resent message
 
 '''
 
 class Confirmer(object):
 
-    def __init__(self):
+    '''
+    :param thread: The RabbitThread, to be notified when no more
+        messages are waiting for confirmation.
+    :param spool: Optional. MessageSpool to be notified about
+        acked messages.
+    :param metrics: Optional. PublishMetrics to be notified
+        about acked and nacked messages.
+    '''
+    def __init__(self, thread, spool=None, metrics=None):
+        self.thread = thread
+        self.__spool = spool
+        self.__metrics = metrics
 
         # Logging:
         self.__first_confirm_receival = True
@@ -44,9 +79,8 @@ class Confirmer(object):
         self.__LOGFREQUENCY = 10
 
         # Stacks of unconfirmed/nacked messages:
-        self.__unconfirmed_delivery_tags = [] # only accessed internally
-        self.__unconfirmed_messages_dict = {} # dict, because I need to retrieve them by delivery tag (on ack/nack)
-        self.__nacked_messages = []           # only accessed internally, and from outside after thread is dead
+        self.__unconfirmed = collections.OrderedDict() # delivery tag -> message, ordered by delivery tag
+        self.__nacked_messages = []                    # only accessed internally, and from outside after thread is dead
 
     '''
     Callback, called by RabbitMQ.
@@ -57,7 +91,6 @@ class Confirmer(object):
         self.__logcounter += 1
 
         if confirmation_type == 'ack':
-            logtrace(LOGGER, 'Received "ACK" from messaging service.')
             self.__react_on_ack(deliv_tag, multiple)
         elif confirmation_type == 'nack':
             logtrace(LOGGER, 'Received "NACK" from messaging service.')
@@ -68,16 +101,18 @@ class Confirmer(object):
             raise UnknownServerResponse(msg+':'+str(method_frame))
             # This should never happen, unless if I parse the server's response wrongly.
 
+        self.thread.tell_publisher_messages_were_confirmed()
+        if len(self.__unconfirmed) == 0:
+            self.thread.tell_shutter_all_messages_confirmed()
+
     def __react_on_ack(self, deliv_tag, multiple):
         if self.__first_confirm_receival:
             self.__first_confirm_receival = False
             loginfo(LOGGER, 'Received first message confirmation from RabbitMQ.')
 
         if multiple:
-            logtrace(LOGGER, 'Received "ACK" for multiple messages from messaging service.')
             self.__react_on_multiple_delivery_ack(deliv_tag)
         else:
-            logtrace(LOGGER, 'Received "ACK" for single message from messaging service.')
             self.__react_on_single_delivery_ack(deliv_tag)
 
 
@@ -90,14 +125,21 @@ class Confirmer(object):
             self.__nack_delivery_tag_and_message_single(deliv_tag)
 
     def __nack_delivery_tag_and_message_single(self, deliv_tag):
-        msg = self.__unconfirmed_messages_dict.pop(str(deliv_tag))
-        self.__nacked_messages.append(msg)
-        self.__unconfirmed_delivery_tags.remove(deliv_tag)
+        try:
+            msg = self.__unconfirmed.pop(deliv_tag)
+            self.__nacked_messages.append(msg)
+            if self.__metrics is not None:
+                self.__metrics.on_messages_nacked([msg])
+            delivery.set_not_delivered([msg], 'The message was rejected (NACK) by RabbitMQ')
+        except KeyError as e:
+            logdebug(LOGGER, 'Could not remove %i from unconfirmed.', deliv_tag)
 
     def __nack_delivery_tag_and_message_several(self, deliv_tag):
-        for candidate_deliv_tag in copy.copy(self.__unconfirmed_delivery_tags):
-            if candidate_deliv_tag <= deliv_tag:
-                self.__nack_delivery_tag_and_message_single(candidate_deliv_tag)
+        removed = self.__pop_up_to_delivery_tag(deliv_tag)
+        self.__nacked_messages.extend(removed)
+        if self.__metrics is not None:
+            self.__metrics.on_messages_nacked(removed)
+        delivery.set_not_delivered(removed, 'The message was rejected (NACK) by RabbitMQ')
 
     def __get_confirm_info(self, method_frame):
         try:
@@ -112,37 +154,60 @@ class Confirmer(object):
 
     def __react_on_single_delivery_ack(self, deliv_tag):
         self.__remove_delivery_tag_and_message_single(deliv_tag)
-        logdebug(LOGGER, 'Received ack for delivery tag %i. Waiting for %i confirms.', deliv_tag, len(self.__unconfirmed_delivery_tags))
-        logtrace(LOGGER, 'Received ack for delivery tag %i.', deliv_tag)
-        logtrace(LOGGER, 'Now left in queue to be confirmed: %i messages.', len(self.__unconfirmed_delivery_tags))
+        logdebug(LOGGER, 'Received ack for delivery tag %i. Waiting for %i confirms.', deliv_tag, len(self.__unconfirmed))
 
     def __react_on_multiple_delivery_ack(self, deliv_tag):
         self.__remove_delivery_tag_and_message_several(deliv_tag)
-        logdebug(LOGGER, 'Received ack for delivery tag %i and all below. Waiting for %i confirms.', deliv_tag, len(self.__unconfirmed_delivery_tags))
-        logtrace(LOGGER, 'Received ack for delivery tag %i and all below.', deliv_tag)
-        logtrace(LOGGER, 'Now left in queue to be confirmed: %i messages.', len(self.__unconfirmed_delivery_tags))
+        logdebug(LOGGER, 'Received ack for delivery tag %i and all below. Waiting for %i confirms.', deliv_tag, len(self.__unconfirmed))
 
     def __remove_delivery_tag_and_message_single(self, deliv_tag):
         try:
-            self.__unconfirmed_delivery_tags.remove(deliv_tag)
-            ms = self.__unconfirmed_messages_dict.pop(str(deliv_tag))
-            logtrace(LOGGER, 'Received ack for message %s.', ms)
-        except ValueError as e:
+            ms = self.__unconfirmed.pop(deliv_tag)
+            if logutils.TRACE_ENABLED:
+                logtrace(LOGGER, 'Received ack for message %s.', ms)
+            if self.__spool is not None:
+                self.__spool.ack(ms)
+            if self.__metrics is not None:
+                self.__metrics.on_messages_acked([ms])
+            delivery.set_delivered([ms])
+        except KeyError as e:
             logdebug(LOGGER, 'Could not remove %i from unconfirmed.', deliv_tag)
 
     def __remove_delivery_tag_and_message_several(self, deliv_tag):
-        for candidate_deliv_tag in copy.copy(self.__unconfirmed_delivery_tags):
-            if candidate_deliv_tag <= deliv_tag:
-                self.__remove_delivery_tag_and_message_single(candidate_deliv_tag)
+        removed = self.__pop_up_to_delivery_tag(deliv_tag)
+        if self.__spool is not None:
+            self.__spool.ack_many(removed)
+        if self.__metrics is not None:
+            self.__metrics.on_messages_acked(removed)
+        delivery.set_delivered(removed)
+
+    '''
+    Removes all messages with delivery tags up to (and including)
+    the given one from the stack of unconfirmed messages.
+
+    As the tags are stored in increasing order, we only pop
+    from the front, until we find a bigger tag.
+
+    :return: List of the removed messages, in order of
+        their delivery tags.
+    '''
+    def __pop_up_to_delivery_tag(self, deliv_tag):
+        removed = []
+        while len(self.__unconfirmed) > 0:
+            oldest_tag = next(iter(self.__unconfirmed))
+            if oldest_tag > deliv_tag:
+                break
+            removed.append(self.__unconfirmed.popitem(last=False)[1])
+        return removed
 
 
     ''' Called by unit test.'''
     def get_num_unconfirmed(self):
-        return len(self.__unconfirmed_messages_dict)
+        return len(self.__unconfirmed)
 
     ''' Called by unit test.'''
     def get_copy_of_unconfirmed_tags(self):
-        return self.__unconfirmed_delivery_tags[:]
+        return list(self.__unconfirmed.keys())
 
     '''
     Called by the main thread, for rescuing, after joining.
@@ -153,17 +218,36 @@ class Confirmer(object):
 
     '''
     Called by feeder, to let the confirmer know which had been sent.
+
+    The delivery tags must be passed in increasing order (which
+    is the case, as the feeder increments them for every message,
+    and they are only reset together with the stack).
     '''
-    def put_to_unconfirmed_delivery_tags(self, delivery_tag):
-        logtrace(LOGGER, 'Adding delivery tag %i to unconfirmed.', delivery_tag)
-        self.__unconfirmed_delivery_tags.append(delivery_tag)
+    def put_to_unconfirmed(self, delivery_tag, msg):
+        if logutils.TRACE_ENABLED:
+            logtrace(LOGGER, 'Adding message with delivery tag %i to unconfirmed: %s', delivery_tag, msg)
+        self.__unconfirmed[delivery_tag] = msg
 
     '''
-    Called by feeder, to let the confirmer know which had been sent.
+    Called by returnhandler: A returned message is acked anyway,
+    but it is resent, so its future must not be resolved by
+    that ack, but by the confirm of the resent message.
+
+    Takes the future away from the oldest unconfirmed message
+    with the given body. Returns are rare, so it is ok to
+    search through the stack.
+
+    :param body: The body (bytes) of the returned message.
+    :return: The future, or None if no unconfirmed message
+        with that body carries a future.
     '''
-    def put_to_unconfirmed_messages_dict(self, delivery_tag, msg):
-        logtrace(LOGGER, 'Adding message with delivery tag %i to unconfirmed: %s', delivery_tag, msg)
-        self.__unconfirmed_messages_dict[str(delivery_tag)] = msg
+    def take_future_of_unconfirmed(self, body):
+        for msg in self.__unconfirmed.values():
+            future = getattr(msg, 'future', None)
+            if future is not None and msg.body == body:
+                msg.future = None
+                return future
+        return None
 
     '''
     This resets which messages had not be confirmed yet.
@@ -190,8 +274,7 @@ class Confirmer(object):
 
     '''
     def reset_unconfirmed_messages_and_delivery_tags(self):
-        self.__unconfirmed_delivery_tags = []
-        self.__unconfirmed_messages_dict = {}
+        self.__unconfirmed = collections.OrderedDict()
 
     '''
     Called by builder, during reconnection,
@@ -206,7 +289,4 @@ class Confirmer(object):
     this only after joining.
     '''
     def get_unconfirmed_messages_as_list_copy(self):
-        newlist = []
-        for deliv_tag,message in self.__unconfirmed_messages_dict.items():
-            newlist.append(message)
-        return newlist
+        return list(self.__unconfirmed.values())
@@ -7,6 +7,7 @@ else:
     import queue as queue
 from .. import rabbitutils
 import esgfpid.defaults as defaults
+import esgfpid.utils.logutils as logutils
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
 
 LOGGER = logging.getLogger(__name__)
@@ -19,10 +20,18 @@ It is very simple. Basically the only method it exposes
 (except for some simple getter/setter which is rarely ever used)
 is publish_message(), which is called from the main thread.
 
+If the thread has several channels, the messages are spread over
+the open channels round-robin. Each channel has its own delivery
+numbers (and its own confirmer). Note that the order in which the
+messages arrive at RabbitMQ is then only kept per channel.
+
+If a metrics registry is used (see metrics.py), it is told about
+every successful publish.
+
 '''
 class RabbitFeeder(object):
 
-    def __init__(self, thread, statemachine, nodemanager):
+    def __init__(self, thread, statemachine, nodemanager, num_channels=1, metrics=None):
         self.thread = thread
 
         '''
@@ -46,8 +55,29 @@ class RabbitFeeder(object):
         "The delivery tag is valid only within the channel from which
         the message was received. I.e. a client MUST NOT receive a
         message on one channel and then acknowledge it on another."
-        Source: https://www.rabbitmq.com/amqp-0-9-1-reference.html '''
-        self.__delivery_number = 1
+        Source: https://www.rabbitmq.com/amqp-0-9-1-reference.html
+
+        So there is one delivery number per channel. '''
+        self.__delivery_numbers = [1]*num_channels
+
+        '''
+        Index of the channel to try first for the next message.
+        '''
+        self.__next_channel_index = 0
+
+        '''
+        How many messages are published per trigger at most. Once this
+        budget is used up and there are still messages left, the feeder
+        re-arms itself, so that the ioloop can handle other events (e.g.
+        confirms from RabbitMQ) in between.
+        '''
+        self.__max_publish_per_trigger = defaults.RABBIT_ASYN_PUBLISH_MAX_PER_TRIGGER
+
+        '''
+        Optional. PublishMetrics to be notified about
+        every published message.
+        '''
+        self.__metrics = metrics
 
         # Logging
         self.__first_publication_trigger = True
@@ -58,32 +88,28 @@ class RabbitFeeder(object):
         self.__have_not_warned_about_force_close_yet = True
 
     '''
-    Triggers the publication of one message to RabbitMQ, if the
-    state machine currently allows this.
-
-    The message is fetched from the Queue of unpublished messages.
-
-    So far, whenever the library wants to publish messages, it
-    fires as many of these "publish_message" events as messages
-    were published (and some extra, to be sure).
-    If some of these triggers cannot be acted upon, as the module
-    is not in a state where it is allowed to publish, the triggers
-    should be fired as soon as the module is in available state
-    again.
-
-    # TODO: Find better way to make sure enough publish events are fired.
-    Are we sure there is not ever a way to have some messages
-    in the unpublished Queue that could be sent, but aren't, because
-    no event was fired for them? For example, if an exception occurs
-    during publish, and the message was put back - will there ever
-    be an event to trigger its publication? I don't think so.
-
-    Interim solution (hack):
-    (a) At the moment, for every message that the publisher hands 
-        over, I fire two events (rabbitthread).
-    (b) During the close-down algorithm, if there is unpublished
-        messages, I fire publish events, to make sure they are
-        published (thread_shutter).
+    Triggers the publication of the messages waiting in the Queue
+    of unpublished messages to RabbitMQ, if the state machine
+    currently allows this.
+
+    One trigger drains the Queue: The feeder publishes messages
+    until the Queue is empty, up to a maximum number of messages
+    per trigger (see "RABBIT_ASYN_PUBLISH_MAX_PER_TRIGGER" in the
+    defaults). If messages are left once this budget is used up,
+    the feeder fires a new trigger for itself, so the ioloop can
+    handle confirms in between.
+
+    So one trigger is enough for any number of messages that were
+    put into the Queue before the trigger is executed. Triggers that
+    find an empty Queue simply return.
+
+    If the module is not in a state where it is allowed to publish,
+    or if RabbitMQ blocked the connection, the trigger is not acted
+    upon. The builder fires a new trigger as soon as the module is
+    in available state again, or the connection was unblocked. If a publish
+    fails (e.g. because the channel was closed), the message is put
+    back and the feeder stops draining. The messages are then published
+    on the next trigger (e.g. after the reconnection).
 
     '''
     def publish_message(self):
@@ -101,9 +127,13 @@ class RabbitFeeder(object):
             self.__log_why_cannot_feed_the_rabbit_now()
 
         elif self.statemachine.is_AVAILABLE() or self.statemachine.is_AVAILABLE_BUT_WANTS_TO_STOP():
-            log_every_x_times(LOGGER, self.__logcounter_trigger, self.__LOGFREQUENCY, 'Received trigger for publishing message to RabbitMQ (trigger %i).', self.__logcounter_trigger)
-            self.__log_publication_trigger()
-            self.__publish_message_to_channel()
+            if self.statemachine.is_connection_blocked():
+                log_every_x_times(LOGGER, self.__logcounter_trigger, self.__LOGFREQUENCY, 'Received trigger for feeding the rabbit while the connection is blocked (trigger %i).', self.__logcounter_trigger)
+                logdebug(LOGGER, 'Cannot publish message to RabbitMQ now, as RabbitMQ blocked the connection. Publishing resumes when it is unblocked.')
+            else:
+                log_every_x_times(LOGGER, self.__logcounter_trigger, self.__LOGFREQUENCY, 'Received trigger for publishing message to RabbitMQ (trigger %i).', self.__logcounter_trigger)
+                self.__log_publication_trigger()
+                self.__publish_messages_to_channel()
 
         elif self.statemachine.is_PERMANENTLY_UNAVAILABLE() or self.statemachine.is_FORCE_FINISHED():
             log_every_x_times(LOGGER, self.__logcounter_trigger, self.__LOGFREQUENCY, 'Received late trigger for feeding the rabbit (trigger %i).', self.__logcounter_trigger)
@@ -135,9 +165,28 @@ class RabbitFeeder(object):
                     logwarn(LOGGER, 'Could not publish message(s) to RabbitMQ. The sender was closed by the user.')
                     self.__have_not_warned_about_force_close_yet = False
         else:
-            if self.thread._channel is None:
+            if self.__choose_channel() is None:
                 logerror(LOGGER, 'Very unexpected. Could not publish message(s) to RabbitMQ. There is no channel.')
 
+    '''
+    Publishes messages from the stack until it is empty, or
+    until the maximum number of messages per trigger is reached.
+    In the latter case, a new trigger is fired, so the rest of the
+    messages is published after the ioloop had the chance to handle
+    other events.
+    '''
+    def __publish_messages_to_channel(self):
+        num_published = 0
+        while num_published < self.__max_publish_per_trigger:
+            success = self.__publish_message_to_channel()
+            if not success:
+                return # Queue empty or publish failed: Stop draining.
+            num_published += 1
+
+        if self.thread.get_num_unpublished() > 0:
+            logtrace(LOGGER, 'Published %i messages in this trigger. Re-arming for the rest.', num_published)
+            self.thread.add_event_publish_message()
+
     '''
     Retrieves a message from stack and tries to publish it
     to RabbitMQ.
@@ -148,41 +197,67 @@ class RabbitFeeder(object):
     Note: The publish may cause an error if the Channel was closed.
     A closed Channel should be handled in the on_channel_close()
     callback, but we catch it here in case the clean up was not quick enough.
+
+    :return: True if a message was published, False if the stack was
+        empty or the publish failed.
     '''
     def __publish_message_to_channel(self):
 
+        # Find a channel to publish to:
+        channel_index = self.__choose_channel()
+        if channel_index is None:
+            logwarn(LOGGER, 'Cannot publish message to RabbitMQ because there is no open channel.')
+            return False
+        delivery_number = self.__delivery_numbers[channel_index]
+
         # Find a message to publish.
         # If no messages left, well, nothing to publish!
         try:
             message = self.__get_message_from_stack()
         except queue.Empty as e:
             logtrace(LOGGER, 'Queue empty. No more messages to be published.')
-            return
+            return False
 
         # Now try to publish it.
         # If anything goes wrong, you need to put it back to
         # the stack of unpublished messages!
         try:
-            success = self.__try_publishing_otherwise_put_back_to_stack(message)
+            success = self.__try_publishing_otherwise_put_back_to_stack(message, channel_index)
             if success:
-                self.__postparations_after_successful_feeding(message)
+                self.__postparations_after_successful_feeding(message, channel_index)
+            return success
 
         # Treat various errors that may occur during publishing:
         except pika.exceptions.ChannelClosed as e:
-            logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ because the Channel is closed (%s)', self.__delivery_number+1, repr(e))
+            logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ because the Channel is closed (%s)', delivery_number, repr(e))
 
         except AttributeError as e:
-            if self.thread._channel is None:
-                logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ because there is no channel.', self.__delivery_number+1)
+            if self.thread._channels[channel_index] is None:
+                logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ because there is no channel.', delivery_number)
             else:
-                logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ (unexpected error %s:%s)', self.__delivery_number+1, e.__class__.__name__, repr(e))
+                logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ (unexpected error %s:%s)', delivery_number, e.__class__.__name__, repr(e))
 
         except AssertionError as e:
-            logwarn(LOGGER, 'Cannot publish message to RabbitMQ %i because of AssertionError: "%s"', self.__delivery_number+1,e)
+            logwarn(LOGGER, 'Cannot publish message to RabbitMQ %i because of AssertionError: "%s"', delivery_number, e)
             if 'A non-string value was supplied for self.exchange' in repr(e):
                 exch = self.thread.get_exchange_name()
                 logwarn(LOGGER, 'Exchange was "%s" (type %s)', exch, type(exch))
 
+        return False
+
+
+    '''
+    Returns the index of the next open channel (round-robin),
+    or None if no channel is open.
+    '''
+    def __choose_channel(self):
+        num_channels = len(self.__delivery_numbers)
+        for i in range(num_channels):
+            channel_index = (self.__next_channel_index + i) % num_channels
+            if self.thread._channels[channel_index] is not None:
+                self.__next_channel_index = (channel_index + 1) % num_channels
+                return channel_index
+        return None
 
     '''
     Retrieve an unpublished message from stack.
@@ -193,7 +268,8 @@ class RabbitFeeder(object):
     '''
     def __get_message_from_stack(self, seconds=0):
         message = self.thread.get_message_from_unpublished_stack(seconds)
-        logtrace(LOGGER, 'Found message to be published. Now left in queue to be published: %i messages.', self.thread.get_num_unpublished())
+        if logutils.TRACE_ENABLED: # counting the messages needs the queue's lock
+            logtrace(LOGGER, 'Found message to be published. Now left in queue to be published: %i messages.', self.thread.get_num_unpublished())
         return message
 
     '''
@@ -201,22 +277,25 @@ class RabbitFeeder(object):
     Queue if it failed.
 
     :param message: Message to be sent.
+    :param channel_index: Which of the thread's channels to use.
     :raises: pika.exceptions.ChannelClosed, if the Channel is closed.
     '''
-    def __try_publishing_otherwise_put_back_to_stack(self, message):
+    def __try_publishing_otherwise_put_back_to_stack(self, message, channel_index):
         try:
+            channel = self.thread._channels[channel_index]
+
             # Getting message info:
             properties = self.nodemanager.get_properties_for_message_publications()
             routing_key, msg_string = rabbitutils.get_routing_key_and_string_message_from_message_if_possible(message)
             routing_key = self.nodemanager.adapt_routing_key_for_untrusted(routing_key)
             
-            # Logging
-            logtrace(LOGGER, 'Publishing message %i (key %s) (body %s)...', self.__delivery_number+1, routing_key, msg_string) # +1 because it will be incremented after the publish.
-            log_every_x_times(LOGGER, self.__logcounter_trigger, self.__LOGFREQUENCY, 'Trying actual publish... (trigger no. %i).', self.__logcounter_trigger)
-            logtrace(LOGGER, '(Publish to channel no. %i).', self.thread._channel.channel_number)
+            # Logging (once per message, so only if trace is on):
+            if logutils.TRACE_ENABLED:
+                logtrace(LOGGER, 'Publishing message %i (channel no. %i) (key %s) (body %s)...',
+                    self.__delivery_numbers[channel_index], channel.channel_number, routing_key, msg_string)
 
             # Actual publish to exchange
-            self.thread._channel.basic_publish(
+            channel.basic_publish(
                 exchange=self.thread.get_exchange_name(),
                 routing_key=routing_key,
                 body=msg_string,
@@ -236,25 +315,27 @@ class RabbitFeeder(object):
             raise e
 
     '''
-    If a publish was successful, pass it to the confirmer module
-    and in increment delivery_number for the next message.
+    If a publish was successful, pass it to the channel's confirmer
+    module and in increment the channel's delivery_number for the
+    next message.
     '''
-    def __postparations_after_successful_feeding(self, msg):
+    def __postparations_after_successful_feeding(self, msg, channel_index):
 
         # Pass the successfully published message and its delivery_number
         # to the confirmer module, to wait for its confirmation.
         # Increase the delivery number for the next message.
-        self.thread.put_to_unconfirmed_delivery_tags(self.__delivery_number)
-        self.thread.put_to_unconfirmed_messages_dict(self.__delivery_number, msg)
-        self.__delivery_number += 1
+        delivery_number = self.__delivery_numbers[channel_index]
+        self.thread.put_to_unconfirmed(delivery_number, msg, channel_index)
+        self.__delivery_numbers[channel_index] += 1
+        if self.__metrics is not None:
+            self.__metrics.on_message_published(msg)
 
         # Logging
         self.__logcounter_success += 1
         log_every_x_times(LOGGER, self.__logcounter_success, self.__LOGFREQUENCY, 'Actual publish to channel done (trigger no. %i, publish no. %i).', self.__logcounter_trigger, self.__logcounter_success)
-        logtrace(LOGGER, 'Publishing messages %i to RabbitMQ... done.', self.__delivery_number-1)
-        if (self.__delivery_number-1 == 1):
+        if self.__logcounter_success == 1:
             loginfo(LOGGER, 'First message published to RabbitMQ.')
-        logdebug(LOGGER, 'Message published (no. %i)', self.__delivery_number-1)
+        logdebug(LOGGER, 'Message published (no. %i on channel %i)', delivery_number, channel_index)
 
     '''
     Reset the delivery_number for the messages.
@@ -270,6 +351,12 @@ class RabbitFeeder(object):
     published message, and reset to one at channel reopen).
 
     (called by the builder during reconnection / channel reopen).
+
+    :param channel_index: The channel that was reopened, or None
+        if all channels were reopened (reconnection).
     '''
-    def reset_delivery_number(self):
-        self.__delivery_number = 1
+    def reset_delivery_number(self, channel_index=None):
+        if channel_index is None:
+            self.__delivery_numbers = [1]*len(self.__delivery_numbers)
+        else:
+            self.__delivery_numbers[channel_index] = 1
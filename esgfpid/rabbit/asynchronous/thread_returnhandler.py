@@ -2,6 +2,8 @@ import logging
 import pika
 import json
 import esgfpid.assistant.messages
+from esgfpid.exceptions import MessageNotDeliveredException
+from ..rabbitutils import MessageEnvelope
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
 
 LOGGER = logging.getLogger(__name__)
@@ -10,8 +12,14 @@ LOGGER.addHandler(logging.NullHandler())
 
 class UnacceptedMessagesHandler(object):
 
-    def __init__(self, thread):
+    '''
+    :param thread: The RabbitThread, to resend the messages.
+    :param metrics: Optional. PublishMetrics to be notified
+        about returned messages.
+    '''
+    def __init__(self, thread, metrics=None):
         self.thread = thread
+        self.__metrics = metrics
 
         self.__have_warned_about_double_unroutable_already = False
 
@@ -24,11 +32,16 @@ class UnacceptedMessagesHandler(object):
         # so we do not need to retrieve them from the unconfirmed
         # messages after resending.
         # In the end, we'll have published 40 messages and received 40 acks.
+        # This is why the delivery future of the returned message is
+        # taken away from it, so that it is resolved by the confirm of
+        # the resent message (or failed, if it comes back again).
 
         # Logging...
         logtrace(LOGGER, 'Return frame: %s', returned_frame) # <Basic.Return(['exchange=rabbitsender_integration_tests', 'reply_code=312', 'reply_text=NO_ROUTE', 'routing_key=cmip6.publisher.HASH.cart.datasets'])>
         logtrace(LOGGER, 'Return props: %s', props)  # <BasicProperties(['content_type=application/json', 'delivery_mode=2'])>
         logtrace(LOGGER, 'Return body: %s', body)
+        if self.__metrics is not None:
+            self.__metrics.on_message_returned()
 
         # Was it the first or second time it comes back?
         if returned_frame.reply_text == 'NO_ROUTE':
@@ -48,15 +61,24 @@ class UnacceptedMessagesHandler(object):
                 body_json['original_routing_key'], frame.routing_key)
             self.__have_warned_about_double_unroutable_already = True
         logdebug(LOGGER, 'This is the second time the message comes back. Dropping it.')
+        future = self.thread.take_future_of_unconfirmed(body)
+        if future is not None:
+            future.set_not_delivered(MessageNotDeliveredException(
+                'The message was returned by RabbitMQ twice (routing key "%s")' % frame.routing_key, body))
 
     def __resend_message(self, returned_frame, props, body):
+        future = self.thread.take_future_of_unconfirmed(body)
         try:
             body_json = json.loads(body)
             body_json = self.__add_emergency_routing_key(body_json)
-            self.__resend_an_unroutable_message(json.dumps(body_json))
+            message = MessageEnvelope.from_message(body_json)
+            message.future = future
+            self.__resend_an_unroutable_message(message)
         except pika.exceptions.ChannelClosed as e:
             logdebug(LOGGER, 'Error during "on_message_not_accepted": %s: %s', e.__class__.__name__, repr(e))
             logerror(LOGGER, 'Could not resend message: %s: %s', e.__class__.__name__, repr(e))
+            if future is not None:
+                future.set_not_delivered(MessageNotDeliveredException('Could not resend the returned message', body))
 
     def __add_emergency_routing_key(self, body_json):
         emergency_routing_key = esgfpid.utils.RABBIT_EMERGENCY_ROUTING_KEY
@@ -7,6 +7,25 @@ import time
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
+'''
+The ShutDowner is responsible for closing the connection to RabbitMQ,
+either by force (not caring about pending messages), or gently.
+
+The gentle finish is event-driven: If messages are still pending
+(i.e. not published or not confirmed), the shutter does not poll, but
+waits to be notified by the Confirmer (via the thread) once no more
+messages are waiting for confirmation. It then closes, if no messages
+are waiting to be published either.
+
+To make sure the main thread does not wait forever, a timeout is
+scheduled on the ioloop when the gentle finish starts. The waiting
+time is counted from then, so it is not prolonged by reconnections.
+
+While RabbitMQ blocks the connection (flow control), nothing can be
+published, which does not mean that the module is not progressing.
+So the waiting time is extended by the time spent blocked, up to a
+maximum (see "RABBIT_ASYN_FINISH_MAX_EXTENSION_SECONDS" in the defaults).
+'''
 class ShutDowner(object):
 
     def __init__(self, thread, statemachine):
@@ -14,10 +33,18 @@ class ShutDowner(object):
         self.statemachine = statemachine
 
         '''
-        To count how many times we've iterated during
-        the iterative, recursive check for pending messages.
+        Point in time (seconds since epoch) after which we stop
+        waiting for pending messages during a gentle finish.
+        Set when the gentle finish starts.
         '''
-        self.__close_decision_iterations = 0
+        self.__deadline = None
+
+        '''
+        Time that the connection had been blocked by RabbitMQ
+        before the gentle finish started. The time blocked after
+        that extends the deadline.
+        '''
+        self.__seconds_blocked_before_finish = 0
 
         '''
         To see, in case of a reconnect, if the module was in
@@ -57,89 +84,112 @@ class ShutDowner(object):
         # accepted.
 
         # Inform user
+        timeout_seconds = defaults.RABBIT_ASYN_FINISH_TIMEOUT_SECONDS
         if self.__are_any_messages_pending():
-            wait_seconds = defaults.RABBIT_ASYN_FINISH_WAIT_SECONDS
-            max_waits = defaults.RABBIT_ASYN_FINISH_MAX_TRIES
-            loginfo(LOGGER, 'Preparing to close PID module. Some messages are pending. Maximum waiting time: %i seconds. (%s)', wait_seconds*max_waits, get_now_utc_as_formatted_string())
+            loginfo(LOGGER, 'Preparing to close PID module. Some messages are pending. Maximum waiting time: %s seconds. (%s)', timeout_seconds, get_now_utc_as_formatted_string())
         else:
             loginfo(LOGGER, 'Closing PID module. No pending messages. (%s)', get_now_utc_as_formatted_string())
 
-        # Go through decision tree (close or wait for pending messages)
-        self.__close_decision_iterations = 1
+        # Close now, or wait for the confirmer to tell us that
+        # all messages were confirmed (or for the timeout):
         self.__is_in_process_of_gently_closing = True
-        self.recursive_decision_about_closing()
-        # This iteratively checks if all messages are published+confirmed.
-        # If not, it waits and then rechecks, up to a maximum number of iterations.
+        self.__deadline = time.time() + timeout_seconds
+        self.__seconds_blocked_before_finish = self.statemachine.get_seconds_blocked()
+        self.decide_about_closing()
+        if self.__is_in_process_of_gently_closing:
+            self.__schedule_timeout()
         # The main thread waits for this by using a threading.Event.
 
     ''' Called by builder (via thread), so close-events are not lost if a new ioloop is started.'''
     def continue_gently_closing_if_applicable(self):
         if self.__is_in_process_of_gently_closing:
-            logdebug(LOGGER, 'Continue gentle shutdown even after reconnect (iteration %i)...', self.__close_decision_iterations)
+            logdebug(LOGGER, 'Continue gentle shutdown even after reconnect...')
             if self.thread._connection is not None:
-                wait_seconds = defaults.RABBIT_ASYN_FINISH_WAIT_SECONDS
-                self.thread._connection.ioloop.call_later(wait_seconds, self.recursive_decision_about_closing)
+                self.__schedule_timeout()
+                self.thread._connection.ioloop.call_later(0, self.decide_about_closing)
             else:
                 logerror(LOGGER, 'Connection was None when trying to wait for pending messages (after reconnect). Synchronization error between threads!')
 
-    def recursive_decision_about_closing(self):
-        logdebug(LOGGER, 'Gentle finish (iteration %i): Deciding about whether we can close the thread or not...', self.__close_decision_iterations)
-        iteration = self.__close_decision_iterations
-        if self.__are_any_messages_pending():
-            self.__inform_about_pending_messages()
-            self.__decide_what_to_do_about_pending_messages(iteration)
-        else:
-            self.__close_because_all_done(iteration)
-
-    def __decide_what_to_do_about_pending_messages(self, iteration):
-        logdebug(LOGGER, 'Gentle finish (iteration %i): Decide what to do about the pending messages...', self.__close_decision_iterations)
-        if self.__have_we_waited_enough_now(iteration):
-            self.__close_because_waited_long_enough()
+    '''
+    Called by the confirmer (via thread), whenever there are
+    no more messages waiting for confirmation.
+    '''
+    def on_all_messages_confirmed(self):
+        if self.__is_in_process_of_gently_closing:
+            logdebug(LOGGER, 'Gentle finish: All published messages are confirmed.')
+            self.decide_about_closing()
+
+    '''
+    Closes if nothing is pending anymore, or if there is
+    no point in waiting. Otherwise, it does nothing, as we
+    will be notified by the confirmer (or the timeout).
+    '''
+    def decide_about_closing(self):
+        self.__decide_about_closing(timeout_reached=False)
+
+    '''
+    If the connection was blocked in the meantime, the deadline
+    may have moved, so we wait some more.
+    '''
+    def __on_timeout(self):
+        if self.__is_in_process_of_gently_closing and self.__get_extension_seconds() > 0 and time.time() < self.__get_deadline():
+            logdebug(LOGGER, 'Gentle finish: Extending the waiting time, as RabbitMQ blocked the connection for %.1f seconds.', self.__get_extension_seconds())
+            self.__schedule_timeout()
+            return
+        self.__decide_about_closing(timeout_reached=True)
+
+    def __decide_about_closing(self, timeout_reached):
+        if not self.__is_in_process_of_gently_closing:
+            logtrace(LOGGER, 'Gentle finish: Already closed, nothing to decide.')
+            return
+        logdebug(LOGGER, 'Gentle finish: Deciding about whether we can close the thread or not...')
+        if not self.__are_any_messages_pending():
+            self.__close_because_all_done()
         elif self.__module_is_not_progressing_anymore():
             self.__close_because_no_point_in_waiting()
+        elif timeout_reached or time.time() >= self.__get_deadline():
+            self.__close_because_waited_long_enough()
         else:
+            self.__inform_about_pending_messages()
             # Make sure the messages can be sent, in case some events
             # were lost during reconnecting or something...
             num_unpub = self.thread.get_num_unpublished()
-            logdebug(LOGGER, 'Triggering %i publish events...' % num_unpub)
-            for i in range(int(1.1*num_unpub)):
+            if num_unpub > 0:
+                logdebug(LOGGER, 'Triggering publish event for %i unpublished messages...', num_unpub)
                 self.thread.add_event_publish_message()
-            # Now wait some more...
-            self.__wait_some_more_and_redecide(iteration)
+            logdebug(LOGGER, 'Gentle finish: Waiting for the pending messages to be confirmed.')
+
+    '''
+    Adds the timeout to the ioloop. After a reconnect, this has to
+    be done again, as the events of the old ioloop are lost. The
+    timeout is computed from the deadline, so reconnects do not
+    prolong the waiting time.
+    '''
+    def __schedule_timeout(self):
+        if self.thread._connection is not None:
+            remaining_seconds = max(0, self.__get_deadline() - time.time())
+            logdebug(LOGGER, 'Gentle finish: Waiting up to %.1f seconds for pending messages.', remaining_seconds)
+            self.thread._connection.ioloop.call_later(remaining_seconds, self.__on_timeout)
+        else:
+            logerror(LOGGER, 'Connection was None when trying to wait for pending messages. Synchronization error between threads!')
 
-    # Decision rules:
+    def __get_extension_seconds(self):
+        seconds_blocked = self.statemachine.get_seconds_blocked() - self.__seconds_blocked_before_finish
+        return min(seconds_blocked, defaults.RABBIT_ASYN_FINISH_MAX_EXTENSION_SECONDS)
 
-    def __have_we_waited_enough_now(self, iteration):
-        logdebug(LOGGER, 'Gentle finish (iteration %i): Check if the rabbit thread has waited long enough...', self.__close_decision_iterations)
-
-        wait_seconds = defaults.RABBIT_ASYN_FINISH_WAIT_SECONDS
-        max_waits = defaults.RABBIT_ASYN_FINISH_MAX_TRIES
-
-        tried = iteration
-        waited = iteration-1
-
-        # Logging:
-        logdebug(LOGGER, 'Gentle finish (iteration %i): At this point we have tried %i times and waited %i/%i times (%i seconds)', self.__close_decision_iterations, tried, waited, max_waits, waited*wait_seconds)
-        log_every_x_seconds = 2
-        if ((waited*wait_seconds)%log_every_x_seconds==0 or waited>=max_waits):
-            msg = self.__get_string_about_pending_messages()
-            loginfo(LOGGER, 'Still pending: %s messages... (waited %.1f/%.1f seconds)', msg, waited*wait_seconds, max_waits*wait_seconds)
-        
-        # Return:
-        if waited >= max_waits:
-            logdebug(LOGGER, 'Gentle finish (iteration %i): The rabbit thread has waited long enough for pending messages at close down.', self.__close_decision_iterations)
-            return True
-        logdebug(LOGGER, 'Gentle finish (iteration %i): We should wait a little more for pending messages.', self.__close_decision_iterations)
-        return False
+    def __get_deadline(self):
+        return self.__deadline + self.__get_extension_seconds()
+
+    # Decision rules:
 
     def __are_any_messages_pending(self):
-        logdebug(LOGGER, 'Gentle finish (iteration %i): Checking for any pending messages...', self.__close_decision_iterations)
+        logdebug(LOGGER, 'Gentle finish: Checking for any pending messages...')
         sent_done = self.__check_all_were_sent()
         confirmed_done = self.__check_all_were_confirmed()
         if sent_done and confirmed_done:
-            logdebug(LOGGER, 'Gentle finish (iteration %i): No more pending messages.', self.__close_decision_iterations)
+            logdebug(LOGGER, 'Gentle finish: No more pending messages.')
             return False # none pending
-        logdebug(LOGGER, 'Gentle finish (iteration %i): Some pending messages left.', self.__close_decision_iterations)
+        logdebug(LOGGER, 'Gentle finish: Some pending messages left.')
         return True # some are pending
 
     def __check_all_were_sent(self):
@@ -157,44 +207,24 @@ class ShutDowner(object):
 
     def __module_is_not_progressing_anymore(self):
         if self.statemachine.is_PERMANENTLY_UNAVAILABLE() or self.statemachine.is_FORCE_FINISHED():
-            logdebug(LOGGER, 'Gentle finish (iteration %i): The rabbit thread is not active anymore, so we might as well close it.', self.__close_decision_iterations)
+            logdebug(LOGGER, 'Gentle finish: The rabbit thread is not active anymore, so we might as well close it.')
             return True
         return False
 
-    def __wait_some_more_and_redecide(self, iteration):
-        wait_seconds = defaults.RABBIT_ASYN_FINISH_WAIT_SECONDS
-        logdebug(LOGGER, 'Gentle finish (iteration %i): Waiting some more for pending messages...', self.__close_decision_iterations)
-        # Instead of time.sleep(), add an event to the thread's ioloop
-        self.__close_decision_iterations += 1
-        if self.thread._connection is not None:
-            self.thread._connection.ioloop.call_later(wait_seconds, self.recursive_decision_about_closing)
-            self.__is_in_process_of_gently_closing = True
-            # Problem: If a reconnect occurs after this, this event will be lost.
-            # I cannot retrieve if from the ioloop and pass it to the new one.
-            # So, during a reconnection, we check if gently-finish was running,
-            # and add a new timeout to the new ioloop, using
-            # "continue_gently_closing_if_applicable()".
-            # This may mess up the amount of time the gently-finish takes, though.
-            # TODO Maybe one day it is possible to transfer events from one ioloop to
-            # another?
-        else:
-            logerror(LOGGER, 'Connection was None when trying to wait for pending messages. Synchronization error between threads!')
-
-    
     def __tell_publisher_to_stop_waiting_for_gentle_finish(self):
         logdebug(LOGGER, 'Main thread does not need to wait anymore. (%s).', get_now_utc_as_formatted_string())
 
-        # This avoids that the last iteration is redone
-        # and redone upon reconnection, as after reconnection,
-        # if this is True, the algorithm is entered again.
+        # This avoids that the decision is redone upon
+        # reconnection, on the timeout or on a confirm,
+        # as in all these cases, if this is True, the
+        # algorithm is entered again.
         self.__is_in_process_of_gently_closing = False
 
         # This releases the event that blocks the main thread
         # until the gentle finish is done.
         self.thread.tell_publisher_to_stop_waiting_for_gentle_finish()
 
-    def __close_because_all_done(self, iteration):
-        logdebug(LOGGER, 'Gentle finish (iteration %i): All messages sent and confirmed in %ith try (waited and rechecked %i times).', self.__close_decision_iterations, iteration, iteration-1)
+    def __close_because_all_done(self):
         loginfo(LOGGER, 'All messages sent and confirmed. Closing.')
         self.__normal_finish()
         self.__tell_publisher_to_stop_waiting_for_gentle_finish()
@@ -202,7 +232,7 @@ class ShutDowner(object):
     def __close_because_no_point_in_waiting(self):
 
         # Logging, depending on why we closed...
-        logdebug(LOGGER, 'Gentle finish (iteration %i): Closing, as there is no point in waiting any longer.', self.__close_decision_iterations)
+        logdebug(LOGGER, 'Gentle finish: Closing, as there is no point in waiting any longer.')
         if self.statemachine.get_detail_closed_by_publisher():
             logwarn(LOGGER, 'Not waiting for pending messages: No connection to server (previously closed by user).')
         elif self.statemachine.detail_could_not_connect:
@@ -215,6 +245,8 @@ class ShutDowner(object):
         self.__tell_publisher_to_stop_waiting_for_gentle_finish()
 
     def __close_because_waited_long_enough(self):
+        msg = self.__get_string_about_pending_messages()
+        loginfo(LOGGER, 'Still pending after %.1f seconds: %s messages.', defaults.RABBIT_ASYN_FINISH_TIMEOUT_SECONDS+self.__get_extension_seconds(), msg)
         logdebug(LOGGER, 'We have waited long enough. Now closing by force.')
         self.__force_finish('Force finish as normal waiting period in normal finish is over.')
         self.__tell_publisher_to_stop_waiting_for_gentle_finish()
@@ -1,5 +1,7 @@
 
 
+import time
+
 class StateMachine(object):
     
     def __init__(self):
@@ -21,6 +23,12 @@ class StateMachine(object):
         self.detail_asked_to_gently_close_by_publisher = False
         self.detail_could_not_connect = False
 
+        # Flow control: RabbitMQ may block the connection (e.g.
+        # during a memory or disk alarm). This does not change the
+        # state, but publishing is paused while it is blocked.
+        self.__blocked_since = None
+        self.__seconds_blocked = 0.0
+
     #
     # Setters
     #
@@ -122,4 +130,33 @@ class StateMachine(object):
             self.__detail_closed_by_publisher = True
 
     def get_detail_closed_by_publisher(self):
-        return self.__detail_closed_by_publisher
\ No newline at end of file
+        return self.__detail_closed_by_publisher
+
+    #
+    # Flow control
+    #
+
+    ''' Called by the rabbit thread.'''
+    def set_detail_connection_blocked(self):
+        if self.__blocked_since is None:
+            self.__blocked_since = time.time()
+
+    ''' Called by the rabbit thread.'''
+    def set_detail_connection_unblocked(self):
+        if self.__blocked_since is not None:
+            self.__seconds_blocked += time.time() - self.__blocked_since
+            self.__blocked_since = None
+
+    def is_connection_blocked(self):
+        if self.__blocked_since is None:
+            return False
+        return True
+
+    '''
+    Total time that the connection(s) were blocked by RabbitMQ,
+    including the current blocking, if any.
+    '''
+    def get_seconds_blocked(self):
+        if self.__blocked_since is None:
+            return self.__seconds_blocked
+        return self.__seconds_blocked + (time.time() - self.__blocked_since)
\ No newline at end of file
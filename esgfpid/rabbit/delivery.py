@@ -0,0 +1,242 @@
+import time
+import logging
+import threading
+from esgfpid.exceptions import MessageNotDeliveredException
+from esgfpid.utils import logerror
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+================
+Delivery futures
+================
+
+In asynchronous mode, the messages are handed over to the rabbit
+thread, and their delivery confirmation arrives later. To let the
+caller know whether a message was delivered, each message (each
+MessageEnvelope) carries a DeliveryFuture, which is returned by the
+RabbitMessageSender's send methods.
+
+A future is resolved exactly once (the first resolution wins):
+
+ * delivered by the Confirmer, when RabbitMQ acked the message,
+ * not delivered by the Confirmer, when RabbitMQ nacked it,
+ * not delivered by the UnacceptedMessagesHandler, when RabbitMQ
+   returned it a second time (with the emergency routing key),
+ * not delivered by the AsynchronousRabbitConnector, when the
+   message was still unpublished or unconfirmed after the thread
+   was finished, or when it was refused or dropped.
+
+If RabbitMQ returns a message the first time, it is resent as a new
+envelope, and the future is handed over to that one.
+
+The futures are small (they only store their state), and all of
+them share one condition, which is only used to wake up threads
+that wait for a future. So they can be attached to each message
+without costing much.
+
+An AggregateDeliveryFuture is resolved once all the futures it
+contains are resolved (e.g. all messages of a dataset).
+
+API:
+ * DeliveryFuture.done(), wait(), succeeded(), exception() and
+   add_done_callback(), called by the library user.
+ * DeliveryFuture.set_delivered() and set_not_delivered(), called
+   by the modules listed above (via the helper functions).
+ * set_delivered() and set_not_delivered() called by the modules
+   listed above, for lists of messages that may or may not carry
+   a future.
+
+'''
+
+'''
+Shared by all futures: Protects their state, and wakes up the
+threads that wait for any of them.
+'''
+_CONDITION = threading.Condition()
+
+
+class DeliveryFuture(object):
+
+    __slots__ = ('__done', '__exception', '__callbacks')
+
+    def __init__(self):
+        self.__done = False
+        self.__exception = None
+        self.__callbacks = None
+
+    '''
+    :return: True if the message was delivered or if
+        it failed, False while it is still on its way.
+    '''
+    def done(self):
+        return self.__done
+
+    '''
+    :return: True if the message was delivered (i.e.
+        confirmed by RabbitMQ), False otherwise.
+    '''
+    def succeeded(self):
+        return self.__done and self.__exception is None
+
+    '''
+    :return: The exception that tells why the message was not
+        delivered. None if it was delivered, or if it is still
+        on its way (see done()).
+    '''
+    def exception(self):
+        return self.__exception
+
+    '''
+    Block until the future is resolved.
+
+    :param timeout: Optional. Maximum number of seconds to wait.
+        If None, it waits until the future is resolved.
+    :return: True if the future was resolved, False if the
+        timeout expired before.
+    '''
+    def wait(self, timeout=None):
+        with _CONDITION:
+            if timeout is None:
+                while not self.__done:
+                    _CONDITION.wait()
+            else:
+                # The condition is shared, so we may be woken up
+                # by other futures, and have to wait again:
+                deadline = time.time() + timeout
+                remaining = timeout
+                while not self.__done and remaining > 0:
+                    _CONDITION.wait(remaining)
+                    remaining = deadline - time.time()
+            return self.__done
+
+    '''
+    Add a function that is called with the future as its only
+    argument once the future is resolved. If it is resolved
+    already, the function is called right away.
+
+    Note: The function is usually called by the rabbit thread,
+    so it must be fast and must not block.
+    '''
+    def add_done_callback(self, function):
+        with _CONDITION:
+            if not self.__done:
+                if self.__callbacks is None:
+                    self.__callbacks = []
+                self.__callbacks.append(function)
+                return
+        _call(function, self)
+
+    '''
+    Called when RabbitMQ confirmed the message.
+
+    :return: True if this resolved the future, False if it
+        had been resolved before.
+    '''
+    def set_delivered(self):
+        return self.__resolve(None)
+
+    '''
+    Called when the message cannot be delivered.
+
+    :param exception: The exception that tells why.
+    :return: True if this resolved the future, False if it
+        had been resolved before.
+    '''
+    def set_not_delivered(self, exception):
+        return self.__resolve(exception)
+
+    def __resolve(self, exception):
+        with _CONDITION:
+            if self.__done:
+                return False
+            self.__exception = exception
+            self.__done = True
+            callbacks = self.__callbacks
+            self.__callbacks = None
+            _CONDITION.notify_all()
+        if callbacks is not None:
+            for function in callbacks:
+                _call(function, self)
+        return True
+
+
+class AggregateDeliveryFuture(DeliveryFuture):
+
+    '''
+    A future for several messages. It is resolved once all of
+    the given futures are resolved. It succeeds if all of
+    them succeeded. Otherwise, its exception is a
+    MessageNotDeliveredException listing the undelivered
+    messages (in their order).
+
+    :param futures: List of DeliveryFutures (may be empty).
+    '''
+    def __init__(self, futures):
+        super(AggregateDeliveryFuture, self).__init__()
+        self.futures = list(futures)
+        self.__num_pending = len(self.futures)
+        if self.__num_pending == 0:
+            self.set_delivered()
+        for future in self.futures:
+            future.add_done_callback(self.__on_one_done)
+
+    '''
+    :return: The number of messages that were delivered so far.
+    '''
+    def get_num_delivered(self):
+        return sum(1 for future in self.futures if future.succeeded())
+
+    def __on_one_done(self, unused_future):
+        with _CONDITION:
+            self.__num_pending -= 1
+            all_done = self.__num_pending == 0
+        if all_done:
+            self.__on_all_done()
+
+    def __on_all_done(self):
+        undelivered = [_get_message(future.exception()) for future in self.futures if not future.succeeded()]
+        if len(undelivered) == 0:
+            self.set_delivered()
+        else:
+            msg = '%i of %i messages were not delivered' % (len(undelivered), len(self.futures))
+            self.set_not_delivered(MessageNotDeliveredException(msg, undelivered[0], undelivered))
+
+
+#
+# Helpers
+#
+
+'''
+Resolve the futures of the given messages (if they carry one)
+as delivered.
+'''
+def set_delivered(messages):
+    for message in messages:
+        future = getattr(message, 'future', None)
+        if future is not None:
+            future.set_delivered()
+
+'''
+Resolve the futures of the given messages (if they carry one)
+as not delivered.
+
+:param messages: The messages.
+:param reason: String that tells why.
+'''
+def set_not_delivered(messages, reason):
+    for message in messages:
+        future = getattr(message, 'future', None)
+        if future is not None:
+            future.set_not_delivered(MessageNotDeliveredException(reason, message))
+
+def _get_message(exception):
+    return getattr(exception, 'rabbit_msg', None)
+
+def _call(function, future):
+    try:
+        function(future)
+    except Exception as e:
+        # Never let the library user's callback break the rabbit thread:
+        logerror(LOGGER, 'Error in callback of delivery future: %s: %s', e.__class__.__name__, e)
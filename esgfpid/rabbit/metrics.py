@@ -0,0 +1,297 @@
+import time
+import logging
+import threading
+from .rabbitutils import MessageEnvelope
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+=======
+Metrics
+=======
+
+The metrics registry records what happens to the messages on their
+way to RabbitMQ, so that the throughput of a publisher can be measured
+instead of guessed:
+
+ * How long a message waits in the queue (enqueued -> published).
+ * How long it waits for its confirm (published -> acked).
+ * How long it takes altogether (enqueued -> acked).
+ * How long the module spends reconnecting (first failed connection
+   attempt -> ready for publishing again).
+ * How many messages were enqueued, refused (by the limiter),
+   published, republished (after a reconnection), acked, nacked and
+   returned, and how many reconnection attempts were made.
+ * The current queue depths (via gauge functions, which are only
+   called when a snapshot is made).
+
+It is only used in asynchronous mode, and only if it was switched on
+(see "messaging_service_metrics" in the connector). It is filled by
+callbacks from the AsynchronousRabbitConnector (main thread, enqueue)
+and from the RabbitFeeder, the Confirmer, the UnacceptedMessagesHandler
+and the ConnectionBuilder (rabbit thread), so it is thread-safe. If
+messages are distributed over several nodes, all connectors share one
+registry.
+
+The time when a message was enqueued is stored in the message itself
+(they are wrapped in MessageEnvelopes in asynchronous mode), so it
+survives the message being spilled to disk by the limiter (which
+creates a new object). Once a message is published, it is recognized
+by its identity. The registry keeps a reference to each published
+message until it is confirmed (or left over when the thread finished),
+so that the identity cannot be reused in the meantime.
+
+API:
+ * on_...() called by the modules listed above.
+ * add_gauge() called by the AsynchronousRabbitConnector.
+ * get_snapshot() and get_prometheus_text() called by the library user
+   (via the RabbitMessageSender and the Connector).
+
+'''
+
+'''
+Upper bounds (in seconds) of the histogram buckets of the durations.
+'''
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+COUNTERS = [
+    ('messages_enqueued', 'Messages handed over to the sender.'),
+    ('messages_refused', 'Messages refused because too many were in flight.'),
+    ('messages_published', 'Messages published to RabbitMQ (first publication).'),
+    ('messages_republished', 'Messages published again after a reconnection.'),
+    ('messages_acked', 'Messages confirmed (ack) by RabbitMQ.'),
+    ('messages_nacked', 'Messages rejected (nack) by RabbitMQ.'),
+    ('messages_returned', 'Messages returned by RabbitMQ as unroutable.'),
+    ('reconnections', 'Reconnection attempts.')
+]
+
+DURATIONS = [
+    ('queue_seconds', 'Time between enqueueing and publishing a message.'),
+    ('confirm_seconds', 'Time between publishing a message and its ack.'),
+    ('total_seconds', 'Time between enqueueing a message and its ack.'),
+    ('reconnection_seconds', 'Time from a failed connection until ready for publishing again.')
+]
+
+class PublishMetrics(object):
+
+    '''
+    :param clock: Optional. Function returning the current
+        time in seconds. Defaults to time.time (only passed
+        by unit tests).
+    '''
+    def __init__(self, clock=None):
+        if clock is None:
+            clock = time.time
+        self.__clock = clock
+        self.__lock = threading.Lock()
+
+        self.__counters = dict((name, 0) for name, unused in COUNTERS)
+        self.__durations = dict((name, Histogram()) for name, unused in DURATIONS)
+
+        '''
+        Name -> list of functions returning a number. If several
+        connectors register the same gauge, the values are added.
+        '''
+        self.__gauges = {}
+
+        '''
+        Messages that were published and wait to be confirmed.
+        id(message) -> [message, enqueue time, publish time]
+        '''
+        self.__pending = {}
+
+        '''
+        Time of the first failed connection since the module
+        was last ready, or None if it is not reconnecting.
+        '''
+        self.__reconnecting_since = None
+
+    #################
+    ### Callbacks ###
+    #################
+
+    ''' Called by the AsynchronousRabbitConnector (main thread). '''
+    def on_messages_enqueued(self, messages):
+        now = self.__clock()
+        with self.__lock:
+            self.__counters['messages_enqueued'] += len(messages)
+            for message in messages:
+                if isinstance(message, MessageEnvelope):
+                    message.enqueued_at = now
+
+    '''
+    Called by the AsynchronousRabbitConnector (main thread) if
+    the limiter did not accept some of the enqueued messages.
+    '''
+    def on_messages_refused(self, messages):
+        with self.__lock:
+            self.__counters['messages_refused'] += len(messages)
+
+    ''' Called by the RabbitFeeder after a successful publish. '''
+    def on_message_published(self, message):
+        now = self.__clock()
+        with self.__lock:
+            entry = self.__pending.get(id(message))
+            if entry is None:
+                # Enqueue time is None e.g. for a returned message,
+                # which was not enqueued by the library caller.
+                self.__counters['messages_published'] += 1
+                enqueued_at = getattr(message, 'enqueued_at', None)
+                if enqueued_at is not None:
+                    self.__durations['queue_seconds'].observe(now - enqueued_at)
+                self.__pending[id(message)] = [message, enqueued_at, now]
+            else:
+                self.__counters['messages_republished'] += 1
+                entry[2] = now
+
+    ''' Called by the Confirmer. '''
+    def on_messages_acked(self, messages):
+        now = self.__clock()
+        with self.__lock:
+            self.__counters['messages_acked'] += len(messages)
+            for message in messages:
+                entry = self.__pending.pop(id(message), None)
+                if entry is None:
+                    continue
+                if entry[2] is not None:
+                    self.__durations['confirm_seconds'].observe(now - entry[2])
+                if entry[1] is not None:
+                    self.__durations['total_seconds'].observe(now - entry[1])
+
+    ''' Called by the Confirmer. '''
+    def on_messages_nacked(self, messages):
+        with self.__lock:
+            self.__counters['messages_nacked'] += len(messages)
+            for message in messages:
+                self.__pending.pop(id(message), None)
+
+    '''
+    Called by the AsynchronousRabbitConnector after the thread
+    finished, with the messages that were not confirmed, so
+    they are not kept forever.
+    '''
+    def on_messages_left_over(self, messages):
+        with self.__lock:
+            for message in messages:
+                self.__pending.pop(id(message), None)
+
+    ''' Called by the UnacceptedMessagesHandler. '''
+    def on_message_returned(self):
+        with self.__lock:
+            self.__counters['messages_returned'] += 1
+
+    '''
+    Called by the ConnectionBuilder whenever it schedules
+    a new connection attempt after a failure.
+    '''
+    def on_reconnection_scheduled(self):
+        now = self.__clock()
+        with self.__lock:
+            self.__counters['reconnections'] += 1
+            if self.__reconnecting_since is None:
+                self.__reconnecting_since = now
+
+    '''
+    Called by the ConnectionBuilder when the connection
+    is ready for publishing.
+    '''
+    def on_connection_ready(self):
+        now = self.__clock()
+        with self.__lock:
+            if self.__reconnecting_since is not None:
+                self.__durations['reconnection_seconds'].observe(now - self.__reconnecting_since)
+                self.__reconnecting_since = None
+
+    '''
+    Registers a function that returns the current value of
+    a gauge (e.g. the number of unpublished messages).
+
+    :param name: Name of the gauge, e.g. "messages_unpublished".
+    :param function: Function without arguments that returns
+        a number. Called whenever a snapshot is made.
+    '''
+    def add_gauge(self, name, function):
+        with self.__lock:
+            self.__gauges.setdefault(name, []).append(function)
+
+    ###############
+    ### Reports ###
+    ###############
+
+    '''
+    :return: A dictionary with the counters (integers), the
+        durations (dictionaries with "count", "sum", "max"
+        and "buckets", the latter mapping the upper bounds to
+        the cumulative counts) and the gauges (numbers).
+    '''
+    def get_snapshot(self):
+        with self.__lock:
+            snapshot = dict(self.__counters)
+            for name, histogram in self.__durations.items():
+                snapshot[name] = histogram.get_snapshot()
+            gauges = dict((name, functions[:]) for name, functions in self.__gauges.items())
+        # Gauges are evaluated outside of the lock, as they
+        # may need locks of their own:
+        for name, functions in gauges.items():
+            snapshot[name] = sum(function() for function in functions)
+        return snapshot
+
+    '''
+    :param prefix: Optional. Prefix for the metric names.
+    :return: The snapshot in the Prometheus text exposition
+        format (version 0.0.4), as a string.
+    '''
+    def get_prometheus_text(self, prefix='esgfpid_'):
+        snapshot = self.get_snapshot()
+        lines = []
+        for name, helptext in COUNTERS:
+            metric = prefix+name+'_total'
+            lines.append('# HELP %s %s' % (metric, helptext))
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %s' % (metric, snapshot[name]))
+        for name, helptext in DURATIONS:
+            metric = prefix+name
+            histogram = snapshot[name]
+            lines.append('# HELP %s %s' % (metric, helptext))
+            lines.append('# TYPE %s histogram' % metric)
+            for bound in LATENCY_BUCKETS:
+                lines.append('%s_bucket{le="%s"} %i' % (metric, bound, histogram['buckets'][bound]))
+            lines.append('%s_bucket{le="+Inf"} %i' % (metric, histogram['count']))
+            lines.append('%s_sum %s' % (metric, repr(histogram['sum'])))
+            lines.append('%s_count %i' % (metric, histogram['count']))
+        for name in sorted(set(snapshot.keys()) - set(self.__counters.keys()) - set(self.__durations.keys())):
+            metric = prefix+name
+            lines.append('# TYPE %s gauge' % metric)
+            lines.append('%s %s' % (metric, snapshot[name]))
+        return '\n'.join(lines)+'\n'
+
+'''
+Counts durations in buckets (see LATENCY_BUCKETS).
+Not thread-safe, the PublishMetrics take care of locking.
+'''
+class Histogram(object):
+
+    def __init__(self):
+        self.__bucket_counts = [0]*len(LATENCY_BUCKETS)
+        self.__count = 0
+        self.__sum = 0.0
+        self.__max = 0.0
+
+    def observe(self, seconds):
+        self.__count += 1
+        self.__sum += seconds
+        if seconds > self.__max:
+            self.__max = seconds
+        for i in range(len(LATENCY_BUCKETS)):
+            if seconds <= LATENCY_BUCKETS[i]:
+                self.__bucket_counts[i] += 1
+                break
+
+    def get_snapshot(self):
+        buckets = {}
+        cumulative = 0
+        for i in range(len(LATENCY_BUCKETS)):
+            cumulative += self.__bucket_counts[i]
+            buckets[LATENCY_BUCKETS[i]] = cumulative
+        return dict(count=self.__count, sum=self.__sum, max=self.__max, buckets=buckets)
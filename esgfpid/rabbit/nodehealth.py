@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+import esgfpid.defaults
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+CACHE_FILE_NAME = 'esgfpid_node_health.json'
+
+'''
+===========
+Node health
+===========
+
+Keeps track of which RabbitMQ nodes failed recently, so that a node
+that keeps failing is skipped for a while ("circuit breaker"), instead
+of being retried again and again while other nodes are available.
+
+For each node, the consecutive connection failures are counted. Once
+there were RABBIT_NODE_FAILURES_BEFORE_COOLDOWN of them, the node is
+"cooling down" for RABBIT_NODE_COOLDOWN_SECONDS after its last failure.
+During that time, the NodeManager only selects it once no other node
+is left to try. After that time, it is tried normally again; if it
+fails once more, it cools down again right away. A successful
+connection resets the count.
+
+It also remembers how long connecting to each node took, so that the
+NodeManager can prefer the nodes that answer fast over the slow ones
+(and over the ones that failed recently) within a priority.
+
+There is one process-wide instance (NODE_HEALTH), shared by all
+NodeManagers (and all threads), so that every connector created
+during the process lifetime profits from what the earlier ones
+found out.
+
+Optionally, the information is also kept in a small JSON file in a
+directory (see get_node_health()), so that it is shared by all
+processes that use the same directory, e.g. many short-lived
+publisher processes. The file is re-read whenever another process
+changed it, and every change is merged into the latest version and
+written atomically (via a temporary file), so that concurrent
+processes cannot corrupt it (at worst, one change of a concurrent
+process is lost). Problems with the file are logged and ignored, as
+the cache is only an optimization. Entries that were not updated for
+RABBIT_NODE_HEALTH_MAX_AGE_SECONDS are dropped.
+
+API:
+ * record_failure() and record_success() called by the NodeManager,
+   when the connection modules report on the current node.
+ * is_cooling_down() and get_preferred_keys() called by the
+   NodeManager, to select nodes.
+ * get_node_health() called by the RabbitMessageSender, to get the
+   instance for a cache directory.
+
+'''
+
+'''
+Instances for cache directories (directory -> NodeHealth), so
+that all NodeManagers of the process that use the same directory
+share one instance.
+'''
+_INSTANCES_PER_DIR = {}
+_INSTANCES_LOCK = threading.Lock()
+
+'''
+:param cache_dir: Optional. Directory for the cache file. If
+    None, the process-wide instance without a file is returned.
+:return: The NodeHealth object to be used by the NodeManagers.
+'''
+def get_node_health(cache_dir=None):
+    if cache_dir is None:
+        return NODE_HEALTH
+    cache_dir = os.path.abspath(cache_dir)
+    with _INSTANCES_LOCK:
+        if cache_dir not in _INSTANCES_PER_DIR:
+            _INSTANCES_PER_DIR[cache_dir] = NodeHealth(cache_file=os.path.join(cache_dir, CACHE_FILE_NAME))
+        return _INSTANCES_PER_DIR[cache_dir]
+
+class NodeHealth(object):
+
+    '''
+    :param clock: Optional. Function returning the current
+        time in seconds. Defaults to time.time (only passed
+        by unit tests).
+    :param cache_file: Optional. Path of the JSON file to
+        share the information with other processes. If None,
+        it is only kept in memory.
+    '''
+    def __init__(self, clock=None, cache_file=None):
+        if clock is None:
+            clock = time.time
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__cache_file = cache_file
+
+        '''
+        Node key -> dictionary with "failures" (number of
+        consecutive failures), "last_failure" (time of the last
+        failure), "connect_seconds" (how long the last successful
+        connections took, smoothed) and "updated" (time of the last
+        change).
+        '''
+        self.__nodes = {}
+
+        '''
+        Modification time and size of the cache file when it was
+        last read or written (to notice changes by other processes).
+        '''
+        self.__cache_stamp = None
+
+        if self.__cache_file is not None:
+            logdebug(LOGGER, 'Using node health cache file %s.', self.__cache_file)
+            with self.__lock:
+                self.__reload_if_changed()
+
+    def record_failure(self, node_key):
+        with self.__lock:
+            self.__reload_if_changed()
+            entry = self.__get_entry(node_key)
+            entry['failures'] += 1
+            entry['last_failure'] = entry['updated'] = self.__clock()
+            num = entry['failures']
+            self.__save()
+        if num == esgfpid.defaults.RABBIT_NODE_FAILURES_BEFORE_COOLDOWN:
+            loginfo(LOGGER, 'RabbitMQ node %s failed %i times in a row. Skipping it for %s seconds, if possible.',
+                node_key, num, esgfpid.defaults.RABBIT_NODE_COOLDOWN_SECONDS)
+
+    '''
+    :param node_key: The node that was connected to.
+    :param connect_seconds: Optional. How long connecting took.
+    '''
+    def record_success(self, node_key, connect_seconds=None):
+        with self.__lock:
+            self.__reload_if_changed()
+            entry = self.__get_entry(node_key)
+            entry['failures'] = 0
+            entry['last_failure'] = None
+            entry['updated'] = self.__clock()
+            if connect_seconds is not None:
+                if entry['connect_seconds'] is None:
+                    entry['connect_seconds'] = connect_seconds
+                else:
+                    # Smooth it, one slow connection should not count too much:
+                    entry['connect_seconds'] = (entry['connect_seconds'] + connect_seconds) / 2.0
+            self.__save()
+
+    def is_cooling_down(self, node_key):
+        with self.__lock:
+            self.__reload_if_changed()
+            entry = self.__nodes.get(node_key)
+            if entry is None or entry['failures'] < esgfpid.defaults.RABBIT_NODE_FAILURES_BEFORE_COOLDOWN:
+                return False
+            return (self.__clock() - entry['last_failure']) < esgfpid.defaults.RABBIT_NODE_COOLDOWN_SECONDS
+
+    '''
+    Returns the nodes to choose from (randomly, to spread the
+    load): The ones with the fewest recent failures, and of
+    those, the ones that did not take much longer to connect
+    than the fastest one (see RABBIT_NODE_LATENCY_TOLERANCE).
+    Nodes without any known connection time are kept, so that
+    they get a chance.
+
+    :param node_keys: List of node keys.
+    :return: List of node keys (a subset, in the same order).
+    '''
+    def get_preferred_keys(self, node_keys):
+        with self.__lock:
+            self.__reload_if_changed()
+            entries = [self.__nodes.get(key) for key in node_keys]
+        failures = [0 if entry is None else entry['failures'] for entry in entries]
+        seconds = [None if entry is None else entry['connect_seconds'] for entry in entries]
+        least_failures = min(failures) if len(failures) > 0 else 0
+        known = [seconds[i] for i in range(len(node_keys)) if failures[i] == least_failures and seconds[i] is not None]
+        limit = None
+        if len(known) > 0:
+            limit = min(known) * esgfpid.defaults.RABBIT_NODE_LATENCY_TOLERANCE
+        preferred = []
+        for i in range(len(node_keys)):
+            if failures[i] != least_failures:
+                continue
+            if limit is not None and seconds[i] is not None and seconds[i] > limit:
+                continue
+            preferred.append(node_keys[i])
+        return preferred
+
+    '''
+    Forget all failures. Called by unit tests.
+    '''
+    def reset(self):
+        with self.__lock:
+            self.__nodes = {}
+
+    ###############
+    ### Helpers ###
+    ###############
+
+    def __get_entry(self, node_key):
+        if node_key not in self.__nodes:
+            self.__nodes[node_key] = dict(failures=0, last_failure=None, connect_seconds=None, updated=None)
+        return self.__nodes[node_key]
+
+    '''
+    Reads the cache file if it was changed since it was last read.
+    Not thread-safe, the lock has to be held by the caller.
+    '''
+    def __reload_if_changed(self):
+        if self.__cache_file is None:
+            return
+        try:
+            stamp = self.__get_cache_stamp()
+        except OSError:
+            return # Not created yet
+        if stamp == self.__cache_stamp:
+            return
+        try:
+            with open(self.__cache_file, 'r') as cachefile:
+                nodes = json.load(cachefile)['nodes']
+            self.__nodes.update(nodes)
+            self.__cache_stamp = stamp
+            logtrace(LOGGER, 'Read node health cache (%i nodes).', len(nodes))
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            logwarn(LOGGER, 'Could not read node health cache file %s (%s: %s). Ignoring it.', self.__cache_file, e.__class__.__name__, e)
+            self.__cache_stamp = stamp
+
+    def __get_cache_stamp(self):
+        stat = os.stat(self.__cache_file)
+        return (stat.st_mtime, stat.st_size)
+
+    '''
+    Atomically replaces the cache file by the current information.
+    Not thread-safe, the lock has to be held by the caller.
+    '''
+    def __save(self):
+        if self.__cache_file is None:
+            return
+        now = self.__clock()
+        for key in list(self.__nodes.keys()):
+            updated = self.__nodes[key]['updated']
+            if updated is not None and now - updated > esgfpid.defaults.RABBIT_NODE_HEALTH_MAX_AGE_SECONDS:
+                del self.__nodes[key]
+        directory = os.path.dirname(self.__cache_file)
+        tmpname = None
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            filedesc, tmpname = tempfile.mkstemp(dir=directory, prefix='.'+CACHE_FILE_NAME)
+            with os.fdopen(filedesc, 'w') as tmpfile:
+                json.dump(dict(version=1, nodes=self.__nodes), tmpfile)
+            os.rename(tmpname, self.__cache_file)
+            self.__cache_stamp = self.__get_cache_stamp()
+        except (IOError, OSError) as e:
+            logwarn(LOGGER, 'Could not write node health cache file %s (%s: %s).', self.__cache_file, e.__class__.__name__, e)
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
+
+NODE_HEALTH = NodeHealth()
@@ -7,6 +7,7 @@ import esgfpid.defaults
 import esgfpid.exceptions
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times, make_logsafe
 from .naturalsorting import natural_keys
+from .nodehealth import NODE_HEALTH
 import esgfpid.utils
 
 LOGGER = logging.getLogger(__name__)
@@ -34,16 +35,31 @@ responsible for providing this info to the library.
 It can deal with trusted and open nodes and with integer
 priorities. It returns the instance access info dictionaries
 in a well-defined order, 
+
+Nodes that failed several times in a row recently (see nodehealth.py)
+are skipped as long as other nodes are left to try. Within a priority,
+the nodes that connected fast before are preferred (instead of picking
+any node at random). The connection modules report the failures and
+successes via report_failure_of_current() and
+report_success_of_current().
 '''
 class NodeManager(object):
 
     '''
-    Constructor that takes no params. It creates an empty
-    container for RabbitMQ node information. The node 
-    information then has to be added using "add_trusted_node()"
-    and "add_open_node()".
+    Constructor. It creates an empty container for RabbitMQ
+    node information. The node information then has to be
+    added using "add_trusted_node()" and "add_open_node()".
+
+    :param node_health: Optional. NodeHealth object that keeps
+        track of failing and slow nodes. Defaults to the
+        process-wide one.
     '''
-    def __init__(self):
+    def __init__(self, node_health=None):
+
+        # Failing nodes (shared by all node managers of the process)
+        if node_health is None:
+            node_health = NODE_HEALTH
+        self.__node_health = node_health
 
         # Props for basic_publish (needed by thread_feeder)
         self.__properties = pika.BasicProperties(
@@ -305,7 +321,6 @@ class NodeManager(object):
             # TODO Test and fix SSL in pika with python 3.7
 
         # Get some defaults:
-        socket_timeout = esgfpid.defaults.RABBIT_PIKA_SOCKET_TIMEOUT
         connection_attempts = esgfpid.defaults.RABBIT_PIKA_CONNECTION_ATTEMPTS
         retry_delay = esgfpid.defaults.RABBIT_PIKA_CONNECTION_RETRY_DELAY_SECONDS
         
@@ -317,7 +332,6 @@ class NodeManager(object):
             port=port,
             virtual_host=vhost,
             credentials=credentials,
-            socket_timeout=socket_timeout,
             connection_attempts=connection_attempts,
             retry_delay=retry_delay,
             heartbeat=heartbeat,
@@ -426,22 +440,74 @@ class NodeManager(object):
 
     def __get_highest_priority_node(self, dict_of_nodes):
 
-        # Get highest priority:
+        # Get highest priority (skipping the priorities whose
+        # nodes are all cooling down after failures, if possible):
         available_priorities = list(dict_of_nodes.keys())
         available_priorities.sort(key=natural_keys)
-        current_priority = available_priorities.pop(0)
+        current_priority = available_priorities[0]
+        for prio in available_priorities:
+            if len(self.__get_nodes_not_cooling_down(dict_of_nodes[prio])) > 0:
+                current_priority = prio
+                break
         list_of_priority_nodes = dict_of_nodes[current_priority]
 
-        # Select one of them
-        if len(list_of_priority_nodes)==1:
-            nexthost = list_of_priority_nodes.pop()
-            if len(list_of_priority_nodes)==0:
-                dict_of_nodes.pop(current_priority)
-            return nexthost
-        else:
-            nexthost = self.__select_and_remove_random_url_from_list(list_of_priority_nodes)
-            return nexthost
-        # TODO WHAT IF NONE LEFT???
+        # Select one of them (not one that is cooling down, if possible,
+        # and preferably one that connected fast before)
+        candidates = self.__get_nodes_not_cooling_down(list_of_priority_nodes)
+        if len(candidates) == 0:
+            logdebug(LOGGER, 'All nodes left to try failed recently. Trying them anyway.')
+            candidates = list_of_priority_nodes[:]
+        candidates = self.__get_preferred_nodes(candidates)
+        nexthost = self.__select_and_remove_random_url_from_list(candidates)
+        list_of_priority_nodes.remove(nexthost)
+        if len(list_of_priority_nodes)==0:
+            dict_of_nodes.pop(current_priority)
+        return nexthost
+
+    def __get_nodes_not_cooling_down(self, list_of_nodes):
+        return [node for node in list_of_nodes if not self.__node_health.is_cooling_down(self.__get_node_key(node))]
+
+    def __get_preferred_nodes(self, list_of_nodes):
+        keys = [self.__get_node_key(node) for node in list_of_nodes]
+        preferred_keys = self.__node_health.get_preferred_keys(keys)
+        return [list_of_nodes[i] for i in range(len(keys)) if keys[i] in preferred_keys]
+
+    def __get_node_key(self, node):
+        params = node['params']
+        return '%s:%s%s' % (params.host, params.port, params.virtual_host)
+
+    '''
+    Tell the node manager that connecting to the current
+    node failed, so that it is skipped for a while if this
+    happens repeatedly (see nodehealth.py).
+    '''
+    def report_failure_of_current(self):
+        if self.__current_node is not None:
+            self.report_failure_of_node(self.__current_node)
+
+    '''
+    Tell the node manager that the current node works.
+
+    :param connect_seconds: Optional. How long it took to
+        connect to it.
+    '''
+    def report_success_of_current(self, connect_seconds=None):
+        if self.__current_node is not None:
+            self.report_success_of_node(self.__current_node, connect_seconds)
+
+    '''
+    Same as report_failure_of_current(), for any node (as
+    returned by get_all_nodes()).
+    '''
+    def report_failure_of_node(self, node):
+        self.__node_health.record_failure(self.__get_node_key(node))
+
+    '''
+    Same as report_success_of_current(), for any node (as
+    returned by get_all_nodes()).
+    '''
+    def report_success_of_node(self, node, connect_seconds=None):
+        self.__node_health.record_success(self.__get_node_key(node), connect_seconds)
 
     '''
     Return a pika.BasicProperties object needed for
@@ -535,6 +601,65 @@ class NodeManager(object):
 
         self.set_next_host()
 
+    '''
+    For distributing the messages over several nodes at once
+    (see DistributingRabbitConnector): Returns one NodeManager
+    per trusted node of the highest priority.
+
+    Each of them knows all the nodes, like this one, but
+    prefers "its" node: The other nodes of the highest priority
+    get the lowest priority, so they are only used if "its" node
+    fails. Nodes of other priorities keep their priority.
+
+    :return: List of tuples (NodeManager, weight). The weight
+        is the node's "weight" (1 if none was given).
+    '''
+    def make_node_managers_for_active_nodes(self):
+        all_nodes = []
+        for prio, nodes in self.__trusted_nodes_archive.items():
+            all_nodes.extend(nodes)
+        if len(all_nodes) == 0:
+            raise esgfpid.exceptions.ArgumentError('No trusted RabbitMQ nodes were passed.')
+
+        priorities = list(self.__trusted_nodes_archive.keys())
+        priorities.sort(key=natural_keys)
+        active_nodes = self.__trusted_nodes_archive[priorities[0]]
+
+        managers_and_weights = []
+        for active_node in active_nodes:
+            manager = NodeManager(self.__node_health)
+            for node in all_nodes:
+                kwargs = dict((k, v) for k,v in node.items() if k not in ['credentials', 'params', 'is_open'])
+                if node['priority'] == active_node['priority'] and node is not active_node:
+                    kwargs['priority'] = LAST_PRIO
+                manager.add_trusted_node(**kwargs)
+            weight = active_node.get('weight')
+            if weight is None:
+                weight = 1
+            managers_and_weights.append((manager, weight))
+            logdebug(LOGGER, 'Node manager for active node: %s (weight %s)', active_node['host'], weight)
+
+        return managers_and_weights
+
+    '''
+    Return all RabbitMQ nodes that were added (no matter
+    whether they were tried already), e.g. for checking all
+    of them at once. Trusted ones first, each sorted by
+    priority.
+
+    :return: List of node info dictionaries (containing
+        "host", "priority", "exchange_name", "is_open" and
+        "params", the pika.ConnectionParameters).
+    '''
+    def get_all_nodes(self):
+        all_nodes = []
+        for archive in [self.__trusted_nodes_archive, self.__open_nodes_archive]:
+            priorities = list(archive.keys())
+            priorities.sort(key=natural_keys)
+            for prio in priorities:
+                all_nodes.extend(archive[prio])
+        return all_nodes
+
     def _get_prio_stored_for_current(self):
         # Currently only used in unit test
         return self.__current_node['priority']
@@ -1,8 +1,12 @@
 import logging
 import pika
 import esgfpid.utils
-from esgfpid.utils import logwarn
+from esgfpid.utils import logwarn, logdebug
 from .nodemanager import NodeManager
+from .rabbitutils import MessageEnvelope
+from .delivery import DeliveryFuture
+from .metrics import PublishMetrics
+from .nodehealth import get_node_health
 from .asynchronous import AsynchronousRabbitConnector
 from .synchronous import SynchronousRabbitConnector
 
@@ -20,6 +24,8 @@ It is basically a facade/wrapper for either a
 :py:class:`~esgfpid.rabbit.synchronous.SynchronousServerConnector`
 or a 
 :py:class:`~esgfpid.rabbit.asynchronous.asynchronous.AsynchronousServerConnector`
+or (in asyncio mode) an
+:py:class:`~esgfpid.rabbit.aio.AioRabbitConnector`
 
 '''
 class RabbitMessageSender(object):
@@ -38,6 +44,42 @@ class RabbitMessageSender(object):
         should work in synchronous mode.
     :param test_publication: Mandatory. Boolean to tell whether
         a test flag should be added to all messages.
+    :param spool_file: Optional. Path of a file to keep the
+        messages in until they are confirmed, so they can be
+        replayed after a crash. Only used in asynchronous mode.
+    :param max_in_flight: Optional. Maximum number of messages
+        waiting to be published or confirmed. Only used in
+        asynchronous mode.
+    :param overflow_policy: Optional. What to do if the limit
+        is reached ("block", "raise" or "spill").
+    :param overflow_timeout_seconds: Optional. How long to
+        block at most if the limit is reached.
+    :param num_channels: Optional. On how many channels to
+        publish. Only used in asynchronous mode.
+    :param distribution: Optional. If None, one RabbitMQ node
+        is used at a time. Otherwise, the messages are distributed
+        over all trusted nodes of the highest priority, using this
+        strategy ("round_robin" or "least_unconfirmed"). Only used
+        in asynchronous mode.
+    :param metrics: Optional. Boolean. If True, the publication
+        metrics are recorded (see get_metrics()). Only used in
+        asynchronous mode. Defaults to False.
+    :param node_health_dir: Optional. Directory of the file where
+        failing and slow nodes are recorded, shared by all
+        processes using it (see nodehealth.py). If None, this
+        is only kept in memory.
+    :param connection_pool: Optional. Boolean. If True, the
+        connections are given back to the process-wide pool
+        instead of being closed, and borrowed from it when
+        opening (see synchronous/connectionpool.py). Only used
+        in synchronous mode. Defaults to False.
+    :param publish_window: Optional. How many messages to publish
+        at once (see send_many_messages_to_queue()). Only used in
+        synchronous mode.
+    :param is_asyncio_mode: Optional. Boolean. If True, the
+        messages are sent on the running asyncio event loop, and
+        the send methods return futures (see aio/aio.py). Then,
+        is_synchronous_mode is ignored. Defaults to False.
 
     '''
     def __init__(self, **args):
@@ -51,16 +93,73 @@ class RabbitMessageSender(object):
         ]
         esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
 
-        self.__ASYNCHRONOUS = not args['is_synchronous_mode']
+        if 'is_asyncio_mode' not in args or args['is_asyncio_mode'] is None:
+            args['is_asyncio_mode'] = False
+        self.__ASYNCIO = args['is_asyncio_mode']
+        self.__ASYNCHRONOUS = not args['is_synchronous_mode'] and not self.__ASYNCIO
         self.__test_publication = args['test_publication']
+        if 'spool_file' not in args:
+            args['spool_file'] = None
+        if 'max_in_flight' not in args:
+            args['max_in_flight'] = None
+        if 'overflow_policy' not in args:
+            args['overflow_policy'] = None
+        if 'overflow_timeout_seconds' not in args:
+            args['overflow_timeout_seconds'] = None
+        if 'num_channels' not in args:
+            args['num_channels'] = None
+        if 'distribution' not in args:
+            args['distribution'] = None
+        if 'metrics' not in args:
+            args['metrics'] = None
+        if 'node_health_dir' not in args:
+            args['node_health_dir'] = None
+        if 'connection_pool' not in args:
+            args['connection_pool'] = None
+        if 'publish_window' not in args:
+            args['publish_window'] = None
+        self.__metrics = None
+        if self.__ASYNCHRONOUS and args['metrics']:
+            self.__metrics = PublishMetrics()
         self.__node_manager = self.__make_rabbit_settings(args)
         self.__server_connector = self.__init_server_connector(args, self.__node_manager)
 
     def __init_server_connector(self, args, node_manager):
+        if self.__ASYNCIO:
+            # Imported here, as asyncio is not available on Python 2:
+            from .aio import AioRabbitConnector
+            return AioRabbitConnector(node_manager)
+
+        if self.__ASYNCHRONOUS and args['distribution'] is not None:
+            node_managers_and_weights = node_manager.make_node_managers_for_active_nodes()
+            if len(node_managers_and_weights) > 1:
+                return esgfpid.rabbit.asynchronous.DistributingRabbitConnector(
+                    node_managers_and_weights,
+                    strategy=args['distribution'],
+                    spool_file=args['spool_file'],
+                    max_in_flight=args['max_in_flight'],
+                    overflow_policy=args['overflow_policy'],
+                    overflow_timeout_seconds=args['overflow_timeout_seconds'],
+                    num_channels=args['num_channels'],
+                    metrics=self.__metrics
+                )
+            logdebug(LOGGER, 'Only one node of the highest priority, so there is nothing to distribute.')
+
         if self.__ASYNCHRONOUS:
-            return esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(node_manager)
+            return esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(
+                node_manager,
+                spool_file=args['spool_file'],
+                max_in_flight=args['max_in_flight'],
+                overflow_policy=args['overflow_policy'],
+                overflow_timeout_seconds=args['overflow_timeout_seconds'],
+                num_channels=args['num_channels'],
+                metrics=self.__metrics
+            )
         else:
-            return esgfpid.rabbit.synchronous.SynchronousRabbitConnector(node_manager)
+            connection_pool = None
+            if args['connection_pool']:
+                connection_pool = esgfpid.rabbit.synchronous.CONNECTION_POOL
+            return esgfpid.rabbit.synchronous.SynchronousRabbitConnector(node_manager, connection_pool, args['publish_window'])
 
 
     '''
@@ -85,7 +184,7 @@ class RabbitMessageSender(object):
     belong to one dataset, and closes it again.
     '''
     def open_rabbit_connection(self):
-        if not self.__ASYNCHRONOUS:
+        if not self.__ASYNCHRONOUS and not self.__ASYNCIO:
             return self.__server_connector.open_rabbit_connection()
 
     '''
@@ -107,7 +206,7 @@ class RabbitMessageSender(object):
     belong to one dataset, and closes it again.
     '''
     def close_rabbit_connection(self):
-        if not self.__ASYNCHRONOUS:
+        if not self.__ASYNCHRONOUS and not self.__ASYNCIO:
             return self.__server_connector.close_rabbit_connection()
 
 
@@ -123,8 +222,15 @@ class RabbitMessageSender(object):
 
     Please see documentation of asynchronous rabbit module
     (:func:`~rabbit.asynchronous.asynchronous.AsynchronousRabbitConnector.force_finish_rabbit_thread`).
+
+    In asyncio mode, the connection is closed.
+
+    :return: In asyncio mode, a future that is resolved when
+        the connection is closed. Otherwise None.
     '''
     def finish(self):
+        if self.__ASYNCIO:
+            return self.__server_connector.close()
         if self.__ASYNCHRONOUS:
             self.__server_connector.finish_rabbit_thread()
 
@@ -156,9 +262,27 @@ class RabbitMessageSender(object):
     (:func:`~rabbit.asynchronous.asynchronous.AsynchronousRabbitConnector.force_finish_rabbit_thread`).
     '''
     def force_finish(self):
+        if self.__ASYNCIO:
+            return self.__server_connector.close()
         if self.__ASYNCHRONOUS:
             self.__server_connector.force_finish_rabbit_thread()
 
+    '''
+    Return the publication metrics recorded so far (see
+    :py:class:`~esgfpid.rabbit.metrics.PublishMetrics`).
+
+    :param prometheus: Optional. If True, they are returned
+        in the Prometheus text format instead of as a dict.
+    :return: A dictionary (or string), or None if no metrics
+        are recorded (synchronous mode, or switched off).
+    '''
+    def get_metrics(self, prometheus=False):
+        if self.__metrics is None:
+            return None
+        if prometheus:
+            return self.__metrics.get_prometheus_text()
+        return self.__metrics.get_snapshot()
+
     def any_leftovers(self):
         if self.__ASYNCHRONOUS:
             return self.__server_connector.any_leftovers()
@@ -172,15 +296,21 @@ class RabbitMessageSender(object):
 
     In asynchronous mode, we cannot tell whether the
     delivery as successful, as the delivery confirmation
-    will arrive later.
+    will arrive later. A DeliveryFuture is returned, which
+    tells once it has arrived (see delivery.py).
 
     In synchronous mode, if the delivery was not successful,
     an exception is raised.
 
+    In asyncio mode, a future is returned, which tells whether
+    the delivery was successful once the confirm arrived.
+
     :param: JSON message as string or dictionary. It should
         include its routing key as a dictionary entry with
         key "ROUTING_KEY", Otherwise a default routing key
         will be used to send the message.
+    :return: In asynchronous mode, a DeliveryFuture. In
+        asyncio mode, an asyncio future. Otherwise None.
     :raises: esgfpid.exceptions.MessageNotDeliveredException:
         In case the message was not delivered. Only in
         synchronous mode.
@@ -188,10 +318,55 @@ class RabbitMessageSender(object):
     def send_message_to_queue(self, message):
         if self.__test_publication == True:
             message['test_publication'] = True
-        self.__server_connector.send_message_to_queue(message)
+        if self.__ASYNCHRONOUS:
+            envelope = self.__make_envelope(message)
+            self.__server_connector.send_message_to_queue(envelope)
+            return envelope.future
+        return self.__server_connector.send_message_to_queue(message)
+
+    '''
+    Send many messages to RabbitMQ.
+
+    In asynchronous mode, they are handed over to the
+    thread all at once, which is much faster than handing
+    them over one by one.
+
+    In synchronous mode, they are sent one after the other,
+    or several at once if a publish window was configured (see
+    :func:`~rabbit.synchronous.SynchronousRabbitConnector.send_many_messages_to_queue`).
+
+    In asynchronous mode, the messages are serialized here (see
+    MessageEnvelope), so the rabbit thread only has to pass the
+    bytes on.
+
+    :param messages: List of JSON messages (see
+        send_message_to_queue()).
+    :return: In asynchronous mode, a list of DeliveryFutures.
+        In asyncio mode, a list of asyncio futures. Otherwise
+        None.
+    :raises: esgfpid.exceptions.MessageNotDeliveredException:
+        In case a message was not delivered. Only in
+        synchronous mode.
+    '''
+    def send_many_messages_to_queue(self, messages):
+        if self.__test_publication == True:
+            for message in messages:
+                message['test_publication'] = True
+        if self.__ASYNCHRONOUS:
+            envelopes = [self.__make_envelope(message) for message in messages]
+            self.__server_connector.send_many_messages_to_queue(envelopes)
+            return [envelope.future for envelope in envelopes]
+        else:
+            return self.__server_connector.send_many_messages_to_queue(messages)
+
+    def __make_envelope(self, message):
+        envelope = MessageEnvelope.from_message(message)
+        if envelope.future is None:
+            envelope.future = DeliveryFuture()
+        return envelope
 
     def __make_rabbit_settings(self, args):
-        node_manager = NodeManager()
+        node_manager = NodeManager(get_node_health(args['node_health_dir']))
 
         # Add all RabbitMQ nodes:
         for cred in args['credentials']:
@@ -204,6 +379,8 @@ class RabbitMessageSender(object):
                 cred['port'] = None
             if 'ssl_enabled' not in cred:
                 cred['ssl_enabled'] = None
+            if 'weight' not in cred:
+                cred['weight'] = None
 
             # Open node:
             if cred['password'] == 'jzlnL78ZpExV#_QHz':
@@ -228,7 +405,8 @@ class RabbitMessageSender(object):
                     priority=cred['priority'],
                     vhost=cred['vhost'],
                     port=cred['port'],
-                    ssl_enabled=cred['ssl_enabled']
+                    ssl_enabled=cred['ssl_enabled'],
+                    weight=cred['weight']
                 )
 
         return node_manager
\ No newline at end of file
@@ -7,6 +7,82 @@ from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
+'''
+A message that is ready to be published: The routing key and
+the body, already serialized and encoded to UTF-8 bytes.
+
+The envelope is made once, in the main thread, when the message
+is handed over to the asynchronous connector. The rabbit thread
+then publishes (and, after reconnections, republishes) the bytes
+as they are, without serializing the message again.
+'''
+class MessageEnvelope(object):
+
+    def __init__(self, routing_key, body):
+        self.routing_key = routing_key
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.body = body
+        # In asynchronous mode, the DeliveryFuture that tells the
+        # sender whether the message was delivered (see delivery.py):
+        self.future = None
+        # If metrics are recorded, the time when the sender
+        # received the message (see metrics.py):
+        self.enqueued_at = None
+
+    '''
+    :param msg: Message as JSON string or dictionary, or an
+        envelope (which is returned as it is).
+    :return: The envelope.
+    '''
+    @classmethod
+    def from_message(cls, msg):
+        if isinstance(msg, cls):
+            return msg
+        routing_key, msg_string = get_routing_key_and_string_message_from_message_if_possible(msg)
+        return cls(routing_key, msg_string)
+
+    def get_json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+    def __repr__(self):
+        return 'MessageEnvelope(%s, %s)' % (self.routing_key, self.body.decode('utf-8'))
+
+'''
+How long to wait before trying all RabbitMQ hosts again, after
+all of them failed: Exponential backoff with jitter.
+
+The upper limit doubles with every round (starting at
+RABBIT_RECONNECTION_SECONDS, up to RABBIT_RECONNECTION_MAX_SECONDS).
+The wait is a random value between half of it and all of it, so
+that many publishers that lost the same node do not all come
+back at the same time.
+
+:param attempt: Number of the round of reconnection attempts
+    (starting at 1).
+:return: Seconds to wait (float).
+'''
+def get_reconnection_wait_seconds(attempt):
+    base = esgfpid.defaults.RABBIT_RECONNECTION_SECONDS
+    upper = min(esgfpid.defaults.RABBIT_RECONNECTION_MAX_SECONDS, base * 2**max(attempt-1, 0))
+    return upper/2.0 + random.random()*upper/2.0
+
+'''
+Converts a message (envelope or not) to a dictionary that can be
+written to a file as JSON, and back.
+
+Used for the spool file and the spill file.
+'''
+def message_to_record(msg):
+    if isinstance(msg, MessageEnvelope):
+        return {'key': msg.routing_key, 'body': msg.body.decode('utf-8')}
+    return {'msg': msg}
+
+def message_from_record(record):
+    if 'body' in record:
+        return MessageEnvelope(record['key'], record['body'])
+    return record['msg']
+
 '''
 Retrieves the routing key from the message, checks
 the message's validity and returns
@@ -19,8 +95,9 @@ with the key "ROUTING_KEY". Otherwise, a default
 routing key is added.
 
 :param msg: Message to be sent to RabbitMQ as JSON
-    string or dictionary.
-:return: Routing key string and string message as tuple.
+    string or dictionary, or as MessageEnvelope.
+:return: Routing key string and string message as tuple
+    (for envelopes, the message is returned as bytes).
 '''
 def get_routing_key_and_string_message_from_message_if_possible(msg):
 
@@ -31,6 +108,10 @@ def get_routing_key_and_string_message_from_message_if_possible(msg):
     
     if msg is None:
         raise ValueError('The message that was passed is None.')
+
+    # Envelopes were serialized before:
+    if isinstance(msg, MessageEnvelope):
+        return msg.routing_key, msg.body
     
     # Get JSON from message, if possible!
     if isinstance(msg, str):
@@ -1 +1,2 @@
 from .synchronous import SynchronousRabbitConnector
+from .connectionpool import ConnectionPool, CONNECTION_POOL
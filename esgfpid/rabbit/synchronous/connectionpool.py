@@ -0,0 +1,184 @@
+import time
+import atexit
+import socket
+import logging
+import threading
+import pika
+import esgfpid.defaults as defaults
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+===============
+Connection pool
+===============
+
+Keeps blocking connections (with their channel) to RabbitMQ open
+after the synchronous module is done with them, so that the next
+publication (dataset, unpublication, errata, data cart...) does not
+have to pay the TCP, AMQP (and TLS) handshakes again.
+
+The connections are kept per node and credentials (host, port,
+virtual host, user name and password), so a connection is only
+handed out for the same node with the same credentials.
+
+A connection is only used by one SynchronousRabbitConnector at a
+time: It is taken out of the pool when borrowed, and put back when
+given back. Blocking connections are not thread-safe, but they may be
+used by different threads one after the other.
+
+Idle connections are closed after RABBIT_SYN_POOL_IDLE_SECONDS (they
+do not process heartbeats while idle, so RabbitMQ may close them
+anyway), and at most RABBIT_SYN_POOL_MAX_IDLE_PER_NODE are kept per
+node. Before a connection is handed out, it is checked whether it
+still works (by processing the pending events); broken ones are
+dropped.
+
+There is one process-wide instance (CONNECTION_POOL). Its connections
+are closed when the interpreter exits.
+
+API:
+ * borrow() called by the SynchronousRabbitConnector, when it opens
+   the connection.
+ * give_back() called by the SynchronousRabbitConnector, when it
+   closes the connection.
+ * close_all() called on exit (and by the library user, if needed).
+
+'''
+class ConnectionPool(object):
+
+    '''
+    :param clock: Optional. Function returning the current
+        time in seconds. Defaults to time.time (only passed
+        by unit tests).
+    '''
+    def __init__(self, clock=None):
+        if clock is None:
+            clock = time.time
+        self.__clock = clock
+        self.__lock = threading.Lock()
+
+        '''
+        Key (see __get_key()) -> list of [connection, channel,
+        time when it was given back], the most recent last.
+        '''
+        self.__idle = {}
+
+    '''
+    Take a working connection to the given node out of the
+    pool, if there is one.
+
+    :param params: pika.ConnectionParameters of the node.
+    :return: Tuple (connection, channel), or None if there
+        is no working idle connection to that node.
+    '''
+    def borrow(self, params):
+        key = self.__get_key(params)
+        while True:
+            with self.__lock:
+                expired = self.__remove_expired()
+                entries = self.__idle.get(key)
+                entry = entries.pop() if entries else None
+            self.__close_all_of(expired)
+            if entry is None:
+                return None
+            connection, channel, unused = entry
+            # Checked outside of the lock, as it may take a while:
+            if self.__is_working(connection, channel):
+                logdebug(LOGGER, 'Reusing pooled connection to RabbitMQ at %s.', params.host)
+                return connection, channel
+            logdebug(LOGGER, 'Dropping broken pooled connection to RabbitMQ at %s.', params.host)
+            self.__close(connection)
+
+    '''
+    Put a connection back into the pool (or close it, if it
+    does not work anymore or if there are enough idle ones).
+
+    :param params: pika.ConnectionParameters of the node.
+    :param connection: The pika.BlockingConnection.
+    :param channel: Its channel (with delivery confirmation).
+    '''
+    def give_back(self, params, connection, channel):
+        if connection is None or not connection.is_open or channel is None or not channel.is_open:
+            self.__close(connection)
+            return
+        key = self.__get_key(params)
+        with self.__lock:
+            expired = self.__remove_expired()
+            entries = self.__idle.setdefault(key, [])
+            pooled = len(entries) < defaults.RABBIT_SYN_POOL_MAX_IDLE_PER_NODE
+            if pooled:
+                entries.append([connection, channel, self.__clock()])
+                logtrace(LOGGER, 'Pooled connection to RabbitMQ at %s (%i idle).', params.host, len(entries))
+        self.__close_all_of(expired)
+        if pooled:
+            return
+        logdebug(LOGGER, 'Enough idle connections to RabbitMQ at %s, closing this one.', params.host)
+        self.__close(connection)
+
+    def get_num_idle(self):
+        with self.__lock:
+            return sum(len(entries) for entries in self.__idle.values())
+
+    '''
+    Close all idle connections.
+    '''
+    def close_all(self):
+        with self.__lock:
+            connections = [entry[0] for entries in self.__idle.values() for entry in entries]
+            self.__idle = {}
+        if len(connections) > 0:
+            logdebug(LOGGER, 'Closing %i pooled connections to RabbitMQ.', len(connections))
+        self.__close_all_of(connections)
+
+    ###############
+    ### Helpers ###
+    ###############
+
+    def __get_key(self, params):
+        return (params.host, params.port, params.virtual_host,
+            params.credentials.username, params.credentials.password)
+
+    '''
+    Removes the connections that were idle for too long, and
+    returns them, to be closed outside of the lock.
+    Not thread-safe, the lock has to be held by the caller.
+    '''
+    def __remove_expired(self):
+        now = self.__clock()
+        expired = []
+        for key in list(self.__idle.keys()):
+            entries = self.__idle[key]
+            while len(entries) > 0 and now - entries[0][2] > defaults.RABBIT_SYN_POOL_IDLE_SECONDS:
+                logdebug(LOGGER, 'Closing pooled connection to RabbitMQ at %s (idle for too long).', key[0])
+                expired.append(entries.pop(0)[0])
+            if len(entries) == 0:
+                del self.__idle[key]
+        return expired
+
+    def __close_all_of(self, connections):
+        for connection in connections:
+            self.__close(connection)
+
+    def __is_working(self, connection, channel):
+        if not connection.is_open or not channel.is_open:
+            return False
+        try:
+            connection.process_data_events()
+        except (pika.exceptions.AMQPError, socket.error) as e:
+            logtrace(LOGGER, 'Pooled connection failed the check (%s).', e.__class__.__name__)
+            return False
+        return connection.is_open and channel.is_open
+
+    def __close(self, connection):
+        if connection is None or not connection.is_open:
+            return
+        try:
+            connection.close()
+        except (pika.exceptions.AMQPError, socket.error) as e:
+            logtrace(LOGGER, 'Error when closing pooled connection (%s).', e.__class__.__name__)
+
+CONNECTION_POOL = ConnectionPool()
+atexit.register(CONNECTION_POOL.close_all)
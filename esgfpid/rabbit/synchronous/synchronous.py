@@ -3,6 +3,7 @@ import datetime
 import json
 import pika
 import time
+import socket
 import esgfpid.utils
 import esgfpid.defaults as defaults
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
@@ -25,9 +26,16 @@ class SynchronousRabbitConnector(object):
     :param node_manager: NodeManager object that contains 
         the info about all the available RabbitMQ instances,
         their credentials, their priorities.
+    :param connection_pool: Optional. ConnectionPool to borrow
+        open connections from, and to give them back to instead
+        of closing them (see connectionpool.py).
+    :param publish_window: Optional. How many messages to publish
+        at once when several messages are sent (see
+        send_many_messages_to_queue()). Defaults to 1, i.e. every
+        message is confirmed before the next one is published.
 
     '''
-    def __init__(self, nodemanager):
+    def __init__(self, nodemanager, connection_pool=None, publish_window=None):
 
         loginfo(LOGGER, 'Init of SynchronousRabbitConnector!!! Bla')
 
@@ -37,6 +45,35 @@ class SynchronousRabbitConnector(object):
         '''
         self.__nodemanager = nodemanager
 
+        '''
+        Optional pool of open connections, shared by all
+        connectors of the process.
+        '''
+        self.__connection_pool = connection_pool
+
+        '''
+        Whether the current connection was borrowed from the pool
+        (then it took no time to connect, which must not be
+        reported to the node manager).
+        '''
+        self.__borrowed = False
+
+        '''
+        How many messages to publish at once, and the transactional
+        channel used for that (opened when needed, see
+        send_many_messages_to_queue()).
+        '''
+        if publish_window is None:
+            publish_window = defaults.RABBIT_SYN_PUBLISH_WINDOW
+        self.__publish_window = publish_window
+        self.__window_channel = None
+
+        '''
+        Bodies of the messages returned by RabbitMQ (as unroutable)
+        during the last transaction on the window channel.
+        '''
+        self.__returned_bodies = []
+
         '''
         Props for basic_publish. Does not
         depend on host, so store it once for all.
@@ -58,10 +95,11 @@ class SynchronousRabbitConnector(object):
 
         '''
         How many seconds to wait before reconnecting after having tried
-        all hosts. (There is no waiting time trying to connect to a different
-        host after one fails).
+        all hosts is computed for every round (exponential backoff with
+        jitter, see rabbitutils.get_reconnection_wait_seconds()). There
+        is no waiting time trying to connect to a different host after
+        one fails.
         '''
-        self.__wait_seconds_before_reconnect = defaults.RABBIT_RECONNECTION_SECONDS
 
         '''
         To see how much time it takes to connect. Once a connection is
@@ -122,8 +160,13 @@ class SynchronousRabbitConnector(object):
 
             if success:
                 continue_connecting = False
+                self.__reconnect_counter = 0
+                if not self.__borrowed:
+                    time_passed = datetime.datetime.now() - self.__start_connect_time
+                    self.__nodemanager.report_success_of_current(time_passed.total_seconds())
 
             else:
+                self.__nodemanager.report_failure_of_current()
 
                 # Log failure:
                 oldhost = self.__nodemanager.get_connection_parameters().host
@@ -142,7 +185,7 @@ class SynchronousRabbitConnector(object):
                 else:
                     self.__reconnect_counter += 1;
                     if self.__reconnect_counter <= self.__max_reconnection_tries:
-                        reopen_seconds = self.__wait_seconds_before_reconnect
+                        reopen_seconds = rabbitutils.get_reconnection_wait_seconds(self.__reconnect_counter)
                         logdebug(LOGGER, 'Connection failure: Failed connecting to all hosts. Waiting %s seconds and starting over.', reopen_seconds)
                         self.__nodemanager.reset_nodes()
                         newhost = self.__nodemanager.get_connection_parameters().host
@@ -167,9 +210,19 @@ class SynchronousRabbitConnector(object):
     '''
     def __try_connecting_to_next(self):
         success = False
+        self.__borrowed = False
 
-        # Open connection
+        # Reuse an open connection, if there is one:
         params = self.__nodemanager.get_connection_parameters()
+        if self.__connection_pool is not None:
+            borrowed = self.__connection_pool.borrow(params)
+            if borrowed is not None:
+                self.__connection, self.__channel = borrowed
+                self.__communication_established = True
+                self.__borrowed = True
+                return True
+
+        # Open connection
         connection = self.__setup_rabbit_connection(params)
 
         # If connection is ok, open channel
@@ -285,8 +338,22 @@ class SynchronousRabbitConnector(object):
     ### Close connection ###
     ########################
 
+    '''
+    Closes the connection, or gives it back to the connection
+    pool (if there is one), so it can be reused by the next
+    publication. Either way, the next message will open (or
+    borrow) a connection again.
+    '''
     def close_rabbit_connection(self):
-        if (self.__connection is not None) and (self.__connection.is_open):
+        self.__communication_established = False
+        self.__close_window_channel()
+        if self.__connection_pool is not None and self.__connection is not None:
+            params = self.__nodemanager.get_connection_parameters()
+            self.__connection_pool.give_back(params, self.__connection, self.__channel)
+            # Must not be used anymore, it may be borrowed by others now:
+            self.__connection = None
+            self.__channel = None
+        elif (self.__connection is not None) and (self.__connection.is_open):
             self.__connection.close()
             # From pika doc: If there are any open channels, it will attempt to
             # close them prior to fully disconnecting
@@ -329,6 +396,126 @@ class SynchronousRabbitConnector(object):
         if not success:
             raise MessageNotDeliveredException(error_msg, msg_string)
 
+    '''
+    Send several messages to RabbitMQ, synchronously.
+
+    If the publish window is larger than 1, up to that many
+    messages are published at once, in a transaction on a
+    separate channel, and then committed together. This waits
+    for RabbitMQ once per window instead of once per message.
+    (The blocking channels of pika can only wait for the confirm
+    of one message at a time, so transactions are used instead
+    of publisher confirms here.) Messages returned as unroutable
+    are resent with the emergency routing key, like single
+    messages are.
+
+    Otherwise, the messages are sent one after the other (see
+    send_message_to_queue()).
+
+    :param messages: List of JSON messages.
+    :raises: esgfpid.exceptions.MessageNotDeliveredException:
+        As soon as messages were not delivered. The messages
+        that were not delivered (including the ones that were
+        not sent yet) are in its "undelivered_messages".
+    '''
+    def send_many_messages_to_queue(self, messages):
+        if self.__publish_window <= 1:
+            for message in messages:
+                self.send_message_to_queue(message)
+            return
+
+        self.__open_connection_if_not_open()
+        keys_and_bodies = [rabbitutils.get_routing_key_and_string_message_from_message_if_possible(message) for message in messages]
+        for start in range(0, len(keys_and_bodies), self.__publish_window):
+            window = keys_and_bodies[start:start+self.__publish_window]
+            error_msg, undelivered = self.__send_window(window)
+            if len(undelivered) > 0:
+                not_sent = [body for unused, body in keys_and_bodies[start+self.__publish_window:]]
+                error_msg += ' %i messages were not delivered (%i of them were not sent yet).' % (len(undelivered)+len(not_sent), len(not_sent))
+                logerror(LOGGER, error_msg)
+                undelivered.extend(not_sent)
+                raise MessageNotDeliveredException(error_msg, undelivered[0], undelivered)
+        logdebug(LOGGER, 'Successful delivery of %i messages (in windows of %i).', len(keys_and_bodies), self.__publish_window)
+
+    '''
+    :param window: List of tuples (routing key, message body).
+    :return: Tuple (error message or None, list of bodies of
+        the messages that were not delivered).
+    '''
+    def __send_window(self, window):
+        try:
+            returned = self.__publish_and_commit(window)
+            if len(returned) == 0:
+                return None, []
+
+            # Resend the refused ones with the emergency routing key:
+            resend = []
+            for routing_key, msg_string in returned:
+                body_json = json.loads(msg_string)
+                body_json, new_routing_key = rabbitutils.add_emergency_routing_key(body_json)
+                logerror(LOGGER, 'Refused message with routing key "%s". Resending with "%s".' % (routing_key, new_routing_key))
+                resend.append((new_routing_key, json.dumps(body_json)))
+            returned_again = self.__publish_and_commit(resend)
+            if len(returned_again) == 0:
+                return None, []
+            undelivered = [returned[resend.index(item)][1] for item in returned_again]
+            return 'The RabbitMQ node refused messages a second time (with the emergency routing key). Dropping them.', undelivered
+
+        except (pika.exceptions.AMQPError, socket.error) as e:
+            # Uncommitted messages are discarded by RabbitMQ, so
+            # none of the window was delivered:
+            self.__window_channel = None
+            error_msg = 'Publishing %i messages failed (%s).' % (len(window), e.__class__.__name__)
+            return error_msg, [body for unused, body in window]
+
+    '''
+    Publishes the messages in one transaction.
+
+    :param keys_and_bodies: List of tuples (routing key,
+        message body).
+    :return: The tuples of the messages that were returned
+        as unroutable.
+    '''
+    def __publish_and_commit(self, keys_and_bodies):
+        channel = self.__get_window_channel()
+        self.__returned_bodies = []
+        for routing_key, msg_string in keys_and_bodies:
+            channel.basic_publish(
+                exchange=self.__get_exchange_name(),
+                routing_key=routing_key,
+                body=msg_string,
+                mandatory=self.__mandatory_flag,
+                properties=self.__props
+            )
+        channel.tx_commit()
+        self.__connection.process_data_events() # calls __on_message_returned
+        returned = []
+        for routing_key, msg_string in keys_and_bodies:
+            body = msg_string.encode('utf-8') if not isinstance(msg_string, bytes) else msg_string
+            if body in self.__returned_bodies:
+                self.__returned_bodies.remove(body)
+                returned.append((routing_key, msg_string))
+        return returned
+
+    def __get_window_channel(self):
+        if self.__window_channel is None or not self.__window_channel.is_open:
+            logdebug(LOGGER, 'Opening channel for publishing %i messages at once.', self.__publish_window)
+            self.__window_channel = self.__connection.channel()
+            self.__window_channel.tx_select()
+            self.__window_channel.add_on_return_callback(self.__on_message_returned)
+        return self.__window_channel
+
+    def __on_message_returned(self, channel, method, properties, body):
+        self.__returned_bodies.append(body)
+
+    def __close_window_channel(self):
+        if self.__window_channel is not None and self.__window_channel.is_open:
+            try:
+                self.__window_channel.close()
+            except (pika.exceptions.AMQPError, socket.error) as e:
+                logdebug(LOGGER, 'Error when closing the channel (%s).', e.__class__.__name__)
+        self.__window_channel = None
+
     def __open_connection_if_not_open(self):
         if not self.__communication_established:
             self.open_rabbit_connection()
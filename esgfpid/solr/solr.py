@@ -4,6 +4,7 @@ import json
 import esgfpid.utils
 import esgfpid.solr.tasks.filehandles_same_dataset
 import esgfpid.solr.tasks.all_versions_of_dataset
+import esgfpid.solr.tasks.filehandles_many_datasets
 import esgfpid.solr.serverconnector
 import esgfpid.defaults
 import esgfpid.exceptions
@@ -164,6 +165,33 @@ class SolrInteractor(object):
         result_dict = finder.retrieve_dataset_handles_or_version_numbers_of_all_versions(drs_id, self.__prefix)
         return result_dict
 
+    # Task 3
+
+    def retrieve_file_handles_of_many_datasets(self, **args):
+        '''
+        :param datasets: List of (drs_id, version_number) tuples.
+        :param data_node: The data node of all of them.
+        :return: Dictionary of lists of handles, with the
+            (drs_id, version_number) tuples as keys. Datasets whose
+            files were not found are not contained.
+        :raise: SolrSwitchedOff
+        '''
+
+        mandatory_args = ['datasets', 'data_node']
+        esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
+        LOGGER.debug('Looking for files of %i datasets.', len(args['datasets']))
+
+        if self.__switched_on:
+            return self.__retrieve_file_handles_of_many_datasets(**args)
+        else:
+            msg = 'Cannot retrieve handles of files of many datasets.'
+            raise esgfpid.exceptions.SolrSwitchedOff(msg)
+
+    def __retrieve_file_handles_of_many_datasets(self, **args):
+        finder = esgfpid.solr.tasks.filehandles_many_datasets.FindFilesOfManyDatasetVersions(self)
+        args['prefix'] = self.__prefix
+        return finder.retrieve_file_handles_of_many_datasets(**args)
+
 
 
 
@@ -0,0 +1,99 @@
+import esgfpid.utils
+import esgfpid.defaults
+import esgfpid.exceptions
+import logging
+from . import utils as solrutils
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+Retrieves the handles of the files of many dataset versions
+(of the same data node) at once, for the consistency checks
+of a batch of publications.
+
+Instead of one query per dataset version (see task 1), the
+dataset ids are grouped, and each group is retrieved in one
+query (paged, if it has many files). As facets cannot tell
+which file belongs to which dataset, the file documents are
+requested, with only their dataset id and tracking id.
+
+Only the first strategy of task 1 (same data node) is used.
+Dataset versions for which no files were found are not
+contained in the result, so their files can still be looked
+for at other data nodes (by task 1).
+'''
+class FindFilesOfManyDatasetVersions(object):
+
+    def __init__(self, solr_interactor):
+        self.__solr_interactor = solr_interactor
+
+    def retrieve_file_handles_of_many_datasets(self, **args):
+        '''
+        :param datasets: List of (drs_id, version_number) tuples.
+        :param data_node: The data node of all of them.
+        :param prefix: The handle prefix.
+        :return: Dictionary with the (drs_id, version_number) tuples
+            as keys and the lists of file handles as values. Dataset
+            versions for which no files were found, or whose group's
+            query failed, are not contained.
+        :raise: SolrSwitchedOff
+        '''
+        mandatory_args = ['datasets', 'data_node', 'prefix']
+        esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
+
+        datasets = list(args['datasets'])
+        group_size = esgfpid.defaults.SOLR_DATASETS_PER_QUERY
+        tracking_ids = {}
+        for start in range(0, len(datasets), group_size):
+            group = datasets[start:start+group_size]
+            try:
+                self.__retrieve_tracking_ids_of_group(group, args['data_node'], tracking_ids)
+            except (esgfpid.exceptions.SolrError, esgfpid.exceptions.SolrResponseError) as e:
+                LOGGER.debug('Could not retrieve the files of %i datasets: %s', len(group), repr(e))
+
+        file_handles = {}
+        for dataset, ids in tracking_ids.items():
+            file_handles[dataset] = solrutils.make_handles_from_tracking_ids(ids, args['prefix'])
+        LOGGER.debug('Retrieved files of %i of %i datasets from solr.', len(file_handles), len(datasets))
+        return file_handles
+
+    def __retrieve_tracking_ids_of_group(self, group, data_node, tracking_ids):
+        dataset_ids = {}
+        for drs_id, version_number in group:
+            dataset_id = drs_id + '.v' + str(version_number) + '|' + data_node
+            dataset_ids[dataset_id] = (drs_id, version_number)
+
+        # Collect per group first, so a failing group adds nothing:
+        group_tracking_ids = {}
+        offset = 0
+        while True:
+            docs = self.__ask_solr_for_files_of_datasets(list(dataset_ids.keys()), offset) # can raise SolrError or SolrSwitchedOff
+            for doc in docs:
+                dataset = dataset_ids.get(doc.get('dataset_id'))
+                ids = doc.get('tracking_id')
+                if dataset is None or ids is None:
+                    continue
+                if not isinstance(ids, list):
+                    ids = [ids]
+                group_tracking_ids.setdefault(dataset, []).extend(ids)
+            if len(docs) < esgfpid.defaults.SOLR_FILES_PER_QUERY:
+                break
+            offset += len(docs)
+        tracking_ids.update(group_tracking_ids)
+
+    def __ask_solr_for_files_of_datasets(self, dataset_ids, offset):
+        LOGGER.debug('Asking solr for the files of %i datasets (offset %i).', len(dataset_ids), offset)
+        query = self.__make_query_files_of_datasets(dataset_ids, offset)
+        response_json = self.__solr_interactor.send_query(query) # can raise SolrError or SolrSwitchedOff, but can't be None
+        return solrutils.extract_docs_from_response_json(response_json) # can raise SolrReponseError
+
+    def __make_query_files_of_datasets(self, dataset_ids, offset):
+        query_dict = self.__solr_interactor.make_solr_base_query()
+        query_dict['type'] = 'File'
+        query_dict['fields'] = 'dataset_id,tracking_id'
+        query_dict['dataset_id'] = dataset_ids # several values are combined with OR
+        query_dict['limit'] = esgfpid.defaults.SOLR_FILES_PER_QUERY
+        query_dict['offset'] = offset
+        return query_dict
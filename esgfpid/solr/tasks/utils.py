@@ -124,3 +124,28 @@ def _extract_facet_fields(response_json):
     except KeyError:
         raise esgfpid.exceptions.SolrResponseError('No "facet_counts" and/or "facet_fields" in response')
 
+
+#
+# Utils for task 3:
+#
+
+def extract_docs_from_response_json(response_json):
+
+    if response_json is None:
+        raise esgfpid.exceptions.SolrResponseError('Response is None')
+
+    try:
+        return response_json['response']['docs']
+    except (KeyError, TypeError):
+        raise esgfpid.exceptions.SolrResponseError('No "response" and/or "docs" in response')
+
+def make_handles_from_tracking_ids(tracking_ids, prefix):
+
+    # Remove duplicates
+    list_nodup = _remove_duplicates_from_list(tracking_ids)
+
+    # Add prefixes if not there:
+    list_with_prefixes = _prepend_prefix_to_list_items_if_not_there(list_nodup, prefix)
+
+    # Add "hdl:" if not there:
+    return _prepend_hdl_to_list_items_of_not_there(list_with_prefixes)
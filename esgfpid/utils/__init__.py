@@ -1,3 +1,7 @@
 
 
-from .allutils import *
\ No newline at end of file
+from .allutils import *
+
+# Read the logging flags (again, if the package is reloaded after
+# changing esgfpid.defaults):
+reload_log_settings()
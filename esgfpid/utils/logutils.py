@@ -1,6 +1,43 @@
 import esgfpid.defaults
 import copy
 
+__all__ = ['logtrace', 'logdebug', 'loginfo', 'logwarn', 'logerror',
+    'log_every_x_times', 'make_logsafe', 'reload_log_settings']
+
+#
+# Logging settings
+#
+
+'''
+The logging flags of esgfpid.defaults (LOG_TRACE_TO_DEBUG,
+LOG_DEBUG_TO_INFO, LOG_INFO_TO_DEBUG) are read once, when this module
+is loaded (and whenever esgfpid.utils is reloaded), not on every
+log call, as some of the helpers below are called several times per
+message in the rabbit module.
+
+If the flags are changed at runtime, reload_log_settings() has to be
+called afterwards.
+
+TRACE_ENABLED can be checked before a trace call whose arguments are
+expensive to compute (e.g. the size of a queue), or which is made for
+every message, so that nothing at all is done if trace logging is off:
+
+    if logutils.TRACE_ENABLED:
+        logtrace(LOGGER, 'Left in queue: %i messages.', queue.qsize())
+'''
+TRACE_ENABLED = False
+_DEBUG_TO_INFO = False
+_INFO_TO_DEBUG = False
+
+def reload_log_settings():
+    '''
+    (Re-)read the logging flags from esgfpid.defaults.
+    '''
+    global TRACE_ENABLED, _DEBUG_TO_INFO, _INFO_TO_DEBUG
+    TRACE_ENABLED = bool(esgfpid.defaults.LOG_TRACE_TO_DEBUG)
+    _DEBUG_TO_INFO = bool(esgfpid.defaults.LOG_DEBUG_TO_INFO)
+    _INFO_TO_DEBUG = bool(esgfpid.defaults.LOG_INFO_TO_DEBUG)
+
 #
 # Logging helpers
 #
@@ -9,20 +46,20 @@ def logtrace(logger, msg, *args, **kwargs):
     '''
     If esgfpid.defaults.LOG_TRACE_TO_DEBUG, messages are treated
     like debug messages (with an added [trace]).
-    Otherwise, they are ignored.
+    Otherwise, they are ignored (without formatting anything).
     '''
-    if esgfpid.defaults.LOG_TRACE_TO_DEBUG:
+    if TRACE_ENABLED:
         logdebug(logger, '[trace] %s' % msg, *args, **kwargs)
-    else:
-        pass
 
 def logdebug(logger, msg, *args, **kwargs):
     '''
     Logs messages as DEBUG,
-    unless show=True and esgfpid.defaults.LOG_SHOW_TO_INFO=True,
+    unless esgfpid.defaults.LOG_DEBUG_TO_INFO
     (then it logs messages as INFO).
+    The arguments are only formatted by the logger
+    if the level is enabled.
     '''
-    if esgfpid.defaults.LOG_DEBUG_TO_INFO:
+    if _DEBUG_TO_INFO:
         logger.info('DEBUG %s ' % msg, *args, **kwargs)
     else:
         logger.debug(msg, *args, **kwargs)
@@ -33,7 +70,7 @@ def loginfo(logger, msg, *args, **kwargs):
     unless esgfpid.defaults.LOG_INFO_TO_DEBUG,
     (then it logs messages as DEBUG).
     '''
-    if esgfpid.defaults.LOG_INFO_TO_DEBUG:
+    if _INFO_TO_DEBUG:
         logger.debug(msg, *args, **kwargs)
     else:
         logger.info(msg, *args, **kwargs)
@@ -79,3 +116,4 @@ def make_logsafe(list_or_dict, forbidden='password'):
 
     return logsafe
 
+reload_log_settings()
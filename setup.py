@@ -19,6 +19,7 @@ packages = [
     'esgfpid/rabbit',
     'esgfpid/rabbit/synchronous',
     'esgfpid/rabbit/asynchronous',
+    'esgfpid/rabbit/aio',
     'esgfpid/solr',
     'esgfpid/solr/tasks'
 ]
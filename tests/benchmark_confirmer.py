@@ -0,0 +1,120 @@
+'''
+Microbenchmark for the Confirmer's bookkeeping of unconfirmed messages.
+
+Replays a stream of publishes and confirms (mixed single and multiple
+acks, and some multiple nacks) against the current Confirmer and against
+the previous, list-based implementation, and prints the time each needed.
+
+The window is the number of messages in flight, i.e. published but not
+confirmed yet, before the broker starts sending confirms.
+
+Usage:
+    python tests/benchmark_confirmer.py [num_messages] [window]
+
+'''
+import sys
+import time
+import copy
+import random
+import logging
+import mock
+import esgfpid.rabbit.asynchronous.thread_confirmer
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+NUM_MESSAGES = 100000
+WINDOW = 5000
+
+'''
+The bookkeeping of the Confirmer as it was before: A list of delivery
+tags and a dict keyed by the tags as strings. A multiple confirm copies
+the list and removes the tags one by one.
+'''
+class LegacyConfirmer(object):
+
+    def __init__(self):
+        self.__unconfirmed_delivery_tags = []
+        self.__unconfirmed_messages_dict = {}
+        self.__nacked_messages = []
+
+    def on_delivery_confirmation(self, method_frame):
+        deliv_tag = method_frame.method.delivery_tag
+        confirmation_type = method_frame.method.NAME.split('.')[1].lower()
+        multiple = method_frame.method.multiple
+        if multiple:
+            for candidate in copy.copy(self.__unconfirmed_delivery_tags):
+                if candidate <= deliv_tag:
+                    self.__remove_single(candidate, confirmation_type)
+        else:
+            self.__remove_single(deliv_tag, confirmation_type)
+
+    def __remove_single(self, deliv_tag, confirmation_type):
+        try:
+            self.__unconfirmed_delivery_tags.remove(deliv_tag)
+            msg = self.__unconfirmed_messages_dict.pop(str(deliv_tag))
+            if confirmation_type == 'nack':
+                self.__nacked_messages.append(msg)
+        except ValueError as e:
+            pass
+
+    def put_to_unconfirmed(self, delivery_tag, msg):
+        self.__unconfirmed_delivery_tags.append(delivery_tag)
+        self.__unconfirmed_messages_dict[str(delivery_tag)] = msg
+
+    def get_num_unconfirmed(self):
+        return len(self.__unconfirmed_messages_dict)
+
+def make_frame(deliv_tag, confirmation_type, multiple):
+    frame = mock.Mock()
+    frame.method.delivery_tag = deliv_tag
+    frame.method.NAME = 'Basic.'+confirmation_type.capitalize()
+    frame.method.multiple = multiple
+    return frame
+
+'''
+Creates the sequence of events: ('publish', tag) and ('confirm', frame).
+The broker confirms the messages in order, sometimes one by one,
+sometimes up to some bigger tag at once (as RabbitMQ does).
+'''
+def make_events(num_messages, window, seed=42):
+    rand = random.Random(seed)
+    events = []
+    confirmed_up_to = 0
+    for tag in range(1, num_messages+1):
+        events.append(('publish', tag))
+        while tag - confirmed_up_to > window or (tag == num_messages and confirmed_up_to < tag):
+            dice = rand.random()
+            if dice < 0.5:
+                confirmed_up_to += 1
+                events.append(('confirm', make_frame(confirmed_up_to, 'ack', False)))
+            else:
+                confirmed_up_to = min(tag, confirmed_up_to+rand.randint(2, 20))
+                kind = 'nack' if dice > 0.98 else 'ack'
+                events.append(('confirm', make_frame(confirmed_up_to, kind, True)))
+    return events
+
+def replay(confirmer, events):
+    start = time.time()
+    for kind, arg in events:
+        if kind == 'publish':
+            confirmer.put_to_unconfirmed(arg, 'message %i' % arg)
+        else:
+            confirmer.on_delivery_confirmation(arg)
+    duration = time.time() - start
+    assert confirmer.get_num_unconfirmed() == 0
+    return duration
+
+if __name__ == '__main__':
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_MESSAGES
+    window = int(sys.argv[2]) if len(sys.argv) > 2 else WINDOW
+
+    events = make_events(num_messages, window)
+    num_confirms = len(events) - num_messages
+    print('Replaying %i publishes and %i confirms (window: %i messages in flight)...' % (num_messages, num_confirms, window))
+
+    new = replay(esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer(mock.Mock()), events)
+    print('Confirmer:        %8.3f seconds' % new)
+    old = replay(LegacyConfirmer(), events)
+    print('Legacy confirmer: %8.3f seconds' % old)
+    print('Speedup:          %8.1f x' % (old/new))
@@ -0,0 +1,58 @@
+'''
+Microbenchmark for handing many messages over from the main thread
+to the rabbit thread (AsynchronousRabbitConnector), as happens when
+a dataset with many files is published.
+
+Compares handing the messages over all at once (as the publish
+assistant does) with handing them over one by one. The thread is
+not started, so only the hand-off is measured, not the publication.
+
+Usage:
+    python tests/benchmark_handoff.py [num_messages]
+
+'''
+import sys
+import time
+import logging
+import mock
+import esgfpid.rabbit.asynchronous
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+NUM_MESSAGES = 100000
+
+def make_connector():
+    connector = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(mock.MagicMock())
+    connector._AsynchronousRabbitConnector__thread = mock.MagicMock()
+    connector._AsynchronousRabbitConnector__not_started_yet = False
+    connector._AsynchronousRabbitConnector__statemachine.set_to_available()
+    return connector
+
+def make_messages(num_messages):
+    return [{'handle':'hdl:21.14100/%i' % i, 'ROUTING_KEY':'foo'} for i in range(num_messages)]
+
+def hand_over_all_at_once(connector, messages):
+    start = time.time()
+    connector.send_many_messages_to_queue(messages)
+    return time.time() - start
+
+def hand_over_one_by_one(connector, messages):
+    start = time.time()
+    for message in messages:
+        connector.send_message_to_queue(message)
+    return time.time() - start
+
+if __name__ == '__main__':
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_MESSAGES
+    messages = make_messages(num_messages)
+    print('Handing %i messages over to the rabbit thread...' % num_messages)
+
+    connector = make_connector()
+    bulk = hand_over_all_at_once(connector, messages)
+    assert connector._AsynchronousRabbitConnector__unpublished_messages_queue.qsize() == num_messages
+    print('All at once: %8.1f milliseconds (%i wake-ups)' % (bulk*1000, connector._AsynchronousRabbitConnector__thread.add_event_publish_message.call_count))
+
+    connector = make_connector()
+    single = hand_over_one_by_one(connector, messages)
+    print('One by one:  %8.1f milliseconds (%i wake-ups)' % (single*1000, connector._AsynchronousRabbitConnector__thread.add_event_publish_message.call_count))
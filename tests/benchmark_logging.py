@@ -0,0 +1,137 @@
+'''
+Microbenchmark for the logging overhead in the rabbit hot path.
+
+Measures how long the per-message logging calls take when trace
+and debug logging are switched off (the normal case on a publisher),
+with the current logging helpers and with the previous ones, which
+looked up the flags in esgfpid.defaults on every call. It runs many
+messages through:
+
+ * the logging calls that the feeder, the confirmer and the
+   asynchronous facade make for every message (the time of an
+   empty loop is subtracted, so it shows the cost of the calls),
+ * the Confirmer (put to unconfirmed, then single ack), which is
+   where most of these calls happen. For the previous behaviour,
+   the Confirmer's trace calls are made unconditionally with the
+   previous helpers, as they were before they were guarded.
+
+Usage:
+    python tests/benchmark_logging.py [num_messages]
+
+'''
+import sys
+import time
+import logging
+import mock
+import esgfpid.defaults
+from esgfpid.utils import logtrace, logdebug, log_every_x_times
+from esgfpid.rabbit.rabbitutils import MessageEnvelope
+import esgfpid.rabbit.asynchronous.thread_confirmer
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+NUM_MESSAGES = 100000
+REPEAT = 5
+
+'''
+The logging helpers as they were before: The flags are looked
+up in esgfpid.defaults on every call.
+'''
+def legacy_logtrace(logger, msg, *args, **kwargs):
+    if esgfpid.defaults.LOG_TRACE_TO_DEBUG:
+        legacy_logdebug(logger, '[trace] %s' % msg, *args, **kwargs)
+    else:
+        pass
+
+def legacy_logdebug(logger, msg, *args, **kwargs):
+    if esgfpid.defaults.LOG_DEBUG_TO_INFO:
+        logger.info('DEBUG %s ' % msg, *args, **kwargs)
+    else:
+        logger.debug(msg, *args, **kwargs)
+
+class StubThread(object):
+    ''' Stands in for the RabbitThread, doing nothing. '''
+
+    def tell_publisher_messages_were_confirmed(self):
+        pass
+
+    def tell_shutter_all_messages_confirmed(self):
+        pass
+
+class StubMethod(object):
+    NAME = 'Basic.Ack'
+    multiple = False
+    delivery_tag = 0
+
+class StubFrame(object):
+    method = StubMethod()
+
+class TraceAlwaysOn(object):
+    ''' Stands in for logutils, so that the guarded trace calls are made. '''
+    TRACE_ENABLED = True
+
+def make_messages(num_messages):
+    return [MessageEnvelope('my.routing.key', '{"handle":"hdl:21.14100/%i","operation":"publish"}' % i) for i in range(num_messages)]
+
+def time_empty_loop(messages):
+    start = time.time()
+    for i, msg in enumerate(messages):
+        pass
+    return time.time() - start
+
+def time_logging_calls(messages, logtrace, logdebug):
+    start = time.time()
+    for i, msg in enumerate(messages):
+        # Feeder:
+        logtrace(LOGGER, 'Publishing message %i (channel %i): %s', i, 1, msg)
+        logtrace(LOGGER, 'Publishing message %i... done.', i)
+        log_every_x_times(LOGGER, i, 100, 'Actual publish to exchange "%s": Message %i (channel %i).', 'exch', i, 1)
+        # Confirmer:
+        logtrace(LOGGER, 'Adding message with delivery tag %i to unconfirmed: %s', i, msg)
+        logdebug(LOGGER, 'Received ack for delivery tag %i. Waiting for %i confirms.', i, 0)
+        # Asynchronous facade:
+        logtrace(LOGGER, 'Handing over one message over to the rabbit thread (%s)', msg)
+        log_every_x_times(LOGGER, i, 100, 'Handing over one message over to the rabbit thread (no. %i).', i)
+    return time.time() - start
+
+def time_confirmer(messages):
+    confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer(StubThread())
+    frame = StubFrame()
+    start = time.time()
+    for tag, msg in enumerate(messages, 1):
+        confirmer.put_to_unconfirmed(tag, msg)
+        frame.method.delivery_tag = tag
+        confirmer.on_delivery_confirmation(frame)
+    return time.time() - start
+
+def time_legacy_confirmer(messages):
+    module = esgfpid.rabbit.asynchronous.thread_confirmer
+    with mock.patch.object(module, 'logtrace', legacy_logtrace), \
+         mock.patch.object(module, 'logdebug', legacy_logdebug), \
+         mock.patch.object(module, 'logutils', TraceAlwaysOn()):
+        return time_confirmer(messages)
+
+def per_message(seconds, num_messages):
+    return seconds * 1e9 / num_messages
+
+if __name__ == '__main__':
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_MESSAGES
+    logging.basicConfig(level=logging.WARNING) # debug switched off
+    messages = make_messages(num_messages)
+    print('Running %i messages through the logging calls (best of %i)...' % (num_messages, REPEAT))
+
+    # The runs before and after are interleaved, so that a
+    # machine getting slower or faster does not favour either:
+    empty, calls, legacy_calls, confirmer, legacy_confirmer = [], [], [], [], []
+    for i in range(REPEAT):
+        empty.append(time_empty_loop(messages))
+        legacy_calls.append(time_logging_calls(messages, legacy_logtrace, legacy_logdebug))
+        calls.append(time_logging_calls(messages, logtrace, logdebug))
+        legacy_confirmer.append(time_legacy_confirmer(messages))
+        confirmer.append(time_confirmer(messages))
+    empty, calls, legacy_calls, confirmer, legacy_confirmer = [min(x) for x in (empty, calls, legacy_calls, confirmer, legacy_confirmer)]
+
+    print('                                 before      after')
+    print('Logging calls per message:  %8.0f ns %8.0f ns' % (per_message(legacy_calls - empty, num_messages), per_message(calls - empty, num_messages)))
+    print('Confirmer put and ack:      %8.0f ns %8.0f ns' % (per_message(legacy_confirmer, num_messages), per_message(confirmer, num_messages)))
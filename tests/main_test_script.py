@@ -161,6 +161,12 @@ if __name__ == '__main__':
             n = tests.countTestCases()
             numtests += n
 
+            from testcases.solr.solr_task3_tests import SolrTask3TestCase
+            tests = unittest.TestLoader().loadTestsFromTestCase(SolrTask3TestCase)
+            tests_to_run.append(tests)
+            n = tests.countTestCases()
+            numtests += n
+
             from testcases.solr.solr_server_tests import SolrServerConnectorTestCase
             tests = unittest.TestLoader().loadTestsFromTestCase(SolrServerConnectorTestCase)
             tests_to_run.append(tests)
@@ -188,6 +194,30 @@ if __name__ == '__main__':
             n = tests.countTestCases()
             numtests += n
 
+            from testcases.rabbit.metrics_tests import MetricsTestCase
+            tests = unittest.TestLoader().loadTestsFromTestCase(MetricsTestCase)
+            tests_to_run.append(tests)
+            n = tests.countTestCases()
+            numtests += n
+
+            from testcases.rabbit.nodehealth_tests import NodeHealthTestCase
+            tests = unittest.TestLoader().loadTestsFromTestCase(NodeHealthTestCase)
+            tests_to_run.append(tests)
+            n = tests.countTestCases()
+            numtests += n
+
+            from testcases.rabbit.delivery_tests import DeliveryFutureTestCase
+            tests = unittest.TestLoader().loadTestsFromTestCase(DeliveryFutureTestCase)
+            tests_to_run.append(tests)
+            n = tests.countTestCases()
+            numtests += n
+
+            from testcases.rabbit.aio_tests import AioRabbitConnectorTestCase
+            tests = unittest.TestLoader().loadTestsFromTestCase(AioRabbitConnectorTestCase)
+            tests_to_run.append(tests)
+            n = tests.countTestCases()
+            numtests += n
+
             if param.syn:
 
                 from testcases.rabbit.syn.rabbit_synchronous_tests import RabbitConnectorTestCase
@@ -196,6 +226,12 @@ if __name__ == '__main__':
                 n = tests.countTestCases()
                 numtests += n
 
+                from testcases.rabbit.syn.connectionpool_tests import ConnectionPoolTestCase
+                tests = unittest.TestLoader().loadTestsFromTestCase(ConnectionPoolTestCase)
+                tests_to_run.append(tests)
+                n = tests.countTestCases()
+                numtests += n
+
             if param.asyn:
 
                 # This tests the API and the thread
@@ -210,6 +246,24 @@ if __name__ == '__main__':
                 tests_to_run.append(tests)
                 numtests += tests.countTestCases()
 
+                # Spool writes to a temporary file.
+                from testcases.rabbit.asyn.spool_tests import SpoolTestCase
+                tests = unittest.TestLoader().loadTestsFromTestCase(SpoolTestCase)
+                tests_to_run.append(tests)
+                numtests += tests.countTestCases()
+
+                # Limiter is isolated, except for the spill file.
+                from testcases.rabbit.asyn.limiter_tests import LimiterTestCase
+                tests = unittest.TestLoader().loadTestsFromTestCase(LimiterTestCase)
+                tests_to_run.append(tests)
+                numtests += tests.countTestCases()
+
+                # Distributor only needs mocked connectors.
+                from testcases.rabbit.asyn.distributor_tests import DistributorTestCase
+                tests = unittest.TestLoader().loadTestsFromTestCase(DistributorTestCase)
+                tests_to_run.append(tests)
+                numtests += tests.countTestCases()
+
                 # Feeder needs some mocking...
                 from testcases.rabbit.asyn.thread_feeder_tests import ThreadFeederTestCase
                 tests = unittest.TestLoader().loadTestsFromTestCase(ThreadFeederTestCase)
@@ -258,6 +312,18 @@ if __name__ == '__main__':
             n = tests.countTestCases()
             numtests += n
 
+            from testcases.batch_publish_tests import BatchPublishTestCase
+            tests = unittest.TestLoader().loadTestsFromTestCase(BatchPublishTestCase)
+            tests_to_run.append(tests)
+            n = tests.countTestCases()
+            numtests += n
+
+            from testcases.workerpool_tests import WorkerPoolTestCase
+            tests = unittest.TestLoader().loadTestsFromTestCase(WorkerPoolTestCase)
+            tests_to_run.append(tests)
+            n = tests.countTestCases()
+            numtests += n
+
         if 'api' in param.modules or 'all' in param.modules:
 
             from testcases.connector_tests import ConnectorTestCase
@@ -266,6 +332,12 @@ if __name__ == '__main__':
             n = tests.countTestCases()
             numtests += n
 
+            from testcases.asyncconnector_tests import AsyncConnectorTestCase
+            tests = unittest.TestLoader().loadTestsFromTestCase(AsyncConnectorTestCase)
+            tests_to_run.append(tests)
+            n = tests.countTestCases()
+            numtests += n
+
         if 'consistency' in param.modules or 'all' in param.modules:
 
             from testcases.consistency_tests import ConsistencyTestCase
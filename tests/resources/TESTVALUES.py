@@ -146,11 +146,17 @@ class MockThread2(object):
         self.undelivered_msg = []
         self.unconfirmed_tags = []
         self.exchange_name = 'foo'
+        self.num_message_events = 0
+        self.unconfirmed_channels = []
         # Rabbit API, used by modules:
         self._channel = mock.MagicMock()
+        self._channels = [self._channel]
         if error is not None:
             self._channel.basic_publish.side_effect = error
 
+    def add_event_publish_message(self):
+        self.num_message_events += 1
+
     def get_message_from_unpublished_stack(self, seconds):
         if len(self.messages) == 0:
             raise queue.Empty()
@@ -167,11 +173,10 @@ class MockThread2(object):
     def get_exchange_name(self):
         return self.exchange_name
 
-    def put_to_unconfirmed_delivery_tags(self, tag):
+    def put_to_unconfirmed(self, tag, msg, channel_index=0):
         self.unconfirmed_tags.append(tag)
-
-    def put_to_unconfirmed_messages_dict(self, tag, msg):
         self.undelivered_msg.append(msg)
+        self.unconfirmed_channels.append(channel_index)
 
 
 '''
@@ -184,6 +189,7 @@ class MockThread3(object):
         self._channel = mock.MagicMock()
         # Methods (used by modules):
         self.send_a_message = mock.MagicMock()
+        self.take_future_of_unconfirmed = mock.MagicMock(return_value=None)
 
         if error is not None:
             self.send_a_message.side_effect = error
@@ -195,9 +201,7 @@ class MockThread4(object):
 
     def __init__(self, error=None):
         self.num_unpublished = 0
-        self.num_unconfirmed = 0.0
-        self.fake_confirms = False
-        self.confirm_rate = 1
+        self.num_unconfirmed = 0
         # Attributes (used by modules):
         self.ERROR_CODE_CONNECTION_FORCE_CLOSED = 999
         self.ERROR_TEXT_CONNECTION_FORCE_CLOSED = "errortext"
@@ -210,8 +214,11 @@ class MockThread4(object):
         self._connection.is_closing = False
         self._connection.is_open = True
 
+        # Events added to the ioloop are stored, to be
+        # run by the test (see run_timers()):
+        self.timers = []
         def side_effect_call_later(seconds, callback):
-            callback()
+            self.timers.append((seconds, callback))
         self._connection.ioloop.call_later = mock.MagicMock()
         self._connection.ioloop.call_later.side_effect = side_effect_call_later
 
@@ -226,24 +233,18 @@ class MockThread4(object):
         return int(round(self.num_unpublished))
 
     def get_num_unconfirmed(self):
-        num_conf = self.num_unconfirmed
-        # This fakes receiving confirms from Rabbit:
-        if self.fake_confirms:
-            self.num_unconfirmed = self.num_unconfirmed - self.confirm_rate
-            if (self.num_unconfirmed < 0):
-                self.num_unconfirmed = 0
-        # This returns num confirms
-        #print('Unconfirmed: '+str(self.num_unconfirmed))
-        return num_conf
+        return self.num_unconfirmed
 
     def side_effect_add_event_publish_message(self):
-        self.num_unpublished = self.num_unpublished -1
-        if (self.num_unpublished < 0):
-            self.num_unpublished = 0
+        # One publish event drains the queue of unpublished messages:
+        self.num_unpublished = 0
         #print('Called add_event_publish_message! Now: %i' % self.num_unpublished)
 
-    def set_fake_confirms(self):
-        self.fake_confirms = True
+    def run_timers(self):
+        timers = sorted(self.timers, key=lambda timer: timer[0])
+        self.timers = []
+        for seconds, callback in timers:
+            callback()
 
 
 
@@ -261,6 +262,11 @@ class MockRabbitSender(object):
         if self.please_print:
             print('Called "send_message_to_queue()" with '+str(msg))
 
+    def send_many_messages_to_queue(self, msgs):
+        self.received_messages.extend(msgs)
+        if self.please_print:
+            print('Called "send_many_messages_to_queue()" with %i messages' % len(msgs))
+
     def open_rabbit_connection(self):
         if self.please_print:
             print('Called "open_rabbit_connection()"')
@@ -298,7 +304,18 @@ def get_coupler_args(**kwargs):
         solr_https_verify=True,
         solr_switched_off=False,
         test_publication=False,
-        message_service_synchronous=False
+        message_service_synchronous=False,
+        messaging_service_spool_file=None,
+        messaging_service_max_in_flight=None,
+        messaging_service_overflow_policy='block',
+        messaging_service_overflow_timeout=60,
+        messaging_service_num_channels=1,
+        messaging_service_distribution=None,
+        messaging_service_metrics=False,
+        messaging_service_node_health_dir=None,
+        messaging_service_connection_pool=False,
+        messaging_service_publish_window=1,
+        message_service_asyncio=False
     )
     for k,v in kwargs.items():
         coupler_args[k] = v
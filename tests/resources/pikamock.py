@@ -13,14 +13,43 @@ class MockChannel(object):
         self.num_unroutables = 0 # Can be set before mock is called
         self.success_counter = 0
         self.channel_number = 1 # This mocks the original API
+        self.transactional = False
+        self.commit_counter = 0 # is incremented at every commit
+        self.num_commit_failures = 0 # Can be set before mock is called
+        self.num_commits_before_failures = 0 # Can be set before mock is called
+        self.__on_return_callback = None
+        self.__to_be_returned = []
 
     def confirm_delivery(self, *args, **kwargs): # This mocks the original API
         pass
 
+    def tx_select(self): # This mocks the original API
+        self.transactional = True
+
+    def tx_commit(self): # This mocks the original API
+        self.commit_counter += 1
+        to_be_returned = self.__to_be_returned
+        self.__to_be_returned = []
+        if self.num_commits_before_failures < self.commit_counter <= self.num_commits_before_failures+self.num_commit_failures:
+            self.is_open = False
+            raise pika.exceptions.ChannelClosed(reply_code=0, reply_text='Channel Closed')
+        for body in to_be_returned:
+            self.__on_return_callback(self, mock.MagicMock(), mock.MagicMock(), body)
+
+    def close(self, *args, **kwargs): # This mocks the original API
+        self.is_open = False
+
     def basic_publish(self, *args, **kwargs): # This mocks the original API
         self.publish_counter += 1
         self.messages.append(kwargs['body'])
         self.routing_keys.append(kwargs['routing_key'])
+        if self.transactional:
+            # Unroutable messages are returned when committing:
+            if self.publish_counter <= self.num_unroutables:
+                self.__to_be_returned.append(kwargs['body'].encode('utf-8'))
+            else:
+                self.success_counter += 1
+            return None
         if self.publish_counter <= self.num_unroutables:
             raise pika.exceptions.UnroutableError('Unroutableeee!')
         elif self.publish_counter <= self.num_failures:
@@ -41,8 +70,8 @@ class MockChannel(object):
     def add_on_close_callback(self, *args, **kwargs): # This mocks the original API
         pass
 
-    def add_on_return_callback(self, *args, **kwargs): # This mocks the original API
-        pass
+    def add_on_return_callback(self, callback): # This mocks the original API
+        self.__on_return_callback = callback
 
 class MockPikaBlockingConnection(object):
 
@@ -50,6 +79,8 @@ class MockPikaBlockingConnection(object):
         self.is_open = True # This mocks the original API
         self.host = params.host # This mocks the original API
         self.raise_channel_closed = False
+        self.channels = [] # All channels that were opened
+        self.num_unroutables = 0 # Passed to the channels that are opened later
 
         #if params.host == 'please.raise.auth.error':
         #    raise pika.exceptions.ProbableAuthenticationError()
@@ -63,7 +94,10 @@ class MockPikaBlockingConnection(object):
         if self.raise_channel_closed:
             raise pika.exceptions.ChannelClosed(reply_code=0, reply_text='Channel Closed')
         else:
-            return MockChannel()
+            channel = MockChannel()
+            channel.num_unroutables = self.num_unroutables
+            self.channels.append(channel)
+            return channel
 
     def close(self): # This mocks the original API
         self.is_open = False
@@ -93,3 +127,67 @@ class MockPikaSelectConnection(object):
     def add_on_close_callback(self, callback):
         pass
 
+
+class MockPikaAsyncioConnection(object):
+    '''
+    Opens right away (on the event loop), and so do its
+    channels. Every published message is acked (or nacked,
+    if the channel's "nack" flag is set).
+    '''
+
+    def __init__(self, loop, on_open_callback, on_close_callback):
+        self.is_open = False # This mocks the original API
+        self.is_closing = False # This mocks the original API
+        self.is_closed = False # This mocks the original API
+        self.channels = []
+        self.__loop = loop
+        self.__on_close_callback = on_close_callback
+        loop.call_soon(self.__open, on_open_callback)
+
+    def __open(self, on_open_callback):
+        self.is_open = True
+        on_open_callback(self)
+
+    def channel(self, on_open_callback): # This mocks the original API
+        channel = MockAsyncioChannel(self.__loop)
+        self.channels.append(channel)
+        self.__loop.call_soon(on_open_callback, channel)
+        return channel
+
+    def close(self): # This mocks the original API
+        self.is_open = False
+        self.is_closing = True
+        self.__loop.call_soon(self.__closed)
+
+    def __closed(self):
+        self.is_closing = False
+        self.is_closed = True
+        self.__on_close_callback(self, 'Closed by user')
+
+class MockAsyncioChannel(object):
+
+    def __init__(self, loop):
+        self.messages = []
+        self.routing_keys = []
+        self.nack = False # Can be set before mock is called
+        self.__loop = loop
+        self.__ack_nack_callback = None
+
+    def add_on_close_callback(self, callback): # This mocks the original API
+        pass
+
+    def add_on_return_callback(self, callback): # This mocks the original API
+        pass
+
+    def confirm_delivery(self, ack_nack_callback, callback=None): # This mocks the original API
+        self.__ack_nack_callback = ack_nack_callback
+        self.__loop.call_soon(callback, mock.MagicMock())
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False): # This mocks the original API
+        self.messages.append(body)
+        self.routing_keys.append(routing_key)
+        method_frame = mock.MagicMock()
+        method_frame.method.NAME = 'Basic.Nack' if self.nack else 'Basic.Ack'
+        method_frame.method.delivery_tag = len(self.messages)
+        method_frame.method.multiple = False
+        self.__loop.call_soon(self.__ack_nack_callback, method_frame)
@@ -0,0 +1,179 @@
+import unittest
+import mock
+import logging
+import json
+import asyncio
+import tests.resources.pikamock
+import tests.utils as utils
+
+# Import of code to be tested:
+import esgfpid
+import esgfpid.rabbit.aio
+import esgfpid.rabbit.nodehealth
+from esgfpid.exceptions import MessageNotDeliveredException
+
+# Logging
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Test resources:
+from resources.TESTVALUES import *
+import resources.TESTVALUES as TESTHELPERS
+
+'''
+Replaces the pika connection by a mock that opens and
+acks everything on the event loop.
+'''
+def make_mocked_connection(aiorabbit, params):
+    connection = tests.resources.pikamock.MockPikaAsyncioConnection(
+        asyncio.get_event_loop(),
+        aiorabbit.on_connection_open,
+        aiorabbit.on_connection_closed)
+    CONNECTIONS.append(connection)
+    return connection
+CONNECTIONS = []
+
+class AsyncConnectorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+        esgfpid.rabbit.nodehealth.NODE_HEALTH.reset() # no failures from earlier tests
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        del CONNECTIONS[:]
+        patcher = mock.patch.object(esgfpid.rabbit.aio.AioRabbitConnector,
+            '_AioRabbitConnector__make_connection', autospec=True, side_effect=make_mocked_connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def make_connector(self):
+        return esgfpid.AsyncConnector(**TESTHELPERS.get_connector_args(
+            data_node=DATA_NODE,
+            thredds_service_path=THREDDS))
+
+    def get_sent_messages(self):
+        return [json.loads(msg) for conn in CONNECTIONS for channel in conn.channels for msg in channel.messages]
+
+    # Tests
+
+    def test_add_errata_ids_ok(self):
+
+        # Preparation:
+        testconnector = self.make_connector()
+
+        # Run code to be tested:
+        async def run():
+            async with testconnector:
+                await testconnector.add_errata_ids(
+                    drs_id=DRS_ID,
+                    version_number=DS_VERSION,
+                    errata_ids=ERRATA_SEVERAL
+                )
+        self.loop.run_until_complete(run())
+
+        # Check result:
+        sent = self.get_sent_messages()
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]['operation'], 'add_errata_ids')
+        self.assertEqual(sent[0]['errata_ids'], ERRATA_SEVERAL)
+        # Connection was closed:
+        self.assertTrue(CONNECTIONS[0].is_closed)
+
+    def test_publication_ok(self):
+
+        # Preparation:
+        testconnector = self.make_connector()
+
+        # Run code to be tested:
+        async def run():
+            assistant = testconnector.create_publication_assistant(
+                drs_id=DRS_ID,
+                version_number=DS_VERSION,
+                is_replica=False
+            )
+            await assistant.add_file(
+                file_name=FILENAME,
+                file_handle=FILEHANDLE_HDL,
+                checksum=CHECKSUM,
+                file_size=FILESIZE,
+                publish_path=PUBLISH_PATH,
+                checksum_type=CHECKSUMTYPE,
+                file_version=FILEVERSION
+            )
+            await assistant.dataset_publication_finished()
+            return assistant.get_dataset_handle()
+        handle = self.loop.run_until_complete(run())
+
+        # Check result: File and dataset message sent
+        self.assertEqual(handle, DATASETHANDLE_HDL)
+        sent = self.get_sent_messages()
+        self.assertEqual(sorted(msg['operation'] for msg in sent), ['publish', 'publish'])
+        self.assertEqual(sorted(msg['aggregation_level'] for msg in sent), ['dataset', 'file'])
+
+    def test_streamed_file_nack_raises(self):
+
+        # Preparation:
+        testconnector = self.make_connector()
+
+        # Run code to be tested:
+        async def run():
+            await testconnector.add_errata_ids(drs_id=DRS_ID, version_number=DS_VERSION, errata_ids=ERRATA)
+            assistant = testconnector.create_publication_assistant(
+                drs_id=DRS_ID,
+                version_number=DS_VERSION,
+                is_replica=False,
+                stream_files=True
+            )
+            CONNECTIONS[0].channels[0].nack = True # only the file message
+            await assistant.add_file(
+                file_name=FILENAME,
+                file_handle=FILEHANDLE_HDL,
+                checksum=CHECKSUM,
+                file_size=FILESIZE,
+                publish_path=PUBLISH_PATH,
+                checksum_type=CHECKSUMTYPE,
+                file_version=FILEVERSION
+            )
+            CONNECTIONS[0].channels[0].nack = False
+            await assistant.dataset_publication_finished()
+
+        # Check result: The file message was streamed, and its
+        # failure is reported when the publication is finished:
+        with self.assertRaises(MessageNotDeliveredException):
+            self.loop.run_until_complete(run())
+        sent = self.get_sent_messages()
+        self.assertEqual([msg.get('aggregation_level') for msg in sent], [None, 'file', 'dataset'])
+
+    def test_concurrent_operations_share_connection(self):
+
+        # Preparation:
+        testconnector = self.make_connector()
+        carts = [{DRS_ID+str(i): None} for i in range(5)]
+
+        # Run code to be tested:
+        async def run():
+            return await asyncio.gather(*[testconnector.create_data_cart_pid(cart) for cart in carts])
+        handles = self.loop.run_until_complete(run())
+
+        # Check result:
+        self.assertEqual(len(set(handles)), 5)
+        self.assertEqual(len(CONNECTIONS), 1)
+        self.assertEqual(len(self.get_sent_messages()), 5)
+
+    def test_nack_raises(self):
+
+        # Preparation:
+        testconnector = self.make_connector()
+
+        # Run code to be tested:
+        async def run():
+            await testconnector.add_errata_ids(drs_id=DRS_ID, version_number=DS_VERSION, errata_ids=ERRATA)
+            CONNECTIONS[0].channels[0].nack = True
+            await testconnector.remove_errata_ids(drs_id=DRS_ID, version_number=DS_VERSION, errata_ids=ERRATA)
+        with self.assertRaises(MessageNotDeliveredException):
+            self.loop.run_until_complete(run())
@@ -0,0 +1,206 @@
+import unittest
+import mock
+import logging
+import esgfpid
+import esgfpid.exceptions
+from esgfpid.assistant.batch import BatchPublicationAssistant
+from esgfpid.rabbit.delivery import DeliveryFuture
+
+# Logging
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Test resources:
+from resources.TESTVALUES import *
+import resources.TESTVALUES as TESTHELPERS
+
+
+class BatchPublishTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_batch(self, testcoupler):
+        return BatchPublicationAssistant(
+            coupler=testcoupler,
+            prefix=PREFIX_NO_HDL,
+            thredds_service_path=THREDDS,
+            data_node=DATA_NODE,
+            consumer_solr_url=SOLR_URL_CONSUMER
+        )
+
+    def make_solrmock(self, testcoupler, previous_files_of_many, previous_files_of_one):
+        solrmock = mock.Mock()
+        solrmock.retrieve_file_handles_of_many_datasets.return_value = previous_files_of_many
+        solrmock.retrieve_file_handles_of_same_dataset.return_value = previous_files_of_one
+        TESTHELPERS.patch_with_solr_mock(testcoupler, solrmock)
+        return solrmock
+
+    # Tests
+
+    def test_batch_publication_ok(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler, mock.MagicMock())
+        rabbitmock.send_message_to_queue.return_value = None # synchronous
+        rabbitmock.send_many_messages_to_queue.return_value = None
+        testbatch = self.make_batch(testcoupler)
+        fileargs = TESTHELPERS.get_args_for_adding_file()
+
+        # Run code to be tested:
+        testbatch.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION, is_replica=False, records=[fileargs])
+        assistant = testbatch.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION2, is_replica=False)
+        assistant.add_file(**fileargs)
+        results = testbatch.finish()
+
+        # Check result:
+        self.assertEqual([result['success'] for result in results], [True, True])
+        self.assertEqual([result['version_number'] for result in results], [DS_VERSION, DS_VERSION2])
+        self.assertEqual(results[0]['dataset_handle'], DATASETHANDLE_HDL)
+        self.assertIsNone(results[0]['future'])
+        self.assertEqual(rabbitmock.send_message_to_queue.call_count, 2)
+        self.assertEqual(rabbitmock.send_many_messages_to_queue.call_count, 2)
+
+        # Check result: Synchronous connection opened once for all:
+        rabbitmock.open_rabbit_connection.assert_called_once_with()
+        rabbitmock.close_rabbit_connection.assert_called_once_with()
+
+    def test_batch_publication_returns_futures(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler, mock.MagicMock())
+        rabbitmock.send_message_to_queue.side_effect = lambda message: DeliveryFuture()
+        rabbitmock.send_many_messages_to_queue.side_effect = lambda messages: [DeliveryFuture() for message in messages]
+        testbatch = self.make_batch(testcoupler)
+        testbatch.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION, is_replica=False,
+            records=[TESTHELPERS.get_args_for_adding_file()])
+
+        # Run code to be tested:
+        results = testbatch.finish()
+
+        # Check result:
+        self.assertEqual(len(results[0]['future'].futures), 2)
+
+    def test_batch_publication_prefetched_consistency_check(self):
+
+        # Test variables:
+        fileargs = TESTHELPERS.get_args_for_adding_file()
+        previous = {(DRS_ID, DS_VERSION): [FILEHANDLE_HDL, FILEHANDLE2_HDL]}
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler()
+        solrmock = self.make_solrmock(testcoupler, previous, [FILEHANDLE_HDL])
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        testbatch = self.make_batch(testcoupler)
+        testbatch.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION, is_replica=False, records=[fileargs])
+        testbatch.add_dataset(drs_id=DRS_ID, version_number=str(DS_VERSION2), is_replica=False, records=[fileargs])
+
+        # Run code to be tested:
+        results = testbatch.finish()
+
+        # Check result: Asked solr once for all:
+        solrmock.retrieve_file_handles_of_many_datasets.assert_called_once_with(
+            datasets=[(DRS_ID, DS_VERSION), (DRS_ID, DS_VERSION2)],
+            data_node=DATA_NODE)
+
+        # Check result: First dataset misses a file, so it is not published:
+        self.assertFalse(results[0]['success'])
+        self.assertIsInstance(results[0]['error'], esgfpid.exceptions.InconsistentFilesetException)
+
+        # Check result: Second dataset was not found, so solr was asked for it
+        # separately, and it is consistent:
+        self.assertTrue(results[1]['success'])
+        self.assertIsNone(results[1]['error'])
+        self.assertEqual(solrmock.retrieve_file_handles_of_same_dataset.call_count, 1)
+        self.assertEqual(len(rabbitmock.received_messages), 2)
+
+    def test_batch_publication_solr_error(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler()
+        solrmock = self.make_solrmock(testcoupler, None, [FILEHANDLE_HDL])
+        solrmock.retrieve_file_handles_of_many_datasets.side_effect = esgfpid.exceptions.SolrError('Oops')
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        testbatch = self.make_batch(testcoupler)
+        testbatch.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION, is_replica=False,
+            records=[TESTHELPERS.get_args_for_adding_file()])
+
+        # Run code to be tested:
+        results = testbatch.finish()
+
+        # Check result: Each dataset was checked on its own:
+        self.assertTrue(results[0]['success'])
+        solrmock.retrieve_file_handles_of_same_dataset.assert_called_once()
+
+    def test_batch_publication_dataset_without_files(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        testbatch = self.make_batch(testcoupler)
+        testbatch.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION, is_replica=False)
+        testbatch.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION2, is_replica=False,
+            records=[TESTHELPERS.get_args_for_adding_file()])
+
+        # Run code to be tested:
+        results = testbatch.finish()
+
+        # Check result:
+        self.assertIsInstance(results[0]['error'], esgfpid.exceptions.OperationUnsupportedException)
+        self.assertTrue(results[1]['success'])
+        self.assertEqual(len(rabbitmock.received_messages), 2)
+
+    def test_batch_publication_send_error_does_not_stop_others(self):
+
+        # Test variables:
+        error = esgfpid.exceptions.MessageNotDeliveredException('Oops', None)
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler, mock.MagicMock())
+        rabbitmock.send_message_to_queue.side_effect = [None, None, error, None] # synchronous
+        rabbitmock.send_many_messages_to_queue.return_value = None
+        testbatch = self.make_batch(testcoupler)
+        for i in range(4):
+            testbatch.add_dataset(drs_id='%s.%i' % (DRS_ID, i), version_number=DS_VERSION, is_replica=False,
+                records=[TESTHELPERS.get_args_for_adding_file()])
+
+        # Run code to be tested:
+        results = testbatch.finish()
+
+        # Check result:
+        self.assertEqual([result['success'] for result in results], [True, True, False, True])
+        self.assertIs(results[2]['error'], error)
+        self.assertEqual(rabbitmock.send_message_to_queue.call_count, 4)
+        rabbitmock.close_rabbit_connection.assert_called_once_with()
+
+    def test_batch_publication_too_late(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        testbatch = self.make_batch(testcoupler)
+        testbatch.finish()
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.OperationUnsupportedException):
+            testbatch.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION, is_replica=False)
+        with self.assertRaises(esgfpid.exceptions.OperationUnsupportedException):
+            testbatch.finish()
+
+    def test_create_via_connector(self):
+
+        # Preparations:
+        args = TESTHELPERS.get_connector_args(thredds_service_path='foo', data_node='bar')
+        testconnector = esgfpid.Connector(**args)
+
+        # Run code to be tested:
+        testbatch = testconnector.create_batch_publication_assistant()
+
+        # Check result:
+        self.assertIsInstance(testbatch, BatchPublicationAssistant)
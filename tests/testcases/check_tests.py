@@ -7,7 +7,9 @@ import tests.resources.pikamock
 import tests.resources.error_messages
 import esgfpid.utils
 import esgfpid.check
+import esgfpid.rabbit.nodehealth
 import pika
+import time
 
 # Logging
 LOGGER = logging.getLogger(__name__)
@@ -28,6 +30,7 @@ class CheckTestCase(unittest.TestCase):
 
     def setUp(self):
         LOGGER.info('######## Next test (%s) ##########', __name__)
+        esgfpid.rabbit.nodehealth.NODE_HEALTH.reset() # no failures from earlier tests
 
     def tearDown(self):
         LOGGER.info('#############################')
@@ -514,3 +517,116 @@ class CheckTestCase(unittest.TestCase):
             'Wrong stdout message.\n\nWe expected:\n\n%s\n\nWe got:\n\n%s\n' % (expected_message, output))
         self.assertEqual(expected_return, returned_msg,
             'Wrong return message.\n\nWe expected:\n\n%s\n\nWe got:\n\n%s\n' % (expected_return, returned_msg))
+
+    #
+    # Checking all hosts concurrently
+    #
+
+    def make_connector_with_three_hosts(self):
+        rabbit1 = dict(user='johndoe', password='abc123yx', priority=1, url='dead.host')
+        rabbit2 = dict(user='johndoe', password='abc123yx', priority=1, url='good.host')
+        rabbit3 = dict(user='johndoe', password='abc123yx', priority=2, url='hanging.host')
+        return TESTHELPERS.get_connector(messaging_service_credentials=[rabbit1,rabbit2,rabbit3])
+
+    def mock_response_depending_on_host(self, params):
+        if params.host == 'good.host':
+            return tests.resources.pikamock.MockPikaBlockingConnection(params)
+        elif params.host == 'hanging.host':
+            time.sleep(1)
+            return tests.resources.pikamock.MockPikaBlockingConnection(params)
+        else:
+            raise pika.exceptions.AMQPConnectionError('Connection refused')
+
+    @mock.patch('esgfpid.check.RabbitChecker._RabbitChecker__pika_blocking_connection')
+    def test_probe_all_hosts(self, connection_patch):
+
+        # Define the replacement for the patched method:
+        connection_patch.side_effect = self.mock_response_depending_on_host
+        testconnector = self.make_connector_with_three_hosts()
+
+        # Run code to be tested:
+        start = time.time()
+        report = esgfpid.check.probe_pid_queue_nodes(
+            connector = testconnector,
+            send_message = True,
+            timeout_seconds = 0.3
+        )
+        duration = time.time() - start
+
+        # Check result: The working one first
+        self.assertEqual([result['host'] for result in report], ['good.host', 'dead.host', 'hanging.host'])
+        self.assertEqual([result['ok'] for result in report], [True, False, False])
+        self.assertIsNone(report[0]['error'])
+        self.assertTrue(report[0]['seconds'] < 0.3)
+        self.assertIn('Connection failure', report[1]['error'])
+        self.assertEqual(report[2]['error'], 'No answer within 0.3 seconds.')
+        self.assertTrue(duration < 1, 'Waited for the hanging host (%s seconds)' % duration)
+
+    @mock.patch('esgfpid.check.RabbitChecker._RabbitChecker__pika_blocking_connection')
+    def test_probe_all_hosts_unexpected_error(self, connection_patch):
+
+        # Define the replacement for the patched method:
+        connection_patch.side_effect = RuntimeError('Oops')
+        testconnector = self.make_connector_with_three_hosts()
+
+        # Run code to be tested:
+        report = esgfpid.check.probe_pid_queue_nodes(
+            connector = testconnector,
+            timeout_seconds = 0.3
+        )
+
+        # Check result: Each failure has a reason
+        self.assertEqual([result['ok'] for result in report], [False, False, False])
+        self.assertEqual([result['error'] for result in report], ["RuntimeError('Oops')"]*3)
+
+    @mock.patch('esgfpid.check.RabbitChecker._RabbitChecker__pika_blocking_connection')
+    def test_probe_all_hosts_reorders_nodes(self, connection_patch):
+
+        # Define the replacement for the patched method:
+        connection_patch.side_effect = self.mock_response_depending_on_host
+        testconnector = self.make_connector_with_three_hosts()
+        nodemanager = testconnector._Connector__coupler._Coupler__rabbit_message_sender._RabbitMessageSender__node_manager
+
+        # Run code to be tested:
+        testconnector.probe_pid_queue_nodes(timeout_seconds=0.3)
+
+        # Check result: The node manager avoids the failed one now
+        for i in range(5):
+            nodemanager.reset_nodes()
+            self.assertEqual(nodemanager.get_connection_parameters().host, 'good.host')
+
+    @mock.patch('esgfpid.check.RabbitChecker._RabbitChecker__pika_blocking_connection')
+    def test_run_check_concurrent(self, connection_patch):
+
+        # Define the replacement for the patched method:
+        connection_patch.side_effect = self.mock_response_depending_on_host
+        testconnector = self.make_connector_with_three_hosts()
+
+        # Run code to be tested:
+        returned_msg = esgfpid.check.check_pid_queue_availability(
+            connector = testconnector,
+            concurrent = True,
+            timeout_seconds = 0.3
+        )
+
+        # Check result:
+        self.assertIsNone(returned_msg)
+
+    @mock.patch('esgfpid.check.RabbitChecker._RabbitChecker__pika_blocking_connection')
+    def test_run_check_concurrent_all_failed(self, connection_patch):
+
+        # Define the replacement for the patched method:
+        connection_patch.side_effect = pika.exceptions.ProbableAuthenticationError
+        testconnector = self.make_connector_with_three_hosts()
+
+        # Run code to be tested:
+        returned_msg = esgfpid.check.check_pid_queue_availability(
+            connector = testconnector,
+            concurrent = True,
+            timeout_seconds = 0.3
+        )
+
+        # Check result:
+        self.assertIn('CONNECTION TO THE PID MESSAGING QUEUE FAILED DEFINITIVELY', returned_msg)
+        for host in ['dead.host', 'good.host', 'hanging.host']:
+            self.assertIn('host "%s": Authentication failure (user johndoe).' % host, returned_msg)
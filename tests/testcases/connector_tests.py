@@ -537,6 +537,17 @@ class ConnectorTestCase(unittest.TestCase):
         self.assertEqual(coupler_args['disable_insecure_request_warning'],False)
         self.assertEqual(coupler_args['message_service_synchronous'],False)
         self.assertEqual(coupler_args['consumer_solr_url'],None)
+        self.assertEqual(coupler_args['messaging_service_spool_file'],None)
+        self.assertEqual(coupler_args['messaging_service_max_in_flight'],None)
+        self.assertEqual(coupler_args['messaging_service_overflow_policy'],'block')
+        self.assertEqual(coupler_args['messaging_service_overflow_timeout'],60)
+        self.assertEqual(coupler_args['messaging_service_num_channels'],1)
+        self.assertEqual(coupler_args['messaging_service_distribution'],None)
+        self.assertEqual(coupler_args['messaging_service_metrics'],False)
+        self.assertEqual(coupler_args['messaging_service_node_health_dir'],None)
+        self.assertEqual(coupler_args['messaging_service_connection_pool'],False)
+        self.assertEqual(coupler_args['messaging_service_publish_window'],1)
+        self.assertEqual(coupler_args['message_service_asyncio'],False)
         
     '''
     Test whether the correct defaults are set
@@ -678,6 +689,24 @@ class ConnectorTestCase(unittest.TestCase):
     # Unpublication
     #
 
+    '''
+    The metrics are passed on from the rabbit module.
+    '''
+    def test_get_messaging_metrics(self):
+
+        # Preparations:
+        testconnector = TESTHELPERS.get_connector()
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testconnector, mock.MagicMock())
+        rabbitmock.get_metrics.return_value = {'messages_acked':5}
+
+        # Run code to be tested:
+        metrics = testconnector.get_messaging_metrics()
+        testconnector.get_messaging_metrics(prometheus=True)
+
+        # Check result:
+        self.assertEqual(metrics, {'messages_acked':5})
+        rabbitmock.get_metrics.assert_called_with(True)
+
     '''
     If we want to unpublish a dataset, "data_node" has to
     be specified in the beginning!
@@ -96,6 +96,36 @@ class MessageCreationTestcase(unittest.TestCase):
         same = utils.is_json_same(expected, received_message)
         self.assertTrue(same, error_message(expected, received_message))
 
+    def test_make_messages_publication_files_same_as_one_by_one(self):
+
+        # Test variables
+        args_dict = self.__get_args_dict_file()
+        args_dict['is_replica'] = True
+        args_dict['data_url'] = 'myurl.de/path/filey.nc'
+        args_dict2 = copy.deepcopy(args_dict)
+        args_dict2['file_handle'] = '123/789'
+        records = [messages.FileRecord(
+            args['file_handle'], args['file_size'], args['file_name'],
+            args['checksum'], 'path/filey.nc', args['checksum_type'],
+            args['file_version']) for args in (args_dict, args_dict2)]
+
+        # Run code to be tested:
+        received_messages = messages.publish_files(
+            records,
+            data_url_base='myurl.de/',
+            data_node=args_dict['data_node'],
+            parent_dataset=args_dict['parent_dataset'],
+            is_replica=True,
+            timestamp=args_dict['timestamp'])
+
+        # Check result:
+        expected_messages = [messages.publish_file(**args_dict), messages.publish_file(**args_dict2)]
+        self.assertEqual(received_messages, expected_messages)
+
+        # The records only hold the file's own information:
+        with self.assertRaises(AttributeError):
+            records[0].data_node = 'dkrz.de'
+
     def test_make_message_publication_dataset_ok(self):
 
         # Test variables
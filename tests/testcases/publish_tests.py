@@ -1,10 +1,15 @@
+import os
+import shutil
+import tempfile
 import unittest
+import mock
 import logging
 import tests.utils as utils
 from tests.utils import compare_json_return_errormessage as error_message
 
 from esgfpid.assistant.publish import DatasetPublicationAssistant
 from esgfpid.exceptions import SolrSwitchedOff
+from esgfpid.rabbit.delivery import DeliveryFuture, AggregateDeliveryFuture
 
 # Logging
 LOGGER = logging.getLogger(__name__)
@@ -192,6 +197,49 @@ class PublishTestCase(unittest.TestCase):
         same = utils.is_json_same(expected_rabbit_task, received_rabbit_task)
         self.assertTrue(same, error_message(expected_rabbit_task, received_rabbit_task))
 
+    def test_normal_publication_returns_future(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        dataset_future = DeliveryFuture()
+        file_futures = [DeliveryFuture(), DeliveryFuture()]
+        rabbitmock = mock.MagicMock()
+        rabbitmock.send_message_to_queue.return_value = dataset_future
+        rabbitmock.send_many_messages_to_queue.return_value = file_futures
+        TESTHELPERS.patch_with_rabbit_mock(testcoupler, rabbitmock)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, **dsargs)
+        fileargs = TESTHELPERS.get_args_for_adding_file()
+
+        # Run code to be tested:
+        assistant.add_file(**fileargs)
+        future = assistant.dataset_publication_finished()
+
+        # Check result: Resolved once all messages of the dataset are:
+        self.assertIsInstance(future, AggregateDeliveryFuture)
+        self.assertEqual(future.futures, [dataset_future]+file_futures)
+        dataset_future.set_delivered()
+        file_futures[0].set_delivered()
+        self.assertFalse(future.done())
+        file_futures[1].set_not_delivered(esgfpid.exceptions.MessageNotDeliveredException('nack', 'foo'))
+        self.assertIsInstance(future.exception(), esgfpid.exceptions.MessageNotDeliveredException)
+        self.assertEqual(future.exception().undelivered_messages, ['foo'])
+
+    def test_normal_publication_returns_no_future(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        TESTHELPERS.patch_with_rabbit_mock(testcoupler) # returns nothing, like synchronous mode
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, **dsargs)
+        assistant.add_file(**TESTHELPERS.get_args_for_adding_file())
+
+        # Run code to be tested:
+        future = assistant.dataset_publication_finished()
+
+        # Check result:
+        self.assertIsNone(future)
+
     def test_add_file_wrong_prefix(self):
 
         # Preparations:
@@ -429,6 +477,341 @@ class PublishTestCase(unittest.TestCase):
         with self.assertRaises(esgfpid.exceptions.InconsistentFilesetException):
             assistant.dataset_publication_finished()
 
+    #
+    # Testing streamed publication
+    # (file messages are sent as soon as the files are added)
+    #
+
+    def test_streamed_publication_ok(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, stream_files=True, **dsargs)
+        fileargs = TESTHELPERS.get_args_for_adding_file()
+
+        # Run code to be tested:
+        assistant.add_file(**fileargs)
+
+        # Check result (file was sent right away):
+        self.assertEqual(len(rabbitmock.received_messages), 1)
+        received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, 0)
+        expected_rabbit_task = TESTHELPERS.get_rabbit_message_publication_file()
+        same = utils.is_json_same(expected_rabbit_task, received_rabbit_task)
+        self.assertTrue(same, error_message(expected_rabbit_task, received_rabbit_task))
+        self.assertEqual(assistant._DatasetPublicationAssistant__list_of_file_records, [])
+
+        # Run code to be tested:
+        assistant.dataset_publication_finished()
+
+        # Check result (dataset, after the file):
+        self.assertEqual(len(rabbitmock.received_messages), 2)
+        received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, 1)
+        expected_rabbit_task = TESTHELPERS.get_rabbit_message_publication_dataset()
+        same = utils.is_json_same(expected_rabbit_task, received_rabbit_task)
+        self.assertTrue(same, error_message(expected_rabbit_task, received_rabbit_task))
+
+    def test_streamed_publication_opens_connection_once(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler, mock.MagicMock())
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, stream_files='true', **dsargs)
+        args1 = TESTHELPERS.get_args_for_adding_file()
+        args2 = TESTHELPERS.get_args_for_adding_file()
+        args2['file_handle'] = PREFIX_WITH_HDL+'/789'
+
+        # Run code to be tested:
+        assistant.add_file(**args1)
+        assistant.add_file(**args2)
+        future = assistant.dataset_publication_finished()
+
+        # Check result:
+        self.assertEqual(rabbitmock.send_message_to_queue.call_count, 3)
+        rabbitmock.send_many_messages_to_queue.assert_not_called()
+        rabbitmock.open_rabbit_connection.assert_called_once_with()
+        rabbitmock.close_rabbit_connection.assert_called_once_with()
+        self.assertIsNone(future)
+
+    def test_streamed_publication_returns_future(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        file_future = DeliveryFuture()
+        dataset_future = DeliveryFuture()
+        rabbitmock = mock.MagicMock()
+        rabbitmock.send_message_to_queue.side_effect = [file_future, dataset_future]
+        TESTHELPERS.patch_with_rabbit_mock(testcoupler, rabbitmock)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, stream_files=True, **dsargs)
+
+        # Run code to be tested:
+        assistant.add_file(**TESTHELPERS.get_args_for_adding_file())
+        future = assistant.dataset_publication_finished()
+
+        # Check result:
+        self.assertIsInstance(future, AggregateDeliveryFuture)
+        self.assertEqual(future.futures, [file_future, dataset_future])
+
+    def test_streamed_publication_with_neg_consis_check(self):
+
+        # Test variables:
+        args1 = TESTHELPERS.get_args_for_adding_file()
+        prev_list = [args1['file_handle'], PREFIX_NO_HDL +'/random_suffix_abc123']
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler()
+        TESTHELPERS.patch_solr_returns_previous_files(testcoupler, prev_list) # solr returns file list
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, stream_files=True, **dsargs)
+        assistant.add_file(**args1)
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.InconsistentFilesetException):
+            assistant.dataset_publication_finished()
+
+        # Check result: The dataset message (the "commit") was not sent:
+        self.assertEqual(len(rabbitmock.received_messages), 1)
+        received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, 0)
+        self.assertIn('publi-file', received_rabbit_task['ROUTING_KEY'])
+
+        # Run code to be tested: Finishing is still possible:
+        assistant.dataset_publication_finished(ignore_exception=True)
+
+        # Check result:
+        self.assertEqual(len(rabbitmock.received_messages), 2)
+        received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, 1)
+        self.assertIn('publi-ds', received_rabbit_task['ROUTING_KEY'])
+
+    def test_streamed_publication_refuses_superfluous_file(self):
+
+        # Test variables:
+        args1 = TESTHELPERS.get_args_for_adding_file()
+        args2 = TESTHELPERS.get_args_for_adding_file()
+        args2['file_handle'] = PREFIX_WITH_HDL+'/789'
+        prev_list = [args1['file_handle']]
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler()
+        TESTHELPERS.patch_solr_returns_previous_files(testcoupler, prev_list) # solr returns file list
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, stream_files=True, **dsargs)
+        assistant.add_file(**args1)
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.InconsistentFilesetException):
+            assistant.add_file(**args2)
+        with self.assertRaises(esgfpid.exceptions.InconsistentFilesetException):
+            assistant.add_files(records=[args2])
+
+        # Check result: The superfluous file's message was not sent:
+        self.assertEqual(len(rabbitmock.received_messages), 1)
+
+        # Run code to be tested: The others are consistent:
+        assistant.dataset_publication_finished()
+
+        # Check result:
+        self.assertEqual(len(rabbitmock.received_messages), 2)
+        received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, 1)
+        self.assertEqual(received_rabbit_task['files'], [args1['file_handle']])
+
+    def test_init_string_wrong_stream_flag(self):
+
+        # Preparations
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        args = TESTHELPERS.get_args_for_publication_assistant()
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.ArgumentError) as raised:
+            DatasetPublicationAssistant(coupler=testcoupler, stream_files='Maybe', **args)
+        self.assertIn('"Maybe" could not be parsed to boolean', repr(raised.exception))
+
+    #
+    # Testing adding many files at once
+    #
+
+    def get_assistant_and_rabbitmock(self):
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, **dsargs)
+        return assistant, testcoupler, rabbitmock
+
+    def check_two_file_messages(self, testcoupler, handle1, handle2, file_version=FILEVERSION):
+        for index, handle in ((1, handle1), (2, handle2)):
+            received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, index)
+            expected_rabbit_task = TESTHELPERS.get_rabbit_message_publication_file()
+            expected_rabbit_task['handle'] = handle
+            expected_rabbit_task['file_version'] = file_version
+            same = utils.is_json_same(expected_rabbit_task, received_rabbit_task)
+            self.assertTrue(same, error_message(expected_rabbit_task, received_rabbit_task))
+
+    def test_add_files_records_ok(self):
+
+        # Preparations:
+        assistant, testcoupler, rabbitmock = self.get_assistant_and_rabbitmock()
+        args1 = TESTHELPERS.get_args_for_adding_file()
+        args2 = TESTHELPERS.get_args_for_adding_file()
+        args2['file_handle'] = FILEHANDLE_NO_HDL.replace(SUFFIX_FILE, SUFFIX_FILE2)
+        args2['file_size'] = str(FILESIZE)
+
+        # Run code to be tested:
+        assistant.add_files(iter([args1, args2]))
+        assistant.dataset_publication_finished()
+
+        # Check result (dataset):
+        received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, 0)
+        self.assertEqual(sorted(received_rabbit_task['files']), [FILEHANDLE_HDL, FILEHANDLE2_HDL])
+
+        # Check result (files):
+        self.check_two_file_messages(testcoupler, FILEHANDLE_HDL, FILEHANDLE2_HDL)
+
+    def test_add_files_columns_ok(self):
+
+        # Preparations:
+        assistant, testcoupler, rabbitmock = self.get_assistant_and_rabbitmock()
+
+        # Run code to be tested:
+        assistant.add_files(
+            file_name=[FILENAME, FILENAME],
+            file_handle=[FILEHANDLE_HDL, FILEHANDLE2_HDL],
+            file_size=[FILESIZE, FILESIZE],
+            checksum=[CHECKSUM, CHECKSUM],
+            checksum_type=[CHECKSUMTYPE, CHECKSUMTYPE],
+            publish_path=[PUBLISH_PATH, '/'+PUBLISH_PATH+'/'],
+            file_version=[int(FILEVERSION), FILEVERSION]
+        )
+        assistant.dataset_publication_finished()
+
+        # Check result:
+        self.assertEqual(len(rabbitmock.received_messages), 3)
+        self.check_two_file_messages(testcoupler, FILEHANDLE_HDL, FILEHANDLE2_HDL)
+
+    def test_add_files_mapfile_ok(self):
+
+        # Preparations:
+        assistant, testcoupler, rabbitmock = self.get_assistant_and_rabbitmock()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'my.map')
+        line = '%s#%s | /esg/data/%s/%s | %i | mod_time=123.0 | checksum=%s | checksum_type=%s | tracking_id=%s\n'
+        with open(path, 'w') as mapfile:
+            mapfile.write('# comment\n\n')
+            mapfile.write(line % (DRS_ID, FILEVERSION, PUBLISH_PATH, FILENAME, FILESIZE, CHECKSUM, CHECKSUMTYPE, FILEHANDLE_HDL))
+            mapfile.write(line % (DRS_ID, FILEVERSION, PUBLISH_PATH, FILENAME, FILESIZE, CHECKSUM, CHECKSUMTYPE, FILEHANDLE2_HDL))
+
+        # Run code to be tested:
+        assistant.add_files(mapfile=path, data_root='/esg/data')
+        assistant.dataset_publication_finished()
+
+        # Check result:
+        # (The publish path contains the file name here)
+        self.assertEqual(len(rabbitmock.received_messages), 3)
+        for index in (1, 2):
+            received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, index)
+            self.assertEqual(received_rabbit_task['file_name'], FILENAME)
+            self.assertEqual(received_rabbit_task['file_size'], FILESIZE)
+            self.assertEqual(received_rabbit_task['file_version'], FILEVERSION)
+            self.assertEqual(received_rabbit_task['checksum_type'], CHECKSUMTYPE)
+            self.assertEqual(received_rabbit_task['data_url'], 'http://'+DATA_NODE+'/'+THREDDS+'/'+PUBLISH_PATH+'/'+FILENAME)
+
+    def test_add_files_mapfile_missing_tracking_id(self):
+
+        # Preparations:
+        assistant, testcoupler, rabbitmock = self.get_assistant_and_rabbitmock()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'my.map')
+        with open(path, 'w') as mapfile:
+            mapfile.write('%s | /esg/data/%s | 123 | checksum=abc | checksum_type=SHA256\n' % (DRS_ID, FILENAME))
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.ArgumentError) as raised:
+            assistant.add_files(mapfile=path)
+        self.assertIn('line 1: Missing tracking_id', str(raised.exception))
+
+    def test_file_messages_created_in_chunks(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler, mock.MagicMock())
+        rabbitmock.send_message_to_queue.return_value = DeliveryFuture()
+        rabbitmock.send_many_messages_to_queue.side_effect = lambda messages: [DeliveryFuture() for message in messages]
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, **dsargs)
+        handles = [PREFIX_WITH_HDL+'/%i' % i for i in range(5)]
+        assistant.add_files(
+            file_name=[FILENAME]*5,
+            file_handle=handles,
+            file_size=[FILESIZE]*5,
+            checksum=[CHECKSUM]*5,
+            checksum_type=[CHECKSUMTYPE]*5,
+            publish_path=[PUBLISH_PATH]*5,
+            file_version=[FILEVERSION]*5
+        )
+
+        # Run code to be tested:
+        with mock.patch('esgfpid.defaults.PUBLISH_FILE_MESSAGES_PER_CHUNK', 2):
+            future = assistant.dataset_publication_finished()
+
+        # Check result:
+        calls = rabbitmock.send_many_messages_to_queue.call_args_list
+        self.assertEqual([len(call[0][0]) for call in calls], [2, 2, 1])
+        sent_handles = [message['handle'] for call in calls for message in call[0][0]]
+        self.assertEqual(sent_handles, handles)
+        self.assertEqual(len(future.futures), 6)
+
+    def test_add_files_wrong_prefix_adds_none(self):
+
+        # Preparations:
+        assistant, testcoupler, rabbitmock = self.get_assistant_and_rabbitmock()
+        args1 = TESTHELPERS.get_args_for_adding_file()
+        args2 = TESTHELPERS.get_args_for_adding_file()
+        args2['file_handle'] = 'hdl:1234/56789'
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.ESGFException) as raised:
+            assistant.add_files([args1, args2])
+        self.assertIn('does not have the expected handle prefix', str(raised.exception))
+
+        # Check result: No file was added:
+        self.assertEqual(assistant._DatasetPublicationAssistant__list_of_file_handles, [])
+        self.assertEqual(assistant._DatasetPublicationAssistant__list_of_file_records, [])
+        with self.assertRaises(esgfpid.exceptions.OperationUnsupportedException):
+            assistant.dataset_publication_finished()
+
+    def test_add_files_wrong_args(self):
+
+        # Preparations:
+        assistant, testcoupler, rabbitmock = self.get_assistant_and_rabbitmock()
+        args = TESTHELPERS.get_args_for_adding_file()
+        columns = dict((key, [value]) for key, value in args.items())
+
+        # Run code to be tested and check exception:
+        # Record lacks an arg:
+        del args['checksum']
+        with self.assertRaises(esgfpid.exceptions.ArgumentError) as raised:
+            assistant.add_files([args])
+        self.assertIn('Missing mandatory arguments: checksum', str(raised.exception))
+
+        # Columns differ in length:
+        columns['file_name'].append('another.nc')
+        with self.assertRaises(esgfpid.exceptions.ArgumentError) as raised:
+            assistant.add_files(**columns)
+        self.assertIn('differ in length', str(raised.exception))
+
+        # Several sources:
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            assistant.add_files([args], **columns)
+
+        # No source:
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            assistant.add_files()
+
     #
     # Testing invalid operations
     # (publication actions occur at the wrong time / wrong state)
@@ -0,0 +1,201 @@
+import unittest
+import mock
+import logging
+import json
+import asyncio
+import tests.resources.pikamock
+import esgfpid.defaults
+import esgfpid.exceptions
+import esgfpid.rabbit.aio
+import esgfpid.rabbit.nodehealth
+from esgfpid.rabbit.exceptions import PIDServerException
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Test resources:
+from resources.TESTVALUES import *
+import resources.TESTVALUES as TESTHELPERS
+
+class AioRabbitConnectorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+        esgfpid.rabbit.nodehealth.NODE_HEALTH.reset() # no failures from earlier tests
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def make_rabbit(self, nodemanager=None):
+        if nodemanager is None:
+            nodemanager = TESTHELPERS.get_nodemanager()
+        return esgfpid.rabbit.aio.AioRabbitConnector(nodemanager)
+
+    def make_ready(self, testrabbit):
+        channel = tests.resources.pikamock.MockChannel()
+        testrabbit.on_channel_open(channel)
+        testrabbit.on_confirm_select_ok(mock.MagicMock())
+        return channel
+
+    def make_confirm(self, deliv_tag, multiple=False, name='Basic.Ack'):
+        method_frame = mock.MagicMock()
+        method_frame.method.delivery_tag = deliv_tag
+        method_frame.method.multiple = multiple
+        method_frame.method.NAME = name
+        return method_frame
+
+    def make_messages(self, num):
+        return [{"foo":"bar%i" % i, "ROUTING_KEY":"mykey"} for i in range(num)]
+
+    # Tests
+
+    @mock.patch('esgfpid.rabbit.aio.AioRabbitConnector._AioRabbitConnector__make_connection')
+    def test_send_before_ready(self, connectionmock):
+
+        # Preparation:
+        testrabbit = self.make_rabbit()
+
+        # Run code to be tested:
+        futures = testrabbit.send_many_messages_to_queue(self.make_messages(3))
+
+        # Check result:
+        # Connecting, but nothing published yet:
+        self.assertEqual(connectionmock.call_count, 1)
+        self.assertEqual(testrabbit.get_num_unpublished(), 3)
+        # Once ready, they are published:
+        channel = self.make_ready(testrabbit)
+        self.assertEqual(channel.publish_counter, 3)
+        self.assertEqual(testrabbit.get_num_unconfirmed(), 3)
+        self.assertFalse(any(future.done() for future in futures))
+        # Sending more does not connect again:
+        testrabbit.send_message_to_queue(self.make_messages(1)[0])
+        self.assertEqual(connectionmock.call_count, 1)
+        self.assertEqual(channel.publish_counter, 4)
+
+    @mock.patch('esgfpid.rabbit.aio.AioRabbitConnector._AioRabbitConnector__make_connection')
+    def test_ack_and_nack(self, connectionmock):
+
+        # Preparation:
+        testrabbit = self.make_rabbit()
+        futures = testrabbit.send_many_messages_to_queue(self.make_messages(4))
+        self.make_ready(testrabbit)
+
+        # Run code to be tested:
+        testrabbit.on_delivery_confirmation(self.make_confirm(2, multiple=True))
+        testrabbit.on_delivery_confirmation(self.make_confirm(3, name='Basic.Nack'))
+
+        # Check result:
+        self.assertIsNone(futures[0].result())
+        self.assertIsNone(futures[1].result())
+        self.assertIsInstance(futures[2].exception(), esgfpid.exceptions.MessageNotDeliveredException)
+        self.assertFalse(futures[3].done())
+        self.assertEqual(testrabbit.get_num_unconfirmed(), 1)
+
+    @mock.patch('esgfpid.rabbit.aio.AioRabbitConnector._AioRabbitConnector__make_connection')
+    def test_returned_message_resent(self, connectionmock):
+
+        # Preparation:
+        testrabbit = self.make_rabbit()
+        msg = self.make_messages(1)[0]
+        future = testrabbit.send_message_to_queue(msg)
+        channel = self.make_ready(testrabbit)
+
+        # Run code to be tested: Returned, then acked:
+        testrabbit.on_message_returned(channel, mock.MagicMock(), None, json.dumps(msg).encode('utf-8'))
+        testrabbit.on_delivery_confirmation(self.make_confirm(1))
+
+        # Check result:
+        # Resent with emergency routing key:
+        self.assertFalse(future.done())
+        self.assertEqual(channel.publish_counter, 2)
+        self.assertEqual(channel.routing_keys[1], esgfpid.utils.RABBIT_EMERGENCY_ROUTING_KEY)
+        self.assertEqual(json.loads(channel.messages[1])['original_routing_key'], 'mykey')
+        # Returned a second time, the message is dropped:
+        testrabbit.on_message_returned(channel, mock.MagicMock(), None, channel.messages[1].encode('utf-8'))
+        testrabbit.on_delivery_confirmation(self.make_confirm(2))
+        self.assertIsInstance(future.exception(), esgfpid.exceptions.MessageNotDeliveredException)
+
+    @mock.patch('esgfpid.rabbit.aio.AioRabbitConnector._AioRabbitConnector__make_connection')
+    def test_connection_lost_republishes_unconfirmed(self, connectionmock):
+
+        # Preparation:
+        testrabbit = self.make_rabbit()
+        futures = testrabbit.send_many_messages_to_queue(self.make_messages(3))
+        self.make_ready(testrabbit)
+        testrabbit.on_delivery_confirmation(self.make_confirm(1))
+
+        # Run code to be tested:
+        testrabbit.on_connection_closed(mock.MagicMock(), 'Connection reset')
+
+        # Check result:
+        # Next node is tried right away:
+        self.assertEqual(connectionmock.call_count, 2)
+        self.assertEqual(testrabbit.get_num_unpublished(), 2)
+        # The unconfirmed ones are published again, in their order:
+        channel = self.make_ready(testrabbit)
+        self.assertEqual(channel.messages, [json.dumps(msg) for msg in self.make_messages(3)[1:]])
+        testrabbit.on_delivery_confirmation(self.make_confirm(2, multiple=True))
+        self.assertTrue(all(future.done() and future.exception() is None for future in futures))
+
+    @mock.patch('esgfpid.rabbit.aio.AioRabbitConnector._AioRabbitConnector__make_connection')
+    def test_no_node_reachable(self, connectionmock):
+
+        # Preparation:
+        testrabbit = self.make_rabbit()
+        future = testrabbit.send_message_to_queue(self.make_messages(1)[0])
+
+        # Run code to be tested: All three nodes fail
+        with mock.patch('esgfpid.defaults.RABBIT_RECONNECTION_MAX_TRIES', 0):
+            for i in range(3):
+                self.assertFalse(future.done())
+                testrabbit.on_connection_error(mock.MagicMock(), Exception('Connection refused'))
+
+        # Check result:
+        self.assertEqual(connectionmock.call_count, 3)
+        self.assertIsInstance(future.exception(), PIDServerException)
+        self.assertEqual(testrabbit.get_num_unpublished(), 0)
+        # The next message tries connecting again:
+        testrabbit.send_message_to_queue(self.make_messages(1)[0])
+        self.assertEqual(connectionmock.call_count, 4)
+
+    @mock.patch('esgfpid.rabbit.aio.AioRabbitConnector._AioRabbitConnector__make_connection')
+    def test_close_fails_pending(self, connectionmock):
+
+        # Preparation:
+        testrabbit = self.make_rabbit()
+        futures = testrabbit.send_many_messages_to_queue(self.make_messages(2))
+        self.make_ready(testrabbit)
+        testrabbit.on_delivery_confirmation(self.make_confirm(1))
+        connection = connectionmock.return_value
+        connection.is_closed = False
+        connection.is_closing = False
+
+        # Run code to be tested:
+        closed = testrabbit.close()
+        testrabbit.on_connection_closed(connection, 'Closed by user')
+
+        # Check result:
+        connection.close.assert_called_once_with()
+        self.assertTrue(closed.done())
+        self.assertIsNone(futures[0].exception())
+        self.assertIsInstance(futures[1].exception(), esgfpid.exceptions.MessageNotDeliveredException)
+
+    @mock.patch('esgfpid.rabbit.aio.AioRabbitConnector._AioRabbitConnector__make_connection')
+    def test_future_collector(self, connectionmock):
+
+        # Preparation:
+        testrabbit = self.make_rabbit()
+
+        # Run code to be tested:
+        with esgfpid.rabbit.aio.FutureCollector() as collected:
+            futures = testrabbit.send_many_messages_to_queue(self.make_messages(2))
+            futures.append(testrabbit.send_message_to_queue(self.make_messages(1)[0]))
+        outside = testrabbit.send_message_to_queue(self.make_messages(1)[0])
+
+        # Check result:
+        self.assertEqual(collected, futures)
+        self.assertNotIn(outside, collected)
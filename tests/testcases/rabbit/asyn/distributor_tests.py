@@ -0,0 +1,120 @@
+import unittest
+import mock
+import logging
+import esgfpid.rabbit.asynchronous.distributor
+import esgfpid.exceptions
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+class DistributorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_distributor(self, weights, strategy=None):
+        connectors = []
+        def make_connector(distributor_self, node_manager, spool_file, connector_args):
+            connector = mock.MagicMock()
+            connector.is_accepting_messages.return_value = True
+            connector.get_num_in_flight.return_value = 0
+            connector.spool_file = spool_file
+            connectors.append(connector)
+            return connector
+        with mock.patch('esgfpid.rabbit.asynchronous.distributor.DistributingRabbitConnector._DistributingRabbitConnector__create_connector', autospec=True) as createpatch:
+            createpatch.side_effect = make_connector
+            distributor = esgfpid.rabbit.asynchronous.distributor.DistributingRabbitConnector(
+                [(mock.MagicMock(), weight) for weight in weights],
+                strategy=strategy,
+                spool_file='/tmp/spool')
+        return distributor, connectors
+
+    def get_received(self, connector):
+        received = []
+        for call in connector.send_many_messages_to_queue.call_args_list:
+            received.extend(call[0][0])
+        for call in connector.send_message_to_queue.call_args_list:
+            received.append(call[0][0])
+        return received
+
+    # Tests
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            self.make_distributor([1, 1], strategy='foo')
+
+    def test_one_spool_file_per_node(self):
+        distributor, connectors = self.make_distributor([1, 1])
+        self.assertEqual([c.spool_file for c in connectors], ['/tmp/spool.0', '/tmp/spool.1'])
+
+    def test_weighted_round_robin(self):
+
+        # Preparation:
+        distributor, connectors = self.make_distributor([2, 1])
+
+        # Run code to be tested:
+        distributor.send_many_messages_to_queue(list(range(6)))
+
+        # Check result: Each connector got its share at once, by weight
+        self.assertEqual(connectors[0].send_many_messages_to_queue.call_count, 1)
+        self.assertEqual(self.get_received(connectors[0]), [0, 2, 3, 5])
+        self.assertEqual(self.get_received(connectors[1]), [1, 4])
+
+    def test_round_robin_single_messages(self):
+
+        # Preparation:
+        distributor, connectors = self.make_distributor([1, 1, 1])
+
+        # Run code to be tested:
+        for i in range(4):
+            distributor.send_message_to_queue(i)
+
+        # Check result:
+        self.assertEqual([self.get_received(c) for c in connectors], [[0, 3], [1], [2]])
+
+    def test_least_unconfirmed(self):
+
+        # Preparation:
+        distributor, connectors = self.make_distributor([1, 1], strategy='least_unconfirmed')
+        connectors[0].get_num_in_flight.return_value = 5
+        connectors[1].get_num_in_flight.return_value = 2
+
+        # Run code to be tested:
+        distributor.send_many_messages_to_queue(list(range(5)))
+
+        # Check result: The second one catches up first
+        self.assertEqual(self.get_received(connectors[0]), [3])
+        self.assertEqual(self.get_received(connectors[1]), [0, 1, 2, 4])
+
+    def test_skips_connectors_not_accepting(self):
+
+        # Preparation:
+        distributor, connectors = self.make_distributor([1, 1])
+        connectors[0].is_accepting_messages.return_value = False
+
+        # Run code to be tested:
+        distributor.send_many_messages_to_queue(list(range(3)))
+
+        # Check result:
+        self.assertEqual(self.get_received(connectors[0]), [])
+        self.assertEqual(self.get_received(connectors[1]), [0, 1, 2])
+
+    def test_lifecycle(self):
+
+        # Preparation:
+        distributor, connectors = self.make_distributor([1, 1])
+        connectors[0].is_finished.return_value = True
+        connectors[1].is_finished.return_value = False
+
+        # Run code to be tested:
+        distributor.start_rabbit_thread()
+        distributor.finish_rabbit_thread()
+
+        # Check result:
+        for connector in connectors:
+            connector.start_rabbit_thread.assert_called_once_with()
+            connector.finish_rabbit_thread.assert_called_once_with()
+        self.assertFalse(distributor.is_finished())
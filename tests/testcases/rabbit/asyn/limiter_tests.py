@@ -0,0 +1,141 @@
+import unittest
+import mock
+import logging
+import threading
+import esgfpid.exceptions
+import esgfpid.rabbit.asynchronous.limiter
+from esgfpid.rabbit.rabbitutils import MessageEnvelope
+from esgfpid.rabbit.delivery import DeliveryFuture
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+class LimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+        self.queue = [] # Messages in flight
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_limiter(self, policy, max_in_flight=3, timeout=0.1):
+        count_function = lambda: len(self.queue)
+        return esgfpid.rabbit.asynchronous.limiter.InFlightLimiter(max_in_flight, policy, timeout, count_function)
+
+    def put_function(self, messages):
+        self.queue.extend(messages)
+
+    # Tests
+
+    def test_unknown_policy(self):
+
+        # Run code to be tested:
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            self.make_limiter('foo')
+
+    def test_raise_ok(self):
+
+        # Preparation:
+        limiter = self.make_limiter('raise')
+
+        # Run code to be tested:
+        limiter.put_many(['a','b'], self.put_function)
+        with self.assertRaises(esgfpid.exceptions.MessageQueueFullException) as e:
+            limiter.put_many(['c','d'], self.put_function)
+
+        # Check result (nothing of the second batch was accepted):
+        self.assertEqual(self.queue, ['a','b'])
+        self.assertEqual(e.exception.undelivered_messages, ['c','d'])
+
+    def test_block_timeout(self):
+
+        # Preparation:
+        limiter = self.make_limiter('block')
+
+        # Run code to be tested:
+        with self.assertRaises(esgfpid.exceptions.MessageQueueFullException) as e:
+            limiter.put_many(['a','b','c','d','e'], self.put_function)
+
+        # Check result (the first ones were accepted):
+        self.assertEqual(self.queue, ['a','b','c'])
+        self.assertEqual(e.exception.undelivered_messages, ['d','e'])
+
+    def test_block_until_confirmed(self):
+
+        # Preparation:
+        limiter = self.make_limiter('block', timeout=10)
+        limiter.put_many(['a','b','c'], self.put_function)
+
+        # Confirms arrive in another thread:
+        def confirm():
+            del self.queue[0:2]
+            limiter.on_messages_confirmed(self.put_function)
+        timer = threading.Timer(0.05, confirm)
+        timer.start()
+
+        # Run code to be tested (blocks until confirms arrive):
+        limiter.put_many(['d','e'], self.put_function)
+        timer.join()
+
+        # Check result:
+        self.assertEqual(self.queue, ['c','d','e'])
+
+    def test_spill_ok(self):
+
+        # Preparation:
+        limiter = self.make_limiter('spill')
+
+        # Run code to be tested:
+        limiter.put_many(['a','b'], self.put_function)
+        limiter.put_many([{'c':1},'d'], self.put_function)
+        limiter.put_many(['e'], self.put_function)
+
+        # Check result (the rest was spilled):
+        self.assertEqual(self.queue, ['a','b',{'c':1}])
+        self.assertEqual(limiter.get_num_spilled(), 2)
+
+        # Run code to be tested: Confirm two, so two are unspilled.
+        del self.queue[0:2]
+        limiter.on_messages_confirmed(self.put_function)
+
+        # Check result (in order):
+        self.assertEqual(self.queue, [{'c':1},'d','e'])
+        self.assertEqual(limiter.get_num_spilled(), 0)
+        limiter.close()
+
+    def test_spill_keeps_order(self):
+
+        # Preparation:
+        limiter = self.make_limiter('spill')
+        limiter.put_many(['a','b','c','d'], self.put_function)
+        del self.queue[0:3]
+
+        # Run code to be tested: Room again, but one is spilled.
+        limiter.put_many(['e'], self.put_function)
+
+        # Check result (no overtaking):
+        self.assertEqual(self.queue, [])
+        self.assertEqual(limiter.get_num_spilled(), 2)
+        self.assertEqual(limiter.get_spilled_messages(), ['d','e'])
+        self.assertEqual(limiter.get_num_spilled(), 0)
+        limiter.close()
+
+    def test_spill_keeps_futures(self):
+
+        # Preparation:
+        limiter = self.make_limiter('spill', max_in_flight=1)
+        envelopes = [MessageEnvelope('mykey', 'foo%i' % i) for i in range(4)]
+        envelopes[1].future = DeliveryFuture()
+        envelopes[3].future = DeliveryFuture()
+
+        # Run code to be tested:
+        limiter.put_many(envelopes, self.put_function)
+        spilled = limiter.get_spilled_messages()
+
+        # Check result (the futures are back at the right messages):
+        self.assertEqual([msg.body for msg in spilled], [b'foo1', b'foo2', b'foo3'])
+        self.assertIs(spilled[0].future, envelopes[1].future)
+        self.assertIsNone(spilled[1].future)
+        self.assertIs(spilled[2].future, envelopes[3].future)
+        limiter.close()
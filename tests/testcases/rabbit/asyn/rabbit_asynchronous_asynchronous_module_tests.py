@@ -6,6 +6,7 @@ import logging
 import json
 import requests
 import esgfpid.rabbit.asynchronous
+import esgfpid.rabbit.nodehealth
 from esgfpid.rabbit.asynchronous.exceptions import OperationNotAllowed
 import tests.mocks.responsemock
 import tests.mocks.pikamock
@@ -27,6 +28,7 @@ class RabbitAsynModuleTestCase(unittest.TestCase):
 
     def setUp(self):
         LOGGER.info('######## Next test (%s) ##########', __name__)
+        esgfpid.rabbit.nodehealth.NODE_HEALTH.reset() # no failures from earlier tests
         self.testrabbit = None
         self.thread = None
 
@@ -3,8 +3,15 @@ import mock
 import logging
 import datetime
 import time
+import os
+import shutil
+import tempfile
 import esgfpid.rabbit.asynchronous
+import esgfpid.rabbit.metrics
+import esgfpid.exceptions
 from esgfpid.rabbit.asynchronous.exceptions import OperationNotAllowed
+from esgfpid.rabbit.rabbitutils import MessageEnvelope
+from esgfpid.rabbit.delivery import DeliveryFuture
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -58,6 +65,35 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
         thread = testrabbit._AsynchronousRabbitConnector__thread
         self.assertIsInstance(thread, esgfpid.rabbit.asynchronous.rabbitthread.RabbitThread, 'Constructor fail.')
 
+    def test_init_several_channels(self):
+
+        # Test variables:
+        nodemanager = TESTHELPERS.get_nodemanager()
+
+        # Run code to be tested:
+        testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(nodemanager, num_channels=3)
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(nodemanager, num_channels=0)
+
+        # Check result:
+        thread = testrabbit._AsynchronousRabbitConnector__thread
+        self.assertEqual(thread._channels, [None, None, None])
+        self.assertEqual(len(thread._RabbitThread__confirmers), 3)
+
+        # Unconfirmed messages are counted over all channels,
+        # and the shutter is only told when all are confirmed:
+        thread._RabbitThread__shutter = shuttermock = mock.MagicMock()
+        thread.put_to_unconfirmed(1, 'a', 0)
+        thread.put_to_unconfirmed(1, 'b', 2)
+        self.assertEqual(thread.get_num_unconfirmed(), 2)
+        thread.reset_unconfirmed_messages_and_delivery_tags(0)
+        thread.tell_shutter_all_messages_confirmed()
+        shuttermock.on_all_messages_confirmed.assert_not_called()
+        self.assertEqual(thread.get_unconfirmed_messages_as_list_copy(), ['b'])
+        thread.reset_unconfirmed_messages_and_delivery_tags()
+        thread.tell_shutter_all_messages_confirmed()
+        shuttermock.on_all_messages_confirmed.assert_called_once_with()
+
 
     #
     # Start thread
@@ -172,6 +208,7 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
 
         # Mock the connection (it has to hand the event over to the feeder mock):
         connectionmock = testrabbit._AsynchronousRabbitConnector__thread._connection = TESTHELPERS.get_connection_mock()
+        testrabbit._AsynchronousRabbitConnector__thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
 
         # Mock the feeder (it has to receive the publish event):
         feedermock = testrabbit._AsynchronousRabbitConnector__thread._RabbitThread__feeder = mock.MagicMock()
@@ -180,9 +217,10 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
         testrabbit.send_message_to_queue('foo')
         testrabbit.send_many_messages_to_queue(['a','b','c'])
 
-        # Check that publish was called:
+        # Check that publish was called (once per call, as
+        # one trigger drains the queue):
         feedermock.publish_message.assert_called()
-        self.assertTrue(feedermock.publish_message.call_count>=4)
+        self.assertEqual(feedermock.publish_message.call_count, 2)
 
         # Check that the four messages were put into the queue:
         msg_queue = testrabbit._AsynchronousRabbitConnector__unpublished_messages_queue
@@ -199,6 +237,7 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
 
         # Mock the connection (it has to hand the event over to the feeder mock):
         connectionmock = testrabbit._AsynchronousRabbitConnector__thread._connection = TESTHELPERS.get_connection_mock()
+        testrabbit._AsynchronousRabbitConnector__thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
 
         # Mock the feeder (it has to receive the publish event):
         feedermock = testrabbit._AsynchronousRabbitConnector__thread._RabbitThread__feeder = mock.MagicMock()
@@ -227,6 +266,7 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
 
         # Mock the connection (it has to hand the event over to the feeder mock):
         connectionmock = testrabbit._AsynchronousRabbitConnector__thread._connection = TESTHELPERS.get_connection_mock()
+        testrabbit._AsynchronousRabbitConnector__thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
 
         # Run code to be tested:
         testrabbit.send_message_to_queue('foo')
@@ -253,6 +293,7 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
 
         # Mock the connection (it has to hand the event over to the feeder mock):
         connectionmock = testrabbit._AsynchronousRabbitConnector__thread._connection = TESTHELPERS.get_connection_mock()
+        testrabbit._AsynchronousRabbitConnector__thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
 
         # Run code to be tested:
         with self.assertRaises(OperationNotAllowed):
@@ -268,6 +309,129 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
         self.assertTrue(msg_queue.empty())
 
 
+    def test_send_message_limit_reached(self):
+
+        # Preparations
+        nodemanager = TESTHELPERS.get_nodemanager()
+        testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(nodemanager,
+            max_in_flight=3, overflow_policy='raise')
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_waiting_to_be_available()
+        testrabbit._AsynchronousRabbitConnector__not_started_yet = False
+
+        # Run code to be tested:
+        testrabbit.send_many_messages_to_queue(['a','b'])
+        with self.assertRaises(esgfpid.exceptions.MessageQueueFullException):
+            testrabbit.send_many_messages_to_queue(['c','d'])
+
+        # Messages that are put back by the thread are not limited:
+        testrabbit.resend_many_messages_to_queue(['x','y'])
+
+        # Check that only the accepted messages were put into the queue:
+        msg_queue = testrabbit._AsynchronousRabbitConnector__unpublished_messages_queue
+        self.assertEqual(msg_queue.qsize(), 4)
+        self.assert_messages_are_in_queue(msg_queue, ['a', 'b', 'x', 'y'])
+
+    def test_send_message_refused_or_dropped_fails_futures(self):
+
+        # Preparations
+        nodemanager = TESTHELPERS.get_nodemanager()
+        testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(nodemanager,
+            max_in_flight=1, overflow_policy='raise')
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_waiting_to_be_available()
+        testrabbit._AsynchronousRabbitConnector__not_started_yet = False
+        envelopes = [MessageEnvelope('mykey', 'foo%i' % i) for i in range(3)]
+        for envelope in envelopes:
+            envelope.future = DeliveryFuture()
+
+        # Run code to be tested:
+        testrabbit.send_message_to_queue(envelopes[0])
+        with self.assertRaises(esgfpid.exceptions.MessageQueueFullException):
+            testrabbit.send_many_messages_to_queue(envelopes[1:2])
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_permanently_unavailable()
+        testrabbit.send_message_to_queue(envelopes[2])
+
+        # Check result:
+        self.assertFalse(envelopes[0].future.done())
+        self.assertIsInstance(envelopes[1].future.exception(), esgfpid.exceptions.MessageNotDeliveredException)
+        self.assertIsInstance(envelopes[2].future.exception(), esgfpid.exceptions.MessageNotDeliveredException)
+
+    def test_send_message_limit_reached_spool(self):
+
+        # Preparations
+        nodemanager = TESTHELPERS.get_nodemanager()
+        tempdir = tempfile.mkdtemp()
+        testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(nodemanager,
+            spool_file=os.path.join(tempdir, 'spool.jsonl'), max_in_flight=1, overflow_policy='raise')
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_waiting_to_be_available()
+        testrabbit._AsynchronousRabbitConnector__not_started_yet = False
+        spool = testrabbit._AsynchronousRabbitConnector__spool
+        spool.open()
+
+        # Run code to be tested:
+        testrabbit.send_message_to_queue(MessageEnvelope('mykey', 'a'))
+        with self.assertRaises(esgfpid.exceptions.MessageQueueFullException):
+            testrabbit.send_many_messages_to_queue([MessageEnvelope('mykey', 'b')])
+
+        # Check result: The refused message is not in the spool,
+        # so it is not replayed later:
+        self.assertEqual(spool.get_num_pending(), 1)
+        spool.close()
+        shutil.rmtree(tempdir)
+
+    def test_send_message_spilled_spool(self):
+
+        # Preparations
+        nodemanager = TESTHELPERS.get_nodemanager()
+        tempdir = tempfile.mkdtemp()
+        testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(nodemanager,
+            spool_file=os.path.join(tempdir, 'spool.jsonl'), max_in_flight=1, overflow_policy='spill')
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_waiting_to_be_available()
+        testrabbit._AsynchronousRabbitConnector__not_started_yet = False
+        spool = testrabbit._AsynchronousRabbitConnector__spool
+        spool.open()
+        msg_queue = testrabbit._AsynchronousRabbitConnector__unpublished_messages_queue
+
+        # Run code to be tested:
+        testrabbit.send_many_messages_to_queue([MessageEnvelope('mykey', 'a'), MessageEnvelope('mykey', 'b')])
+        first = msg_queue.get(False)
+        self.assertEqual(spool.get_num_pending(), 1)
+        spool.ack(first) # as if published and confirmed
+        testrabbit.on_messages_confirmed() # moves the spilled message to the queue
+        second = msg_queue.get(False)
+        spool.ack(second)
+
+        # Check result: The message read from the spill file was
+        # acked, so nothing is replayed:
+        self.assertEqual(second.body, b'b')
+        self.assertEqual(spool.get_num_pending(), 0)
+        spool.close()
+        self.assertEqual(esgfpid.rabbit.asynchronous.spool.MessageSpool(spool._MessageSpool__filename).open(), [])
+        shutil.rmtree(tempdir)
+
+    def test_send_message_metrics(self):
+
+        # Preparations
+        nodemanager = TESTHELPERS.get_nodemanager()
+        metrics = esgfpid.rabbit.metrics.PublishMetrics()
+        testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(nodemanager,
+            max_in_flight=3, overflow_policy='raise', metrics=metrics)
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_waiting_to_be_available()
+        testrabbit._AsynchronousRabbitConnector__not_started_yet = False
+
+        # Run code to be tested:
+        testrabbit.send_many_messages_to_queue(['a','b'])
+        with self.assertRaises(esgfpid.exceptions.MessageQueueFullException):
+            testrabbit.send_many_messages_to_queue(['c','d'])
+        testrabbit.resend_many_messages_to_queue(['x']) # not new
+
+        # Check result:
+        snapshot = metrics.get_snapshot()
+        self.assertEqual(snapshot['messages_enqueued'], 4)
+        self.assertEqual(snapshot['messages_refused'], 2)
+        self.assertEqual(snapshot['messages_unpublished'], 3)
+        self.assertEqual(snapshot['messages_unconfirmed'], 0)
+        self.assertEqual(snapshot['messages_spilled'], 0)
+
     #
     # Gently finish
     #
@@ -291,6 +455,7 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
 
         # Mock the connection (it has to hand the event over to the feeder mock):
         connectionmock = testrabbit._AsynchronousRabbitConnector__thread._connection = TESTHELPERS.get_connection_mock()
+        testrabbit._AsynchronousRabbitConnector__thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
 
         # Run code to be tested:
         testrabbit.finish_rabbit_thread()
@@ -300,6 +465,36 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
         wait_event_mock.wait.assert_called()
         joinmock.assert_called()
 
+    def test_gently_finish_fails_futures_of_leftovers(self):
+
+        # Preparations
+        nodemanager = TESTHELPERS.get_nodemanager()
+        testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(nodemanager)
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_waiting_to_be_available()
+        testrabbit._AsynchronousRabbitConnector__not_started_yet = False
+        thread = testrabbit._AsynchronousRabbitConnector__thread
+        thread._RabbitThread__gently_finish_ready = mock.MagicMock()
+        thread.join = mock.MagicMock()
+        thread._RabbitThread__shutter = mock.MagicMock()
+        thread._connection = TESTHELPERS.get_connection_mock()
+        envelopes = [MessageEnvelope('mykey', 'foo%i' % i) for i in range(3)]
+        for envelope in envelopes:
+            envelope.future = DeliveryFuture()
+        # One unpublished, one unconfirmed, one acked:
+        testrabbit.send_message_to_queue(envelopes[0])
+        thread.put_to_unconfirmed(1, envelopes[1])
+        envelopes[2].future.set_delivered()
+
+        # Run code to be tested:
+        testrabbit.finish_rabbit_thread()
+
+        # Check result
+        self.assertIsInstance(envelopes[0].future.exception(), esgfpid.exceptions.MessageNotDeliveredException)
+        self.assertIn('not published', envelopes[0].future.exception().msg)
+        self.assertIsInstance(envelopes[1].future.exception(), esgfpid.exceptions.MessageNotDeliveredException)
+        self.assertIn('not confirmed', envelopes[1].future.exception().msg)
+        self.assertTrue(envelopes[2].future.succeeded())
+
     #
     # Force finish
     #
@@ -319,6 +514,7 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
         
         # Mock the connection (it has to hand the event over to the feeder mock):
         connectionmock = testrabbit._AsynchronousRabbitConnector__thread._connection = TESTHELPERS.get_connection_mock()
+        testrabbit._AsynchronousRabbitConnector__thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
 
         # Run code to be tested:
         testrabbit.force_finish_rabbit_thread()
@@ -347,6 +543,7 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
         
         # Mock the connection (it has to hand the event over to the feeder mock):
         connectionmock = testrabbit._AsynchronousRabbitConnector__thread._connection = TESTHELPERS.get_connection_mock()
+        testrabbit._AsynchronousRabbitConnector__thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
 
         # Run code to be tested:
         testrabbit.force_finish_rabbit_thread()
@@ -399,39 +596,69 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
         # Can't really check results... Cannot block the events to unblock them here,
         # without opening a thread...
 
-    def test_wait_for_connection(self):
+    def test_events_kept_until_connection_is_ready(self):
 
         # Preparation:
         nodemanager = TESTHELPERS.get_nodemanager()
         testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(nodemanager)
         testrabbit._AsynchronousRabbitConnector__statemachine.set_to_available()
         testrabbit._AsynchronousRabbitConnector__not_started_yet = False
+        thread = testrabbit._AsynchronousRabbitConnector__thread
 
         # Mock the feeder (it has to receive the publish event):
-        feedermock = testrabbit._AsynchronousRabbitConnector__thread._RabbitThread__feeder = mock.MagicMock()
-
-        # Mock event...
-        # So when the synchronisation is done, a connection is there...
-        # When the event is called, we mock the connection (it has to hand the event over to the feeder mock):
-
-        def sync_side_effect():
-            connectionmock = testrabbit._AsynchronousRabbitConnector__thread._connection = TESTHELPERS.get_connection_mock()
-        sync_event_mock = mock.MagicMock()
-        sync_event_mock.wait.side_effect = sync_side_effect
-        testrabbit._AsynchronousRabbitConnector__thread._RabbitThread__connection_is_set =  sync_event_mock
+        feedermock = thread._RabbitThread__feeder = mock.MagicMock()
 
         # Connection must be None first:
-        testrabbit._AsynchronousRabbitConnector__thread._connection = None
+        thread._connection = None
 
         # Run code to be tested:
+        # This must not block, although there is no connection:
         testrabbit.send_message_to_queue('foo')
 
-        # Check if the event was unblocked:
-        sync_event_mock.wait.assert_called()
+        # Check that the event was kept, not handed over yet:
+        feedermock.publish_message.assert_not_called()
+        self.assertEqual(thread._RabbitThread__pending_events, [feedermock.publish_message])
+
+        # Run code to be tested:
+        # The builder tells the thread that the connection is ready:
+        connectionmock = thread._connection = TESTHELPERS.get_connection_mock()
+        thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
 
         # Check that publish was called:
-        feedermock.publish_message.assert_called()
+        feedermock.publish_message.assert_called_once_with()
+        self.assertEqual(thread._RabbitThread__pending_events, [])
 
-        # Check that the four messages were put into the queue:
+        # Check that the message was put into the queue:
         msg_queue = testrabbit._AsynchronousRabbitConnector__unpublished_messages_queue
         self.assert_messages_are_in_queue(msg_queue, ['foo'])
+
+        # Run code to be tested:
+        # Further events are handed over directly:
+        testrabbit.send_message_to_queue('bar')
+
+        # Check result:
+        self.assertEqual(feedermock.publish_message.call_count, 2)
+        self.assertEqual(connectionmock.ioloop.call_later.call_count, 2)
+
+    def test_events_kept_in_order_until_connection_is_ready(self):
+
+        # Preparation:
+        nodemanager = TESTHELPERS.get_nodemanager()
+        testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(nodemanager)
+        thread = testrabbit._AsynchronousRabbitConnector__thread
+        calls = []
+        feedermock = thread._RabbitThread__feeder = mock.MagicMock()
+        feedermock.publish_message.side_effect = lambda: calls.append('publish')
+        shuttermock = thread._RabbitThread__shutter = mock.MagicMock()
+        shuttermock.force_finish.side_effect = lambda: calls.append('finish')
+        thread._connection = None
+
+        # Run code to be tested:
+        thread.add_event_publish_message()
+        thread.add_event_force_finish()
+        self.assertEqual(calls, [])
+        thread._connection = TESTHELPERS.get_connection_mock()
+        thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
+
+        # Check result:
+        self.assertEqual(calls, ['publish', 'finish'])
@@ -0,0 +1,204 @@
+import unittest
+import mock
+import logging
+import os
+import json
+import time
+import shutil
+import tempfile
+import esgfpid.rabbit.asynchronous.spool
+import esgfpid.rabbit.rabbitutils
+import esgfpid.rabbit.asynchronous.thread_confirmer
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'spool.jsonl')
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+        shutil.rmtree(self.tempdir)
+
+    def make_spool(self):
+        return esgfpid.rabbit.asynchronous.spool.MessageSpool(self.filename)
+
+    def read_records(self):
+        with open(self.filename, 'r') as spoolfile:
+            return [json.loads(line) for line in spoolfile]
+
+    def make_ack(self, deliv_tag, multiple):
+        method_frame = mock.MagicMock()
+        method_frame.method.delivery_tag = deliv_tag
+        method_frame.method.multiple = multiple
+        method_frame.method.NAME = 'foo.ack'
+        return method_frame
+
+    # Tests
+
+    def test_open_new_file_ok(self):
+
+        # Run code to be tested:
+        spool = self.make_spool()
+        replayed = spool.open()
+        spool.close()
+
+        # Check result:
+        self.assertEqual(replayed, [])
+        self.assertTrue(os.path.exists(self.filename))
+        self.assertEqual(self.read_records(), [])
+
+    def test_put_and_ack_ok(self):
+
+        # Preparation:
+        spool = self.make_spool()
+        spool.open()
+        msg1 = {'foo':'bar1'}
+        msg2 = {'foo':'bar2'}
+
+        # Run code to be tested:
+        spool.put(msg1)
+        spool.put_many([msg2])
+        spool.ack(msg1)
+
+        # Check result:
+        self.assertEqual(spool.get_num_pending(), 1)
+        spool.close()
+        # After compaction, only the unacked message is left:
+        records = self.read_records()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['msg'], msg2)
+
+    def test_put_same_message_twice(self):
+
+        # Preparation:
+        spool = self.make_spool()
+        spool.open()
+        msg = {'foo':'bar'}
+
+        # Run code to be tested (e.g. republication after reconnect):
+        spool.put(msg)
+        spool.put_many([msg])
+        spool.ack(msg)
+
+        # Check result:
+        self.assertEqual(spool.get_num_pending(), 0)
+        spool.close()
+        self.assertEqual(self.read_records(), [])
+
+    def test_replay_after_crash_ok(self):
+
+        # Preparation: Write some records, do not close (crash):
+        spool = self.make_spool()
+        spool.open()
+        spool.put_many([{'foo':'bar1'}, {'foo':'bar2'}, {'foo':'bar3'}])
+        spool.ack({'foo':'bar2'}) # Equal, but not the same object, so not acked
+        spool._MessageSpool__sync()
+        # Simulate truncated last line:
+        with open(self.filename, 'a') as spoolfile:
+            spoolfile.write('{"op": "ack", "i')
+
+        # Run code to be tested:
+        newspool = self.make_spool()
+        replayed = newspool.open()
+
+        # Check result:
+        self.assertEqual(replayed, [{'foo':'bar1'}, {'foo':'bar2'}, {'foo':'bar3'}])
+        self.assertEqual(newspool.get_num_pending(), 3)
+        # Replayed messages are not recorded a second time:
+        newspool.put_many(replayed)
+        newspool.close()
+        self.assertEqual(len(self.read_records()), 3)
+
+    def test_replay_envelopes(self):
+
+        # Preparation:
+        spool = self.make_spool()
+        spool.open()
+        envelope = esgfpid.rabbit.rabbitutils.MessageEnvelope('my.key', '{"foo": "bar"}')
+        spool.put(envelope)
+        spool._MessageSpool__sync()
+
+        # Run code to be tested:
+        replayed = self.make_spool().open()
+
+        # Check result:
+        self.assertEqual(len(replayed), 1)
+        self.assertEqual(replayed[0].routing_key, 'my.key')
+        self.assertEqual(replayed[0].body, envelope.body)
+
+    def test_batched_fsync(self):
+
+        # Preparation:
+        spool = self.make_spool()
+        spool.open()
+        spool._MessageSpool__FSYNC_EVERY_N = 3
+        spool._MessageSpool__FSYNC_SECONDS = 1000
+
+        # Run code to be tested:
+        with mock.patch('os.fsync') as fsyncpatch:
+            spool.put_many(['a', 'b'])
+            fsyncpatch.assert_not_called()
+            spool.put('c')
+            self.assertEqual(fsyncpatch.call_count, 1)
+        spool.close()
+
+    def test_timed_fsync_when_idle(self):
+
+        # Preparation:
+        spool = self.make_spool()
+        spool.open()
+        spool._MessageSpool__FSYNC_EVERY_N = 1000
+        spool._MessageSpool__FSYNC_SECONDS = 0.05
+
+        # Run code to be tested:
+        with mock.patch('os.fsync') as fsyncpatch:
+            spool.put('a')
+            fsyncpatch.assert_not_called()
+            time.sleep(0.3) # nothing else is written
+
+            # Check result:
+            self.assertEqual(fsyncpatch.call_count, 1)
+        spool.close()
+
+    def test_put_write_error_is_logged(self):
+
+        # Preparation:
+        spool = self.make_spool()
+        spool.open()
+        realfile = spool._MessageSpool__file
+        brokenfile = mock.MagicMock()
+        brokenfile.write.side_effect = IOError(28, 'No space left on device')
+        spool._MessageSpool__file = brokenfile
+
+        # Run code to be tested (does not raise):
+        spool.put_many(['a', 'b'])
+
+        # Check result:
+        brokenfile.write.assert_called_once()
+        spool._MessageSpool__file = realfile
+        spool.close()
+
+    def test_confirmer_writes_tombstones(self):
+
+        # Preparation:
+        spool = self.make_spool()
+        spool.open()
+        messages = ['foo1', 'foo2', 'foo3', 'foo4']
+        spool.put_many(messages)
+        confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer(mock.MagicMock(), spool)
+        for i in range(4):
+            confirmer.put_to_unconfirmed(i+1, messages[i])
+
+        # Run code to be tested:
+        confirmer.on_delivery_confirmation(self.make_ack(1, False))
+        confirmer.on_delivery_confirmation(self.make_ack(3, True))
+
+        # Check result:
+        spool.close()
+        records = self.read_records()
+        self.assertEqual([rec['msg'] for rec in records], ['foo4'])
@@ -3,6 +3,8 @@ import mock
 import logging
 import datetime
 import pika
+import esgfpid.rabbit.nodehealth
+
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
@@ -14,6 +16,7 @@ class ThreadBuilderTestCase(unittest.TestCase):
 
     def setUp(self):
         LOGGER.info('######## Next test (%s) ##########', __name__)
+        esgfpid.rabbit.nodehealth.NODE_HEALTH.reset() # no failures from earlier tests
 
     def tearDown(self):
         LOGGER.info('#############################')
@@ -21,10 +24,11 @@ class ThreadBuilderTestCase(unittest.TestCase):
     def make_builder(self, args=None):
 
         statemachine = esgfpid.rabbit.asynchronous.thread_statemachine.StateMachine()
-        confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer()
         nodemanager = TESTHELPERS.get_nodemanager()
 
         thread = mock.MagicMock()
+        thread._channels = [None]
+        confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer(thread)
         thread.ERROR_CODE_CONNECTION_CLOSED_BY_USER=999
         thread.ERROR_TEXT_CONNECTION_FORCE_CLOSED='(forced finish)'
         thread.ERROR_TEXT_CONNECTION_NORMAL_SHUTDOWN='(not reopen)'
@@ -35,7 +39,7 @@ class ThreadBuilderTestCase(unittest.TestCase):
         builder = esgfpid.rabbit.asynchronous.thread_builder.ConnectionBuilder(
             thread,
             statemachine,
-            confirmer,
+            [confirmer],
             returnhandler,
             shutter,
             nodemanager)
@@ -164,6 +168,7 @@ class ThreadBuilderTestCase(unittest.TestCase):
 
         # Preparation:
         builder = self.make_builder()
+        builder._ConnectionBuilder__start_connect_time = datetime.datetime.now()
 
         # Run code to be tested:
         unused_connection = None
@@ -171,6 +176,7 @@ class ThreadBuilderTestCase(unittest.TestCase):
 
         # Check result:
         self.assertEqual(channelpatch.call_count, 1)
+        self.assertIsNotNone(builder._ConnectionBuilder__connect_seconds)
         builder.thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events.assert_called_with()
 
     #
@@ -225,7 +231,7 @@ class ThreadBuilderTestCase(unittest.TestCase):
         testchannel.add_on_close_callback.assert_called()
         builder.thread.get_num_unpublished.assert_called()
         builder.thread.add_event_publish_message.assert_called()
-        builder.thread.add_event_publish_message.call_count >= 11
+        self.assertEqual(builder.thread.add_event_publish_message.call_count, 1)
 
 
     '''
@@ -321,7 +327,7 @@ class ThreadBuilderTestCase(unittest.TestCase):
         testchannel.add_on_close_callback.assert_called()
         builder.thread.get_num_unpublished.assert_called()
         builder.thread.add_event_publish_message.assert_called()
-        builder.thread.add_event_publish_message.call_count >= 11
+        self.assertEqual(builder.thread.add_event_publish_message.call_count, 1)
         builder.shutter.safety_finish.assert_not_called()
 
     #
@@ -423,7 +429,9 @@ class ThreadBuilderTestCase(unittest.TestCase):
 
         # Check result:
         # Reconnect was called:
-        wait_seconds = esgfpid.defaults.RABBIT_RECONNECTION_SECONDS
+        # (first round: between half and all of the base waiting time)
+        wait_seconds = mock_connection.ioloop.call_later.call_args[0][0]
+        self.assertTrue(esgfpid.defaults.RABBIT_RECONNECTION_SECONDS/2.0 <= wait_seconds <= esgfpid.defaults.RABBIT_RECONNECTION_SECONDS)
         mock_connection.ioloop.call_later.assert_called_with(wait_seconds, builder.reconnect)
         # This was called inside reconnect:
         builder.thread._connection.ioloop.stop.assert_called()
@@ -584,6 +592,103 @@ class ThreadBuilderTestCase(unittest.TestCase):
         # Check result
         builder.thread._connection.close.assert_called()
 
+    '''
+    With several channels, publishing starts once all
+    of them are open.
+    '''
+    def test_on_channel_open_several_channels(self):
+
+        # Preparation:
+        builder = self.make_builder()
+        builder.confirmers.append(esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer(builder.thread))
+        builder.thread._channels = [None, None]
+        builder._ConnectionBuilder__start_connect_time = datetime.datetime.now()
+        builder.thread.get_num_unpublished.return_value = 0
+        builder.statemachine.set_to_waiting_to_be_available()
+        channel0 = mock.MagicMock()
+        channel1 = mock.MagicMock()
+
+        # Run code to be tested:
+        builder.on_channel_open(channel1, channel_index=1)
+        self.assertFalse(builder.statemachine.is_AVAILABLE())
+        builder.on_channel_open(channel0, channel_index=0)
+
+        # Check result: Each channel confirms to its own confirmer
+        self.assertTrue(builder.statemachine.is_AVAILABLE())
+        self.assertEqual(builder.thread._channels, [channel0, channel1])
+        callback = channel1.confirm_delivery.call_args[1]['ack_nack_callback']
+        self.assertEqual(callback, builder.confirmers[1].on_delivery_confirmation)
+
+    '''
+    If one of several channels is closed because the exchange
+    did not exist, only this one is reopened, and only its
+    unconfirmed messages are republished.
+    '''
+    def test_on_channel_no_exchange_several_channels(self):
+
+        # Preparation:
+        builder = self.make_builder()
+        builder.statemachine.set_to_available()
+        builder.thread._connection = mock.MagicMock()
+        builder.thread._channels = [mock.MagicMock(), mock.MagicMock()]
+        builder.thread.get_unconfirmed_messages_as_list_copy_during_lifetime.return_value = ['foo']
+
+        # Run code to be tested:
+        exception = pika.exceptions.ChannelClosed(404, 'foo')
+        builder.on_channel_closed(builder.thread._channels[1], exception, channel_index=1)
+
+        # Check result
+        self.assertIsNone(builder.thread._channels[1])
+        self.assertIsNotNone(builder.thread._channels[0])
+        builder.thread.reset_delivery_number.assert_called_with(1)
+        builder.thread.reset_unconfirmed_messages_and_delivery_tags.assert_called_with(1)
+        builder.thread.get_unconfirmed_messages_as_list_copy_during_lifetime.assert_called_with(1)
+        builder.thread.send_many_messages.assert_called_with(['foo'])
+        self.assertEqual(builder.thread._connection.channel.call_count, 1)
+
+    #
+    # Flow control
+    #
+
+    def test_on_connection_blocked_and_unblocked(self):
+
+        # Preparation:
+        builder = self.make_builder()
+        builder.statemachine.set_to_available()
+        builder.thread.get_num_unpublished.return_value = 3
+        method_frame = mock.MagicMock()
+        method_frame.method.reason = 'low on memory'
+
+        # Run code to be tested: Blocked
+        builder.on_connection_blocked(builder.thread._connection, method_frame)
+
+        # Check result
+        self.assertTrue(builder.statemachine.is_connection_blocked())
+        self.assertTrue(builder.statemachine.is_AVAILABLE())
+        builder.thread.add_event_publish_message.assert_not_called()
+
+        # Run code to be tested: Unblocked
+        builder.on_connection_unblocked(builder.thread._connection, method_frame)
+
+        # Check result (publication resumes):
+        self.assertFalse(builder.statemachine.is_connection_blocked())
+        self.assertTrue(builder.statemachine.get_seconds_blocked() > 0)
+        builder.thread.add_event_publish_message.assert_called_once_with()
+
+    def test_on_connection_closed_while_blocked(self):
+
+        # Preparation:
+        builder = self.make_builder()
+        builder.statemachine.set_to_available()
+        builder.statemachine.set_detail_connection_blocked()
+
+        # Run code to be tested:
+        exception = pika.exceptions.ConnectionClosed(999, 'foo(not reopen)foo')
+        builder.on_connection_closed(None, exception)
+
+        # Check result
+        self.assertFalse(builder.statemachine.is_connection_blocked())
+
     #
     # on_connection_close
     #
@@ -668,8 +773,8 @@ class ThreadBuilderTestCase(unittest.TestCase):
 
         # Check result:
         builder.thread._connection.ioloop.stop.assert_called_with()
-        builder.thread.reset_delivery_number.assert_called_with()
-        builder.thread.reset_unconfirmed_messages_and_delivery_tags.assert_called_with()
+        builder.thread.reset_delivery_number.assert_called_with(None)
+        builder.thread.reset_unconfirmed_messages_and_delivery_tags.assert_called_with(None)
         builder.thread.send_many_messages.assert_not_called()
         connpatch.assert_called()
 
@@ -688,8 +793,8 @@ class ThreadBuilderTestCase(unittest.TestCase):
 
         # Check result:
         builder.thread._connection.ioloop.stop.assert_called_with()
-        builder.thread.reset_delivery_number.assert_called_with()
-        builder.thread.reset_unconfirmed_messages_and_delivery_tags.assert_called_with()
+        builder.thread.reset_delivery_number.assert_called_with(None)
+        builder.thread.reset_unconfirmed_messages_and_delivery_tags.assert_called_with(None)
         builder.thread.send_many_messages.assert_called()
         connpatch.assert_called()
 
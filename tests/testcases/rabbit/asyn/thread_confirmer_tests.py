@@ -1,15 +1,17 @@
 import unittest
 import mock
 import logging
-import copy
 import os
 import esgfpid.rabbit.asynchronous.thread_confirmer
+import esgfpid.exceptions
+from esgfpid.rabbit.rabbitutils import MessageEnvelope
+from esgfpid.rabbit.delivery import DeliveryFuture
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
 UNCONFIRMED_TAGS = [1,2,3,4]
-UNCONFIRMED_MESSAGES = {'1':'foo1', '2':'foo2', '3':'foo3', '4':'foo4'}
+UNCONFIRMED_MESSAGES = ['foo1', 'foo2', 'foo3', 'foo4']
 
 class ThreadConfirmerTestCase(unittest.TestCase):
 
@@ -20,9 +22,10 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         LOGGER.info('#############################')
 
     def make_confirmer(self):
-        confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer()
-        confirmer._Confirmer__unconfirmed_delivery_tags = copy.copy(UNCONFIRMED_TAGS)
-        confirmer._Confirmer__unconfirmed_messages_dict = copy.copy(UNCONFIRMED_MESSAGES)
+        thread = mock.MagicMock()
+        confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer(thread)
+        for tag, msg in zip(UNCONFIRMED_TAGS, UNCONFIRMED_MESSAGES):
+            confirmer.put_to_unconfirmed(tag, msg)
         return confirmer
 
     # Tests
@@ -46,15 +49,15 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         confirmer.on_delivery_confirmation(method_frame)
 
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
         expected_unconf = [1,3,4]
         self.assertEqual(unconf, expected_unconf,
             'Unconfirmed delivery tags: %s, expected %s' % (unconf, expected_unconf))
         # Check result (messages)
-        unconf_dict = confirmer._Confirmer__unconfirmed_messages_dict
-        expected_unconf_dict = {'1':'foo1', '3':'foo3', '4':'foo4'}
-        self.assertEqual(unconf_dict, expected_unconf_dict,
-            'Unconfirmed messages: %s, expected %s' % (unconf_dict, expected_unconf_dict))
+        unconf_msgs = confirmer.get_unconfirmed_messages_as_list_copy()
+        expected_unconf_msgs = ['foo1', 'foo3', 'foo4']
+        self.assertEqual(unconf_msgs, expected_unconf_msgs,
+            'Unconfirmed messages: %s, expected %s' % (unconf_msgs, expected_unconf_msgs))
 
 
     def test_multiple_ack_ok(self):
@@ -72,15 +75,68 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         confirmer.on_delivery_confirmation(method_frame)
 
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
         expected_unconf = [3,4]
         self.assertEqual(unconf, expected_unconf,
             'Unconfirmed delivery tags: %s, expected %s' % (unconf, expected_unconf))
         # Check result (messages)
-        unconf_dict = confirmer._Confirmer__unconfirmed_messages_dict
-        expected_unconf_dict = {'3':'foo3', '4':'foo4'}
-        self.assertEqual(unconf_dict, expected_unconf_dict,
-            'Unconfirmed messages: %s, expected %s' % (unconf_dict, expected_unconf_dict))
+        unconf_msgs = confirmer.get_unconfirmed_messages_as_list_copy()
+        expected_unconf_msgs = ['foo3', 'foo4']
+        self.assertEqual(unconf_msgs, expected_unconf_msgs,
+            'Unconfirmed messages: %s, expected %s' % (unconf_msgs, expected_unconf_msgs))
+
+    def test_multiple_ack_after_single_ack_ok(self):
+
+        # Preparation:
+        confirmer = self.make_confirmer()
+        method_frame = mock.MagicMock()
+        method_frame.method.NAME = 'foo.ack'
+
+        # Single ack in the middle, then multiple ack above it:
+        method_frame.method.delivery_tag = 2
+        method_frame.method.multiple = False
+        confirmer.on_delivery_confirmation(method_frame)
+        method_frame.method.delivery_tag = 3
+        method_frame.method.multiple = True
+        confirmer.on_delivery_confirmation(method_frame)
+
+        # Check result:
+        self.assertEqual(confirmer.get_copy_of_unconfirmed_tags(), [4])
+        self.assertEqual(confirmer.get_unconfirmed_messages_as_list_copy(), ['foo4'])
+
+    def test_all_confirmed_tells_shutter(self):
+
+        # Preparation:
+        confirmer = self.make_confirmer()
+        method_frame = mock.MagicMock()
+        method_frame.method.NAME = 'foo.ack'
+        method_frame.method.multiple = True
+
+        # Run code to be tested: Some left
+        method_frame.method.delivery_tag = 3
+        confirmer.on_delivery_confirmation(method_frame)
+        confirmer.thread.tell_shutter_all_messages_confirmed.assert_not_called()
+        confirmer.thread.tell_publisher_messages_were_confirmed.assert_called_once_with()
+
+        # Run code to be tested: None left
+        method_frame.method.delivery_tag = 4
+        confirmer.on_delivery_confirmation(method_frame)
+        confirmer.thread.tell_shutter_all_messages_confirmed.assert_called_once_with()
+
+    def test_ack_unknown_tag_ok(self):
+
+        # Preparation:
+        confirmer = self.make_confirmer()
+        method_frame = mock.MagicMock()
+        method_frame.method.delivery_tag = 99
+        method_frame.method.multiple = False
+        method_frame.method.NAME = 'foo.ack'
+
+        # Run code to be tested:
+        confirmer.on_delivery_confirmation(method_frame)
+
+        # Check result (nothing was removed):
+        self.assertEqual(confirmer.get_copy_of_unconfirmed_tags(), UNCONFIRMED_TAGS)
 
     #
     # Nacks
@@ -101,15 +157,15 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         confirmer.on_delivery_confirmation(method_frame)
 
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
         expected_unconf = [1,3,4]
         self.assertEqual(unconf, expected_unconf,
             'Unconfirmed delivery tags: %s, expected %s' % (unconf, expected_unconf))
         # Check result (messages)
-        unconf_dict = confirmer._Confirmer__unconfirmed_messages_dict
-        expected_unconf_dict = {'1':'foo1', '3':'foo3', '4':'foo4'}
-        self.assertEqual(unconf_dict, expected_unconf_dict,
-            'Unconfirmed messages: %s, expected %s' % (unconf_dict, expected_unconf_dict))
+        unconf_msgs = confirmer.get_unconfirmed_messages_as_list_copy()
+        expected_unconf_msgs = ['foo1', 'foo3', 'foo4']
+        self.assertEqual(unconf_msgs, expected_unconf_msgs,
+            'Unconfirmed messages: %s, expected %s' % (unconf_msgs, expected_unconf_msgs))
         # Check result (nacked)
         nacked = confirmer._Confirmer__nacked_messages
         exp = ['foo2']
@@ -132,15 +188,15 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         nacked_copy = confirmer.get_copy_of_nacked()
 
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
         expected_unconf = [3,4]
         self.assertEqual(unconf, expected_unconf,
             'Unconfirmed delivery tags: %s, expected %s' % (unconf, expected_unconf))
         # Check result (messages)
-        unconf_dict = confirmer._Confirmer__unconfirmed_messages_dict
-        expected_unconf_dict = {'3':'foo3', '4':'foo4'}
-        self.assertEqual(unconf_dict, expected_unconf_dict,
-            'Unconfirmed messages: %s, expected %s' % (unconf_dict, expected_unconf_dict))
+        unconf_msgs = confirmer.get_unconfirmed_messages_as_list_copy()
+        expected_unconf_msgs = ['foo3', 'foo4']
+        self.assertEqual(unconf_msgs, expected_unconf_msgs,
+            'Unconfirmed messages: %s, expected %s' % (unconf_msgs, expected_unconf_msgs))
         # Check result (nacked)
         nacked = confirmer._Confirmer__nacked_messages
         exp = ['foo1', 'foo2']
@@ -151,6 +207,61 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         self.assertEqual(nacked_copy, exp,
             'Nacked messages: %s, expected %s' % (nacked_copy, exp))
 
+    #
+    # Delivery futures
+    #
+
+    def test_ack_and_nack_resolve_futures(self):
+
+        # Preparation:
+        thread = mock.MagicMock()
+        confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer(thread)
+        envelopes = [MessageEnvelope('mykey', 'foo%i' % i) for i in range(4)]
+        for tag, envelope in enumerate(envelopes, 1):
+            envelope.future = DeliveryFuture()
+            confirmer.put_to_unconfirmed(tag, envelope)
+        method_frame = mock.MagicMock()
+        method_frame.method.delivery_tag = 2
+        method_frame.method.multiple = True
+        method_frame.method.NAME = 'foo.ack'
+
+        # Run code to be tested:
+        confirmer.on_delivery_confirmation(method_frame)
+        method_frame.method.delivery_tag = 3
+        method_frame.method.multiple = False
+        method_frame.method.NAME = 'foo.nack'
+        confirmer.on_delivery_confirmation(method_frame)
+
+        # Check result:
+        self.assertTrue(envelopes[0].future.succeeded())
+        self.assertTrue(envelopes[1].future.succeeded())
+        self.assertIsInstance(envelopes[2].future.exception(), esgfpid.exceptions.MessageNotDeliveredException)
+        self.assertFalse(envelopes[3].future.done())
+
+    def test_take_future_of_unconfirmed(self):
+
+        # Preparation:
+        confirmer = self.make_confirmer() # some messages without future
+        envelope = MessageEnvelope('mykey', 'bar')
+        future = envelope.future = DeliveryFuture()
+        confirmer.put_to_unconfirmed(5, envelope)
+
+        # Run code to be tested:
+        taken = confirmer.take_future_of_unconfirmed(b'bar')
+        not_found = confirmer.take_future_of_unconfirmed(b'baz')
+
+        # Check result:
+        self.assertIs(taken, future)
+        self.assertIsNone(not_found)
+        # The ack of the returned message does not resolve it:
+        self.assertIsNone(envelope.future)
+        method_frame = mock.MagicMock()
+        method_frame.method.delivery_tag = 5
+        method_frame.method.multiple = False
+        method_frame.method.NAME = 'foo.ack'
+        confirmer.on_delivery_confirmation(method_frame)
+        self.assertFalse(future.done())
+
     #
     # During publish
     #
@@ -161,19 +272,18 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         confirmer = self.make_confirmer()
 
         # Run code to be tested:
-        confirmer.put_to_unconfirmed_delivery_tags(100)
-        confirmer.put_to_unconfirmed_messages_dict(100, 'foo100')
+        confirmer.put_to_unconfirmed(100, 'foo100')
 
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
         expected_unconf = [1,2,3,4,100]
         self.assertEqual(unconf, expected_unconf,
             'Unconfirmed delivery tags: %s, expected %s' % (unconf, expected_unconf))
         # Check result (messages)
-        unconf_dict = confirmer._Confirmer__unconfirmed_messages_dict
-        expected_unconf_dict = {'1':'foo1', '2':'foo2', '3':'foo3', '4':'foo4', '100':'foo100'}
-        self.assertEqual(unconf_dict, expected_unconf_dict,
-            'Unconfirmed messages: %s, expected %s' % (unconf_dict, expected_unconf_dict))
+        unconf_msgs = confirmer.get_unconfirmed_messages_as_list_copy()
+        expected_unconf_msgs = ['foo1', 'foo2', 'foo3', 'foo4', 'foo100']
+        self.assertEqual(unconf_msgs, expected_unconf_msgs,
+            'Unconfirmed messages: %s, expected %s' % (unconf_msgs, expected_unconf_msgs))
 
     #
     # Getting leftovers
@@ -209,9 +319,7 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         unconf_retrieved = confirmer.get_copy_of_unconfirmed_tags()
     
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
-        self.assertEqual(unconf, [],
-            'Unconfirmed delivery tags: %s, expected %s' % (unconf, []))
+        self.assertEqual(confirmer.get_num_unconfirmed(), 0)
         self.assertEqual(unconf_retrieved, [],
             'Unconfirmed delivery tags: %s, expected %s' % (unconf_retrieved, []))
 
@@ -6,6 +6,7 @@ if sys.version[0] == '2':
 else:
     import queue as queue
 import pika
+import mock
 import esgfpid.rabbit.asynchronous.thread_feeder
 from esgfpid.rabbit.asynchronous.exceptions import OperationNotAllowed
 
@@ -24,7 +25,7 @@ class ThreadFeederTestCase(unittest.TestCase):
     def tearDown(self):
         LOGGER.info('#############################')
 
-    def make_feeder(self, error=None):
+    def make_feeder(self, error=None, metrics=None):
 
         thread = TESTHELPERS.get_thread_mock2(error)
         statemachine = esgfpid.rabbit.asynchronous.thread_statemachine.StateMachine()
@@ -33,7 +34,8 @@ class ThreadFeederTestCase(unittest.TestCase):
         feeder = esgfpid.rabbit.asynchronous.thread_feeder.RabbitFeeder(
             thread,
             statemachine,
-            nodemanager)
+            nodemanager,
+            metrics=metrics)
 
         statemachine.set_to_available()
         nodemanager.set_next_host() # otherwise, we cannot call its method inside the publish method
@@ -61,6 +63,36 @@ class ThreadFeederTestCase(unittest.TestCase):
         # Message not waiting in queue anymore:
         self.assertNotIn(msg, thread.messages)
 
+    def test_send_message_tells_metrics(self):
+
+        # Preparation:
+        msg = "{'foo':'bar'}"
+        metrics = mock.MagicMock()
+        feeder, thread = self.make_feeder(metrics=metrics)
+        thread.messages.append(msg)
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result:
+        metrics.on_message_published.assert_called_once_with(msg)
+
+    def test_send_message_connection_blocked(self):
+
+        # Preparation:
+        msg = "{'foo':'bar'}"
+        feeder, thread = self.make_feeder()
+        thread.messages.append(msg)
+        feeder.statemachine.set_detail_connection_blocked()
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result:
+        # Publish was not called, message still waiting:
+        thread._channel.basic_publish.assert_not_called()
+        self.assertIn(msg, thread.messages)
+
     def test_routing_key_ok(self):
 
         # Preparation:
@@ -152,6 +184,66 @@ class ThreadFeederTestCase(unittest.TestCase):
         self.assertIn(msg, thread.messages)
         self.assertIn(msg, thread.put_back)
 
+    def test_send_many_messages_one_trigger(self):
+
+        # Preparation:
+        feeder, thread = self.make_feeder()
+        for i in range(5):
+            thread.messages.append("{'foo':'bar%i'}" % i)
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result:
+        # All messages were published by one trigger:
+        self.assertEqual(thread._channel.basic_publish.call_count, 5)
+        self.assertEqual(len(thread.messages), 0)
+        self.assertEqual(len(thread.undelivered_msg), 5)
+        self.assertEqual(thread.unconfirmed_tags, [1,2,3,4,5])
+        # No re-arming needed:
+        self.assertEqual(thread.num_message_events, 0)
+
+    def test_send_many_messages_budget_exceeded(self):
+
+        # Preparation:
+        feeder, thread = self.make_feeder()
+        feeder._RabbitFeeder__max_publish_per_trigger = 3
+        for i in range(5):
+            thread.messages.append("{'foo':'bar%i'}" % i)
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result:
+        # Only three were published, and a new trigger was fired:
+        self.assertEqual(thread._channel.basic_publish.call_count, 3)
+        self.assertEqual(len(thread.messages), 2)
+        self.assertEqual(thread.num_message_events, 1)
+
+        # Run the re-armed trigger:
+        feeder.publish_message()
+
+        # Check result:
+        self.assertEqual(thread._channel.basic_publish.call_count, 5)
+        self.assertEqual(len(thread.messages), 0)
+        self.assertEqual(thread.num_message_events, 1)
+
+    def test_send_many_messages_error_stops_draining(self):
+
+        # Preparation:
+        feeder, thread = self.make_feeder(error=pika.exceptions.ChannelClosed(reply_code=0, reply_text='Channel Closed'))
+        for i in range(5):
+            thread.messages.append("{'foo':'bar%i'}" % i)
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result:
+        # Only one publish was tried, all messages are still waiting:
+        thread._channel.basic_publish.assert_called_once()
+        self.assertEqual(len(thread.messages), 5)
+        self.assertEqual(thread.num_message_events, 0)
+
     def test_send_message_NOT_STARTED_YET(self):
 
         # Preparation:
@@ -228,7 +320,7 @@ class ThreadFeederTestCase(unittest.TestCase):
         thread.messages.append(msg)
 
         # Pre-Check:
-        self.assertEqual(feeder._RabbitFeeder__delivery_number, 1)
+        self.assertEqual(feeder._RabbitFeeder__delivery_numbers, [1])
 
         # Increase delivery number:
         feeder.publish_message()
@@ -237,11 +329,59 @@ class ThreadFeederTestCase(unittest.TestCase):
         thread._channel.basic_publish.assert_called()
 
         # Check if it was increased:
-        self.assertEqual(feeder._RabbitFeeder__delivery_number, 4)
+        self.assertEqual(feeder._RabbitFeeder__delivery_numbers, [4])
 
         # Run code to be tested:
         feeder.reset_delivery_number()
 
         # Check if it was reset:
-        self.assertEqual(feeder._RabbitFeeder__delivery_number, 1)
+        self.assertEqual(feeder._RabbitFeeder__delivery_numbers, [1])
 
+    #
+    # Several channels
+    #
+
+    def test_round_robin_over_channels(self):
+
+        # Preparation:
+        thread = TESTHELPERS.get_thread_mock2()
+        thread._channels = [mock.MagicMock(), mock.MagicMock(), mock.MagicMock()]
+        statemachine = esgfpid.rabbit.asynchronous.thread_statemachine.StateMachine()
+        statemachine.set_to_available()
+        nodemanager = TESTHELPERS.get_nodemanager()
+        nodemanager.set_next_host()
+        feeder = esgfpid.rabbit.asynchronous.thread_feeder.RabbitFeeder(thread, statemachine, nodemanager, 3)
+        for i in range(5):
+            thread.messages.append('{"foo":"bar%i"}' % i)
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result: Spread over channels, each with its own delivery tags
+        self.assertEqual([channel.basic_publish.call_count for channel in thread._channels], [2, 2, 1])
+        self.assertEqual(thread.unconfirmed_channels, [0, 1, 2, 0, 1])
+        self.assertEqual(thread.unconfirmed_tags, [1, 1, 1, 2, 2])
+
+        # Run code to be tested: Reset one channel
+        feeder.reset_delivery_number(1)
+        self.assertEqual(feeder._RabbitFeeder__delivery_numbers, [3, 1, 2])
+
+    def test_closed_channel_is_skipped(self):
+
+        # Preparation:
+        thread = TESTHELPERS.get_thread_mock2()
+        thread._channels = [mock.MagicMock(), None]
+        statemachine = esgfpid.rabbit.asynchronous.thread_statemachine.StateMachine()
+        statemachine.set_to_available()
+        nodemanager = TESTHELPERS.get_nodemanager()
+        nodemanager.set_next_host()
+        feeder = esgfpid.rabbit.asynchronous.thread_feeder.RabbitFeeder(thread, statemachine, nodemanager, 2)
+        thread.messages.append('{"foo":"bar1"}')
+        thread.messages.append('{"foo":"bar2"}')
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result:
+        self.assertEqual(thread._channels[0].basic_publish.call_count, 2)
+        self.assertEqual(thread.unconfirmed_channels, [0, 0])
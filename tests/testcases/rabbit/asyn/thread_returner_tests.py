@@ -9,6 +9,8 @@ import pika
 import mock
 import json
 import esgfpid.rabbit.asynchronous.thread_returnhandler
+import esgfpid.exceptions
+from esgfpid.rabbit.delivery import DeliveryFuture
 from esgfpid.rabbit.asynchronous.exceptions import OperationNotAllowed
 
 LOGGER = logging.getLogger(__name__)
@@ -61,7 +63,8 @@ class ThreadReturnerTestCase(unittest.TestCase):
         thread.send_a_message.assert_called_once_with(mock.ANY)
         call_args, call_kwargs = thread.send_a_message.call_args
         expected = {"foo": "bar", "ROUTING_KEY": emergency_routing_key, "original_routing_key": routing_key}
-        self.assertEqual(json.loads(call_args[0]), expected)
+        self.assertEqual(call_args[0].get_json(), expected)
+        self.assertEqual(call_args[0].routing_key, emergency_routing_key)
 
     def test_send_message_second_time(self):
 
@@ -82,6 +85,46 @@ class ThreadReturnerTestCase(unittest.TestCase):
         # Check result:
         thread.send_a_message.assert_not_called()
 
+    def test_future_handed_over_to_resent_message(self):
+
+        # Preparation:
+        routing_key = 'foobar'
+        body = '{"foo":"bar", "ROUTING_KEY":"%s"}' % routing_key
+        handler, thread = self.make_returnhandler()
+        future = DeliveryFuture()
+        thread.take_future_of_unconfirmed.return_value = future
+        frame = mock.MagicMock()
+        frame.reply_text = 'NO_ROUTE'
+        frame.routing_key = routing_key
+
+        # Run code to be tested:
+        handler.on_message_not_accepted(thread._channel, frame, mock.MagicMock(), body)
+
+        # Check result:
+        thread.take_future_of_unconfirmed.assert_called_once_with(body)
+        call_args, call_kwargs = thread.send_a_message.call_args
+        self.assertIs(call_args[0].future, future)
+        self.assertFalse(future.done())
+
+    def test_future_fails_second_time(self):
+
+        # Preparation:
+        emergency_routing_key = esgfpid.utils.RABBIT_EMERGENCY_ROUTING_KEY
+        body = '{"foo":"bar", "ROUTING_KEY":"%s", "original_routing_key":"foobar"}' % emergency_routing_key
+        handler, thread = self.make_returnhandler()
+        future = DeliveryFuture()
+        thread.take_future_of_unconfirmed.return_value = future
+        frame = mock.MagicMock()
+        frame.reply_text = 'NO_ROUTE'
+        frame.routing_key = emergency_routing_key
+
+        # Run code to be tested:
+        handler.on_message_not_accepted(thread._channel, frame, mock.MagicMock(), body)
+
+        # Check result:
+        thread.send_a_message.assert_not_called()
+        self.assertIsInstance(future.exception(), esgfpid.exceptions.MessageNotDeliveredException)
+
     def test_send_message_other(self):
 
         # Preparation:
@@ -102,7 +145,7 @@ class ThreadReturnerTestCase(unittest.TestCase):
         thread.send_a_message.assert_called_once_with(mock.ANY)
         call_args, call_kwargs = thread.send_a_message.call_args
         expected = {"foo": "bar", "ROUTING_KEY": emergency_routing_key, "original_routing_key": routing_key}
-        self.assertEqual(json.loads(call_args[0]), expected)
+        self.assertEqual(call_args[0].get_json(), expected)
 
 
     def test_send_message_no_key(self):
@@ -124,7 +167,7 @@ class ThreadReturnerTestCase(unittest.TestCase):
         thread.send_a_message.assert_called_once_with(mock.ANY)
         call_args, call_kwargs = thread.send_a_message.call_args
         expected = {"foo": "bar", "ROUTING_KEY": emergency_routing_key, "original_routing_key": "None"}
-        self.assertEqual(json.loads(call_args[0]), expected)
+        self.assertEqual(call_args[0].get_json(), expected)
 
 
     def test_send_message_error(self):
@@ -147,4 +190,4 @@ class ThreadReturnerTestCase(unittest.TestCase):
         thread.send_a_message.assert_called_once_with(mock.ANY)
         call_args, call_kwargs = thread.send_a_message.call_args
         expected = {"foo": "bar", "ROUTING_KEY": emergency_routing_key, "original_routing_key": "None"}
-        self.assertEqual(json.loads(call_args[0]), expected)
+        self.assertEqual(call_args[0].get_json(), expected)
@@ -1,6 +1,8 @@
 import unittest
 import mock
 import logging
+import time
+import esgfpid.defaults
 import esgfpid.rabbit.asynchronous.thread_shutter
 from esgfpid.rabbit.asynchronous.exceptions import OperationNotAllowed
 
@@ -124,8 +126,10 @@ class ThreadShutterTestCase(unittest.TestCase):
         self.assertEqual(shutter.thread.get_num_unconfirmed(), 0)
         self.assertEqual(shutter.thread.get_num_unpublished(), 0)
         self.assertFalse(shutter.thread.add_event_publish_message.called)
-        # Check if connection was closed:
+        # Check if connection was closed (without waiting):
         shutter.thread._connection.close.assert_called()
+        self.assertEqual(shutter.thread.timers, [])
+        shutter.thread.tell_publisher_to_stop_waiting_for_gentle_finish.assert_called()
     
     def test_gently_finish_with_unpublished_messages_ok(self):
 
@@ -136,6 +140,13 @@ class ThreadShutterTestCase(unittest.TestCase):
         # Run code to be tested:
         shutter.finish_gently()
 
+        # Check that publish was triggered, but not closed yet:
+        self.assertTrue(shutter.thread.add_event_publish_message.called)
+        shutter.thread._connection.close.assert_not_called()
+
+        # Confirmer tells us that all were confirmed:
+        shutter.on_all_messages_confirmed()
+
         # Check result state:
         state = shutter.statemachine._StateMachine__state
         exp = shutter.statemachine._StateMachine__PERMANENTLY_UNAVAILABLE
@@ -144,7 +155,6 @@ class ThreadShutterTestCase(unittest.TestCase):
         # Check leftovers:
         self.assertEqual(shutter.thread.get_num_unconfirmed(), 0)
         self.assertEqual(shutter.thread.get_num_unpublished(), 0)
-        self.assertTrue(shutter.thread.add_event_publish_message.called)
         # Check if connection was closed:
         shutter.thread._connection.close.assert_called()
 
@@ -153,33 +163,41 @@ class ThreadShutterTestCase(unittest.TestCase):
         # Preparation:
         shutter = self.make_shutter()
         shutter.thread.num_unconfirmed = 4
-        shutter.thread.fake_confirms = True
-        shutter.thread.confirm_rate = 0.22
 
         # Run code to be tested:
         shutter.finish_gently()
 
+        # Check that it is waiting, with a timeout:
+        shutter.thread._connection.close.assert_not_called()
+        self.assertEqual(len(shutter.thread.timers), 1)
+        self.assertTrue(shutter.thread.timers[0][0] <= esgfpid.defaults.RABBIT_ASYN_FINISH_TIMEOUT_SECONDS)
+
+        # Last confirms arrive:
+        shutter.thread.num_unconfirmed = 0
+        shutter.on_all_messages_confirmed()
+
         # Check result state:
         state = shutter.statemachine._StateMachine__state
         exp = shutter.statemachine._StateMachine__PERMANENTLY_UNAVAILABLE
         self.assertEqual(state, exp)
+        shutter.thread._connection.close.assert_called_once()
 
-        # Check leftovers:
-        self.assertEqual(shutter.thread.get_num_unconfirmed(), 0)
-        self.assertEqual(shutter.thread.get_num_unpublished(), 0)
-        # Check if connection was closed:
-        shutter.thread._connection.close.assert_called()
+        # The timeout does not do anything anymore:
+        shutter.thread.run_timers()
+        state = shutter.statemachine._StateMachine__state
+        self.assertEqual(state, exp)
+        shutter.thread._connection.close.assert_called_once()
 
     def test_gently_finish_wait_too_long(self):
 
         # Preparation:
         shutter = self.make_shutter()
         shutter.thread.num_unconfirmed = 100
-        shutter.thread.fake_confirms = True
-        shutter.thread.confirm_rate = 0.22
 
         # Run code to be tested:
         shutter.finish_gently()
+        shutter.thread._connection.close.assert_not_called()
+        shutter.thread.run_timers() # Timeout
 
         # Check result state:
         state = shutter.statemachine._StateMachine__state
@@ -190,6 +208,32 @@ class ThreadShutterTestCase(unittest.TestCase):
         self.assertTrue(shutter.thread.get_num_unconfirmed()>0)
         # Check if connection was closed:
         shutter.thread._connection.close.assert_called()
+        shutter.thread.tell_publisher_to_stop_waiting_for_gentle_finish.assert_called()
+
+    def test_gently_finish_extended_while_blocked(self):
+
+        # Preparation:
+        shutter = self.make_shutter()
+        shutter.thread.num_unconfirmed = 100
+
+        # Run code to be tested:
+        shutter.finish_gently()
+        # RabbitMQ blocks the connection for three seconds:
+        shutter.statemachine._StateMachine__seconds_blocked = 3
+        shutter.thread.run_timers() # Timeout
+
+        # Check that it waits some more:
+        shutter.thread._connection.close.assert_not_called()
+        self.assertEqual(len(shutter.thread.timers), 1)
+        self.assertTrue(shutter.thread.timers[0][0] > esgfpid.defaults.RABBIT_ASYN_FINISH_TIMEOUT_SECONDS)
+
+        # Run code to be tested: Blocked a very long time
+        shutter.statemachine._StateMachine__seconds_blocked = 1000
+        max_seconds = esgfpid.defaults.RABBIT_ASYN_FINISH_TIMEOUT_SECONDS+esgfpid.defaults.RABBIT_ASYN_FINISH_MAX_EXTENSION_SECONDS
+        shutter.thread.run_timers()
+
+        # Check that the extension is capped:
+        self.assertTrue(shutter.thread.timers[0][0] <= max_seconds)
 
     def test_gently_finish_with_leftovers_not_progressing_1(self):
 
@@ -197,7 +241,6 @@ class ThreadShutterTestCase(unittest.TestCase):
         shutter = self.make_shutter()
         shutter.thread.num_unpublished = 100
         shutter.thread.num_unconfirmed = 100
-        shutter.thread.fake_confirms = False
         shutter.statemachine.set_to_permanently_unavailable()
         shutter.statemachine.detail_could_not_connect = True
 
@@ -224,7 +267,6 @@ class ThreadShutterTestCase(unittest.TestCase):
         shutter = self.make_shutter()
         shutter.thread.num_unpublished = 100
         shutter.thread.num_unconfirmed = 100
-        shutter.thread.fake_confirms = False
         shutter.statemachine.set_to_permanently_unavailable()
         shutter.statemachine.detail_authentication_exception = True
 
@@ -251,7 +293,6 @@ class ThreadShutterTestCase(unittest.TestCase):
         shutter = self.make_shutter()
         shutter.thread.num_unpublished = 100
         shutter.thread.num_unconfirmed = 100
-        shutter.thread.fake_confirms = False
         shutter.statemachine.set_to_permanently_unavailable()
         shutter.statemachine.set_detail_closed_by_publisher()
 
@@ -269,6 +310,20 @@ class ThreadShutterTestCase(unittest.TestCase):
         # Check if connection was closed:
         shutter.thread._connection.close.assert_called()
 
+    def test_all_confirmed_while_not_closing(self):
+
+        # Preparation:
+        shutter = self.make_shutter()
+
+        # Run code to be tested:
+        shutter.on_all_messages_confirmed()
+
+        # Check that nothing was closed:
+        shutter.thread._connection.close.assert_not_called()
+        state = shutter.statemachine._StateMachine__state
+        exp = shutter.statemachine._StateMachine__IS_AVAILABLE
+        self.assertEqual(state, exp)
+
     def test_not_continuing(self):
 
         # Preparation:
@@ -289,12 +344,22 @@ class ThreadShutterTestCase(unittest.TestCase):
         # Preparation:
         shutter = self.make_shutter()
         shutter._ShutDowner__is_in_process_of_gently_closing = True
-        shutter.recursive_decision_about_closing = mock.MagicMock() # to be able to check if it was called
+        shutter._ShutDowner__deadline = time.time()+1
+        shutter.decide_about_closing = mock.MagicMock() # to be able to check if it was called
         
         # Run code to be tested
         shutter.continue_gently_closing_if_applicable()
         self.assertTrue(shutter.thread._connection.ioloop.call_later.called)
-        self.assertTrue(shutter.recursive_decision_about_closing.called)
+
+        # Check that the timeout only covers the remaining time:
+        self.assertEqual(len(shutter.thread.timers), 2)
+        timeout_seconds = max(timer[0] for timer in shutter.thread.timers)
+        self.assertTrue(0 < timeout_seconds <= 1)
+
+        # Check that the decision is redone on the new ioloop:
+        shutter.thread.timers = [timer for timer in shutter.thread.timers if timer[0] == 0]
+        shutter.thread.run_timers()
+        self.assertTrue(shutter.decide_about_closing.called)
         # Check if connection was closed:
         # (Cannot be closed, as we mock the method that would lead to closing)
         shutter.thread._connection.close.assert_not_called()
@@ -305,37 +370,35 @@ class ThreadShutterTestCase(unittest.TestCase):
         shutter = self.make_shutter()
         shutter.thread.num_unpublished = 100
         shutter.thread.num_unconfirmed = 100
-        shutter.thread.fake_confirms = False
+        shutter.thread.add_event_publish_message.side_effect = None
 
-        # Patch the shutter method to interrupt it:
-        real_method = shutter.recursive_decision_about_closing
-        shutter.recursive_decision_about_closing = mock.MagicMock() # to be able to check if it was called
-        
-        # Start a gentle close down, which is interrupted by the patch:
+        # Start a gentle close down, which waits for the messages:
         shutter.finish_gently()
+        shutter.thread._connection.close.assert_not_called()
 
-        # Shutting is interrupted, so messages were not sent:
-        self.assertFalse(shutter.thread.add_event_publish_message.called)
-        self.assertEqual(shutter.thread.num_unconfirmed, 100)
-        self.assertEqual(shutter.thread.num_unpublished, 100)
-        # The mock was called, instead of the real method (this is the interrupting):
-        self.assertTrue(shutter.recursive_decision_about_closing.called)
-
-        # Restore the old method
-        shutter.recursive_decision_about_closing = real_method
-        shutter.thread.fake_confirms = True
+        # Reconnect: The events of the old ioloop are lost:
+        shutter.thread.timers = []
+        shutter.thread.add_event_publish_message.reset_mock()
 
         # Run code to be tested: Continue shutting:
         shutter.continue_gently_closing_if_applicable()
+        shutter.thread.timers = [timer for timer in shutter.thread.timers if timer[0] == 0]
+        shutter.thread.run_timers()
 
         # Check if the shutting really was continued
         self.assertTrue(shutter.thread.add_event_publish_message.called)
+        shutter.thread._connection.close.assert_not_called()
+
+        # Messages are published and confirmed now:
+        shutter.thread.num_unpublished = 0
+        shutter.thread.num_unconfirmed = 0
+        shutter.on_all_messages_confirmed()
 
-        # Check if messages were sent now:
-        self.assertTrue(shutter.thread.num_unconfirmed <= 99)
-        self.assertTrue(shutter.thread.num_unpublished <= 99)
         # Check if connection was closed:
         shutter.thread._connection.close.assert_called()
+        state = shutter.statemachine._StateMachine__state
+        exp = shutter.statemachine._StateMachine__PERMANENTLY_UNAVAILABLE
+        self.assertEqual(state, exp)
 
     #
     # Safety finish
@@ -0,0 +1,158 @@
+import unittest
+import mock
+import logging
+import threading
+import esgfpid.exceptions
+from esgfpid.rabbit.rabbitutils import MessageEnvelope
+from esgfpid.rabbit.delivery import DeliveryFuture, AggregateDeliveryFuture
+import esgfpid.rabbit.delivery
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+class DeliveryFutureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_envelopes(self, num):
+        envelopes = []
+        for i in range(num):
+            envelope = MessageEnvelope('mykey', '{"foo":"bar%i"}' % i)
+            envelope.future = DeliveryFuture()
+            envelopes.append(envelope)
+        return envelopes
+
+    # Tests
+
+    def test_delivered(self):
+
+        # Preparation:
+        future = DeliveryFuture()
+        callback = mock.MagicMock()
+        future.add_done_callback(callback)
+        self.assertFalse(future.done())
+        self.assertFalse(future.wait(0))
+
+        # Run code to be tested:
+        resolved = future.set_delivered()
+
+        # Check result:
+        self.assertTrue(resolved)
+        self.assertTrue(future.done())
+        self.assertTrue(future.succeeded())
+        self.assertIsNone(future.exception())
+        self.assertTrue(future.wait(0))
+        callback.assert_called_once_with(future)
+
+    def test_first_resolution_wins(self):
+
+        # Preparation:
+        future = DeliveryFuture()
+        error = esgfpid.exceptions.MessageNotDeliveredException('nack', 'foo')
+
+        # Run code to be tested:
+        first = future.set_not_delivered(error)
+        second = future.set_delivered()
+
+        # Check result:
+        self.assertTrue(first)
+        self.assertFalse(second)
+        self.assertFalse(future.succeeded())
+        self.assertIs(future.exception(), error)
+
+    def test_callback_after_done_and_callback_error(self):
+
+        # Preparation:
+        future = DeliveryFuture()
+        broken = mock.MagicMock(side_effect=ValueError('oops'))
+        callback = mock.MagicMock()
+        future.add_done_callback(broken)
+
+        # Run code to be tested:
+        future.set_delivered()
+        future.add_done_callback(callback)
+
+        # Check result:
+        # The error in the first callback does not escape:
+        broken.assert_called_once_with(future)
+        callback.assert_called_once_with(future)
+
+    def test_wait_for_other_thread(self):
+
+        # Preparation:
+        future = DeliveryFuture()
+        other = DeliveryFuture()
+        def resolve():
+            other.set_delivered() # wakes up the waiting thread too early
+            future.set_delivered()
+        timer = threading.Timer(0.05, resolve)
+
+        # Run code to be tested:
+        timer.start()
+        done = future.wait(5)
+
+        # Check result:
+        self.assertTrue(done)
+        self.assertTrue(future.succeeded())
+        timer.join()
+
+    def test_helpers(self):
+
+        # Preparation:
+        envelopes = self.make_envelopes(2)
+
+        # Run code to be tested:
+        esgfpid.rabbit.delivery.set_delivered(envelopes[:1]+['no future'])
+        esgfpid.rabbit.delivery.set_not_delivered(envelopes[1:]+['no future'], 'Some reason')
+
+        # Check result:
+        self.assertTrue(envelopes[0].future.succeeded())
+        error = envelopes[1].future.exception()
+        self.assertIsInstance(error, esgfpid.exceptions.MessageNotDeliveredException)
+        self.assertIs(error.rabbit_msg, envelopes[1])
+        self.assertIn('Some reason', error.msg)
+
+    def test_aggregate_delivered(self):
+
+        # Preparation:
+        envelopes = self.make_envelopes(3)
+        aggregate = AggregateDeliveryFuture([envelope.future for envelope in envelopes])
+
+        # Run code to be tested:
+        esgfpid.rabbit.delivery.set_delivered(envelopes[:2])
+        self.assertFalse(aggregate.done())
+        self.assertEqual(aggregate.get_num_delivered(), 2)
+        esgfpid.rabbit.delivery.set_delivered(envelopes[2:])
+
+        # Check result:
+        self.assertTrue(aggregate.done())
+        self.assertTrue(aggregate.succeeded())
+
+    def test_aggregate_not_delivered(self):
+
+        # Preparation:
+        envelopes = self.make_envelopes(3)
+        aggregate = AggregateDeliveryFuture([envelope.future for envelope in envelopes])
+
+        # Run code to be tested:
+        esgfpid.rabbit.delivery.set_not_delivered([envelopes[0], envelopes[2]], 'Some reason')
+        esgfpid.rabbit.delivery.set_delivered([envelopes[1]])
+
+        # Check result:
+        self.assertTrue(aggregate.done())
+        error = aggregate.exception()
+        self.assertIsInstance(error, esgfpid.exceptions.MessageNotDeliveredException)
+        self.assertEqual(error.undelivered_messages, [envelopes[0], envelopes[2]])
+        self.assertIn('2 of 3', error.msg)
+
+    def test_aggregate_empty(self):
+
+        # Run code to be tested:
+        aggregate = AggregateDeliveryFuture([])
+
+        # Check result:
+        self.assertTrue(aggregate.succeeded())
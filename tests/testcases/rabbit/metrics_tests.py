@@ -0,0 +1,197 @@
+import unittest
+import mock
+import logging
+import esgfpid.rabbit.metrics
+import esgfpid.rabbit.asynchronous.thread_confirmer
+import esgfpid.rabbit.asynchronous.limiter
+from esgfpid.rabbit.rabbitutils import MessageEnvelope
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+        self.now = 100.0
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_metrics(self):
+        return esgfpid.rabbit.metrics.PublishMetrics(clock=lambda: self.now)
+
+    def make_envelope(self):
+        return MessageEnvelope('mykey', 'foo')
+
+    def make_ack(self, deliv_tag, multiple, name='foo.ack'):
+        method_frame = mock.MagicMock()
+        method_frame.method.delivery_tag = deliv_tag
+        method_frame.method.multiple = multiple
+        method_frame.method.NAME = name
+        return method_frame
+
+    # Tests
+
+    def test_message_lifecycle(self):
+
+        # Preparation:
+        metrics = self.make_metrics()
+        msg = self.make_envelope()
+
+        # Run code to be tested:
+        metrics.on_messages_enqueued([msg])
+        self.now += 0.5
+        metrics.on_message_published(msg)
+        self.now += 0.002
+        metrics.on_messages_acked([msg])
+
+        # Check result:
+        snapshot = metrics.get_snapshot()
+        self.assertEqual(snapshot['messages_enqueued'], 1)
+        self.assertEqual(snapshot['messages_published'], 1)
+        self.assertEqual(snapshot['messages_acked'], 1)
+        self.assertEqual(snapshot['queue_seconds']['count'], 1)
+        self.assertAlmostEqual(snapshot['queue_seconds']['sum'], 0.5)
+        self.assertEqual(snapshot['queue_seconds']['buckets'][0.1], 0)
+        self.assertEqual(snapshot['queue_seconds']['buckets'][0.5], 1)
+        self.assertAlmostEqual(snapshot['confirm_seconds']['max'], 0.002)
+        self.assertAlmostEqual(snapshot['total_seconds']['sum'], 0.502)
+
+    def test_republish_nack_return_refuse(self):
+
+        # Preparation:
+        metrics = self.make_metrics()
+        msg1, msg2, msg3 = self.make_envelope(), self.make_envelope(), self.make_envelope()
+        metrics.on_messages_enqueued([msg1, msg2, msg3])
+
+        # Run code to be tested:
+        metrics.on_message_published(msg1)
+        metrics.on_message_published(msg1) # after reconnection
+        metrics.on_messages_nacked([msg1])
+        metrics.on_messages_refused([msg2])
+        metrics.on_message_returned()
+
+        # Check result:
+        snapshot = metrics.get_snapshot()
+        self.assertEqual(snapshot['messages_published'], 1)
+        self.assertEqual(snapshot['messages_republished'], 1)
+        self.assertEqual(snapshot['messages_nacked'], 1)
+        self.assertEqual(snapshot['messages_refused'], 1)
+        self.assertEqual(snapshot['messages_returned'], 1)
+        # Only published messages are kept until they are confirmed:
+        self.assertEqual(len(metrics._PublishMetrics__pending), 0)
+
+    def test_left_over_messages_are_forgotten(self):
+
+        # Preparation:
+        metrics = self.make_metrics()
+        msg = self.make_envelope()
+        metrics.on_messages_enqueued([msg])
+        metrics.on_message_published(msg)
+
+        # Run code to be tested:
+        metrics.on_messages_left_over([msg])
+
+        # Check result:
+        self.assertEqual(len(metrics._PublishMetrics__pending), 0)
+        self.assertEqual(metrics.get_snapshot()['messages_published'], 1)
+
+    def test_spilled_message_lifecycle(self):
+
+        # Preparation:
+        metrics = self.make_metrics()
+        spill = esgfpid.rabbit.asynchronous.limiter.SpillFile()
+        msg = self.make_envelope()
+
+        # Run code to be tested:
+        metrics.on_messages_enqueued([msg])
+        spill.put_many([msg])
+        self.now += 0.5
+        readback = spill.get_many(1)[0] # a new object
+        metrics.on_message_published(readback)
+        self.now += 0.5
+        metrics.on_messages_acked([readback])
+        spill.close()
+
+        # Check result: The enqueue time came back from the spill file:
+        snapshot = metrics.get_snapshot()
+        self.assertAlmostEqual(snapshot['queue_seconds']['sum'], 0.5)
+        self.assertAlmostEqual(snapshot['total_seconds']['sum'], 1.0)
+        self.assertEqual(len(metrics._PublishMetrics__pending), 0)
+
+    def test_reconnection_time(self):
+
+        # Preparation:
+        metrics = self.make_metrics()
+
+        # Run code to be tested: Two attempts, then ready
+        metrics.on_reconnection_scheduled()
+        self.now += 3
+        metrics.on_reconnection_scheduled()
+        self.now += 2
+        metrics.on_connection_ready()
+        metrics.on_connection_ready() # e.g. channel reopened
+
+        # Check result:
+        snapshot = metrics.get_snapshot()
+        self.assertEqual(snapshot['reconnections'], 2)
+        self.assertEqual(snapshot['reconnection_seconds']['count'], 1)
+        self.assertEqual(snapshot['reconnection_seconds']['sum'], 5)
+
+    def test_gauges_are_added_up(self):
+
+        # Preparation:
+        metrics = self.make_metrics()
+        metrics.add_gauge('messages_unpublished', lambda: 3)
+        metrics.add_gauge('messages_unpublished', lambda: 4)
+
+        # Run code to be tested:
+        snapshot = metrics.get_snapshot()
+
+        # Check result:
+        self.assertEqual(snapshot['messages_unpublished'], 7)
+
+    def test_prometheus_text(self):
+
+        # Preparation:
+        metrics = self.make_metrics()
+        msg = self.make_envelope()
+        metrics.add_gauge('messages_unconfirmed', lambda: 2)
+        metrics.on_messages_enqueued([msg])
+        self.now += 0.02
+        metrics.on_message_published(msg)
+
+        # Run code to be tested:
+        text = metrics.get_prometheus_text()
+
+        # Check result:
+        lines = text.split('\n')
+        self.assertIn('# TYPE esgfpid_messages_enqueued_total counter', lines)
+        self.assertIn('esgfpid_messages_enqueued_total 1', lines)
+        self.assertIn('# TYPE esgfpid_queue_seconds histogram', lines)
+        self.assertIn('esgfpid_queue_seconds_bucket{le="0.01"} 0', lines)
+        self.assertIn('esgfpid_queue_seconds_bucket{le="0.05"} 1', lines)
+        self.assertIn('esgfpid_queue_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('esgfpid_queue_seconds_count 1', lines)
+        self.assertIn('# TYPE esgfpid_messages_unconfirmed gauge', lines)
+        self.assertIn('esgfpid_messages_unconfirmed 2', lines)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_confirmer_reports_acks_and_nacks(self):
+
+        # Preparation:
+        metrics = mock.MagicMock()
+        confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer(mock.MagicMock(), metrics=metrics)
+        for i in range(4):
+            confirmer.put_to_unconfirmed(i+1, 'foo%i' % (i+1))
+
+        # Run code to be tested:
+        confirmer.on_delivery_confirmation(self.make_ack(1, False))
+        confirmer.on_delivery_confirmation(self.make_ack(3, True))
+        confirmer.on_delivery_confirmation(self.make_ack(4, False, 'foo.nack'))
+
+        # Check result:
+        metrics.on_messages_acked.assert_any_call(['foo1'])
+        metrics.on_messages_acked.assert_any_call(['foo2', 'foo3'])
+        metrics.on_messages_nacked.assert_called_once_with(['foo4'])
@@ -0,0 +1,148 @@
+import unittest
+import logging
+import os
+import json
+import shutil
+import tempfile
+import esgfpid.defaults
+import esgfpid.rabbit.nodehealth
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+Unit tests for esgfpid.rabbit.nodehealth.
+'''
+class NodeHealthTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'health.json')
+        self.now = [1000.0]
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+        shutil.rmtree(self.tempdir)
+
+    def make_health(self, cache_file=None):
+        return esgfpid.rabbit.nodehealth.NodeHealth(clock=lambda: self.now[0], cache_file=cache_file)
+
+    # Tests
+
+    def test_cooldown_expires(self):
+
+        # Test variables:
+        health = self.make_health()
+
+        # Run code to be tested:
+        health.record_failure('foo')
+        once = health.is_cooling_down('foo')
+        for i in range(esgfpid.defaults.RABBIT_NODE_FAILURES_BEFORE_COOLDOWN-1):
+            health.record_failure('foo')
+        cooling = health.is_cooling_down('foo')
+        self.now[0] += esgfpid.defaults.RABBIT_NODE_COOLDOWN_SECONDS
+        expired = health.is_cooling_down('foo')
+        health.record_failure('foo')
+        again = health.is_cooling_down('foo')
+
+        # Check result:
+        self.assertFalse(once)
+        self.assertTrue(cooling)
+        self.assertFalse(expired)
+        self.assertTrue(again)
+        self.assertFalse(health.is_cooling_down('bar'))
+
+    def test_preferred_keys(self):
+
+        # Test variables:
+        health = self.make_health()
+        health.record_success('fast', 0.1)
+        health.record_success('ok', 0.15)
+        health.record_success('slow', 2.0)
+        health.record_success('failed', 0.01)
+        health.record_failure('failed')
+
+        # Run code to be tested:
+        preferred = health.get_preferred_keys(['slow', 'unknown', 'failed', 'fast', 'ok'])
+        only_failed = health.get_preferred_keys(['failed'])
+
+        # Check result: Slow and failed ones are left out
+        self.assertEqual(preferred, ['unknown', 'fast', 'ok'])
+        self.assertEqual(only_failed, ['failed'])
+
+    def test_connect_seconds_smoothed(self):
+
+        # Test variables:
+        health = self.make_health()
+        health.record_success('foo', 0.1)
+
+        # Run code to be tested: One slow connection
+        health.record_success('foo', 0.5)
+
+        # Check result: Still preferred over a node that is always slow
+        health.record_success('bar', 0.7)
+        self.assertEqual(health.get_preferred_keys(['foo', 'bar']), ['foo'])
+
+    def test_cache_shared_between_processes(self):
+
+        # Test variables (two processes):
+        health1 = self.make_health(self.filename)
+        health2 = self.make_health(self.filename)
+
+        # Run code to be tested:
+        for i in range(esgfpid.defaults.RABBIT_NODE_FAILURES_BEFORE_COOLDOWN):
+            health1.record_failure('dead')
+        health2.record_success('fast', 0.1)
+        health2.record_success('slow', 1.0)
+
+        # Check result: Both see everything, also a new one
+        health3 = self.make_health(self.filename)
+        for health in [health1, health2, health3]:
+            self.assertTrue(health.is_cooling_down('dead'))
+            self.assertEqual(health.get_preferred_keys(['slow', 'fast']), ['fast'])
+        with open(self.filename, 'r') as cachefile:
+            self.assertEqual(sorted(json.load(cachefile)['nodes'].keys()), ['dead', 'fast', 'slow'])
+
+    def test_cache_drops_old_entries(self):
+
+        # Test variables:
+        health = self.make_health(self.filename)
+        health.record_success('old', 0.1)
+
+        # Run code to be tested:
+        self.now[0] += esgfpid.defaults.RABBIT_NODE_HEALTH_MAX_AGE_SECONDS + 1
+        health.record_success('new', 0.1)
+
+        # Check result:
+        with open(self.filename, 'r') as cachefile:
+            self.assertEqual(list(json.load(cachefile)['nodes'].keys()), ['new'])
+
+    def test_cache_broken_file_ignored(self):
+
+        # Test variables:
+        with open(self.filename, 'w') as cachefile:
+            cachefile.write('{"nodes": {"foo"')
+
+        # Run code to be tested:
+        health = self.make_health(self.filename)
+        health.record_failure('foo')
+
+        # Check result: Replaced by a valid file
+        self.assertEqual(health.get_preferred_keys(['foo', 'bar']), ['bar'])
+        with open(self.filename, 'r') as cachefile:
+            self.assertEqual(json.load(cachefile)['nodes']['foo']['failures'], 1)
+
+    def test_cache_dir_created(self):
+
+        # Test variables:
+        cache_dir = os.path.join(self.tempdir, 'sub', 'dir')
+
+        # Run code to be tested:
+        health = esgfpid.rabbit.nodehealth.get_node_health(cache_dir)
+        health.record_success('foo', 0.1)
+
+        # Check result:
+        self.assertIs(esgfpid.rabbit.nodehealth.get_node_health(cache_dir), health)
+        self.assertIs(esgfpid.rabbit.nodehealth.get_node_health(None), esgfpid.rabbit.nodehealth.NODE_HEALTH)
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, esgfpid.rabbit.nodehealth.CACHE_FILE_NAME)))
@@ -3,7 +3,9 @@
 import unittest
 import logging
 import pika
+import esgfpid.defaults
 import esgfpid.rabbit
+import esgfpid.rabbit.nodehealth
 import tests.globalvar
 
 LOGGER = logging.getLogger(__name__)
@@ -29,6 +31,7 @@ class NodemanagerTestCase(unittest.TestCase):
 
     def setUp(self):
         LOGGER.info('######## Next test (%s) ##########', __name__)
+        esgfpid.rabbit.nodehealth.NODE_HEALTH.reset() # no failures from earlier tests
 
     def tearDown(self):
         LOGGER.info('#############################')
@@ -148,6 +151,33 @@ class NodemanagerTestCase(unittest.TestCase):
         node = mynodemanager._NodeManager__current_node
         self.assertEqual(node['priority'], '3')
 
+    '''
+    Test if I get one node manager per node of the highest
+    priority (for distributing the messages over them).
+    '''
+    def test_make_node_managers_for_active_nodes(self):
+
+        # Test variables:
+        mynodemanager = esgfpid.rabbit.nodemanager.NodeManager()
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='a', priority=1, weight=2))
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='b', priority=1))
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='c', priority=3))
+
+        # Run code to be tested:
+        managers_and_weights = mynodemanager.make_node_managers_for_active_nodes()
+
+        # Check result: Each one prefers its own node, then the
+        # lower priorities, and the other active node comes last:
+        self.assertEqual(len(managers_and_weights), 2)
+        orders = []
+        for manager, weight in managers_and_weights:
+            order = []
+            while manager.has_more_urls():
+                manager.set_next_host()
+                order.append(manager.get_connection_parameters().host)
+            orders.append((order, weight))
+        self.assertEqual(orders, [(['a', 'c', 'b'], 2), (['b', 'c', 'a'], 1)])
+
     '''
     Test exception if I miss info
     '''
@@ -714,3 +744,91 @@ class NodemanagerTestCase(unittest.TestCase):
         self.assertEqual(new_prio1, 'zzzz_last',  'Prio after changing prio is %s, expected zzzz_last' % new_prio1)
         self.assertEqual(new_prio2, 'zzzz_last',  'Prio after changing prio is %s, expected zzzz_last' % new_prio2)
 
+    #
+    # Skipping failing nodes
+    #
+
+    '''
+    A node that failed repeatedly is skipped while it cools
+    down, if a node of lower priority is available.
+    '''
+    def test_skip_failing_node(self):
+
+        # Test variables:
+        mynodemanager = esgfpid.rabbit.nodemanager.NodeManager()
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='host_bad', priority=1))
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='host_good', priority=2))
+        mynodemanager.set_next_host()
+        for i in range(esgfpid.defaults.RABBIT_NODE_FAILURES_BEFORE_COOLDOWN):
+            mynodemanager.report_failure_of_current()
+
+        # Run code to be tested (resetting selects the first node):
+        mynodemanager.reset_nodes()
+        first = mynodemanager._NodeManager__current_node['params'].host
+        mynodemanager.set_next_host()
+        second = mynodemanager._NodeManager__current_node['params'].host
+
+        # Check result: The failing one is only used as a last resort
+        self.assertEqual(first, 'host_good')
+        self.assertEqual(second, 'host_bad')
+
+    '''
+    A successful connection makes the node count as healthy again.
+    '''
+    def test_failing_node_success_resets(self):
+
+        # Test variables:
+        mynodemanager = esgfpid.rabbit.nodemanager.NodeManager()
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='host_bad', priority=1))
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='host_good', priority=2))
+        mynodemanager.set_next_host()
+        for i in range(esgfpid.defaults.RABBIT_NODE_FAILURES_BEFORE_COOLDOWN):
+            mynodemanager.report_failure_of_current()
+
+        # Run code to be tested:
+        mynodemanager.report_success_of_current()
+        mynodemanager.reset_nodes()
+
+        # Check result:
+        self.assertEqual(mynodemanager._NodeManager__current_node['params'].host, 'host_bad')
+
+    '''
+    Within a priority, a node that connected much faster before
+    is preferred over a slow one.
+    '''
+    def test_prefer_fast_node(self):
+
+        # Test variables:
+        mynodemanager = esgfpid.rabbit.nodemanager.NodeManager()
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='host_slow', priority=1))
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='host_fast', priority=1))
+        # Both were connected to before (the slow one took 3 seconds):
+        durations = dict(host_slow=3.0, host_fast=0.1)
+        mynodemanager.set_next_host()
+        mynodemanager.report_success_of_current(durations[mynodemanager._NodeManager__current_node['params'].host])
+        mynodemanager.set_next_host()
+        mynodemanager.report_success_of_current(durations[mynodemanager._NodeManager__current_node['params'].host])
+
+        # Run code to be tested (resetting selects the first node):
+        hosts = []
+        for i in range(5):
+            mynodemanager.reset_nodes()
+            hosts.append(mynodemanager._NodeManager__current_node['params'].host)
+
+        # Check result:
+        self.assertEqual(hosts, 5*['host_fast'])
+
+    def test_get_all_nodes(self):
+
+        # Test variables:
+        mynodemanager = esgfpid.rabbit.nodemanager.NodeManager()
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='host_b', priority=2))
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='host_a', priority=1))
+        mynodemanager.set_next_host()
+
+        # Run code to be tested:
+        nodes = mynodemanager.get_all_nodes()
+
+        # Check result: All of them, also the one that was tried already
+        self.assertEqual([node['host'] for node in nodes], ['host_a', 'host_b'])
+        self.assertIsInstance(nodes[0]['params'], pika.ConnectionParameters)
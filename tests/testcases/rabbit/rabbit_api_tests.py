@@ -3,6 +3,8 @@ import mock
 import logging
 import json
 import sys
+import copy
+from esgfpid.rabbit.delivery import DeliveryFuture
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -39,6 +41,20 @@ class RabbitTestCase(unittest.TestCase):
             'Wrong type: %s' % type(serverconn))
         self.assertFalse(testrabbit._RabbitMessageSender__ASYNCHRONOUS)
 
+    def test_constructor_syn_connection_pool(self,):
+
+        # Test variables:
+        args = TESTHELPERS.get_rabbit_args(is_synchronous_mode=True, connection_pool=True)
+
+        # Run code to be tested:
+        testrabbit = esgfpid.rabbit.RabbitMessageSender(**args)
+
+        # Check result
+        serverconn = testrabbit._RabbitMessageSender__server_connector
+        self.assertIs(serverconn._SynchronousRabbitConnector__connection_pool, esgfpid.rabbit.synchronous.CONNECTION_POOL)
+        testrabbit = TESTHELPERS.get_rabbit_message_sender(is_synchronous_mode=True)
+        self.assertIsNone(testrabbit._RabbitMessageSender__server_connector._SynchronousRabbitConnector__connection_pool)
+
     def test_constructor_asyn(self,):
 
         # Test variables:
@@ -55,6 +71,39 @@ class RabbitTestCase(unittest.TestCase):
             'Wrong type: %s' % type(serverconn))
         self.assertTrue(testrabbit._RabbitMessageSender__ASYNCHRONOUS)
 
+    def test_constructor_asyn_distributed(self,):
+
+        # Test variables: Two nodes of the same priority
+        cred1 = copy.deepcopy(TEST_RABBIT_CREDS_TRUSTED)
+        cred2 = copy.deepcopy(TEST_RABBIT_CREDS_TRUSTED)
+        cred2['url'] = 'other.host'
+        cred2['weight'] = 3
+        args = TESTHELPERS.get_rabbit_args(is_synchronous_mode=False,
+            credentials=[cred1, cred2], distribution='round_robin')
+
+        # Run code to be tested:
+        testrabbit = esgfpid.rabbit.RabbitMessageSender(**args)
+
+        # Check result
+        serverconn = testrabbit._RabbitMessageSender__server_connector
+        self.assertIsInstance(serverconn, esgfpid.rabbit.asynchronous.DistributingRabbitConnector,
+            'Wrong type: %s' % type(serverconn))
+        self.assertEqual(serverconn._DistributingRabbitConnector__weights, [1, 3])
+
+    def test_constructor_asyn_distributed_one_node(self,):
+
+        # Test variables: Only one node, nothing to distribute
+        args = TESTHELPERS.get_rabbit_args(is_synchronous_mode=False,
+            distribution='round_robin')
+
+        # Run code to be tested:
+        testrabbit = esgfpid.rabbit.RabbitMessageSender(**args)
+
+        # Check result
+        serverconn = testrabbit._RabbitMessageSender__server_connector
+        self.assertIsInstance(serverconn, esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector,
+            'Wrong type: %s' % type(serverconn))
+
 
     def test_open_rabbit_connection(self):
 
@@ -105,14 +154,41 @@ class RabbitTestCase(unittest.TestCase):
 
         # Run code to be tested
         rabbit_syn.send_message_to_queue(msg)
-        rabbit_asyn.send_message_to_queue(msg)
+        future = rabbit_asyn.send_message_to_queue(msg)
 
         # Check result
         mock_connector = rabbit_syn._RabbitMessageSender__server_connector
         mock_connector.send_message_to_queue.assert_called_with(msg)
         mock_connector = rabbit_asyn._RabbitMessageSender__server_connector
-        mock_connector.send_message_to_queue.assert_called_with(msg)
+        call_args, call_kwargs = mock_connector.send_message_to_queue.call_args
+        self.assertEqual(call_args[0].body, b'FOOBAR') # serialized once, here
+        # Asynchronous: The envelope's future is returned:
+        self.assertIsInstance(future, DeliveryFuture)
+        self.assertIs(call_args[0].future, future)
+
+    def test_send_many_messages_to_queue(self):
+
+        # Test variables
+        msgs = [{'foo':'bar1'}, {'foo':'bar2'}]
+
+        # Make test rabbit and replace the connector with a mock:
+        rabbit_syn  = TESTHELPERS.get_rabbit_message_sender(is_synchronous_mode=True)
+        rabbit_asyn = TESTHELPERS.get_rabbit_message_sender(is_synchronous_mode=False)
+        TESTHELPERS.patch_rabbit_with_magic_mock(rabbit_syn)
+        TESTHELPERS.patch_rabbit_with_magic_mock(rabbit_asyn)
+
+        # Run code to be tested
+        rabbit_syn.send_many_messages_to_queue(msgs)
+        futures = rabbit_asyn.send_many_messages_to_queue(msgs)
 
+        # Check result: Both hand them over all at once (synchronous may still send them one by one)
+        mock_connector = rabbit_syn._RabbitMessageSender__server_connector
+        mock_connector.send_many_messages_to_queue.assert_called_with(msgs)
+        mock_connector = rabbit_asyn._RabbitMessageSender__server_connector
+        call_args, call_kwargs = mock_connector.send_many_messages_to_queue.call_args
+        self.assertEqual([envelope.get_json() for envelope in call_args[0]], msgs)
+        mock_connector.send_message_to_queue.assert_not_called()
+        self.assertEqual(futures, [envelope.future for envelope in call_args[0]])
 
     def test_is_finished(self):
 
@@ -171,6 +247,25 @@ class RabbitTestCase(unittest.TestCase):
         mock_connector.force_finish_rabbit_thread.assert_called_with()
 
 
+    def test_get_metrics(self):
+
+        # Make test rabbits:
+        rabbit_syn = TESTHELPERS.get_rabbit_message_sender(is_synchronous_mode=True, metrics=True)
+        rabbit_off = TESTHELPERS.get_rabbit_message_sender(is_synchronous_mode=False)
+        rabbit_asyn = TESTHELPERS.get_rabbit_message_sender(is_synchronous_mode=False, metrics=True)
+
+        # Run code to be tested
+        snapshot = rabbit_asyn.get_metrics()
+        text = rabbit_asyn.get_metrics(prometheus=True)
+
+        # Check result
+        self.assertIsNone(rabbit_syn.get_metrics())
+        self.assertIsNone(rabbit_off.get_metrics())
+        self.assertEqual(snapshot['messages_enqueued'], 0)
+        self.assertEqual(snapshot['messages_unpublished'], 0)
+        self.assertEqual(snapshot['messages_unconfirmed'], 0)
+        self.assertIn('esgfpid_messages_enqueued_total 0', text)
+
     def test_start_ok(self):
 
         # Make test rabbit and replace the connector with a mock:
@@ -2,6 +2,8 @@
 
 import unittest
 import logging
+import json
+import mock
 
 import esgfpid.defaults
 import esgfpid.rabbit.rabbitutils as rutils
@@ -180,3 +182,64 @@ class RabbitUtilsTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             received_key, received_message = rutils.get_routing_key_and_string_message_from_message_if_possible(passed_message)
 
+
+    def test_envelope_from_message(self):
+
+        # Test variables:
+        passed_message = {'foo':'bar', 'ROUTING_KEY':'my.key'}
+
+        # Run code to be checked:
+        envelope = rutils.MessageEnvelope.from_message(passed_message)
+
+        # Check result:
+        self.assertEqual(envelope.routing_key, 'my.key')
+        self.assertIsInstance(envelope.body, bytes)
+        self.assertEqual(envelope.get_json(), passed_message)
+        self.assertIs(rutils.MessageEnvelope.from_message(envelope), envelope)
+
+    def test_get_message_and_routing_key_envelope(self):
+
+        # Test variables:
+        envelope = rutils.MessageEnvelope('my.key', '{"foo": "bar"}')
+
+        # Run code to be checked:
+        with mock.patch('json.dumps') as dumpspatch:
+            received_key, received_message = rutils.get_routing_key_and_string_message_from_message_if_possible(envelope)
+
+        # Check result: Passed through, not serialized again
+        dumpspatch.assert_not_called()
+        self.assertEqual(received_key, 'my.key')
+        self.assertIs(received_message, envelope.body)
+
+    def test_envelope_record_roundtrip(self):
+
+        # Test variables:
+        envelope = rutils.MessageEnvelope('my.key', u'{"foo": "b\u00e4r"}')
+
+        # Run code to be checked:
+        record = json.loads(json.dumps(rutils.message_to_record(envelope)))
+        received = rutils.message_from_record(record)
+        plain = rutils.message_from_record(json.loads(json.dumps(rutils.message_to_record({'foo':'bar'}))))
+
+        # Check result:
+        self.assertEqual(received.routing_key, 'my.key')
+        self.assertEqual(received.body, envelope.body)
+        self.assertEqual(plain, {'foo':'bar'})
+
+    def test_reconnection_wait_seconds(self):
+
+        # Test variables:
+        base = esgfpid.defaults.RABBIT_RECONNECTION_SECONDS
+        maximum = esgfpid.defaults.RABBIT_RECONNECTION_MAX_SECONDS
+
+        # Run code to be checked:
+        with mock.patch('random.random', return_value=0.0):
+            low = [rutils.get_reconnection_wait_seconds(i) for i in (1, 2, 100)]
+        with mock.patch('random.random', return_value=0.999):
+            high = [rutils.get_reconnection_wait_seconds(i) for i in (1, 2, 100)]
+
+        # Check result: Between half and all of the doubled wait, capped
+        self.assertEqual(low, [base/2.0, base, maximum/2.0])
+        self.assertTrue(base*0.99 < high[0] <= base)
+        self.assertTrue(base*2*0.99 < high[1] <= base*2)
+        self.assertTrue(maximum*0.99 < high[2] <= maximum)
@@ -0,0 +1,138 @@
+import unittest
+import mock
+import logging
+import pika
+import tests.resources.pikamock
+
+import esgfpid.defaults
+import esgfpid.rabbit
+import esgfpid.rabbit.nodehealth
+import esgfpid.rabbit.synchronous.connectionpool
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Test resources:
+import resources.TESTVALUES as TESTHELPERS
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+        esgfpid.rabbit.nodehealth.NODE_HEALTH.reset() # no failures from earlier tests
+        self.now = [1000.0]
+        self.pool = esgfpid.rabbit.synchronous.connectionpool.ConnectionPool(clock=lambda: self.now[0])
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_params(self, host='host_foo', username='user_foo'):
+        return pika.ConnectionParameters(host=host, credentials=pika.PlainCredentials(username, 'pw_foo'))
+
+    def make_connection(self, params):
+        connection = tests.resources.pikamock.MockPikaBlockingConnection(params)
+        return connection, connection.channel()
+
+    # Tests
+
+    def test_borrow_given_back(self):
+
+        # Test variables:
+        params = self.make_params()
+        connection, channel = self.make_connection(params)
+
+        # Run code to be tested:
+        empty = self.pool.borrow(params)
+        self.pool.give_back(params, connection, channel)
+        other_user = self.pool.borrow(self.make_params(username='someone_else'))
+        other_host = self.pool.borrow(self.make_params(host='host_bar'))
+        borrowed = self.pool.borrow(self.make_params())
+
+        # Check result:
+        self.assertIsNone(empty)
+        self.assertIsNone(other_user)
+        self.assertIsNone(other_host)
+        self.assertEqual(borrowed, (connection, channel))
+        self.assertTrue(connection.is_open)
+        self.assertEqual(self.pool.get_num_idle(), 0)
+
+    def test_idle_timeout(self):
+
+        # Test variables:
+        params = self.make_params()
+        connection, channel = self.make_connection(params)
+        self.pool.give_back(params, connection, channel)
+
+        # Run code to be tested:
+        self.now[0] += esgfpid.defaults.RABBIT_SYN_POOL_IDLE_SECONDS + 1
+        borrowed = self.pool.borrow(params)
+
+        # Check result:
+        self.assertIsNone(borrowed)
+        self.assertFalse(connection.is_open)
+
+    def test_broken_connection_dropped(self):
+
+        # Test variables:
+        params = self.make_params()
+        connection, channel = self.make_connection(params)
+        self.pool.give_back(params, connection, channel)
+        connection.process_data_events = mock.MagicMock(side_effect=pika.exceptions.StreamLostError('Gone'))
+
+        # Run code to be tested:
+        borrowed = self.pool.borrow(params)
+
+        # Check result:
+        self.assertIsNone(borrowed)
+        self.assertEqual(self.pool.get_num_idle(), 0)
+
+    def test_max_idle_per_node(self):
+
+        # Test variables:
+        params = self.make_params()
+        connections = [self.make_connection(params) for i in range(esgfpid.defaults.RABBIT_SYN_POOL_MAX_IDLE_PER_NODE+1)]
+
+        # Run code to be tested:
+        for connection, channel in connections:
+            self.pool.give_back(params, connection, channel)
+
+        # Check result: The last one was closed
+        self.assertEqual(self.pool.get_num_idle(), esgfpid.defaults.RABBIT_SYN_POOL_MAX_IDLE_PER_NODE)
+        self.assertFalse(connections[-1][0].is_open)
+
+    def test_close_all(self):
+
+        # Test variables:
+        params = self.make_params()
+        connection, channel = self.make_connection(params)
+        self.pool.give_back(params, connection, channel)
+
+        # Run code to be tested:
+        self.pool.close_all()
+
+        # Check result:
+        self.assertFalse(connection.is_open)
+        self.assertEqual(self.pool.get_num_idle(), 0)
+
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_rabbit_connector_reuses_connection(self, connectionmock):
+
+        # Define replacement for mocked method:
+        connectionmock.side_effect = tests.resources.pikamock.MockPikaBlockingConnection
+
+        # Make test rabbits sharing a pool:
+        testrabbit1 = esgfpid.rabbit.synchronous.SynchronousRabbitConnector(TESTHELPERS.get_nodemanager(), self.pool)
+        testrabbit2 = esgfpid.rabbit.synchronous.SynchronousRabbitConnector(TESTHELPERS.get_nodemanager(), self.pool)
+
+        # Run code to be tested:
+        testrabbit1.open_rabbit_connection()
+        connection = testrabbit1._SynchronousRabbitConnector__connection
+        testrabbit1.close_rabbit_connection()
+        testrabbit2.send_message_to_queue({"foo":"bar", "ROUTING_KEY":"mykey"})
+
+        # Check result: Only connected once, and kept open
+        self.assertEqual(connectionmock.call_count, 1)
+        self.assertIs(testrabbit2._SynchronousRabbitConnector__connection, connection)
+        self.assertIsNone(testrabbit1._SynchronousRabbitConnector__connection)
+        self.assertTrue(connection.is_open)
+        self.assertEqual(testrabbit2._SynchronousRabbitConnector__channel.success_counter, 1)
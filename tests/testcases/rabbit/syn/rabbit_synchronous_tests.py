@@ -9,6 +9,7 @@ import pika
 import tests.globalvar
 
 import esgfpid.rabbit
+import esgfpid.rabbit.nodehealth
 from esgfpid.rabbit.exceptions import PIDServerException
 
 LOGGER = logging.getLogger(__name__)
@@ -31,6 +32,7 @@ class RabbitConnectorTestCase(unittest.TestCase):
 
     def setUp(self):
         LOGGER.info('######## Next test (%s) ##########', __name__)
+        esgfpid.rabbit.nodehealth.NODE_HEALTH.reset() # no failures from earlier tests
     
     def tearDown(self):
         LOGGER.info('#############################')
@@ -456,4 +458,114 @@ class RabbitConnectorTestCase(unittest.TestCase):
         self.assertIn(json.dumps(msg), channel.messages,
             'Message %s not found in channel\'s list: %s' % (msg, channel.messages))
         self.assertIn(key, channel.routing_keys,
-            'Routing key %s not found in channel\'s list: %s' % (key, channel.routing_keys))
\ No newline at end of file
+            'Routing key %s not found in channel\'s list: %s' % (key, channel.routing_keys))
+    #
+    # Sending several messages at once:
+    #
+
+    def make_messages(self, num):
+        return [{"foo":"bar%i" % i, "ROUTING_KEY":"mykey"} for i in range(num)]
+
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_send_many_messages_no_window(self, connectionmock):
+
+        # Define replacement for mocked object:
+        def make_mocked_connection(params):
+            return tests.resources.pikamock.MockPikaBlockingConnection(params)
+        connectionmock.side_effect = make_mocked_connection
+
+        # Make test rabbit (default window of 1):
+        testrabbit = TESTHELPERS.get_synchronous_rabbit()
+
+        # Run code to be tested:
+        testrabbit.send_many_messages_to_queue(self.make_messages(3))
+
+        # Check result:
+        # Messages were sent one by one on the confirming channel:
+        channel = testrabbit._SynchronousRabbitConnector__channel
+        self.assertEqual(channel.success_counter, 3)
+        self.assertFalse(channel.transactional)
+        conn = testrabbit._SynchronousRabbitConnector__connection
+        self.assertEqual(len(conn.channels), 1)
+
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_send_many_messages_window_ok(self, connectionmock):
+
+        # Define replacement for mocked object:
+        def make_mocked_connection(params):
+            return tests.resources.pikamock.MockPikaBlockingConnection(params)
+        connectionmock.side_effect = make_mocked_connection
+
+        # Make test rabbit:
+        testrabbit = esgfpid.rabbit.synchronous.SynchronousRabbitConnector(
+            TESTHELPERS.get_nodemanager(), publish_window=4)
+        msgs = self.make_messages(10)
+
+        # Run code to be tested:
+        testrabbit.send_many_messages_to_queue(msgs)
+
+        # Check result:
+        # All sent in one transactional channel, in three commits:
+        conn = testrabbit._SynchronousRabbitConnector__connection
+        window_channel = conn.channels[1]
+        self.assertTrue(window_channel.transactional)
+        self.assertEqual(window_channel.success_counter, 10)
+        self.assertEqual(window_channel.commit_counter, 3)
+        self.assertEqual(window_channel.messages, [json.dumps(msg) for msg in msgs])
+        # Closing closes the window channel:
+        testrabbit.close_rabbit_connection()
+        self.assertFalse(window_channel.is_open)
+
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_send_many_messages_window_unroutable(self, connectionmock):
+
+        # Define replacement for mocked object:
+        def make_mocked_connection(params):
+            return tests.resources.pikamock.MockPikaBlockingConnection(params)
+        connectionmock.side_effect = make_mocked_connection
+
+        # Make test rabbit with connection:
+        testrabbit = esgfpid.rabbit.synchronous.SynchronousRabbitConnector(
+            TESTHELPERS.get_nodemanager(), publish_window=5)
+        testrabbit.open_rabbit_connection()
+        conn = testrabbit._SynchronousRabbitConnector__connection
+        conn.num_unroutables = 1 # first message is returned
+
+        # Run code to be tested:
+        testrabbit.send_many_messages_to_queue(self.make_messages(5))
+
+        # Check result:
+        # The returned one was resent with the emergency routing key:
+        window_channel = conn.channels[1]
+        self.assertEqual(window_channel.publish_counter, 6)
+        self.assertEqual(window_channel.commit_counter, 2)
+        self.assertEqual(window_channel.routing_keys[5], "UNROUTABLE.UNROUTABLE.fresh.UNROUTABLE")
+        self.assertEqual(json.loads(window_channel.messages[5])['foo'], 'bar0')
+
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_send_many_messages_window_commit_fails(self, connectionmock):
+
+        # Define replacement for mocked object:
+        def make_mocked_connection(params):
+            return tests.resources.pikamock.MockPikaBlockingConnection(params)
+        connectionmock.side_effect = make_mocked_connection
+
+        # Make test rabbit:
+        testrabbit = esgfpid.rabbit.synchronous.SynchronousRabbitConnector(
+            TESTHELPERS.get_nodemanager(), publish_window=2)
+        msgs = self.make_messages(5)
+
+        # Make the second commit fail:
+        testrabbit.open_rabbit_connection()
+        window_channel = testrabbit._SynchronousRabbitConnector__get_window_channel()
+        window_channel.num_commits_before_failures = 1
+        window_channel.num_commit_failures = 1
+
+        # Run code to be tested:
+        with self.assertRaises(esgfpid.exceptions.MessageNotDeliveredException) as e:
+            testrabbit.send_many_messages_to_queue(msgs)
+
+        # Check result:
+        # The first window was delivered, the others were not:
+        self.assertEqual(window_channel.commit_counter, 2)
+        self.assertEqual(e.exception.undelivered_messages, [json.dumps(msg) for msg in msgs[2:]])
@@ -0,0 +1,124 @@
+import unittest
+import mock
+import logging
+import esgfpid.solr.solr
+import esgfpid.solr.tasks.filehandles_many_datasets as task
+import esgfpid.exceptions
+
+# Logging:
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Test resources:
+from resources.TESTVALUES import *
+import resources.TESTVALUES as TESTHELPERS
+
+
+class SolrTask3TestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_testtask(self):
+        testsolr = TESTHELPERS.get_testsolr()
+        testtask = task.FindFilesOfManyDatasetVersions(testsolr)
+        return testtask
+
+    def fake_solr_response(self, docs):
+        return {"response": {"numFound": len(docs), "docs": docs}}
+
+    # Actual tests:
+
+    @mock.patch('esgfpid.defaults.SOLR_DATASETS_PER_QUERY', 2)
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_retrieve_grouped_ok(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.side_effect = [
+            self.fake_solr_response([
+                {"dataset_id": "abc.v1|foo.de", "tracking_id": ["123/456"]},
+                {"dataset_id": "abc.v1|foo.de", "tracking_id": ["hdl:123/789"]},
+                {"dataset_id": "def.v2|foo.de", "tracking_id": "123/111"},
+                {"dataset_id": "other.v1|foo.de", "tracking_id": ["123/222"]}
+            ]),
+            self.fake_solr_response([])
+        ]
+
+        # Run code to be tested:
+        testtask = self.make_testtask()
+        received = testtask.retrieve_file_handles_of_many_datasets(
+            datasets=[('abc', 1), ('def', 2), ('ghi', 3)],
+            data_node='foo.de',
+            prefix='123')
+
+        # Check result:
+        # Two groups, one query each. The third dataset has no files:
+        self.assertEqual(getpatch.call_count, 2)
+        query = getpatch.call_args_list[0][0][0]
+        self.assertEqual(sorted(query['dataset_id']), ['abc.v1|foo.de', 'def.v2|foo.de'])
+        self.assertEqual(query['fields'], 'dataset_id,tracking_id')
+        self.assertEqual(query['type'], 'File')
+        self.assertEqual(sorted(received.keys()), [('abc', 1), ('def', 2)])
+        self.assertEqual(sorted(received[('abc', 1)]), ['hdl:123/456', 'hdl:123/789'])
+        self.assertEqual(received[('def', 2)], ['hdl:123/111'])
+
+    @mock.patch('esgfpid.defaults.SOLR_FILES_PER_QUERY', 2)
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_retrieve_paged_ok(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.side_effect = [
+            self.fake_solr_response([
+                {"dataset_id": "abc.v1|foo.de", "tracking_id": ["123/1"]},
+                {"dataset_id": "abc.v1|foo.de", "tracking_id": ["123/2"]}
+            ]),
+            self.fake_solr_response([
+                {"dataset_id": "abc.v1|foo.de", "tracking_id": ["123/3"]}
+            ])
+        ]
+
+        # Run code to be tested:
+        testtask = self.make_testtask()
+        received = testtask.retrieve_file_handles_of_many_datasets(
+            datasets=[('abc', 1)],
+            data_node='foo.de',
+            prefix='123')
+
+        # Check result:
+        self.assertEqual([call[0][0]['offset'] for call in getpatch.call_args_list], [0, 2])
+        self.assertEqual(sorted(received[('abc', 1)]), ['hdl:123/1', 'hdl:123/2', 'hdl:123/3'])
+
+    @mock.patch('esgfpid.defaults.SOLR_DATASETS_PER_QUERY', 1)
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_retrieve_one_group_fails(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.side_effect = [
+            esgfpid.exceptions.SolrError('Oops'),
+            {"no": "docs"},
+            self.fake_solr_response([
+                {"dataset_id": "ghi.v3|foo.de", "tracking_id": ["123/456"]}
+            ])
+        ]
+
+        # Run code to be tested:
+        testtask = self.make_testtask()
+        received = testtask.retrieve_file_handles_of_many_datasets(
+            datasets=[('abc', 1), ('def', 2), ('ghi', 3)],
+            data_node='foo.de',
+            prefix='123')
+
+        # Check result: Only the last group succeeded:
+        self.assertEqual(received, {('ghi', 3): ['hdl:123/456']})
+
+    def test_retrieve_solr_switched_off(self):
+
+        # Preparations
+        testsolr = TESTHELPERS.get_testsolr_switched_off()
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.SolrSwitchedOff):
+            testsolr.retrieve_file_handles_of_many_datasets(datasets=[('abc', 1)], data_node='foo.de')
@@ -43,6 +43,8 @@ class UtilsLoggingTestCase(unittest.TestCase):
         LOGGER.info('######## Next test (%s) ##########', __name__)
 
     def tearDown(self):
+        # The flags are cached, so read the unpatched ones again:
+        esgfpid.utils.reload_log_settings()
         LOGGER.info('#############################')
 
     #
@@ -207,6 +209,29 @@ class UtilsLoggingTestCase(unittest.TestCase):
         self.assertIn('danger', logger.error_messages, 'Error messages: %s' % logger.error_messages)
 
 
+    @mock.patch('esgfpid.defaults')
+    def test_log_settings_cached(self, defaults_patch):
+        ''' Test that the flags are only read when reloading the settings! '''
+
+        # Test variables
+        logger = LoggerMock()
+
+        # Prepare flags
+        defaults_patch.LOG_INFO_TO_DEBUG = False
+        defaults_patch.LOG_DEBUG_TO_INFO = False
+        defaults_patch.LOG_TRACE_TO_DEBUG = False
+        esgfpid.utils.reload_log_settings()
+
+        # Run code to be tested:
+        defaults_patch.LOG_TRACE_TO_DEBUG = True # not read yet
+        esgfpid.utils.logtrace(logger, 'ignored')
+        esgfpid.utils.reload_log_settings()
+        esgfpid.utils.logtrace(logger, 'superdetail')
+
+        # Check results:
+        self.assertTrue(esgfpid.utils.logutils.TRACE_ENABLED)
+        self.assertEqual(logger.debug_messages, ['[trace] superdetail'])
+
     #
     # Logging every xth message
     #
@@ -0,0 +1,304 @@
+import unittest
+import mock
+import logging
+import esgfpid
+import esgfpid.exceptions
+import esgfpid.assistant.workers
+from esgfpid.assistant.workers import PublicationWorkerPool, _make_transferable_error
+from esgfpid.rabbit.delivery import DeliveryFuture
+
+# Logging
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Test resources:
+from resources.TESTVALUES import *
+import resources.TESTVALUES as TESTHELPERS
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_pool(self, testcoupler, **args):
+        return PublicationWorkerPool(
+            coupler=testcoupler,
+            prefix=PREFIX_NO_HDL,
+            thredds_service_path=THREDDS,
+            data_node=DATA_NODE,
+            consumer_solr_url=SOLR_URL_CONSUMER,
+            **args
+        )
+
+    def make_file_records(self, num):
+        records = []
+        for i in range(num):
+            fileargs = TESTHELPERS.get_args_for_adding_file()
+            fileargs['file_handle'] = '%s-%i' % (fileargs['file_handle'], i)
+            records.append(fileargs)
+        return records
+
+    def add_datasets_and_finish(self, testpool, num_datasets, num_files):
+        handles = []
+        for i in range(num_datasets):
+            handles.append(testpool.add_dataset(drs_id='%s.%i' % (DRS_ID, i), version_number=DS_VERSION,
+                is_replica=False, records=self.make_file_records(num_files)))
+        results = testpool.finish()
+        return handles, results
+
+    def check_messages_in_order(self, received_messages, handles, num_files):
+        # Each dataset's messages are sent together, in the
+        # same order as by the publication assistant:
+        self.assertEqual(len(received_messages), len(handles)*(num_files+1))
+        for i, handle in enumerate(handles):
+            messages = received_messages[i*(num_files+1):(i+1)*(num_files+1)]
+            self.assertEqual(messages[0]['aggregation_level'], 'dataset')
+            self.assertEqual(messages[0]['handle'], handle)
+            self.assertEqual(len(messages[0]['files']), num_files)
+            for message in messages[1:]:
+                self.assertEqual(message['aggregation_level'], 'file')
+                self.assertEqual(message['parent_dataset'], handle)
+
+    # Tests
+
+    def test_pool_threads_ok(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        testpool = self.make_pool(testcoupler, num_workers=3)
+
+        # Run code to be tested:
+        handles, results = self.add_datasets_and_finish(testpool, 7, 5)
+
+        # Check result:
+        self.assertEqual([result['success'] for result in results], [True]*7)
+        self.assertEqual([result['dataset_handle'] for result in results], handles)
+        self.assertIsNone(results[0]['future'])
+        self.check_messages_in_order(rabbitmock.received_messages, handles, 5)
+
+    def test_pool_processes_ok(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        testpool = self.make_pool(testcoupler, num_workers=2, use_processes='true')
+
+        # Run code to be tested:
+        handles, results = self.add_datasets_and_finish(testpool, 3, 4)
+
+        # Check result:
+        self.assertEqual([result['success'] for result in results], [True]*3)
+        self.check_messages_in_order(rabbitmock.received_messages, handles, 4)
+
+    def test_pool_opens_connection_once(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler, mock.MagicMock())
+        rabbitmock.send_many_messages_to_queue.return_value = None # synchronous
+        testpool = self.make_pool(testcoupler)
+
+        # Run code to be tested:
+        self.add_datasets_and_finish(testpool, 3, 2)
+
+        # Check result:
+        self.assertEqual(rabbitmock.send_many_messages_to_queue.call_count, 3)
+        rabbitmock.send_message_to_queue.assert_not_called()
+        rabbitmock.open_rabbit_connection.assert_called_once_with()
+        rabbitmock.close_rabbit_connection.assert_called_once_with()
+
+    def test_pool_builds_few_datasets_ahead(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler, mock.MagicMock())
+        num_built_when_sending = []
+        with mock.patch.object(esgfpid.assistant.workers, '_build_dataset_messages',
+                wraps=esgfpid.assistant.workers._build_dataset_messages) as buildmock:
+            rabbitmock.send_many_messages_to_queue.side_effect = lambda messages: num_built_when_sending.append(buildmock.call_count)
+            testpool = self.make_pool(testcoupler, num_workers=1)
+
+            # Run code to be tested:
+            self.add_datasets_and_finish(testpool, 6, 2)
+
+        # Check result: With one worker, at most two datasets are
+        # handed to the pool while the previous one is being sent:
+        self.assertEqual(len(num_built_when_sending), 6)
+        for i, num_built in enumerate(num_built_when_sending):
+            self.assertLessEqual(num_built, i+3)
+
+    def test_pool_send_error_does_not_stop_others(self):
+
+        # Test variables:
+        error = esgfpid.exceptions.MessageNotDeliveredException('Oops', None)
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler, mock.MagicMock())
+        rabbitmock.send_many_messages_to_queue.side_effect = [None, error, None] # synchronous
+        testpool = self.make_pool(testcoupler)
+
+        # Run code to be tested:
+        handles, results = self.add_datasets_and_finish(testpool, 3, 2)
+
+        # Check result:
+        self.assertEqual([result['success'] for result in results], [True, False, True])
+        self.assertIs(results[1]['error'], error)
+        self.assertEqual(rabbitmock.send_many_messages_to_queue.call_count, 3)
+        rabbitmock.close_rabbit_connection.assert_called_once_with()
+
+    def test_pool_returns_futures(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler, mock.MagicMock())
+        rabbitmock.send_many_messages_to_queue.side_effect = lambda messages: [DeliveryFuture() for message in messages]
+        testpool = self.make_pool(testcoupler)
+
+        # Run code to be tested:
+        handles, results = self.add_datasets_and_finish(testpool, 2, 3)
+
+        # Check result:
+        self.assertEqual(len(results[1]['future'].futures), 4)
+
+    def test_pool_prefetched_consistency_check(self):
+
+        # Test variables:
+        records = self.make_file_records(2)
+        drs_ids = ['%s.%i' % (DRS_ID, i) for i in range(2)]
+        previous = {
+            (drs_ids[0], DS_VERSION): [records[0]['file_handle'], records[1]['file_handle']],
+            (drs_ids[1], DS_VERSION): [records[0]['file_handle']]
+        }
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler()
+        solrmock = mock.Mock()
+        solrmock.retrieve_file_handles_of_many_datasets.return_value = previous
+        TESTHELPERS.patch_with_solr_mock(testcoupler, solrmock)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        testpool = self.make_pool(testcoupler)
+        testpool.add_dataset(drs_id=drs_ids[0], version_number=DS_VERSION, is_replica=False, records=records)
+        testpool.add_dataset(drs_id=drs_ids[1], version_number=DS_VERSION, is_replica=False, records=records)
+
+        # Run code to be tested:
+        results = testpool.finish()
+
+        # Check result: Asked solr once for all:
+        solrmock.retrieve_file_handles_of_many_datasets.assert_called_once_with(
+            datasets=[(drs_ids[0], DS_VERSION), (drs_ids[1], DS_VERSION)],
+            data_node=DATA_NODE)
+        solrmock.retrieve_file_handles_of_same_dataset.assert_not_called()
+
+        # Check result: Second dataset has a file too many, so it is not published:
+        self.assertTrue(results[0]['success'])
+        self.assertFalse(results[1]['success'])
+        self.assertIsInstance(results[1]['error'], esgfpid.exceptions.InconsistentFilesetException)
+        self.assertEqual(len(rabbitmock.received_messages), 3)
+
+    def test_pool_bad_files_do_not_stop_others(self):
+
+        # Test variables:
+        wrong_prefix = TESTHELPERS.get_args_for_adding_file()
+        wrong_prefix['file_handle'] = 'hdl:123456/foo'
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        testpool = self.make_pool(testcoupler, use_processes=True)
+        testpool.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION, is_replica=False, records=[wrong_prefix])
+        testpool.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION2, is_replica=False, mapfile='/no/such/mapfile')
+        testpool.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION, is_replica=False)
+        testpool.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION2, is_replica=False,
+            records=self.make_file_records(1))
+
+        # Run code to be tested:
+        results = testpool.finish()
+
+        # Check result:
+        self.assertIsInstance(results[0]['error'], esgfpid.exceptions.ESGFException)
+        self.assertIn('123456', results[0]['error'].msg)
+        self.assertIsInstance(results[1]['error'], esgfpid.exceptions.ArgumentError)
+        self.assertIsInstance(results[2]['error'], esgfpid.exceptions.OperationUnsupportedException)
+        self.assertEqual(results[0]['dataset_handle'], DATASETHANDLE_HDL)
+        self.assertEqual([result['success'] for result in results], [False, False, False, True])
+        self.assertEqual(len(rabbitmock.received_messages), 2)
+
+    def test_pool_unexpected_error_does_not_stop_others(self):
+
+        # Test variables:
+        no_handle = TESTHELPERS.get_args_for_adding_file()
+        no_handle['file_handle'] = None
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        testpool = self.make_pool(testcoupler, use_processes=True)
+        testpool.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION, is_replica=False, records=[no_handle])
+        testpool.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION2, is_replica=False,
+            records=self.make_file_records(1))
+
+        # Run code to be tested:
+        results = testpool.finish()
+
+        # Check result:
+        self.assertIsInstance(results[0]['error'], AttributeError)
+        self.assertEqual([result['success'] for result in results], [False, True])
+        self.assertEqual(len(rabbitmock.received_messages), 2)
+
+    def test_unpicklable_error_is_replaced(self):
+
+        # Test variables:
+        class LocalError(Exception):
+            pass
+
+        # Run code to be tested:
+        error_class, error_args = _make_transferable_error(LocalError('foo'))
+
+        # Check result:
+        self.assertIs(error_class, Exception)
+        self.assertEqual(error_args, ('LocalError: foo',))
+
+    def test_pool_too_late(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        testpool = self.make_pool(testcoupler)
+        testpool.finish()
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.OperationUnsupportedException):
+            testpool.add_dataset(drs_id=DRS_ID, version_number=DS_VERSION, is_replica=False)
+        with self.assertRaises(esgfpid.exceptions.OperationUnsupportedException):
+            testpool.finish()
+
+    def test_pool_wrong_args(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            self.make_pool(testcoupler, num_workers=0)
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            self.make_pool(testcoupler, use_processes='maybe')
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            self.make_pool(testcoupler).add_dataset(drs_id=DRS_ID, version_number='abc', is_replica=False)
+
+    def test_create_via_connector(self):
+
+        # Preparations:
+        args = TESTHELPERS.get_connector_args(thredds_service_path='foo', data_node='bar')
+        testconnector = esgfpid.Connector(**args)
+
+        # Run code to be tested:
+        testpool = testconnector.create_publication_worker_pool(num_workers=2)
+
+        # Check result:
+        self.assertIsInstance(testpool, PublicationWorkerPool)